@@ -1,7 +1,10 @@
 from fastapi import APIRouter, Depends
 from propelauth_py.user import User
 
+from app.db.indexes import suggest_indexes
+from app.security import verify_if_propelauth_user_can_access_project
 from app.security.authentification import propelauth
+from app.services.cache import analytics_cache
 
 router = APIRouter(include_in_schema=False)
 
@@ -14,3 +17,20 @@ def read_root(user: User = Depends(propelauth.require_user)):
 @router.get("/health")
 def health_check():
     return {"status": "OK"}
+
+
+@router.get("/debug/cache")
+def analytics_cache_stats(user: User = Depends(propelauth.require_user)):
+    return analytics_cache.get_stats()
+
+
+@router.get("/debug/{project_id}/indexes")
+async def index_suggestions(
+    project_id: str, user: User = Depends(propelauth.require_user)
+):
+    """
+    Indexes suggested from the slow filtering queries of the project
+    """
+    await verify_if_propelauth_user_can_access_project(user, project_id)
+    suggestions = await suggest_indexes(project_id=project_id)
+    return {"suggestions": [suggestion.model_dump() for suggestion in suggestions]}
@@ -1,7 +1,10 @@
+import asyncio
 import datetime
+import os
+import shutil
+import tempfile
 from typing import List, Optional
 
-import pandas as pd
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, UploadFile
 from google.cloud.storage import Bucket
 from loguru import logger
@@ -32,7 +35,11 @@ from app.security.authorization import get_quota
 from app.services.slack import slack_notification
 from app.services.mongo.events import get_all_events
 from app.services.mongo.extractor import ExtractorClient
-from app.services.mongo.files import process_file_upload_into_log_events
+from app.services.mongo.files import (
+    count_upload_rows,
+    process_file_upload_into_log_events,
+    read_upload_columns,
+)
 from app.services.mongo.projects import (
     add_project_events,
     collect_languages,
@@ -447,44 +454,28 @@ async def post_upload_tasks(
         # Reset the file pointer to the start
         file.file.seek(0)
 
-    # Read file content -> into memory
-    file_params = {}
+    # Copy the file to disk: it's read by chunks when the tasks are processed
     logger.info(f"Reading file {file.filename} content.")
-    tasks_df: pd.DataFrame
+    with tempfile.NamedTemporaryFile(
+        suffix=f".{file_extension}", delete=False
+    ) as upload_file:
+        await asyncio.to_thread(shutil.copyfileobj, file.file, upload_file)
     try:
-        if file_extension == "csv":
-            tasks_df = pd.read_csv(
-                file.file, sep=None, engine="python", on_bad_lines="warn", **file_params
-            )
-        elif file_extension == "xlsx":
-            tasks_df = pd.read_excel(file.file, **file_params)
-        else:
-            # This only happens if you add a new extension and forget to update the supported extensions list
-            raise NotImplementedError(
-                f"Error: The extension {file_extension} is not supported (supported: {SUPPORTED_EXTENSIONS})."
-            )
+        columns = await asyncio.to_thread(
+            read_upload_columns, upload_file.name, file_extension
+        )
     except Exception as e:
+        os.remove(upload_file.name)
         raise HTTPException(
             status_code=400, detail=f"Error: Could not read the file content. {e}"
         )
-
-    # Strip and lowercase the columns
-    tasks_df.columns = tasks_df.columns.str.strip().str.lower()
-    logger.debug(f"Columns: {tasks_df.columns}")
-
-    # Rename task_input to input and task_output to output
-    tasks_df.rename(
-        columns={
-            "task_input": "input",
-            "task_output": "output",
-        },
-        inplace=True,
-    )
+    logger.debug(f"Columns: {columns}")
 
     # Verify if the required columns are present
     required_columns = ["input", "output"]
-    missing_columns = set(required_columns) - set(tasks_df.columns)
+    missing_columns = set(required_columns) - set(columns)
     if missing_columns:
+        os.remove(upload_file.name)
         # The file has been uploaded but the columns are missing (wrong format)
         # We send a slack notification to the phospho team for manual verification
         if config.GCP_BUCKET_CLIENT:
@@ -500,23 +491,30 @@ async def post_upload_tasks(
             detail=f"Missing columns: {missing_columns}. The processing of your file will take up to 24 hours for manual verification.",
         )
 
-    # Drop rows with missing column "input"
-    old_len = tasks_df.shape[0]
-    tasks_df.dropna(subset=["input"], inplace=True)
-    new_len = tasks_df.shape[0]
+    # Rows with missing column "input" are dropped
+    try:
+        nb_rows, nb_rows_dropped = await asyncio.to_thread(
+            count_upload_rows, upload_file.name, file_extension
+        )
+    except Exception as e:
+        os.remove(upload_file.name)
+        raise HTTPException(
+            status_code=400, detail=f"Error: Could not read the file content. {e}"
+        )
 
     # Process the csv file as a background task
     logger.info(f"File {file.filename} uploaded successfully. Processing tasks.")
     background_tasks.add_task(
         process_file_upload_into_log_events,
-        tasks_df=tasks_df,
+        file_path=upload_file.name,
+        file_extension=file_extension,
         project_id=project_id,
         org_id=project.org_id,
     )
     return {
         "status": "ok",
-        "nb_rows_processed": tasks_df.shape[0],
-        "nb_rows_dropped": old_len - new_len,
+        "nb_rows_processed": nb_rows - nb_rows_dropped,
+        "nb_rows_dropped": nb_rows_dropped,
     }
 
 
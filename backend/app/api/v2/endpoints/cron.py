@@ -8,6 +8,7 @@ from app.services.mongo.cron import (
     run_langfuse_sync_pipeline,
     run_langsmith_sync_pipeline,
     run_postgresql_sync_pipeline,
+    run_rollups_backfill_pipeline,
 )
 
 router = APIRouter(tags=["cron"])
@@ -31,6 +32,7 @@ async def run_sync_pipeline(
         # Only run the PostgreSQL sync pipeline once a day, at 10am
         if datetime.datetime.now().hour == 10:
             await run_postgresql_sync_pipeline()
+        await run_rollups_backfill_pipeline()
         return {"status": "ok", "message": "Pipelines ran successfully"}
     except Exception as e:
         return {"status": "error", "message": f"Error running sync pipeline {e}"}
@@ -45,6 +45,34 @@ PLAN_SELFHOSTED_MAX_USERS = os.getenv("PLAN_SELFHOSTED_MAX_USERS", 100)
 
 QUERY_MAX_LEN_LIMIT = 2000  # Limit the number of returned rows for a query to run_analytics_query() service
 
+### ANALYTICS CACHE ###
+# Backend of the dashboard analytics cache: "memory", "redis" or "none" (disabled)
+ANALYTICS_CACHE_BACKEND = os.getenv("ANALYTICS_CACHE_BACKEND", "memory")
+ANALYTICS_CACHE_TTL = int(os.getenv("ANALYTICS_CACHE_TTL", 300))  # in seconds
+ANALYTICS_CACHE_MAX_SIZE = 1024  # Max number of entries of the in-memory cache
+ANALYTICS_CACHE_TIME_BUCKET = 60  # Precision of the date filters in the cache keys, in seconds
+REDIS_URL = os.getenv("REDIS_URL")
+
+### AGGREGATED METRICS ###
+METRICS_MAX_CONCURRENCY = 4  # Max number of metrics computed concurrently per request
+METRICS_TIMEOUT = float(os.getenv("METRICS_TIMEOUT", 20))  # Budget of a metric, in seconds
+
+### SYNC PIPELINES ###
+# Max number of projects synced at once by the Langsmith and Langfuse cron pipelines
+SYNC_PIPELINE_MAX_CONCURRENCY = int(os.getenv("SYNC_PIPELINE_MAX_CONCURRENCY", 8))
+
+### INDEX ADVISOR ###
+# Share of the filtering queries explained to detect the slow query shapes
+INDEX_ADVISOR_SAMPLE_RATE = float(os.getenv("INDEX_ADVISOR_SAMPLE_RATE", 0.01))
+INDEX_ADVISOR_SLOW_QUERY_MS = 200  # Queries slower than this are recorded
+# Above this number of filtered metadata keys, suggest a wildcard index
+INDEX_ADVISOR_MAX_METADATA_INDEXES = 3
+
+### ANALYTICS ROLLUPS ###
+# Answer the time series analytics queries from the pre-aggregated rollups
+ANALYTICS_ROLLUPS_ENABLED = os.getenv("ANALYTICS_ROLLUPS_ENABLED", "true") == "true"
+ANALYTICS_ROLLUPS_BACKFILL_BATCH = 10  # Number of projects backfilled per cron run
+
 ### DOCUMENTATION ##
 
 ADMIN_EMAIL = "notifications@phospho.ai"  # Used when new users sign up
@@ -77,6 +105,10 @@ if ENVIRONMENT != "preview" and PHOSPHO_AI_HUB_URL is None:
 ### Vector Search ###
 QDRANT_URL = os.getenv("QDRANT_URL")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+SEARCH_EMBEDDING_MODEL = "text-embedding-3-small"
+# Cache of the embeddings of the search queries (0 to disable)
+SEARCH_EMBEDDING_CACHE_MAX_SIZE = int(os.getenv("SEARCH_EMBEDDING_CACHE_MAX_SIZE", 10_000))
+SEARCH_EMBEDDING_CACHE_TTL = 24 * 3600  # in seconds
 
 ### WATCHERS ###
 EVALUATION_SOURCE = "phospho-6"  # If phospho
@@ -89,6 +121,11 @@ ARGILLA_API_KEY = os.getenv("ARGILLA_API_KEY", None)  # API Key with role 'owner
 
 MAX_NUMBER_OF_DATASET_SAMPLES = 2000
 MIN_NUMBER_OF_DATASET_SAMPLES = 10
+# Records added to Argilla per request, and number of requests at once
+ARGILLA_PUSH_BATCH_SIZE = int(os.getenv("ARGILLA_PUSH_BATCH_SIZE", 1000))
+ARGILLA_PUSH_MAX_CONCURRENCY = int(os.getenv("ARGILLA_PUSH_MAX_CONCURRENCY", 4))
+# Annotated records written back to MongoDB per bulk write
+ARGILLA_PULL_BATCH_SIZE = int(os.getenv("ARGILLA_PULL_BATCH_SIZE", 5000))
 
 ###############################################
 ### Config below used only in phospho cloud ###
@@ -165,6 +202,12 @@ if ENVIRONMENT != "preview":
         logger.warning("ANYSCALE_API_KEY is missing from the environment variables")
 
 CSV_UPLOAD_MAX_ROWS = 100000
+# Uploaded task files are read by chunks of FILE_UPLOAD_CHUNK_ROWS rows. The tasks are
+# sent to the extractor by batches of at most FILE_UPLOAD_BATCH_MAX_ROWS rows and
+# FILE_UPLOAD_BATCH_MAX_BYTES of text (the Temporal payloads are limited to 2MB)
+FILE_UPLOAD_CHUNK_ROWS = int(os.getenv("FILE_UPLOAD_CHUNK_ROWS", 50_000))
+FILE_UPLOAD_BATCH_MAX_ROWS = int(os.getenv("FILE_UPLOAD_BATCH_MAX_ROWS", 5000))
+FILE_UPLOAD_BATCH_MAX_BYTES = int(os.getenv("FILE_UPLOAD_BATCH_MAX_BYTES", 1_000_000))
 FINE_TUNING_MINIMUM_DOCUMENTS = 20
 
 ### CRON ###
@@ -182,6 +225,8 @@ if credentials_gcp_bucket:
 
 ### SQL DB ###
 SQLDB_CONNECTION_STRING = os.getenv("SQLDB_CONNECTION_STRING")
+# Number of tasks read from MongoDB and copied to Postgres at once by the export
+POSTGRESQL_EXPORT_PAGE_SIZE = int(os.getenv("POSTGRESQL_EXPORT_PAGE_SIZE", 5000))
 
 ### Customer.io
 CUSTOMERIO_WRITE_KEY = os.getenv("CUSTOMERIO_WRITE_KEY")
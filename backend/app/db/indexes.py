@@ -0,0 +1,383 @@
+"""
+Index management for the filtered task and session lists.
+
+- INDEXES declares the compound and partial indexes matching the query shapes
+  generated by task_filtering_pipeline_match and session_filtering_pipeline_match.
+  They are created at startup by `apply_index_migrations`, which is idempotent.
+- `sample_query_shape` explains a sample of the filtering queries. Shapes that are
+  slow or scan the whole collection are recorded in `slow_query_shapes`.
+- `suggest_indexes` turns the recorded shapes into index suggestions, including
+  wildcard indexes on `metadata.*` for projects filtering on many metadata keys.
+"""
+
+import asyncio
+import random
+from typing import Dict, List, Optional, Set, Tuple
+
+import pymongo
+from loguru import logger
+from pydantic import BaseModel
+from pymongo.errors import OperationFailure
+
+from app.core import config
+from app.utils import generate_timestamp
+
+
+class IndexDefinition(BaseModel):
+    collection: str
+    keys: List[Tuple[str, int]]
+    name: str
+    partial_filter: Optional[dict] = None
+    # Query shape served by the index, for documentation and suggestions
+    query_shape: Optional[str] = None
+    reason: Optional[str] = None
+
+    def create_index_kwargs(self) -> dict:
+        kwargs: Dict[str, object] = {"name": self.name, "background": True}
+        if self.partial_filter is not None:
+            kwargs["partialFilterExpression"] = self.partial_filter
+        return kwargs
+
+
+DESC = pymongo.DESCENDING
+
+# Equality fields first, then the created_at range (Equality, Sort, Range rule)
+INDEXES: List[IndexDefinition] = [
+    # Tasks
+    IndexDefinition(
+        collection="tasks",
+        keys=[("project_id", 1), ("created_at", DESC)],
+        name="project_created_at",
+        query_shape="project_id, created_at range",
+    ),
+    IndexDefinition(
+        collection="tasks",
+        keys=[("project_id", 1), ("flag", 1), ("created_at", DESC)],
+        name="project_flag_created_at",
+        query_shape="project_id, flag, created_at range",
+    ),
+    IndexDefinition(
+        collection="tasks",
+        keys=[("project_id", 1), ("language", 1), ("created_at", DESC)],
+        name="project_language_created_at",
+        partial_filter={"language": {"$exists": True}},
+        query_shape="project_id, language, created_at range",
+    ),
+    IndexDefinition(
+        collection="tasks",
+        keys=[("project_id", 1), ("sentiment.label", 1), ("created_at", DESC)],
+        name="project_sentiment_label_created_at",
+        partial_filter={"sentiment.label": {"$exists": True}},
+        query_shape="project_id, sentiment.label, created_at range",
+    ),
+    IndexDefinition(
+        collection="tasks",
+        keys=[("project_id", 1), ("last_eval.source", 1), ("created_at", DESC)],
+        name="project_last_eval_source_created_at",
+        query_shape="project_id, last_eval.source prefix regex, created_at range",
+    ),
+    IndexDefinition(
+        collection="tasks",
+        keys=[("project_id", 1), ("session_id", 1)],
+        name="project_session_id",
+        query_shape="project_id, session_id $in",
+    ),
+    IndexDefinition(
+        collection="tasks",
+        keys=[("project_id", 1), ("is_last_task", 1), ("created_at", DESC)],
+        name="project_is_last_task_created_at",
+        partial_filter={"is_last_task": {"$exists": True}},
+        query_shape="project_id, is_last_task, created_at range",
+    ),
+    # Sessions
+    IndexDefinition(
+        collection="sessions",
+        keys=[("project_id", 1), ("stats.most_common_flag", 1), ("created_at", DESC)],
+        name="project_most_common_flag_created_at",
+        partial_filter={"stats.most_common_flag": {"$exists": True}},
+        query_shape="project_id, stats.most_common_flag, created_at range",
+    ),
+    IndexDefinition(
+        collection="sessions",
+        keys=[
+            ("project_id", 1),
+            ("stats.most_common_language", 1),
+            ("created_at", DESC),
+        ],
+        name="project_most_common_language_created_at",
+        partial_filter={"stats.most_common_language": {"$exists": True}},
+        query_shape="project_id, stats.most_common_language, created_at range",
+    ),
+    IndexDefinition(
+        collection="sessions",
+        keys=[
+            ("project_id", 1),
+            ("stats.most_common_sentiment_label", 1),
+            ("created_at", DESC),
+        ],
+        name="project_most_common_sentiment_label_created_at",
+        partial_filter={"stats.most_common_sentiment_label": {"$exists": True}},
+        query_shape="project_id, stats.most_common_sentiment_label, created_at range",
+    ),
+    # Events
+    IndexDefinition(
+        collection="events",
+        keys=[("project_id", 1), ("event_name", 1), ("created_at", DESC)],
+        name="project_event_name_created_at",
+        query_shape="project_id, event_name, created_at range",
+    ),
+]
+
+
+async def apply_index_migrations(
+    mongo_db, indexes: Optional[List[IndexDefinition]] = None
+) -> None:
+    """
+    Create the declared indexes that don't exist yet. Safe to run at every startup:
+    existing indexes are left untouched, and applied migrations are recorded in the
+    `index_migrations` collection.
+    """
+    if indexes is None:
+        indexes = INDEXES
+
+    existing_indexes: Dict[str, dict] = {}
+    for index in indexes:
+        if index.collection not in existing_indexes:
+            existing_indexes[index.collection] = await mongo_db[
+                index.collection
+            ].index_information()
+        existing = existing_indexes[index.collection].get(index.name)
+        if existing is not None:
+            if [tuple(key) for key in existing["key"]] != [
+                tuple(key) for key in index.keys
+            ]:
+                logger.warning(
+                    f"Index {index.collection}.{index.name} exists with different keys {existing['key']}. Skipping it."
+                )
+            continue
+        try:
+            await mongo_db[index.collection].create_index(
+                index.keys, **index.create_index_kwargs()
+            )
+            await mongo_db["index_migrations"].update_one(
+                {"collection": index.collection, "name": index.name},
+                {
+                    "$set": {
+                        "keys": [list(key) for key in index.keys],
+                        "partial_filter": index.partial_filter,
+                        "applied_at": generate_timestamp(),
+                    }
+                },
+                upsert=True,
+            )
+            logger.info(f"Created index {index.collection}.{index.name}")
+        except OperationFailure as e:
+            # Eg: an index with the same keys but another name already exists
+            logger.warning(f"Could not create index {index.collection}.{index.name}: {e}")
+
+
+def get_query_shape(match: dict) -> List[Tuple[str, str]]:
+    """
+    Returns the shape of a match filter: the list of (field, operators), without the
+    values. Eg: {"project_id": "abc", "created_at": {"$gte": 1}} ->
+    [("created_at", "$gte"), ("project_id", "eq")]
+    """
+    shape: List[Tuple[str, str]] = []
+    for field, value in match.items():
+        if field in ["$and", "$or"] and isinstance(value, list):
+            for sub_match in value:
+                if isinstance(sub_match, dict):
+                    shape.extend(get_query_shape(sub_match))
+        elif isinstance(value, dict) and all(k.startswith("$") for k in value):
+            shape.append((field, ",".join(sorted(value.keys()))))
+        else:
+            shape.append((field, "eq"))
+    return sorted(set(shape))
+
+
+def _plan_stages(plan: object) -> List[str]:
+    """
+    All the stages of an explain plan
+    """
+    stages: List[str] = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+async def _explain_and_record(collection: str, project_id: str, match: dict) -> None:
+    from app.db.mongo import get_mongo_db
+
+    try:
+        mongo_db = await get_mongo_db()
+        explanation = await mongo_db.command(
+            {
+                "explain": {"find": collection, "filter": match},
+                "verbosity": "executionStats",
+            }
+        )
+        stages = _plan_stages(explanation.get("queryPlanner", {}))
+        execution_stats = explanation.get("executionStats", {})
+        execution_time_ms = execution_stats.get("executionTimeMillis", 0)
+        is_collscan = "COLLSCAN" in stages
+        if not is_collscan and execution_time_ms < config.INDEX_ADVISOR_SLOW_QUERY_MS:
+            return
+
+        shape = get_query_shape(match)
+        await mongo_db["slow_query_shapes"].update_one(
+            {
+                "collection": collection,
+                "project_id": project_id,
+                "shape": [list(field) for field in shape],
+            },
+            {
+                "$inc": {"count": 1},
+                "$max": {"max_execution_time_ms": execution_time_ms},
+                "$set": {
+                    "last_seen_at": generate_timestamp(),
+                    "is_collscan": is_collscan,
+                    "docs_examined": execution_stats.get("totalDocsExamined"),
+                    "n_returned": execution_stats.get("nReturned"),
+                },
+            },
+            upsert=True,
+        )
+    except Exception as e:
+        logger.debug(f"Could not explain query on {collection}: {e}")
+
+
+# The event loop only keeps weak references to the tasks: keep the running explains
+_explain_tasks: Set[asyncio.Task] = set()
+
+
+def sample_query_shape(collection: str, project_id: str, match: dict) -> None:
+    """
+    With a probability of INDEX_ADVISOR_SAMPLE_RATE, explain the match filter in the
+    background and record its shape if the query is slow or a collection scan.
+    """
+    if config.INDEX_ADVISOR_SAMPLE_RATE <= 0:
+        return
+    if random.random() >= config.INDEX_ADVISOR_SAMPLE_RATE:
+        return
+    try:
+        task = asyncio.get_running_loop().create_task(
+            _explain_and_record(collection, project_id, match)
+        )
+    except RuntimeError:
+        # No running event loop
+        return
+    _explain_tasks.add(task)
+    task.add_done_callback(_explain_tasks.discard)
+
+
+RANGE_OPERATORS = {"$gt", "$gte", "$lt", "$lte"}
+
+
+def _suggest_index_for_shape(
+    collection: str, shape: List[Tuple[str, str]]
+) -> Optional[IndexDefinition]:
+    """
+    Compound index for a query shape: project_id, then the equality fields, then a
+    single range field. Negations ($ne, $exists) are not selective and are ignored.
+    """
+    equality_fields: List[str] = []
+    range_fields: List[str] = []
+    for field, operators in shape:
+        if field == "project_id" or field.startswith("metadata."):
+            continue
+        if operators in ["eq", "$in", "$regex"]:
+            if field not in equality_fields:
+                equality_fields.append(field)
+        elif set(operators.split(",")).issubset(RANGE_OPERATORS):
+            if field not in range_fields:
+                range_fields.append(field)
+    keys: List[Tuple[str, int]] = [("project_id", 1)]
+    keys.extend((field, 1) for field in equality_fields)
+    if range_fields:
+        # A compound index is only used for one range
+        range_field = "created_at" if "created_at" in range_fields else range_fields[0]
+        keys.append((range_field, DESC))
+    if len(keys) == 1:
+        return None
+    return IndexDefinition(
+        collection=collection,
+        keys=keys,
+        name="_".join(field.replace(".", "_") for field, _ in keys),
+        query_shape=", ".join(f"{field} {operators}" for field, operators in shape),
+    )
+
+
+async def suggest_indexes(
+    project_id: Optional[str] = None,
+    min_count: int = 5,
+) -> List[IndexDefinition]:
+    """
+    Suggest indexes from the recorded slow query shapes.
+
+    Filters on metadata keys are suggested as compound indexes on
+    (project_id, metadata.<key>) when a project uses a few keys, and as a compound
+    wildcard index on (project_id, metadata.$**) (MongoDB >= 7.0) when it uses more
+    than INDEX_ADVISOR_MAX_METADATA_INDEXES keys.
+    """
+    from app.db.mongo import get_mongo_db
+
+    mongo_db = await get_mongo_db()
+    query: Dict[str, object] = {"count": {"$gte": min_count}}
+    if project_id is not None:
+        query["project_id"] = project_id
+    slow_shapes = (
+        await mongo_db["slow_query_shapes"]
+        .find(query)
+        .sort("count", pymongo.DESCENDING)
+        .to_list(length=1000)
+    )
+
+    declared = {(index.collection, tuple(index.keys)) for index in INDEXES}
+    suggestions: Dict[Tuple[str, tuple], IndexDefinition] = {}
+    # (collection, project_id) -> metadata keys
+    metadata_keys: Dict[Tuple[str, str], set] = {}
+    for slow_shape in slow_shapes:
+        collection = slow_shape["collection"]
+        shape = [tuple(field) for field in slow_shape["shape"]]
+        suggestion = _suggest_index_for_shape(collection, shape)  # type: ignore
+        if suggestion is not None:
+            key = (collection, tuple(suggestion.keys))
+            if key not in declared and key not in suggestions:
+                suggestion.reason = f"Seen {slow_shape['count']} times as a slow query"
+                suggestions[key] = suggestion
+        for field, _ in shape:
+            if field.startswith("metadata."):
+                metadata_keys.setdefault(
+                    (collection, slow_shape["project_id"]), set()
+                ).add(field)
+
+    for (collection, shape_project_id), fields in metadata_keys.items():
+        if len(fields) > config.INDEX_ADVISOR_MAX_METADATA_INDEXES:
+            wildcard = IndexDefinition(
+                collection=collection,
+                keys=[("project_id", 1), ("metadata.$**", 1)],
+                name="project_metadata_wildcard",
+                query_shape="project_id, metadata.<any key>",
+                reason=f"Project {shape_project_id} filters on {len(fields)} metadata keys",
+            )
+            suggestions[(collection, tuple(wildcard.keys))] = wildcard
+        else:
+            for field in sorted(fields):
+                metadata_index = IndexDefinition(
+                    collection=collection,
+                    keys=[("project_id", 1), (field, 1), ("created_at", DESC)],
+                    name=f"project_{field.replace('.', '_')}_created_at",
+                    query_shape=f"project_id, {field}, created_at range",
+                    reason=f"Project {shape_project_id} filters on {field}",
+                )
+                suggestions.setdefault(
+                    (collection, tuple(metadata_index.keys)), metadata_index
+                )
+
+    return list(suggestions.values())
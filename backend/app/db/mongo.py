@@ -9,6 +9,8 @@ from app.core.config import (
 )
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from app.db.indexes import apply_index_migrations
+
 mongo_db = None
 
 
@@ -83,6 +85,9 @@ async def connect_and_init_db():
             mongo_db[MONGODB_NAME]["tasks"].create_index(
                 ["project_id", "flag"], background=True
             )
+            mongo_db[MONGODB_NAME]["tasks"].create_index(
+                ["project_id", "created_at", "id"], background=True
+            )
             mongo_db[MONGODB_NAME]["tasks"].create_index(
                 "metadata.version_id", background=True
             )
@@ -315,6 +320,45 @@ async def connect_and_init_db():
             mongo_db[MONGODB_NAME]["job_results"].create_index(
                 ["project_id", "job_metadata.id"], background=True
             )
+            # Version counter used to invalidate the analytics cache
+            mongo_db[MONGODB_NAME]["project_data_versions"].create_index(
+                "project_id", unique=True, background=True
+            )
+            # Analytics rollups
+            mongo_db[MONGODB_NAME]["analytics_rollups"].create_index(
+                [
+                    "project_id",
+                    "collection",
+                    "granularity",
+                    "bucket_start",
+                    "breakdown",
+                ],
+                unique=True,
+                background=True,
+            )
+            mongo_db[MONGODB_NAME]["analytics_rollup_status"].create_index(
+                ["project_id", "collection"], unique=True, background=True
+            )
+            # LLM calls cached by the extractor: expired responses are removed by mongo
+            mongo_db[MONGODB_NAME]["llm_cache"].create_index(
+                "key", unique=True, background=True
+            )
+            mongo_db[MONGODB_NAME]["llm_cache"].create_index(
+                "expires_at", expireAfterSeconds=0, background=True
+            )
+            # Failed webhooks, retried by the extractor
+            mongo_db[MONGODB_NAME]["webhook_retries"].create_index(
+                "id", unique=True, background=True
+            )
+            mongo_db[MONGODB_NAME]["webhook_retries"].create_index(
+                [("status", 1), ("next_attempt_at", 1)], background=True
+            )
+            # High-water marks of the connectors syncs
+            mongo_db[MONGODB_NAME]["sync_cursors"].create_index(
+                ["project_id", "source"], unique=True, background=True
+            )
+            # Compound and partial indexes of the filtering query shapes
+            await apply_index_migrations(mongo_db[MONGODB_NAME])
             # mongo_db[MONGODB_NAME]["recipes"].create_index(
             #     "id", unique=True, background=True
             # )
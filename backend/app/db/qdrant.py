@@ -18,6 +18,9 @@ async def get_qdrant():
 async def init_qdrant():
     global qdrant_db
 
+    if config.QDRANT_URL is None:
+        logger.info("QDRANT_URL is not set, the vector search is disabled")
+        return
     qdrant_db = AsyncQdrantClient(url=config.QDRANT_URL, api_key=config.QDRANT_API_KEY)
     try:
         existing_collections = await qdrant_db.get_collections()
@@ -8,7 +8,10 @@ from urllib.parse import urlparse
 import phospho
 from app.core import config
 from app.db.mongo import close_mongo_db, connect_and_init_db
+from app.db.qdrant import close_qdrant, init_qdrant
+from app.services.cache import close_analytics_cache
 from app.services.integrations import check_health_argilla
+from phospho.lab.language_models import close_clients
 
 logging.info(f"ENVIRONMENT : {config.ENVIRONMENT}")
 
@@ -102,7 +105,12 @@ app.add_middleware(
 # Database
 
 app.add_event_handler("startup", connect_and_init_db)
+app.add_event_handler("startup", init_qdrant)
 app.add_event_handler("shutdown", close_mongo_db)
+app.add_event_handler("shutdown", close_qdrant)
+app.add_event_handler("shutdown", close_analytics_cache)
+# Connection pools of the LLM providers
+app.add_event_handler("shutdown", close_clients)
 
 
 # Other services
@@ -0,0 +1,355 @@
+"""
+Result cache for the analytics services (dashboards, explore, charts).
+
+The dashboard aggregations are expensive and many users watch the same project at
+the same time. Results are cached by (function, project_id, normalized arguments).
+
+Invalidation is done with a per-project version counter stored in the
+`project_data_versions` collection. The extractor increments it every time it writes
+tasks, sessions or events for a project, and the backend when a flag or an event is
+edited (platform, Argilla annotations). The version is part of the cache key, so a
+write makes all the cached results of the project unreachable. They then expire
+with the TTL.
+
+Two backends are supported:
+- "memory": an in-process LRU (default)
+- "redis": a Redis server shared by all the backend replicas (requires `redis`)
+"""
+
+import asyncio
+import datetime
+import functools
+import hashlib
+import inspect
+import json
+import pickle
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+import pydantic
+from loguru import logger
+
+from app.core import config
+from app.db.mongo import get_mongo_db
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+T = TypeVar("T")
+
+
+class CacheBackend:
+    """
+    Interface of a cache backend. Values are python objects.
+    """
+
+    async def get(self, key: str) -> Tuple[bool, Any]:
+        """
+        Returns (found, value)
+        """
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: int) -> None:
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemoryLRUBackend(CacheBackend):
+    """
+    In-process LRU cache with a TTL per entry.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        # key -> (expires_at, value)
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    async def get(self, key: str) -> Tuple[bool, Any]:
+        item = self._data.get(key)
+        if item is None:
+            return False, None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    async def set(self, key: str, value: Any, ttl: int) -> None:
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+
+class RedisBackend(CacheBackend):
+    """
+    Redis cache, shared between the backend replicas. Values are pickled.
+    """
+
+    def __init__(self, url: str, prefix: str = "phospho:analytics:"):
+        if aioredis is None:
+            raise ImportError(
+                "The redis package is required to use the redis cache backend. Install it with `pip install redis`"
+            )
+        self.prefix = prefix
+        self._client = aioredis.from_url(url)
+
+    async def get(self, key: str) -> Tuple[bool, Any]:
+        raw = await self._client.get(self.prefix + key)
+        if raw is None:
+            return False, None
+        return True, pickle.loads(raw)
+
+    async def set(self, key: str, value: Any, ttl: int) -> None:
+        await self._client.set(self.prefix + key, pickle.dumps(value), ex=ttl)
+
+    async def close(self) -> None:
+        await self._client.close()
+
+
+def _normalize(value: Any, time_bucket: int) -> Any:
+    """
+    Turn the arguments of a cached function into a jsonable and stable structure.
+    Timestamps of the filters are floored to `time_bucket` seconds, so that a
+    dashboard sending `created_at_end=now` reuses the same entry.
+    """
+    if isinstance(value, pydantic.BaseModel):
+        value = value.model_dump(exclude_none=True)
+        for field in ("created_at_start", "created_at_end"):
+            if field in value:
+                timestamp = value[field]
+                if isinstance(timestamp, datetime.datetime):
+                    timestamp = timestamp.timestamp()
+                value[field] = int(timestamp) // time_bucket * time_bucket
+    if isinstance(value, dict):
+        return {str(k): _normalize(v, time_bucket) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        normalized = [_normalize(v, time_bucket) for v in value]
+        # Lists of filters (event names, ids...) are order insensitive
+        if all(isinstance(v, str) for v in normalized):
+            normalized = sorted(normalized)
+        return normalized
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+class AnalyticsCache:
+    def __init__(
+        self,
+        backend: Optional[CacheBackend],
+        ttl: int = 300,
+        time_bucket: int = 60,
+        version_refresh: float = 2.0,
+    ):
+        """
+        :param backend: Where to store the results. If None, the cache is disabled.
+        :param ttl: Time to live of the cached results, in seconds.
+        :param time_bucket: Precision of the created_at filters in the cache key, in seconds.
+        :param version_refresh: How long a project data version is trusted in-process, in seconds.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.time_bucket = max(1, time_bucket)
+        self.version_refresh = version_refresh
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        # Concurrent misses on the same key wait for the same computation
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        # project_id -> (version, fetched_at)
+        self._versions: Dict[str, Tuple[int, float]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    async def get_project_data_version(self, project_id: str) -> int:
+        cached_version = self._versions.get(project_id)
+        if (
+            cached_version is not None
+            and time.monotonic() - cached_version[1] < self.version_refresh
+        ):
+            return cached_version[0]
+        mongo_db = await get_mongo_db()
+        doc = await mongo_db["project_data_versions"].find_one(
+            {"project_id": project_id}, {"version": 1}
+        )
+        version = doc.get("version", 0) if doc is not None else 0
+        self._versions[project_id] = (version, time.monotonic())
+        return version
+
+    def build_key(
+        self, function_name: str, project_id: str, version: int, arguments: dict
+    ) -> str:
+        payload = json.dumps(
+            {
+                "function": function_name,
+                "project_id": project_id,
+                "version": version,
+                "arguments": _normalize(arguments, self.time_bucket),
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return f"{project_id}:{hashlib.sha256(payload.encode()).hexdigest()}"
+
+    def get_stats(self) -> Dict[str, object]:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "backend": self.backend.__class__.__name__ if self.backend else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": self.hits / total if total > 0 else None,
+        }
+
+    async def get_or_compute(
+        self, key: str, compute: Callable[[], Awaitable[T]]
+    ) -> T:
+        assert self.backend is not None
+        try:
+            found, value = await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Analytics cache: error reading key {key}: {e}")
+            self.errors += 1
+            found, value = False, None
+        if found:
+            self.hits += 1
+            return value
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            # Someone is already computing this key: wait for the result
+            self.hits += 1
+        else:
+            self.misses += 1
+            task = asyncio.get_running_loop().create_task(
+                self._compute_and_store(key, compute)
+            )
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._forget_in_flight(key, done))
+        # The computation is detached from the callers: if one of them is cancelled
+        # (timeout, client disconnected), the others still get the result
+        return await asyncio.shield(task)
+
+    async def _compute_and_store(
+        self, key: str, compute: Callable[[], Awaitable[T]]
+    ) -> T:
+        assert self.backend is not None
+        value = await compute()
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Analytics cache: error writing key {key}: {e}")
+            self.errors += 1
+        return value
+
+    def _forget_in_flight(self, key: str, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Avoid "exception was never retrieved" warnings if all the callers are gone
+        if not task.cancelled():
+            task.exception()
+
+    def cached(
+        self, func: Callable[..., Awaitable[T]]
+    ) -> Callable[..., Awaitable[T]]:
+        """
+        Decorator for async analytics services that take a `project_id` argument.
+
+        The filters passed to the function are copied, so that the function can mutate
+        them without changing the cache key or the caller's object.
+        """
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return await func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            # **kwargs catch-alls are part of the arguments as well
+            for name, parameter in signature.parameters.items():
+                if parameter.kind == inspect.Parameter.VAR_KEYWORD:
+                    arguments.update(arguments.pop(name, {}))
+            project_id = arguments.pop("project_id", None)
+            if project_id is None:
+                return await func(*args, **kwargs)
+
+            version = await self.get_project_data_version(project_id)
+            key = self.build_key(func.__qualname__, project_id, version, arguments)
+
+            def copy_args():
+                copied_args = [
+                    a.model_copy(deep=True) if isinstance(a, pydantic.BaseModel) else a
+                    for a in bound.args
+                ]
+                copied_kwargs = {
+                    k: v.model_copy(deep=True)
+                    if isinstance(v, pydantic.BaseModel)
+                    else v
+                    for k, v in bound.kwargs.items()
+                }
+                return copied_args, copied_kwargs
+
+            async def compute():
+                copied_args, copied_kwargs = copy_args()
+                return await func(*copied_args, **copied_kwargs)
+
+            return await self.get_or_compute(key, compute)
+
+        return wrapper
+
+
+def _create_backend() -> Optional[CacheBackend]:
+    backend_name = config.ANALYTICS_CACHE_BACKEND
+    if backend_name == "memory":
+        return InMemoryLRUBackend(max_size=config.ANALYTICS_CACHE_MAX_SIZE)
+    if backend_name == "redis":
+        if config.REDIS_URL is None:
+            logger.warning(
+                "ANALYTICS_CACHE_BACKEND is redis but REDIS_URL is not set. Falling back to memory."
+            )
+            return InMemoryLRUBackend(max_size=config.ANALYTICS_CACHE_MAX_SIZE)
+        return RedisBackend(url=config.REDIS_URL)
+    if backend_name != "none":
+        logger.warning(
+            f"Unknown ANALYTICS_CACHE_BACKEND {backend_name}. The analytics cache is disabled."
+        )
+    return None
+
+
+analytics_cache = AnalyticsCache(
+    backend=_create_backend(),
+    ttl=config.ANALYTICS_CACHE_TTL,
+    time_bucket=config.ANALYTICS_CACHE_TIME_BUCKET,
+)
+
+
+async def bump_project_data_version(project_id: str) -> None:
+    """
+    Invalidate all the cached analytics of a project.
+    """
+    mongo_db = await get_mongo_db()
+    await mongo_db["project_data_versions"].update_one(
+        {"project_id": project_id},
+        {"$inc": {"version": 1}, "$set": {"updated_at": int(time.time())}},
+        upsert=True,
+    )
+    analytics_cache._versions.pop(project_id, None)
+
+
+async def close_analytics_cache() -> None:
+    if analytics_cache.backend is not None:
+        await analytics_cache.backend.close()
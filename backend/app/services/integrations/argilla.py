@@ -1,28 +1,28 @@
+import asyncio
+import random
+from collections import Counter
+
 from app.db.mongo import get_mongo_db
-from app.services.mongo.events import (
-    change_label_event,
-    change_value_event,
-    confirm_event,
-    get_event_definition_from_event_id,
-    get_last_event_for_task,
-    remove_event,
-)
+from app.services.cache import bump_project_data_version
+from app.services.mongo.events import get_last_events_for_tasks
 import argilla as rg
-import pandas as pd
 from app.api.platform.models.integrations import (
     DatasetCreationRequest,
     DatasetPullRequest,
     DatasetSamplingParameters,
 )
 from app.services.mongo.projects import get_project_by_id
+from app.services.mongo.rollups import increment_rollups
+from fastapi import HTTPException
 from loguru import logger
 from app.core import config
-from argilla import FeedbackDataset
+from argilla import FeedbackDataset, FeedbackRecord
 from app.utils import health_check
-from typing import Dict, List, Union
-from app.db.models import Task
+from typing import Dict, List, Optional, Set, Union
+from app.db.models import Project, Task
 from app.services.mongo.tasks import get_all_tasks
 from app.utils import generate_valid_name
+from pymongo import InsertOne, UpdateOne
 
 from phospho.models import Event
 
@@ -135,16 +135,83 @@ def get_datasets_name(workspace_id: str, project_id: str) -> list[str]:
 
 
 def sample_tasks(
-    tasks: List[Task], sampling_params: DatasetSamplingParameters
+    tasks: List[Task],
+    sampling_params: DatasetSamplingParameters,
+    labels: Optional[List[str]] = None,
 ) -> List[Task]:
+    """
+    Sample the tasks of a dataset.
+
+    With the balanced sampling, the labels are balanced one after the other, starting
+    with the least frequent: as many tasks with as without the label are kept.
+    """
     if sampling_params.sampling_type == "naive":
         return tasks
+    if sampling_params.sampling_type != "balanced":
+        raise ValueError("Unknown sampling type. Must be naive or balanced.")
 
-    if sampling_params.sampling_type == "balanced":
-        logger.warning("Balanced sampling not implemented yet")
-        return tasks
+    # The task level events detected in each task
+    task_labels: Dict[str, Set[str]] = {
+        task.id: {
+            event.event_definition.event_name
+            for event in task.events or []
+            if event.event_definition is not None
+            and event.event_definition.detection_scope != "session"
+        }
+        for task in tasks
+    }
+
+    sampled_tasks = tasks
+    labels_to_balance = list(labels or [])
+    while len(labels_to_balance) > 0:
+        # Get the label with the least number of tasks
+        label_counts = Counter(
+            label for task in sampled_tasks for label in task_labels[task.id]
+        )
+        label = min(labels_to_balance, key=lambda x: label_counts[x])
+        labels_to_balance.remove(label)
+
+        with_label = [task for task in sampled_tasks if label in task_labels[task.id]]
+        without_label = [
+            task for task in sampled_tasks if label not in task_labels[task.id]
+        ]
+        n_samples = min(len(with_label), len(without_label))
+        if n_samples <= config.MIN_NUMBER_OF_DATASET_SAMPLES:
+            logger.warning(f"Cannot balance label {label} with {n_samples} samples")
+            continue
+
+        logger.debug(f"Balancing label {label} with {n_samples} samples")
+        sampled_tasks = random.sample(with_label, n_samples) + random.sample(
+            without_label, n_samples
+        )
+
+    # Keep the order of the tasks
+    sampled_task_ids = {task.id for task in sampled_tasks}
+    return [task for task in tasks if task.id in sampled_task_ids]
+
+
+async def add_records_in_batches(
+    dataset,
+    records: List[FeedbackRecord],
+    batch_size: int = config.ARGILLA_PUSH_BATCH_SIZE,
+    max_concurrency: int = config.ARGILLA_PUSH_MAX_CONCURRENCY,
+) -> None:
+    """
+    Add the records to a dataset pushed to Argilla, by batches of batch_size records.
+    The Argilla client is blocking: the batches are sent from threads, a few at once.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
 
-    return tasks
+    async def add_batch(batch: List[FeedbackRecord]) -> None:
+        async with semaphore:
+            await asyncio.to_thread(dataset.add_records, batch, show_progress=False)
+
+    await asyncio.gather(
+        *(
+            add_batch(records[i : i + batch_size])
+            for i in range(0, len(records), batch_size)
+        )
+    )
 
 
 async def generate_dataset_from_project(
@@ -347,87 +414,34 @@ async def generate_dataset_from_project(
     logger.debug(tasks[0].events)
 
     # Filter the sampling of tasks based on the dataset creation request
-    if creation_request.sampling_parameters.sampling_type == "naive":
-        sampled_tasks = tasks
-    elif creation_request.sampling_parameters.sampling_type == "balanced":
-        # Build the pandas dataframe
-        df_records = []
-        for task in tasks:
-            df_record: Dict[str, object] = {
-                "user_input": task.input if task.input is not None else "",
-                "assistant_output": task.output if task.output is not None else "",
-                "task_id": task.id,
-            }
-            for tag in taggers:
-                df_record[tag] = False
-
-            if task.events is not None:
-                for event in task.events:
-                    if (
-                        event.event_definition is not None
-                        and event.event_definition.detection_scope != "session"
-                    ):
-                        df_record[event.event_definition.event_name] = True
-
-            df_records.append(df_record)
-
-        df = pd.DataFrame(df_records)
-
-        labels_to_balance = list(taggers.keys()).copy()
-        while len(labels_to_balance) > 0:
-            # Get the label with the least number of True values
-            tag = min(labels_to_balance, key=lambda x: df[x].sum())
-            labels_to_balance.remove(tag)
-
-            logger.debug(f"Balancing label {tag}")
-            # Get the number of True values
-            n_true = df[tag].sum()
-            # Get the number of False values
-            n_false = len(df) - n_true
-            # Get the number of samples to keep
-            n_samples = min(n_true, n_false)
-
-            if n_samples <= config.MIN_NUMBER_OF_DATASET_SAMPLES:
-                logger.warning(f"Cannot balance label {tag} with {n_samples} samples")
-                continue
-
-            logger.debug(f"Balancing label {tag} with {n_samples} samples")
-            # Balance the dataset
-            df = pd.concat(
-                [
-                    df[df[tag]].sample(n=n_samples),
-                    df[~df[tag]].sample(n=n_samples),
-                ]
-            )
-
-        sampled_tasks = [task for task in tasks if task.id in df["task_id"].tolist()]
+    sampled_tasks = sample_tasks(
+        tasks, creation_request.sampling_parameters, labels=list(taggers.keys())
+    )
+    if creation_request.sampling_parameters.sampling_type == "balanced":
         logger.info(
             f"Balanced dataset has {len(sampled_tasks)} tasks (compared to {len(tasks)} before balancing"
         )
 
-    else:
-        raise ValueError("Unknown sampling type. Must be naive or balanced.")
-
     # Make them into Argilla records
-    records = []
-    for task in sampled_tasks:
-        record = rg.FeedbackRecord(
+    records = [
+        rg.FeedbackRecord(
             fields={
                 "user_input": task.input,
                 "assistant_output": task.output,
             },
             metadata={"task_id": task.id},
         )
-        records.append(record)
-
-    print(f"loaded {len(records)} records")
-
-    argilla_dataset.add_records(records)
+        for task in sampled_tasks
+    ]
+    logger.info(f"Pushing {len(records)} records to Argilla")
 
-    # Push the dataset to Argilla
-    argilla_dataset.push_to_argilla(
-        name=creation_request.dataset_name, workspace=creation_request.workspace_id
+    # Push the empty dataset to Argilla, then add the records by batches
+    remote_dataset = await asyncio.to_thread(
+        argilla_dataset.push_to_argilla,
+        name=creation_request.dataset_name,
+        workspace=creation_request.workspace_id,
     )
+    await add_records_in_batches(remote_dataset, records)
 
     logger.info(f"dataset : {argilla_dataset}")
 
@@ -439,15 +453,35 @@ async def pull_dataset_from_argilla(
     pull_request: DatasetPullRequest,
 ) -> FeedbackDataset:
     """
-    Extract a dataset from a project and push it to Argilla
+    Pull an annotated dataset from Argilla and write the annotations back to the events
+    of the project
     """
 
     # Load the project configs, so we know the dataset fields and questions
-    await get_project_by_id(pull_request.project_id)
+    project = await get_project_by_id(pull_request.project_id)
+
+    argilla_dataset = await asyncio.to_thread(
+        lambda: rg.FeedbackDataset.from_argilla(
+            name=pull_request.dataset_name, workspace=pull_request.workspace_id
+        ).pull()
+    )
+    await apply_dataset_annotations(project, argilla_dataset)
+    return argilla_dataset
 
-    argilla_dataset = rg.FeedbackDataset.from_argilla(
-        name=pull_request.dataset_name, workspace=pull_request.workspace_id
-    ).pull()
+
+async def apply_dataset_annotations(
+    project: Project,
+    argilla_dataset: FeedbackDataset,
+    batch_size: int = config.ARGILLA_PULL_BATCH_SIZE,
+) -> int:
+    """
+    Write the annotations of the records of a dataset back to the events of the project.
+
+    The records are processed by batches of batch_size: the last events of the tasks of
+    a batch are loaded with one query, and the changes are written with one bulk write.
+    Return the number of events created or updated.
+    """
+    project_id = project.id
 
     # Get the event ids from the metadata properties
     original_events_ids = {}
@@ -470,101 +504,117 @@ async def pull_dataset_from_argilla(
             argilla_dataset.questions[i].name.replace(" ", "_").lower()
         )
 
-    mongo_db = await get_mongo_db()
-
-    # # Fetch the relevant data in argilla records and transform them into a dict we can process
-    for record in argilla_dataset.records:
-        if len(record.responses) == 0:
-            continue
-
-        task_id = record.metadata["task_id"]
-        # taggers is a list of taggers that are present in this task
-        taggers: list[str] = record.responses[0].values["taggers"].value
+    # The event definitions of the dataset, from the project settings
+    project_event_definitions = {
+        event_definition.id: event_definition
+        for event_definition in project.settings.events.values()
+    }
+    event_definitions = {}
+    for name in original_taggers_list + original_classifiers_and_scorers_list:
+        if original_events_ids[name] not in project_event_definitions:
+            raise HTTPException(status_code=404, detail="Event definition not found")
+        event_definitions[name] = project_event_definitions[original_events_ids[name]]
+    event_names = [
+        event_definition.event_name for event_definition in event_definitions.values()
+    ]
 
-        for tagger in original_taggers_list:
-            event_definition_id = original_events_ids[tagger]
-            event_definition = await get_event_definition_from_event_id(
-                project_id=pull_request.project_id, event_id=event_definition_id
-            )
+    mongo_db = await get_mongo_db()
+    annotated_records = [
+        record for record in argilla_dataset.records if len(record.responses) > 0
+    ]
+    nb_operations = 0
+    for i in range(0, len(annotated_records), batch_size):
+        records = annotated_records[i : i + batch_size]
+        # (task_id, event_name) -> most recent event
+        last_events = await get_last_events_for_tasks(
+            project_id=project_id,
+            task_ids=list({record.metadata["task_id"] for record in records}),
+            event_names=event_names,
+        )
+        operations: List[Union[InsertOne, UpdateOne]] = []
+        new_events: List[dict] = []
 
-            # Loading the most recent occurrence of this exact event for this task in the database
-            last_event_in_db = await get_last_event_for_task(
-                project_id=pull_request.project_id,
+        def create_event(task_id: str, event_definition) -> None:
+            new_event = Event(
                 event_name=event_definition.event_name,
+                source="owner",
+                confirmed=True,
                 task_id=task_id,
+                project_id=project_id,
+                event_definition=event_definition,
+            ).model_dump()
+            operations.append(InsertOne(new_event))
+            new_events.append(new_event)
+            # The next records of the same task see this event
+            last_events[(task_id, event_definition.event_name)] = new_event
+
+        def update_event(event: dict, update: dict) -> None:
+            operations.append(
+                UpdateOne(
+                    {"project_id": project_id, "id": event["id"]}, {"$set": update}
+                )
             )
 
-            if not last_event_in_db or last_event_in_db["removed"] is True:
-                # Create the event
-                if tagger not in taggers:
-                    continue
-                tagger = Event(
-                    event_name=event_definition.event_name,
-                    source="owner",
-                    confirmed=True,
-                    task_id=task_id,
-                    project_id=pull_request.project_id,
-                    event_definition=event_definition,
-                )
-                event_model = Event.model_validate(tagger)
-                await mongo_db["events"].insert_one(tagger.model_dump())
-            else:
-                event_model = Event.model_validate(last_event_in_db)
+        for record in records:
+            task_id = record.metadata["task_id"]
+            # taggers is a list of taggers that are present in this task
+            taggers: list[str] = record.responses[0].values["taggers"].value
 
+            for tagger in original_taggers_list:
+                event_definition = event_definitions[tagger]
+                # The most recent occurrence of this exact event for this task
+                last_event_in_db = last_events.get(
+                    (task_id, event_definition.event_name)
+                )
+                if not last_event_in_db or last_event_in_db.get("removed") is True:
+                    # Create the event
+                    if tagger in taggers:
+                        create_event(task_id, event_definition)
                 # Confirm the tagger event
-                if tagger in taggers:
-                    await confirm_event(
-                        project_id=pull_request.project_id, event_id=event_model.id
-                    )
-
+                elif tagger in taggers:
+                    update_event(last_event_in_db, {"confirmed": True})
                 # Remove the tagger event
                 else:
-                    await remove_event(
-                        project_id=pull_request.project_id, event_id=event_model.id
-                    )
-
-        for classifier_or_scorer in original_classifiers_and_scorers_list:
-            event_definition_id = original_events_ids[classifier_or_scorer]
-            event_definition = await get_event_definition_from_event_id(
-                project_id=pull_request.project_id, event_id=event_definition_id
-            )
-            corrected_label_or_value: Union[str, float] = (
-                record.responses[0].values[classifier_or_scorer].value
-            )
+                    update_event(last_event_in_db, {"removed": True})
 
-            last_event_in_db = await get_last_event_for_task(
-                project_id=pull_request.project_id,
-                task_id=task_id,
-                event_name=event_definition.event_name,
-            )
-
-            if not last_event_in_db or last_event_in_db.removed is True:
-                new_event = Event(
-                    event_name=event_definition.event_name,
-                    source="owner",
-                    confirmed=True,
-                    task_id=task_id,
-                    project_id=pull_request.project_id,
-                    event_definition=event_definition,
+            for classifier_or_scorer in original_classifiers_and_scorers_list:
+                event_definition = event_definitions[classifier_or_scorer]
+                corrected_label_or_value: Union[str, float] = (
+                    record.responses[0].values[classifier_or_scorer].value
                 )
-                event_model = Event.model_validate(new_event)
-                await mongo_db["events"].insert_one(new_event.model_dump())
-            else:
-                event_model = Event.model_validate(last_event_in_db)
-
+                last_event_in_db = last_events.get(
+                    (task_id, event_definition.event_name)
+                )
+                if not last_event_in_db or last_event_in_db.get("removed") is True:
+                    create_event(task_id, event_definition)
                 # Edit the event. Note: this always confirm the event.
-                if isinstance(corrected_label_or_value, str):
-                    await change_label_event(
-                        project_id=pull_request.project_id,
-                        event_id=event_model.id,
-                        new_label=corrected_label_or_value,
+                elif isinstance(corrected_label_or_value, str):
+                    update_event(
+                        last_event_in_db,
+                        {
+                            "score_range.corrected_label": corrected_label_or_value,
+                            "confirmed": True,
+                        },
                     )
-
                 elif isinstance(corrected_label_or_value, float):
-                    await change_value_event(
-                        project_id=pull_request.project_id,
-                        event_id=event_model.id,
-                        new_value=corrected_label_or_value,
+                    update_event(
+                        last_event_in_db,
+                        {
+                            "score_range.corrected_value": corrected_label_or_value,
+                            "confirmed": True,
+                        },
                     )
 
-    return argilla_dataset
+        if len(operations) > 0:
+            # Ordered, so that the events created in this batch exist before their updates
+            await mongo_db["events"].bulk_write(operations)
+            await increment_rollups("events", new_events)
+        nb_operations += len(operations)
+
+    if nb_operations > 0:
+        # Invalidate the cached analytics of the project
+        await bump_project_data_version(project_id)
+    logger.info(
+        f"Applied {nb_operations} annotations of {len(annotated_records)} records to project {project_id}"
+    )
+    return nb_operations
@@ -1,7 +1,8 @@
-from typing import List, Literal, Optional
+import asyncio
+import io
+import json
+from typing import AsyncIterator, Dict, Iterable, List, Literal, Optional
 
-import pandas as pd
-from app.api.platform.models import Pagination
 from app.core import config
 from app.db.mongo import get_mongo_db
 from app.services.mongo.explore import fetch_flattened_tasks
@@ -9,10 +10,171 @@ from app.services.mongo.tasks import get_total_nb_of_tasks
 from app.utils import generate_uuid, slugify_string
 from fastapi import HTTPException
 from loguru import logger
+import psycopg2
+from psycopg2 import sql
 from pydantic import BaseModel, Field
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 
+# Postgres types of the columns of the FlattenedTask. The task_metadata.{key} columns
+# depend on the tasks: they are added as TEXT columns when they appear.
+EXPORT_COLUMNS: Dict[str, str] = {
+    "task_id": "TEXT",
+    "task_input": "TEXT",
+    "task_output": "TEXT",
+    "task_eval": "TEXT",
+    "task_eval_source": "TEXT",
+    "task_eval_at": "BIGINT",
+    "task_created_at": "BIGINT",
+    "session_id": "TEXT",
+    "session_length": "BIGINT",
+    "event_name": "TEXT",
+    "event_created_at": "BIGINT",
+    "event_removal_reason": "TEXT",
+    "event_removed": "BOOLEAN",
+    "event_confirmed": "BOOLEAN",
+    "event_score_range_value": "DOUBLE PRECISION",
+    "event_score_range_min": "DOUBLE PRECISION",
+    "event_score_range_max": "DOUBLE PRECISION",
+    "event_score_range_score_type": "TEXT",
+    "event_score_range_label": "TEXT",
+    "event_source": "TEXT",
+    "event_categories": "TEXT",
+}
+
+
+def encode_copy_value(value: object) -> str:
+    """
+    Encode a value in the text format of COPY FROM STDIN
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+        # Postgres text can't contain NUL characters
+        .replace("\x00", "")
+    )
+
+
+def encode_copy_rows(rows: Iterable[dict], columns: List[str]) -> io.StringIO:
+    """
+    Encode the rows in the text format of COPY FROM STDIN. The missing columns are NULL.
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(
+            "\t".join(encode_copy_value(row.get(column)) for column in columns)
+        )
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+class PostgresqlTableWriter:
+    """
+    Write the flattened tasks of a project to a Postgres table with COPY, in a single
+    transaction committed by finish().
+
+    The methods are blocking: PostgresqlIntegration.push runs them in a thread.
+    """
+
+    def __init__(self, dsn: str, table: str):
+        self.connection = psycopg2.connect(dsn)
+        self.table = table
+        # A full export is written in a staging table, swapped with the table at the end
+        self.staging_table = f"{table[:50]}__export"
+        self.target_table = table
+        self.columns: List[str] = []
+
+    def start_full_export(self) -> None:
+        self.target_table = self.staging_table
+        self.columns = list(EXPORT_COLUMNS.keys())
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}").format(
+                    sql.Identifier(self.staging_table)
+                )
+            )
+            cursor.execute(
+                sql.SQL("CREATE TABLE {} ({})").format(
+                    sql.Identifier(self.staging_table),
+                    sql.SQL(", ").join(
+                        sql.SQL("{} {}").format(
+                            sql.Identifier(column), sql.SQL(column_type)
+                        )
+                        for column, column_type in EXPORT_COLUMNS.items()
+                    ),
+                )
+            )
+
+    def _add_columns(self, cursor, rows: List[dict]) -> None:
+        known_columns = set(self.columns)
+        for row in rows:
+            for column in row.keys():
+                if column in known_columns:
+                    continue
+                cursor.execute(
+                    sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}").format(
+                        sql.Identifier(self.target_table),
+                        sql.Identifier(column),
+                        sql.SQL(EXPORT_COLUMNS.get(column, "TEXT")),
+                    )
+                )
+                self.columns.append(column)
+                known_columns.add(column)
+
+    def write(self, rows: List[dict]) -> None:
+        """
+        Copy the rows to the table.
+        """
+        with self.connection.cursor() as cursor:
+            self._add_columns(cursor, rows)
+            if len(rows) == 0:
+                return
+            copy_query = sql.SQL("COPY {} ({}) FROM STDIN").format(
+                sql.Identifier(self.target_table),
+                sql.SQL(", ").join(sql.Identifier(column) for column in self.columns),
+            )
+            cursor.copy_expert(
+                copy_query.as_string(self.connection),
+                encode_copy_rows(rows, self.columns),
+            )
+
+    def finish(self) -> None:
+        """
+        Swap the staging table of a full export with the table, and commit.
+        """
+        if self.target_table == self.staging_table:
+            with self.connection.cursor() as cursor:
+                cursor.execute(
+                    sql.SQL("DROP TABLE IF EXISTS {}").format(
+                        sql.Identifier(self.table)
+                    )
+                )
+                cursor.execute(
+                    sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                        sql.Identifier(self.staging_table), sql.Identifier(self.table)
+                    )
+                )
+                cursor.execute(
+                    sql.SQL("CREATE INDEX ON {} (task_id)").format(
+                        sql.Identifier(self.table)
+                    )
+                )
+        self.connection.commit()
+
+    def close(self) -> None:
+        # Closing the connection rolls back the transaction if it wasn't committed
+        self.connection.close()
+
 
 class PostgresqlCredentials(BaseModel, extra="allow"):
     org_id: str
@@ -77,6 +239,12 @@ class PostgresqlIntegration:
             raise ValueError("No credentials found")
         return f"{config.SQLDB_CONNECTION_STRING}/{self.credentials.database}"
 
+    def _dsn(self) -> str:
+        # psycopg2 doesn't understand the SQLAlchemy driver suffix
+        return self._connection_string().replace(
+            "postgresql+psycopg2://", "postgresql://"
+        )
+
     async def load_config(self):
         """
         Load the Postgres credentials from MongoDB.
@@ -212,16 +380,55 @@ class PostgresqlIntegration:
 
         return updated_credentials
 
+    async def _iter_task_ids(self, page_size: int) -> AsyncIterator[List[str]]:
+        """
+        Iterate over the ids of the tasks of the project, by pages of page_size tasks,
+        with a keyset on (created_at, id).
+        """
+        mongo_db = await get_mongo_db()
+        query: Dict[str, object] = {"project_id": self.project_id}
+        last_task: Optional[dict] = None
+        while True:
+            page_query = query
+            if last_task is not None:
+                page_query = {
+                    **query,
+                    "$or": [
+                        {"created_at": {"$gt": last_task["created_at"]}},
+                        {
+                            "created_at": last_task["created_at"],
+                            "id": {"$gt": last_task["id"]},
+                        },
+                    ],
+                }
+            tasks = (
+                await mongo_db["tasks"]
+                .find(page_query, {"_id": 0, "id": 1, "created_at": 1})
+                .sort([("created_at", 1), ("id", 1)])
+                .limit(page_size)
+                .to_list(length=page_size)
+            )
+            if len(tasks) == 0:
+                return
+            yield [task["id"] for task in tasks]
+            if len(tasks) < page_size:
+                return
+            last_task = tasks[-1]
+
     async def push(
         self,
-        batch_size: int = 256,
+        page_size: int = config.POSTGRESQL_EXPORT_PAGE_SIZE,
     ) -> Literal["success", "failure"]:
         """
         Export the project to the dedicated Postgres database.
 
-        This replaces the table if it already exists.
+        The table name is the slugified project name. Every export rebuilds the table
+        in a staging table, then swaps it with the previous one. The task created_at
+        comes from the client and the tasks, events and evals can be edited or deleted,
+        so there is no reliable way to only copy what changed since the last export.
 
-        The table name is the slugified project name.
+        The tasks are read from MongoDB by pages, and each page is copied with COPY
+        FROM STDIN while the next page is read. Everything is written in one transaction.
         """
         if self.project_id is None:
             logger.error("No project_id provided")
@@ -246,60 +453,51 @@ class PostgresqlIntegration:
             await self.update_status("finished")
             return "success"
 
-        # Connect to Neon Postgres database, we add asyncpg for async support
-        debug = config.ENVIRONMENT == "test"
+        writer: Optional[PostgresqlTableWriter] = None
+        pending_write: Optional[asyncio.Task] = None
+        nb_rows = 0
         try:
-            engine = create_engine(self._connection_string(), echo=debug)
-            with engine.connect() as connection:
-                logger.debug(
-                    f"Connected to Postgres {self.credentials.server}:{self.credentials.database}"
+            writer = await asyncio.to_thread(
+                PostgresqlTableWriter,
+                self._dsn(),
+                slugify_string(self.project_name),
+            )
+            logger.debug(
+                f"Connected to Postgres {self.credentials.server}:{self.credentials.database}"
+            )
+            await asyncio.to_thread(writer.start_full_export)
+
+            async for task_ids in self._iter_task_ids(page_size):
+                flattened_tasks = await fetch_flattened_tasks(
+                    project_id=self.project_id,
+                    limit=None,
+                    with_events=True,
+                    with_sessions=True,
+                    task_ids=task_ids,
                 )
-                nb_batches = total_nb_tasks // batch_size
-                columns = None
-                for i in range(nb_batches + 1):
-                    logger.debug(
-                        f"Exporting batch {i}/{nb_batches} ({batch_size} tasks)"
-                    )
-                    flattened_tasks = await fetch_flattened_tasks(
-                        project_id=self.project_id,
-                        limit=batch_size,
-                        with_events=True,
-                        with_sessions=True,
-                        pagination=Pagination(page=i, per_page=batch_size),
-                    )
-                    # Convert the list of FlattenedTask to a pandas dataframe
-                    tasks_df = pd.DataFrame(
-                        [task.model_dump() for task in flattened_tasks]
-                    )
-                    # The metadata columns depends on the tasks. To avoid creating a wrong schema, we only create the schema with the first batch
-                    # Then we only keep the columns that are in the first batch
-                    if columns is None:
-                        columns = tasks_df.columns
-                    else:
-                        # Only keep the columns that are in the first batch and remove columns that are not in the first batch
-                        tasks_df = tasks_df[
-                            list(set(columns).intersection(set(tasks_df.columns)))
-                        ]
-                    if_exists_mode = "replace" if i == 0 else "append"
-                    # Note: to_sql is not async, we could use asyncpg directly: https://github.com/MagicStack/asyncpg
-                    pd.DataFrame.to_sql(
-                        tasks_df,
-                        slugify_string(self.project_name),
-                        connection,
-                        if_exists=if_exists_mode,
-                        index=False,
-                    )
-                    logger.debug("Batch uploaded to Postgres")
-
-                connection.close()
-
-            logger.info("Export finished")
+                rows = [task.model_dump() for task in flattened_tasks]
+                nb_rows += len(rows)
+                # Copy this page while the next one is read
+                if pending_write is not None:
+                    await pending_write
+                pending_write = asyncio.create_task(
+                    asyncio.to_thread(writer.write, rows)
+                )
+            if pending_write is not None:
+                await pending_write
+            await asyncio.to_thread(writer.finish)
+            logger.info(f"Export finished: {nb_rows} rows copied")
             await self.update_status("finished")
             return "success"
         except Exception as e:
             logger.error(e)
             await self.update_status("failed")
             return "failure"
+        finally:
+            if pending_write is not None and not pending_write.done():
+                await asyncio.gather(pending_write, return_exceptions=True)
+            if writer is not None:
+                await asyncio.to_thread(writer.close)
 
 
 """
@@ -0,0 +1,119 @@
+"""
+Orchestration of the aggregated metrics of the dashboards.
+
+The metrics of a dashboard are independent aggregations. They run concurrently, with
+at most `max_concurrency` of them at the same time for a request, so that one
+dashboard doesn't take all the connections of the mongo pool.
+
+Each metric has a time budget. If a metric exceeds it, it is cancelled and the other
+metrics are returned anyway, along with the timings of every metric.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import pydantic
+from loguru import logger
+
+from app.core import config
+
+
+class MetricsOrchestrator:
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ):
+        """
+        :param max_concurrency: Max number of metrics computed at the same time.
+            Defaults to config.METRICS_MAX_CONCURRENCY.
+        :param timeout: Time budget of each metric, in seconds.
+            Defaults to config.METRICS_TIMEOUT.
+        """
+        self.max_concurrency = max_concurrency or config.METRICS_MAX_CONCURRENCY
+        self.timeout = timeout if timeout is not None else config.METRICS_TIMEOUT
+        # (names of the metrics, is a group, function, kwargs)
+        self._computations: List[
+            Tuple[List[str], bool, Callable[..., Awaitable[Any]], Dict[str, Any]]
+        ] = []
+        self.timings: Dict[str, Dict[str, object]] = {}
+
+    def add(self, name: str, func: Callable[..., Awaitable[Any]], **kwargs) -> None:
+        """
+        Add a metric computed by `await func(**kwargs)`.
+
+        Pydantic arguments (filters) are copied before the call, so that metrics can't
+        see each other's changes.
+        """
+        self._computations.append(([name], False, func, kwargs))
+
+    def add_group(
+        self,
+        names: List[str],
+        func: Callable[..., Awaitable[Dict[str, Any]]],
+        **kwargs,
+    ) -> None:
+        """
+        Add several metrics computed together by `await func(**kwargs)`, for example
+        with a single $facet pipeline. The function returns a dict {name: value}.
+        """
+        self._computations.append((names, True, func, kwargs))
+
+    @property
+    def is_partial(self) -> bool:
+        return any(timing["status"] != "ok" for timing in self.timings.values())
+
+    async def run(self) -> Dict[str, Any]:
+        """
+        Compute all the metrics. Metrics that exceed their budget are missing from
+        the output. Other errors are raised.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        output: Dict[str, Any] = {}
+
+        async def compute(
+            names: List[str],
+            is_group: bool,
+            func: Callable[..., Awaitable[Any]],
+            kwargs: dict,
+        ) -> None:
+            copied_kwargs = {
+                key: value.model_copy(deep=True)
+                if isinstance(value, pydantic.BaseModel)
+                else value
+                for key, value in kwargs.items()
+            }
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    result = await asyncio.wait_for(
+                        func(**copied_kwargs), timeout=self.timeout
+                    )
+                    status = "ok"
+                except asyncio.TimeoutError:
+                    logger.warning(
+                        f"Metrics {names} exceeded their budget of {self.timeout}s"
+                    )
+                    result = None
+                    status = "timeout"
+                duration_ms = round((time.perf_counter() - start) * 1000, 1)
+
+            for name in names:
+                self.timings[name] = {"status": status, "duration_ms": duration_ms}
+            if status != "ok":
+                return
+            if is_group:
+                for name in names:
+                    output[name] = result.get(name)
+            else:
+                output[names[0]] = result
+
+        await asyncio.gather(
+            *(
+                compute(names, is_group, func, kwargs)
+                for names, is_group, func, kwargs in self._computations
+            )
+        )
+        logger.debug(f"Metrics timings: {self.timings}")
+        return output
@@ -1,3 +1,7 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List
+
+from app.core import config
 from app.db.mongo import get_mongo_db
 from app.security.authorization import get_quota
 from app.services.integrations.postgresql import (
@@ -6,6 +10,7 @@ from app.services.integrations.postgresql import (
 )
 from app.services.mongo.extractor import ExtractorClient
 from app.services.mongo.projects import get_project_by_id
+from app.services.mongo.rollups import ROLLUP_COLLECTIONS, rebuild_rollups
 from loguru import logger
 
 
@@ -18,39 +23,73 @@ async def fetch_projects_to_sync(type: str = "langsmith"):
     return project_ids
 
 
+async def run_for_projects(
+    project_ids: List[str],
+    func: Callable[[str], Awaitable[Any]],
+    max_concurrency: int = config.SYNC_PIPELINE_MAX_CONCURRENCY,
+) -> Dict[str, str]:
+    """
+    Run `await func(project_id)` for all the projects, at most max_concurrency at once.
+    An error in a project doesn't stop the others.
+    Return the status of every project: "ok" or "error"
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    statuses: Dict[str, str] = {}
+
+    async def run(project_id: str) -> None:
+        async with semaphore:
+            try:
+                await func(project_id)
+                statuses[project_id] = "ok"
+            except Exception as e:
+                logger.error(f"Error syncing project {project_id}: {e}")
+                statuses[project_id] = "error"
+
+    await asyncio.gather(*(run(project_id) for project_id in project_ids))
+    return statuses
+
+
+async def sync_langsmith_project(project_id: str) -> None:
+    usage_quota = await get_quota(project_id)
+    extractor_client = ExtractorClient(
+        org_id=usage_quota.org_id,
+        project_id=project_id,
+    )
+    await extractor_client.collect_langsmith_data(
+        langsmith_api_key=None,
+        langsmith_project_name=None,
+        current_usage=usage_quota.current_usage,
+        max_usage=usage_quota.max_usage,
+    )
+
+
 async def run_langsmith_sync_pipeline():
     logger.debug("Running Langsmith synchronisation pipeline")
     projects_ids = await fetch_projects_to_sync(type="langsmith")
-    for project_id in projects_ids:
-        usage_quota = await get_quota(project_id)
-        extractor_client = ExtractorClient(
-            org_id=usage_quota.org_id,
-            project_id=project_id,
-        )
-        await extractor_client.collect_langsmith_data(
-            langsmith_api_key=None,
-            langsmith_project_name=None,
-            current_usage=usage_quota.current_usage,
-            max_usage=usage_quota.max_usage,
-        )
+    await run_for_projects(projects_ids, sync_langsmith_project)
 
     return {"status": "ok"}
 
 
+async def sync_langfuse_project(project_id: str) -> None:
+    usage_quota = await get_quota(project_id)
+    extractor_client = ExtractorClient(org_id=usage_quota.org_id, project_id=project_id)
+    await extractor_client.collect_langfuse_data(
+        langfuse_secret_key=None,
+        langfuse_public_key=None,
+        current_usage=usage_quota.current_usage,
+        max_usage=usage_quota.max_usage,
+    )
+
+
 async def run_langfuse_sync_pipeline():
+    """
+    Sync the Langfuse projects, several at once. Each sync pulls the observations page
+    by page and resumes from the cursor of the project (see the extractor connectors).
+    """
     logger.debug("Running Langfuse synchronisation pipeline")
     projects_ids = await fetch_projects_to_sync(type="langfuse")
-    for project_id in projects_ids:
-        usage_quota = await get_quota(project_id)
-        extractor_client = ExtractorClient(
-            org_id=usage_quota.org_id, project_id=project_id
-        )
-        await extractor_client.collect_langfuse_data(
-            langfuse_secret_key=None,
-            langfuse_public_key=None,
-            current_usage=usage_quota.current_usage,
-            max_usage=usage_quota.max_usage,
-        )
+    await run_for_projects(projects_ids, sync_langfuse_project)
 
     return {"status": "ok"}
 
@@ -79,3 +118,36 @@ async def run_postgresql_sync_pipeline():
                 f"Error running postgresql sync pipeline {integration.get('org_id')}: {e}"
             )
     return {"status": "ok"}
+
+
+async def run_rollups_backfill_pipeline():
+    """
+    Build the analytics rollups of the projects that don't have them yet.
+    """
+    mongo_db = await get_mongo_db()
+    ready_statuses = (
+        await mongo_db["analytics_rollup_status"]
+        .aggregate(
+            [
+                {"$match": {"ready": True}},
+                {"$group": {"_id": "$project_id", "nb_collections": {"$sum": 1}}},
+                {"$match": {"nb_collections": {"$gte": len(ROLLUP_COLLECTIONS)}}},
+            ]
+        )
+        .to_list(length=None)
+    )
+    ready_project_ids = set(status["_id"] for status in ready_statuses)
+    project_ids = await mongo_db["projects"].distinct("id")
+    projects_to_backfill = [
+        project_id for project_id in project_ids if project_id not in ready_project_ids
+    ][: config.ANALYTICS_ROLLUPS_BACKFILL_BATCH]
+    logger.debug(
+        f"Backfilling the analytics rollups of {len(projects_to_backfill)} projects"
+    )
+    for project_id in projects_to_backfill:
+        try:
+            await rebuild_rollups(project_id)
+        except Exception as e:
+            logger.error(f"Error backfilling the rollups of project {project_id}: {e}")
+
+    return {"status": "ok"}
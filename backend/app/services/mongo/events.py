@@ -1,4 +1,4 @@
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from app.db.models import EventDefinition
 from app.db.mongo import get_mongo_db
@@ -263,3 +263,38 @@ async def get_last_event_for_task(
     )
     event = event[0] if event else None
     return event
+
+
+async def get_last_events_for_tasks(
+    project_id: str, task_ids: List[str], event_names: List[str]
+) -> Dict[Tuple[str, str], dict]:
+    """
+    Get the most recent event of each (task_id, event_name) in one query
+    """
+    mongo_db = await get_mongo_db()
+    last_events = (
+        await mongo_db["events"]
+        .aggregate(
+            [
+                {
+                    "$match": {
+                        "project_id": project_id,
+                        "task_id": {"$in": task_ids},
+                        "event_name": {"$in": event_names},
+                    }
+                },
+                {"$sort": {"created_at": -1}},
+                {
+                    "$group": {
+                        "_id": {"task_id": "$task_id", "event_name": "$event_name"},
+                        "event": {"$first": "$$ROOT"},
+                    }
+                },
+            ]
+        )
+        .to_list(length=None)
+    )
+    return {
+        (event["_id"]["task_id"], event["_id"]["event_name"]): event["event"]
+        for event in last_events
+    }
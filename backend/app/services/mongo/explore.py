@@ -22,7 +22,14 @@ import pydantic
 from app.api.platform.models import ABTest, ProjectDataFilters
 from app.db.models import AnalyticsQuery, Eval, FlattenedTask
 from app.db.mongo import get_mongo_db
+from app.services.cache import analytics_cache
+from app.services.metrics import MetricsOrchestrator
 from app.services.mongo.events import get_all_events
+from app.services.mongo.rollups import (
+    merge_analytics_rows,
+    query_rollups,
+    sort_analytics_rows,
+)
 from app.services.mongo.tasks import get_all_tasks
 from app.services.mongo.tasks import (
     get_total_nb_of_tasks,
@@ -211,6 +218,7 @@ async def deprecated_get_dashboard_aggregated_metrics(
     return df_dict
 
 
+@analytics_cache.cached
 async def get_success_rate_per_task_position(
     project_id,
     filters: ProjectDataFilters,
@@ -344,6 +352,7 @@ async def get_success_rate_per_task_position(
     return success_rate_per_message_position_dict
 
 
+@analytics_cache.cached
 async def get_total_success_rate(
     project_id: str,
     filters: ProjectDataFilters,
@@ -387,6 +396,52 @@ async def get_total_success_rate(
     return total_success_rate
 
 
+@analytics_cache.cached
+async def get_total_nb_of_tasks_and_success_rate(
+    project_id: str,
+    filters: ProjectDataFilters,
+) -> Dict[str, object]:
+    """
+    Compute total_nb_tasks and global_success_rate with a single $facet pipeline.
+    Same results as get_total_nb_of_tasks and get_total_success_rate.
+    """
+    mongo_db = await get_mongo_db()
+    main_filter, collection = await task_filtering_pipeline_match(
+        project_id=project_id, filters=filters
+    )
+    pipeline: List[Dict[str, object]] = [
+        {"$match": main_filter},
+        {
+            "$facet": {
+                "total_nb_tasks": [{"$count": "nb_tasks"}],
+                "global_success_rate": [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "global_success_rate": {
+                                "$avg": {
+                                    "$cond": [{"$eq": ["$flag", "success"]}, 1, 0]
+                                }
+                            },
+                        }
+                    },
+                ],
+            }
+        },
+    ]
+    result = await mongo_db[collection].aggregate(pipeline).to_list(length=1)
+    facets = result[0] if len(result) > 0 else {}
+    total_nb_tasks = facets.get("total_nb_tasks", [])
+    global_success_rate = facets.get("global_success_rate", [])
+    return {
+        "total_nb_tasks": total_nb_tasks[0]["nb_tasks"] if total_nb_tasks else None,
+        "global_success_rate": global_success_rate[0]["global_success_rate"]
+        if global_success_rate
+        else None,
+    }
+
+
+@analytics_cache.cached
 async def get_most_detected_tagger_name(
     project_id: str,
     flag: Optional[Literal["success", "failure"]] = None,
@@ -490,29 +545,79 @@ def extract_date_range(filters: dict) -> Tuple[datetime.datetime, datetime.datet
     return start_date, end_date
 
 
+# time dimension -> (pandas frequency, format of the bucket)
+TIME_DIMENSIONS_FREQUENCIES: Dict[str, Tuple[str, str]] = {
+    "minute": ("min", "%Y-%m-%d %H:%M"),
+    "hour": ("h", "%Y-%m-%d %H"),
+    "day": ("D", "%Y-%m-%d"),
+    "month": ("MS", "%Y-%m"),
+}
+
+
 def generate_date_range(
     start_date: datetime.datetime, end_date: datetime.datetime, time_dimension: str
 ) -> List[str]:
-    date_list = []
-    current_date = start_date
-
-    while current_date <= end_date:
-        if time_dimension == "minute":
-            date_list.append(current_date.strftime("%Y-%m-%d %H:%M"))
-            current_date += datetime.timedelta(minutes=1)
-        elif time_dimension == "hour":
-            date_list.append(current_date.strftime("%Y-%m-%d %H"))
-            current_date += datetime.timedelta(hours=1)
-        elif time_dimension == "day":
-            date_list.append(current_date.strftime("%Y-%m-%d"))
-            current_date += datetime.timedelta(days=1)
-        elif time_dimension == "month":
-            date_list.append(current_date.strftime("%Y-%m"))
-            current_date = (
-                current_date.replace(day=1) + datetime.timedelta(days=32)
-            ).replace(day=1)
-
-    return date_list
+    """
+    Generate all the time buckets between start_date and end_date (included), in the
+    format of the time dimension.
+    """
+    frequency, date_format = TIME_DIMENSIONS_FREQUENCIES[time_dimension]
+    start = pd.Timestamp(start_date)
+    if time_dimension == "month":
+        start = start.normalize().replace(day=1)
+    else:
+        start = start.floor(frequency)
+    return (
+        pd.date_range(start=start, end=end_date, freq=frequency)
+        .strftime(date_format)
+        .tolist()
+    )
+
+
+def fill_missing_dates_in_results(
+    result: List[dict],
+    dimensions: List[str],
+    time_dimension: str,
+    all_dates: List[str],
+    max_rows: int,
+) -> Optional[List[dict]]:
+    """
+    Add a row with a value of 0 for every combination of (time bucket, other dimension
+    values) missing from the results. The values of the other dimensions are the ones
+    found in the results.
+
+    Returns None if the filled results would have more than max_rows rows.
+    """
+    # The dimensions with a . are renamed with a _ in the results of the aggregation
+    dimensions = [dimension.replace(".", "_") for dimension in dimensions]
+    df = pd.DataFrame(result, columns=[*dimensions, "value"])
+    other_dimensions = [d for d in dimensions if d != time_dimension]
+
+    levels: List[List[Any]] = [all_dates]
+    for dimension in other_dimensions:
+        values = df[dimension].drop_duplicates().tolist()
+        levels.append(values if len(values) > 0 else [""])
+    nb_rows = math.prod(len(level) for level in levels)
+    if nb_rows > max_rows:
+        return None
+
+    full_index = pd.MultiIndex.from_product(
+        levels, names=[time_dimension, *other_dimensions]
+    ).to_frame(index=False)
+    # A dimension that is None in every row is a float column in one frame and an
+    # object column in the other: they can't be merged without a common type
+    merge_keys = [time_dimension, *other_dimensions]
+    full_index[merge_keys] = full_index[merge_keys].astype(object)
+    df[merge_keys] = df[merge_keys].astype(object)
+    filled_df = full_index.merge(df, on=merge_keys, how="left")
+    values_are_integers = pd.api.types.is_integer_dtype(df["value"]) or df.empty
+    filled_df["value"] = filled_df["value"].fillna(0)
+    if values_are_integers:
+        filled_df["value"] = filled_df["value"].astype(int)
+    filled_df = filled_df[[*dimensions, "value"]].astype(object)
+    # Missing dimensions are returned as None, like mongo does
+    filled_df = filled_df.where(filled_df.notna(), None)
+    return filled_df.to_dict(orient="records")
 
 
 async def run_analytics_query(
@@ -544,9 +649,89 @@ async def run_analytics_query(
 
     If the query is not valid, mongo will raise an hunhandled error.
 
+    Count and sum queries by time bucket are answered from the pre-aggregated rollups
+    when possible (see app.services.mongo.rollups). Only the partial buckets at the
+    edges of the date range are then aggregated from the raw data.
+
     Returns a list of dictionaries.
     """
 
+    rollup_result = None
+    if config.ANALYTICS_ROLLUPS_ENABLED:
+        rollup_result = await query_rollups(query)
+
+    if rollup_result is not None:
+        rollup_rows, edges_filters = rollup_result
+        edges_rows = [
+            await _run_raw_analytics_query(
+                query.model_copy(
+                    update={"filters": edge_filters, "sort": {}, "limit": None}
+                )
+            )
+            for edge_filters in edges_filters
+        ]
+        result = merge_analytics_rows([rollup_rows, *edges_rows], query.dimensions)
+        if query.sort:
+            result = sort_analytics_rows(result, query.sort)
+        if query.limit is not None:
+            result = result[: query.limit]
+    else:
+        result = await _run_raw_analytics_query(query)
+
+    # Fill missing dates with 0
+    if fill_missing_dates:
+        # we select the smallest time dimension for the date range
+        time_dimension = next(
+            (d for d in query.dimensions if d in ["minute", "hour", "day", "month"]),
+            None,
+        )
+        if time_dimension:
+            # Extract date range from filters
+            start_date, end_date = extract_date_range(query.filters)
+            logger.debug(f"Start date: {start_date}, End date: {end_date}")
+
+            if start_date and end_date:
+                # Generate all dates in the range
+                all_dates = generate_date_range(start_date, end_date, time_dimension)
+                logger.debug(f"Generated nb of dates: {len(all_dates)}")
+
+                filled_result = fill_missing_dates_in_results(
+                    result=result,
+                    dimensions=query.dimensions,
+                    time_dimension=time_dimension,
+                    all_dates=all_dates,
+                    max_rows=config.QUERY_MAX_LEN_LIMIT,
+                )
+                if filled_result is not None:
+                    result = filled_result
+                else:
+                    logger.warning(
+                        f"Fill missing dates would return more than {config.QUERY_MAX_LEN_LIMIT} rows for project {query.project_id}. Skipping it."
+                    )
+            else:
+                logger.warning(
+                    f"Fill missing dates is enabled but no start and end filters for project {query.project_id}"
+                )
+
+        else:
+            logger.warning(
+                f"Fill missing dates is enabled but no time dimension found in the query dimensions for project {query.project_id}"
+            )
+
+    # To avoid blocking the backend when sending back a massive list, we limit the number of results to QUERY_MAX_LEN_LIMIT
+    if len(result) >= config.QUERY_MAX_LEN_LIMIT:
+        logger.warning(
+            f"Query returned {len(result)} results for project {query.project_id}. Returning truncated list of size {config.QUERY_MAX_LEN_LIMIT} (the limit)"
+        )
+        result = result[: config.QUERY_MAX_LEN_LIMIT]
+
+    return result
+
+
+async def _run_raw_analytics_query(query: AnalyticsQuery) -> List[dict]:
+    """
+    Run an analytics query by aggregating the raw documents of the collection.
+    """
     mongo_db = await get_mongo_db()
 
     # Let's build the pipeline
@@ -685,69 +870,10 @@ async def run_analytics_query(
     result = (
         await mongo_db[query.collection].aggregate(pipeline).to_list(length=query.limit)
     )
-
-    # Fill missing dates with 0
-    if fill_missing_dates:
-        # we select the smallest time dimension for the date range
-        time_dimension = next(
-            (d for d in query.dimensions if d in ["minute", "hour", "day", "month"]),
-            None,
-        )
-        if time_dimension:
-            # Extract date range from filters
-            start_date, end_date = extract_date_range(query.filters)
-            logger.debug(f"Start date: {start_date}, End date: {end_date}")
-
-            if start_date and end_date:
-                # Generate all dates in the range
-                all_dates = generate_date_range(start_date, end_date, time_dimension)
-                logger.debug(f"Generated nb of dates: {len(all_dates)}")
-
-                # Create a dictionary of existing results
-                result_dict = {
-                    tuple(item[d] for d in query.dimensions): item for item in result
-                }
-
-                # Fill in missing dates with zero values
-                filled_result = []
-                for date in all_dates:
-                    key = tuple(
-                        date if d == time_dimension else "" for d in query.dimensions
-                    )
-                    if key in result_dict:
-                        filled_result.append(result_dict[key])
-                    else:
-                        filled_result.append(
-                            {
-                                **{
-                                    d: (date if d == time_dimension else "")
-                                    for d in query.dimensions
-                                },
-                                "value": 0,
-                            }
-                        )
-
-                result = filled_result
-            else:
-                logger.warning(
-                    f"Fill missing dates is enabled but no start and end filters for project {query.project_id}"
-                )
-
-        else:
-            logger.warning(
-                f"Fill missing dates is enabled but no time dimension found in the query dimensions for project {query.project_id}"
-            )
-
-    # To avoid blocking the backend when sending back a massive list, we limit the number of results to QUERY_MAX_LEN_LIMIT
-    if len(result) >= config.QUERY_MAX_LEN_LIMIT:
-        logger.warning(
-            f"Query returned {len(result)} results for project {query.project_id}. Returning truncated list of size {config.QUERY_MAX_LEN_LIMIT} (the limit)"
-        )
-        result = result[: config.QUERY_MAX_LEN_LIMIT]
-
     return result
 
 
+@analytics_cache.cached
 async def get_nb_of_daily_tasks(
     project_id: str,
     filters: ProjectDataFilters,
@@ -802,6 +928,7 @@ async def get_nb_of_daily_tasks(
     return nb_tasks_per_day[["date", "nb_tasks"]].to_dict(orient="records")
 
 
+@analytics_cache.cached
 async def get_top_taggers_names_and_count(
     project_id: str,
     filters: ProjectDataFilters,
@@ -871,6 +998,7 @@ async def get_top_taggers_names_and_count(
     return result
 
 
+@analytics_cache.cached
 async def get_daily_success_rate(
     project_id: str,
     filters: ProjectDataFilters,
@@ -977,50 +1105,82 @@ async def get_tasks_aggregated_metrics(
         hour=0, minute=0, second=0, microsecond=0
     )
 
-    output: Dict[str, object] = {}
+    orchestrator = MetricsOrchestrator()
 
-    if "total_nb_tasks" in metrics:
-        output["total_nb_tasks"] = await get_total_nb_of_tasks(
-            project_id=project_id, filters=filters
+    if "total_nb_tasks" in metrics and "global_success_rate" in metrics:
+        # Same match stage: computed in a single $facet pipeline
+        orchestrator.add_group(
+            ["total_nb_tasks", "global_success_rate"],
+            get_total_nb_of_tasks_and_success_rate,
+            project_id=project_id,
+            filters=filters,
+        )
+    elif "total_nb_tasks" in metrics:
+        orchestrator.add(
+            "total_nb_tasks",
+            get_total_nb_of_tasks,
+            project_id=project_id,
+            filters=filters,
         )
-    if "global_success_rate" in metrics:
-        output["global_success_rate"] = await get_total_success_rate(
-            project_id=project_id, filters=filters
+    elif "global_success_rate" in metrics:
+        orchestrator.add(
+            "global_success_rate",
+            get_total_success_rate,
+            project_id=project_id,
+            filters=filters,
         )
     if "most_detected_event" in metrics:
-        output["most_detected_event"] = await get_most_detected_tagger_name(
+        orchestrator.add(
+            "most_detected_event",
+            get_most_detected_tagger_name,
             project_id=project_id,
             **filters.model_dump(),
         )
     if "nb_daily_tasks" in metrics:
-        output["nb_daily_tasks"] = await get_nb_of_daily_tasks(
-            project_id=project_id, filters=filters
+        orchestrator.add(
+            "nb_daily_tasks",
+            get_nb_of_daily_tasks,
+            project_id=project_id,
+            filters=filters,
         )
     if "events_ranking" in metrics:
-        output["events_ranking"] = await get_top_taggers_names_and_count(
+        orchestrator.add(
+            "events_ranking",
+            get_top_taggers_names_and_count,
             project_id=project_id,
             limit=5,
             filters=filters,
         )
     if "daily_success_rate" in metrics:
-        output["daily_success_rate"] = await get_daily_success_rate(
+        orchestrator.add(
+            "daily_success_rate",
+            get_daily_success_rate,
             project_id=project_id,
             filters=filters,
         )
     if "success_rate_per_task_position" in metrics:
-        output[
-            "success_rate_per_task_position"
-        ] = await get_success_rate_per_task_position(
-            project_id=project_id, filters=filters
+        orchestrator.add(
+            "success_rate_per_task_position",
+            get_success_rate_per_task_position,
+            project_id=project_id,
+            filters=filters,
         )
     if "date_last_clustering_timestamp" in metrics:
-        output[
-            "date_last_clustering_timestamp"
-        ] = await get_date_last_clustering_timestamp(project_id=project_id)
+        orchestrator.add(
+            "date_last_clustering_timestamp",
+            get_date_last_clustering_timestamp,
+            project_id=project_id,
+        )
     if "last_clustering_composition" in metrics:
-        output["last_clustering_composition"] = await get_last_clustering_composition(
-            project_id=project_id
+        orchestrator.add(
+            "last_clustering_composition",
+            get_last_clustering_composition,
+            project_id=project_id,
         )
+
+    output = await orchestrator.run()
+    if orchestrator.is_partial:
+        output["metrics_timings"] = orchestrator.timings
     return output
 
 
@@ -1078,6 +1238,7 @@ async def get_last_clustering_composition(
     return clusters
 
 
+@analytics_cache.cached
 async def get_total_nb_of_sessions(
     project_id: str,
     filters: Optional[ProjectDataFilters] = None,
@@ -1109,6 +1270,7 @@ async def get_total_nb_of_sessions(
     return total_nb_sessions
 
 
+@analytics_cache.cached
 async def get_global_average_session_length(
     project_id: str,
     filters: Optional[ProjectDataFilters] = None,
@@ -1146,6 +1308,50 @@ async def get_global_average_session_length(
     return global_avg_session_length
 
 
+@analytics_cache.cached
+async def get_total_nb_of_sessions_and_average_length(
+    project_id: str,
+    filters: Optional[ProjectDataFilters] = None,
+) -> Dict[str, object]:
+    """
+    Compute total_nb_sessions and average_session_length with a single $facet pipeline.
+    Same results as get_total_nb_of_sessions and get_global_average_session_length.
+    """
+    mongo_db = await get_mongo_db()
+    global_filters, collection = await session_filtering_pipeline_match(
+        project_id=project_id, filters=filters
+    )
+    pipeline: List[Dict[str, object]] = [
+        {"$match": global_filters},
+        {
+            "$facet": {
+                "total_nb_sessions": [{"$count": "nb_sessions"}],
+                "average_session_length": [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "avg_session_length": {"$avg": "$session_length"},
+                        }
+                    },
+                ],
+            }
+        },
+    ]
+    result = await mongo_db[collection].aggregate(pipeline).to_list(length=1)
+    facets = result[0] if len(result) > 0 else {}
+    total_nb_sessions = facets.get("total_nb_sessions", [])
+    average_session_length = facets.get("average_session_length", [])
+    return {
+        "total_nb_sessions": total_nb_sessions[0]["nb_sessions"]
+        if total_nb_sessions
+        else None,
+        "average_session_length": average_session_length[0]["avg_session_length"]
+        if average_session_length
+        else None,
+    }
+
+
+@analytics_cache.cached
 async def get_last_message_success_rate(
     project_id: str,
     filters: Optional[ProjectDataFilters] = None,
@@ -1216,6 +1422,7 @@ async def get_last_message_success_rate(
     return last_message_success_rate
 
 
+@analytics_cache.cached
 async def get_nb_sessions_per_day(
     project_id: str,
     filters: ProjectDataFilters,
@@ -1288,6 +1495,7 @@ async def get_nb_sessions_per_day(
     return nb_sessions_per_day[["date", "nb_sessions"]].to_dict(orient="records")
 
 
+@analytics_cache.cached
 async def get_nb_sessions_histogram(
     project_id: str,
     filters: Optional[ProjectDataFilters] = None,
@@ -1383,39 +1591,63 @@ async def get_sessions_aggregated_metrics(
         hour=0, minute=0, second=0, microsecond=0
     )
 
-    output: Dict[str, object] = {}
+    orchestrator = MetricsOrchestrator()
 
-    if "total_nb_sessions" in metrics:
-        output["total_nb_sessions"] = await get_total_nb_of_sessions(
+    if "total_nb_sessions" in metrics and "average_session_length" in metrics:
+        # Same match stage: computed in a single $facet pipeline
+        orchestrator.add_group(
+            ["total_nb_sessions", "average_session_length"],
+            get_total_nb_of_sessions_and_average_length,
             project_id=project_id,
             filters=filters,
         )
-    if "average_session_length" in metrics:
-        output["average_session_length"] = await get_global_average_session_length(
+    elif "total_nb_sessions" in metrics:
+        orchestrator.add(
+            "total_nb_sessions",
+            get_total_nb_of_sessions,
+            project_id=project_id,
+            filters=filters,
+        )
+    elif "average_session_length" in metrics:
+        orchestrator.add(
+            "average_session_length",
+            get_global_average_session_length,
             project_id=project_id,
             filters=filters,
         )
     if "last_task_success_rate" in metrics:
-        output["last_task_success_rate"] = await get_last_message_success_rate(
+        orchestrator.add(
+            "last_task_success_rate",
+            get_last_message_success_rate,
             project_id=project_id,
             filters=filters,
         )
     if "nb_sessions_per_day" in metrics:
-        output["nb_sessions_per_day"] = await get_nb_sessions_per_day(
-            project_id=project_id, filters=filters
+        orchestrator.add(
+            "nb_sessions_per_day",
+            get_nb_sessions_per_day,
+            project_id=project_id,
+            filters=filters,
         )
     if "session_length_histogram" in metrics:
-        output["session_length_histogram"] = await get_nb_sessions_histogram(
+        orchestrator.add(
+            "session_length_histogram",
+            get_nb_sessions_histogram,
             project_id=project_id,
             filters=filters,
         )
     if "success_rate_per_task_position" in metrics:
-        output[
-            "success_rate_per_task_position"
-        ] = await get_success_rate_per_task_position(
-            project_id=project_id, quantile_filter=quantile_filter, filters=filters
+        orchestrator.add(
+            "success_rate_per_task_position",
+            get_success_rate_per_task_position,
+            project_id=project_id,
+            quantile_filter=quantile_filter,
+            filters=filters,
         )
 
+    output = await orchestrator.run()
+    if orchestrator.is_partial:
+        output["metrics_timings"] = orchestrator.timings
     return output
 
 
@@ -1837,6 +2069,7 @@ async def compute_session_length_per_metadata(
         return 0, 0.0, 0
 
 
+@analytics_cache.cached
 async def get_success_rate_by_event_name(
     project_id: str,
     filters: Optional[ProjectDataFilters] = None,
@@ -1901,6 +2134,7 @@ async def get_success_rate_by_event_name(
     return result
 
 
+@analytics_cache.cached
 async def get_total_nb_of_detections(
     project_id: str,
     filters: ProjectDataFilters,
@@ -2104,6 +2338,7 @@ async def get_y_pred_y_true(
     return y_pred, y_true
 
 
+@analytics_cache.cached
 async def get_category_distribution(
     project_id: str,
     filters: ProjectDataFilters,
@@ -2173,6 +2408,19 @@ async def get_category_distribution(
     return output
 
 
+# Metrics of get_events_aggregated_metrics that require y_pred and y_true
+EVENTS_PERFORMANCE_METRICS = [
+    "mean_squared_error",
+    "r_squared",
+    "f1_score_binary",
+    "precision_binary",
+    "recall_binary",
+    "f1_score_multiclass",
+    "precision_multiclass",
+    "recall_multiclass",
+]
+
+
 async def get_events_aggregated_metrics(
     project_id: str,
     metrics: Optional[List[str]] = None,
@@ -2184,72 +2432,97 @@ async def get_events_aggregated_metrics(
         metrics = [
             "success_rate_by_event_name",
         ]
-    output: Dict[str, object] = {}
+    orchestrator = MetricsOrchestrator()
     if "success_rate_by_event_name" in metrics:
-        output["success_rate_by_event_name"] = await get_success_rate_by_event_name(
-            project_id=project_id, filters=filters
+        orchestrator.add(
+            "success_rate_by_event_name",
+            get_success_rate_by_event_name,
+            project_id=project_id,
+            filters=filters,
         )
     if "total_nb_events" in metrics:
-        output["total_nb_events"] = await get_total_nb_of_detections(
-            project_id=project_id, filters=filters
+        orchestrator.add(
+            "total_nb_events",
+            get_total_nb_of_detections,
+            project_id=project_id,
+            filters=filters,
         )
     if "category_distribution" in metrics:
         logger.info("Getting category distribution")
-        output["category_distribution"] = await get_category_distribution(
-            project_id=project_id, filters=filters
+        orchestrator.add(
+            "category_distribution",
+            get_category_distribution,
+            project_id=project_id,
+            filters=filters,
         )
 
     # Some metrics require y_pred and y_true
-    performance_metrics = [
-        "mean_squared_error",
-        "r_squared",
-        "f1_score_binary",
-        "precision_binary",
-        "recall_binary",
-        "f1_score_multiclass",
-        "precision_multiclass",
-        "recall_multiclass",
-    ]
-    intersection_metrics = list(set(metrics).intersection(set(performance_metrics)))
+    intersection_metrics = list(
+        set(metrics).intersection(set(EVENTS_PERFORMANCE_METRICS))
+    )
     if filters.event_id is not None and len(intersection_metrics) > 0:
-        y_pred, y_true = await get_y_pred_y_true(
+        orchestrator.add_group(
+            intersection_metrics,
+            get_events_performance_metrics,
             project_id=project_id,
+            metrics=intersection_metrics,
             filters=filters,
         )
-        if y_pred is not None and y_true is not None:
-            if "mean_squared_error" in metrics:
-                output["mean_squared_error"] = mean_squared_error(y_true, y_pred)
-            if "r_squared" in metrics:
-                output["r_squared"] = r2_score(y_true, y_pred)
-            if "f1_score_binary" in metrics:
-                output["f1_score_binary"] = f1_score(y_true, y_pred)
-            if "precision_binary" in metrics:
-                output["precision_binary"] = precision_score(y_true, y_pred)
-            if "recall_binary" in metrics:
-                output["recall_binary"] = recall_score(y_true, y_pred)
-            if "f1_score_multiclass" in metrics:
-                output["f1_score_multiclass"] = f1_score(
-                    y_true, y_pred, average="weighted"
-                )
-            if "precision_multiclass" in metrics:
-                output["precision_multiclass"] = precision_score(
-                    y_true, y_pred, average="weighted"
-                )
-            if "recall_multiclass" in metrics:
-                output["recall_multiclass"] = recall_score(
-                    y_true, y_pred, average="weighted"
-                )
-        else:
-            logger.info(f"No y_pred and y_true found for event {filters.event_id}")
     elif filters.event_id is None and len(intersection_metrics) > 0:
         logger.error(
             f"Event ID is required to compute performance metrics: {intersection_metrics}"
         )
 
+    output = await orchestrator.run()
+    if orchestrator.is_partial:
+        output["metrics_timings"] = orchestrator.timings
     logger.debug(output)
     return output
 
 
+async def get_events_performance_metrics(
+    project_id: str,
+    metrics: List[str],
+    filters: ProjectDataFilters,
+) -> Dict[str, object]:
+    """
+    Compute the performance metrics of an event (see EVENTS_PERFORMANCE_METRICS) by
+    comparing the predictions to the ground truth.
+    """
+    output: Dict[str, object] = {}
+    y_pred, y_true = await get_y_pred_y_true(
+        project_id=project_id,
+        filters=filters,
+    )
+    if y_pred is not None and y_true is not None:
+        if "mean_squared_error" in metrics:
+            output["mean_squared_error"] = mean_squared_error(y_true, y_pred)
+        if "r_squared" in metrics:
+            output["r_squared"] = r2_score(y_true, y_pred)
+        if "f1_score_binary" in metrics:
+            output["f1_score_binary"] = f1_score(y_true, y_pred)
+        if "precision_binary" in metrics:
+            output["precision_binary"] = precision_score(y_true, y_pred)
+        if "recall_binary" in metrics:
+            output["recall_binary"] = recall_score(y_true, y_pred)
+        if "f1_score_multiclass" in metrics:
+            output["f1_score_multiclass"] = f1_score(
+                y_true, y_pred, average="weighted"
+            )
+        if "precision_multiclass" in metrics:
+            output["precision_multiclass"] = precision_score(
+                y_true, y_pred, average="weighted"
+            )
+        if "recall_multiclass" in metrics:
+            output["recall_multiclass"] = recall_score(
+                y_true, y_pred, average="weighted"
+            )
+    else:
+        logger.info(f"No y_pred and y_true found for event {filters.event_id}")
+    return output
+
+
+@analytics_cache.cached
 async def graph_number_of_daily_tasks(project_id: str):
     """
     Graph the number of daily tasks for last week of a project.
@@ -2327,6 +2600,7 @@ async def graph_number_of_daily_tasks(project_id: str):
     return result.to_dict(orient="records")
 
 
+@analytics_cache.cached
 async def get_events_per_day(project_id: str):
     """
     Get the number of events per day for the last week of a project.
@@ -2449,24 +2723,34 @@ async def get_dashboard_aggregated_metrics(
         metrics = [
             "number_of_daily_tasks",
         ]
-    output: Dict[str, object] = {}
+    orchestrator = MetricsOrchestrator()
     if "number_of_daily_tasks" in metrics:
-        output["number_of_daily_tasks"] = await graph_number_of_daily_tasks(
+        orchestrator.add(
+            "number_of_daily_tasks",
+            graph_number_of_daily_tasks,
             project_id=project_id,
         )
     if "events_per_day" in metrics:
-        output["events_per_day"] = await get_events_per_day(project_id=project_id)
+        orchestrator.add(
+            "events_per_day",
+            get_events_per_day,
+            project_id=project_id,
+        )
 
+    output = await orchestrator.run()
+    if orchestrator.is_partial:
+        output["metrics_timings"] = orchestrator.timings
     return output
 
 
 async def fetch_flattened_tasks(
     project_id: str,
-    limit: int = 1000,
+    limit: Optional[int] = 1000,
     with_events: bool = True,
     with_sessions: bool = True,
     pagination: Optional[Pagination] = None,
     with_removed_events: bool = False,
+    task_ids: Optional[List[str]] = None,
 ) -> List[FlattenedTask]:
     """
     Get a flattened representation of the tasks of a project for analytics
@@ -2474,6 +2758,7 @@ async def fetch_flattened_tasks(
     The with_events parameter allows to include the events in the result.
     The with_sessions parameter allows to include the session length in the result.
     The with_removed_events parameter allows to include the removed events in the result ; if with_events is False, this parameter is ignored.
+    The task_ids parameter restricts the result to these tasks. Pass limit=None to get all their rows.
     """
 
     if not with_events and with_removed_events:
@@ -2485,8 +2770,11 @@ async def fetch_flattened_tasks(
     mongo_db = await get_mongo_db()
 
     # Aggregation pipeline
+    match: Dict[str, object] = {"project_id": project_id}
+    if task_ids is not None:
+        match["id"] = {"$in": task_ids}
     pipeline: List[Dict[str, object]] = [
-        {"$match": {"project_id": project_id}},
+        {"$match": match},
     ]
     return_columns = {
         "task_id": "$id",
@@ -2685,7 +2973,7 @@ async def fetch_flattened_tasks(
         )
 
     # Limit
-    else:
+    elif limit is not None:
         pipeline.extend(
             [
                 {"$limit": limit},
@@ -2693,9 +2981,6 @@ async def fetch_flattened_tasks(
         )
 
     # Query Mongo
-    flattened_tasks = (
-        await mongo_db["tasks_with_events"].aggregate(pipeline).to_list(length=limit)
-    )
     if with_events and with_removed_events:
         flattened_tasks = (
             await mongo_db["tasks"].aggregate(pipeline).to_list(length=limit)
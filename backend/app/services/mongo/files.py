@@ -1,7 +1,12 @@
-from typing import List
+import asyncio
+import csv
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import pandas as pd
 from app.api.v2.models.log import LogEvent
+from app.core import config
 from app.core.config import CSV_UPLOAD_MAX_ROWS
 from app.db.models import DatasetRow
 from app.db.mongo import get_mongo_db
@@ -10,7 +15,15 @@ from app.services.mongo.emails import send_quota_exceeded_email
 from app.services.mongo.extractor import ExtractorClient
 from app.utils import generate_uuid
 from loguru import logger
-from pydantic import ValidationError
+from openpyxl import load_workbook
+from pydantic import TypeAdapter, ValidationError
+
+# Columns of the uploaded task files converted to strings
+STRING_COLUMNS = ["input", "output", "session_id", "task_id", "user_id"]
+# Estimated size of the fields of a log event other than its input and output, in bytes
+LOG_EVENT_OVERHEAD_BYTES = 512
+
+log_events_adapter = TypeAdapter(List[LogEvent])
 
 
 async def process_csv_file_as_df(
@@ -75,102 +88,322 @@ async def process_csv_file_as_df(
     )
 
 
-async def process_file_upload_into_log_events(
-    tasks_df: pd.DataFrame, project_id: str, org_id: str
-):
+def normalize_column_name(column: object) -> str:
+    column = str(column).strip().lower()
+    # Rename task_input to input and task_output to output
+    return {"task_input": "input", "task_output": "output"}.get(column, column)
+
+
+def detect_csv_separator(file_path: str) -> str:
     """
-    Used for uploading tasks.
+    Detect the separator of a csv file from its first lines
+    """
+    with open(file_path, newline="", encoding="utf-8", errors="replace") as f:
+        sample = f.read(64 * 1024)
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=",;\t|").delimiter
+    except csv.Error:
+        return ","
 
-    Columns: input, output
 
-    Optional columns: session_id, created_at, task_id, user_id
+def iter_upload_chunks(
+    file_path: str,
+    file_extension: str,
+    chunk_size: int = config.FILE_UPLOAD_CHUNK_ROWS,
+    columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
     """
+    Read an uploaded csv or xlsx file by chunks of chunk_size rows, so that the memory
+    doesn't depend on the size of the file. The column names are normalized.
 
-    # session_id: if provided, concatenate with project_id to avoid collisions
-    if "session_id" in tasks_df.columns:
+    If columns is set, only these (normalized) columns are read.
+    """
+    if file_extension == "csv":
+        reader = pd.read_csv(
+            file_path,
+            sep=detect_csv_separator(file_path),
+            dtype=str,
+            chunksize=chunk_size,
+            on_bad_lines="warn",
+            usecols=(
+                (lambda column: normalize_column_name(column) in columns)
+                if columns is not None
+                else None
+            ),
+        )
+        with reader:
+            for chunk in reader:
+                chunk.columns = [normalize_column_name(c) for c in chunk.columns]
+                yield chunk
+    elif file_extension == "xlsx":
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
         try:
-            unique_sessions = tasks_df["session_id"].unique()
-            # Add a unique identifier to the session_id
-            new_unique_sessions = [
-                f"{project_id}_{session_id}_{generate_uuid()}"
-                for session_id in unique_sessions
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [normalize_column_name(column) for column in next(rows, [])]
+            kept = [
+                index
+                for index, column in enumerate(header)
+                if columns is None or column in columns
             ]
-            unique_sessions_df = pd.DataFrame(
-                {"session_id": unique_sessions, "new_session_id": new_unique_sessions}
+            chunk_rows: List[list] = []
+            for row in rows:
+                chunk_rows.append([row[index] for index in kept])
+                if len(chunk_rows) >= chunk_size:
+                    yield pd.DataFrame(chunk_rows, columns=[header[i] for i in kept])
+                    chunk_rows = []
+            if len(chunk_rows) > 0:
+                yield pd.DataFrame(chunk_rows, columns=[header[i] for i in kept])
+        finally:
+            workbook.close()
+    else:
+        raise NotImplementedError(f"The extension {file_extension} is not supported")
+
+
+def read_upload_columns(file_path: str, file_extension: str) -> List[str]:
+    """
+    The normalized column names of an uploaded file
+    """
+    if file_extension == "csv":
+        return [
+            normalize_column_name(column)
+            for column in pd.read_csv(
+                file_path, sep=detect_csv_separator(file_path), nrows=0
+            ).columns
+        ]
+    chunk = next(iter_upload_chunks(file_path, file_extension, chunk_size=1), None)
+    return list(chunk.columns) if chunk is not None else []
+
+
+def count_upload_rows(file_path: str, file_extension: str) -> Tuple[int, int]:
+    """
+    Count the rows of an uploaded file, and the ones without input (which are dropped).
+    Only the input column is read.
+    """
+    nb_rows = 0
+    nb_rows_without_input = 0
+    for chunk in iter_upload_chunks(file_path, file_extension, columns=["input"]):
+        nb_rows += len(chunk)
+        nb_rows_without_input += int(chunk["input"].isna().sum())
+    return nb_rows, nb_rows_without_input
+
+
+def prepare_tasks_chunk(
+    tasks_df: pd.DataFrame, project_id: str, session_ids: Dict[str, str]
+) -> pd.DataFrame:
+    """
+    Convert a chunk of an uploaded file to log event columns, column by column.
+
+    session_ids maps the session ids of the file to the new session ids: it's shared by
+    all the chunks of a file, so that the tasks of a session stay in the same session.
+    """
+    # Drop rows with missing column "input"
+    tasks_df = tasks_df.dropna(subset=["input"])
+    if len(tasks_df) == 0:
+        return tasks_df
+    tasks_df = tasks_df.copy()
+    for column in STRING_COLUMNS:
+        if column in tasks_df.columns:
+            tasks_df[column] = tasks_df[column].where(
+                tasks_df[column].isna(), tasks_df[column].astype(str)
             )
-            tasks_df = tasks_df.merge(unique_sessions_df, on="session_id", how="left")
-            tasks_df["session_id"] = tasks_df["new_session_id"]
-            tasks_df.drop("new_session_id", axis=1, inplace=True)
 
-        except Exception as e:
-            logger.error(f"Error concatenating session_id: {e}")
-            tasks_df.drop("session_id", axis=1, inplace=True)
+    # session_id: if provided, concatenate with project_id to avoid collisions
+    if "session_id" in tasks_df.columns:
+        for session_id in tasks_df["session_id"].dropna().unique():
+            if session_id not in session_ids:
+                # Add a unique identifier to the session_id
+                session_ids[session_id] = f"{project_id}_{session_id}_{generate_uuid()}"
+        tasks_df["session_id"] = tasks_df["session_id"].map(session_ids)
 
+    uuids = pd.Series(
+        [generate_uuid() for _ in range(len(tasks_df))], index=tasks_df.index
+    )
     if "task_id" in tasks_df.columns:
-        try:
-            tasks_df["task_id"] = tasks_df["task_id"].apply(
-                lambda x: f"{project_id}_{x}_{generate_uuid()}"
-            )
-        except Exception as e:
-            logger.error(f"Error concatenating task_id: {e}")
-            tasks_df.drop("task_id", axis=1, inplace=True)
+        tasks_df["task_id"] = (
+            (project_id + "_" + tasks_df["task_id"] + "_" + uuids)
+            # The missing task ids are generated
+            .fillna(uuids)
+        )
+    else:
+        tasks_df["task_id"] = uuids
+    # Set here rather than by the LogEvent default factories, called row by row
+    tasks_df["client_created_at"] = int(time.time())
 
     # created_at: if provided, convert to datetime, then to timestamp
     if "created_at" in tasks_df.columns:
         try:
-            tasks_df["created_at"] = pd.to_datetime(
-                tasks_df["created_at"], errors="coerce"
+            created_at = pd.to_datetime(
+                tasks_df["created_at"], errors="coerce", utc=True, format="mixed"
             )
-            tasks_df["created_at"] = tasks_df["created_at"].astype(int) // 10**9
-            # Fill NaN values with current timestamp
-            tasks_df["created_at"].fillna(
-                int(pd.Timestamp.now().timestamp()), inplace=True
+            # Fill the missing values with the current timestamp
+            tasks_df["created_at"] = (
+                (created_at.astype("int64") // 10**9)
+                .where(created_at.notna(), int(time.time()))
+                .astype(int)
             )
         except Exception as e:
             logger.error(f"Error converting created_at to timestamp: {e}")
-            tasks_df.drop("created_at", axis=1, inplace=True)
+            tasks_df = tasks_df.drop("created_at", axis=1)
+
+    return tasks_df
+
+
+def build_log_events(tasks_df: pd.DataFrame, project_id: str) -> List[LogEvent]:
+    """
+    Validate the rows of a prepared chunk as log events. The invalid rows are skipped.
+    """
+    # Convert the columns to lists of python values, with None for the missing values
+    columns = list(tasks_df.columns)
+    values = []
+    for column in columns:
+        column_values = tasks_df[column].tolist()
+        missing = tasks_df[column].isna()
+        if missing.any():
+            column_values = [
+                None if is_missing else value
+                for value, is_missing in zip(column_values, missing.tolist())
+            ]
+        values.append(column_values)
+    records = [
+        {
+            "project_id": project_id,
+            **{key: value for key, value in zip(columns, row) if value is not None},
+        }
+        for row in zip(*values)
+    ]
+    try:
+        return log_events_adapter.validate_python(records)
+    except ValidationError as e:
+        invalid_rows = {error["loc"][0] for error in e.errors()}
+        logger.error(
+            f"Error when uploading csv and LogEvent creation: {len(invalid_rows)} invalid rows skipped. {e}"
+        )
+        valid_records = [
+            record for index, record in enumerate(records) if index not in invalid_rows
+        ]
+        return log_events_adapter.validate_python(valid_records)
 
+
+def split_in_batches(
+    log_events: List[LogEvent],
+    max_rows: int = config.FILE_UPLOAD_BATCH_MAX_ROWS,
+    max_bytes: int = config.FILE_UPLOAD_BATCH_MAX_BYTES,
+) -> Iterator[List[LogEvent]]:
+    """
+    Split the log events in batches of at most max_rows events and about max_bytes:
+    the batches of long tasks are smaller.
+    """
+    batch_start = 0
+    batch_bytes = 0
+    for index, log_event in enumerate(log_events):
+        size = (
+            len(log_event.input)
+            + len(log_event.output or "")
+            + LOG_EVENT_OVERHEAD_BYTES
+        )
+        if index > batch_start and (
+            index - batch_start >= max_rows or batch_bytes + size > max_bytes
+        ):
+            yield log_events[batch_start:index]
+            batch_start = index
+            batch_bytes = 0
+        batch_bytes += size
+    if batch_start < len(log_events):
+        yield log_events[batch_start:]
+
+
+async def process_file_upload_into_log_events(
+    file_path: str,
+    file_extension: str,
+    project_id: str,
+    org_id: str,
+    extractor_client: Optional[ExtractorClient] = None,
+) -> int:
+    """
+    Used for uploading tasks.
+
+    Columns: input, output
+
+    Optional columns: session_id, created_at, task_id, user_id
+
+    The file is read by chunks, in a thread, while the previous chunk is sent to the
+    extractor. The file is deleted at the end. Return the number of tasks sent.
+    """
     usage_quota = await get_quota(project_id)
     current_usage = usage_quota.current_usage
     max_usage = usage_quota.max_usage
 
-    extractor_client = ExtractorClient(org_id=org_id, project_id=project_id)
+    if extractor_client is None:
+        extractor_client = ExtractorClient(org_id=org_id, project_id=project_id)
 
-    batch_size = 64
-    for i in range(0, len(tasks_df), batch_size):
-        rows = tasks_df.iloc[i : i + batch_size]
-        try:
-            rows_as_dict = [row.to_dict() for _, row in rows.iterrows()]
-            # Replace NaN values with None
-            rows_as_dict = [
-                {k: v if pd.notnull(v) else None for k, v in row_as_dict.items()}
-                for row_as_dict in rows_as_dict
-            ]
+    session_ids: Dict[str, str] = {}
+    quota_email_sent = False
+    nb_sent = 0
+    nb_rows = 0
+    nb_rows_dropped = 0
 
-            valid_log_events = [
-                LogEvent(project_id=project_id, **row_as_dict)
-                for row_as_dict in rows_as_dict
-            ]
+    def read_next_chunk(chunks: Iterator[pd.DataFrame]) -> Optional[pd.DataFrame]:
+        nonlocal nb_rows, nb_rows_dropped
+        chunk = next(chunks, None)
+        if chunk is None:
+            return None
+        tasks_df = prepare_tasks_chunk(chunk, project_id, session_ids)
+        nb_rows += len(chunk)
+        nb_rows_dropped += len(chunk) - len(tasks_df)
+        return tasks_df
 
-            if max_usage is None or (
-                max_usage is not None
-                and current_usage + len(valid_log_events) - 1 < max_usage
-            ):
-                current_usage += len(valid_log_events)
-                # Send tasks to the extractor
-                await extractor_client.run_process_log_for_tasks(
-                    logs_to_process=valid_log_events,
-                )
-            else:
-                offset = max(0, min(batch_size, max_usage - current_usage))
-
-                extra_logs_to_save = valid_log_events[offset:]
-                valid_log_events = valid_log_events[:offset]
-                logger.warning(f"Max usage quota reached for project: {project_id}")
-                await send_quota_exceeded_email(project_id)
-                await extractor_client.run_process_log_for_tasks(
-                    logs_to_process=valid_log_events,
-                    extra_logs_to_save=extra_logs_to_save,
-                )
-        except ValidationError as e:
-            logger.error(f"Error when uploading csv and LogEvent creation: {e}")
+    next_chunk: Optional[asyncio.Task] = None
+    try:
+        chunks = iter_upload_chunks(file_path, file_extension)
+        next_chunk = asyncio.create_task(asyncio.to_thread(read_next_chunk, chunks))
+        while True:
+            tasks_df = await next_chunk
+            if tasks_df is None:
+                break
+            # Read the next chunk while this one is sent
+            next_chunk = asyncio.create_task(
+                asyncio.to_thread(read_next_chunk, chunks)
+            )
+            if len(tasks_df) == 0:
+                continue
+            log_events = await asyncio.to_thread(build_log_events, tasks_df, project_id)
+            for valid_log_events in split_in_batches(log_events):
+                if max_usage is None or (
+                    current_usage + len(valid_log_events) - 1 < max_usage
+                ):
+                    current_usage += len(valid_log_events)
+                    # Send tasks to the extractor
+                    await extractor_client.run_process_log_for_tasks(
+                        logs_to_process=valid_log_events,
+                    )
+                else:
+                    offset = max(
+                        0, min(len(valid_log_events), max_usage - current_usage)
+                    )
+                    current_usage += offset
+                    extra_logs_to_save = valid_log_events[offset:]
+                    valid_log_events = valid_log_events[:offset]
+                    if not quota_email_sent:
+                        logger.warning(
+                            f"Max usage quota reached for project: {project_id}"
+                        )
+                        await send_quota_exceeded_email(project_id)
+                        quota_email_sent = True
+                    await extractor_client.run_process_log_for_tasks(
+                        logs_to_process=valid_log_events,
+                        extra_logs_to_save=extra_logs_to_save,
+                    )
+                nb_sent += len(valid_log_events)
+    except Exception as e:
+        logger.error(f"Error when processing the uploaded file {file_path}: {e}")
+    finally:
+        if next_chunk is not None:
+            # The thread reading the file can't be cancelled: wait for it
+            await asyncio.gather(next_chunk, return_exceptions=True)
+        os.remove(file_path)
+
+    logger.info(
+        f"Uploaded file processed: {nb_sent} tasks sent for project {project_id}, "
+        + f"{nb_rows} rows read, {nb_rows_dropped} rows dropped without input"
+    )
+    return nb_sent
@@ -21,6 +21,7 @@ from app.security.authentification import propelauth
 from app.services.mongo.explore import fetch_flattened_tasks
 from app.services.mongo.extractor import ExtractorClient
 from app.services.mongo.metadata import fetch_user_metadata
+from app.services.mongo.rollups import increment_rollups
 from app.services.mongo.tasks import (
     get_all_tasks,
     label_sentiment_analysis,
@@ -159,7 +160,15 @@ async def delete_project_related_resources(project_id: str):
     """
     mongo_db = await get_mongo_db()
     # Delete the related collections
-    collections = ["sessions", "tasks", "events", "evals", "logs"]
+    collections = [
+        "sessions",
+        "tasks",
+        "events",
+        "evals",
+        "logs",
+        "analytics_rollups",
+        "analytics_rollup_status",
+    ]
     for collection_name in collections:
         await mongo_db[collection_name].delete_many({"project_id": project_id})
 
@@ -817,6 +826,7 @@ async def populate_default(
         session_ids.append(session.id)
         sessions.append(session.model_dump())
     await mongo_db["sessions"].insert_many(sessions)
+    await increment_rollups("sessions", sessions)
 
     # Add events definitions to the project
 
@@ -909,7 +919,9 @@ async def populate_default(
         validated_event.task = task_pairs.get(validated_event.task_id)
         events.append(validated_event)
         event_pairs[validated_event.event_name] = validated_event
-    await mongo_db["events"].insert_many([event.model_dump() for event in events])
+    events_to_insert = [event.model_dump() for event in events]
+    await mongo_db["events"].insert_many(events_to_insert)
+    await increment_rollups("events", events_to_insert)
 
     # Redefine events on tasks
     for index in range(len(tasks)):
@@ -919,7 +931,9 @@ async def populate_default(
             task.events[number] = event_pairs.get(task.events[number].event_name)
         tasks[index] = task
 
-    await mongo_db["tasks"].insert_many([task.model_dump() for task in tasks])
+    tasks_to_insert = [task.model_dump() for task in tasks]
+    await mongo_db["tasks"].insert_many(tasks_to_insert)
+    await increment_rollups("tasks", tasks_to_insert)
 
     logger.debug(
         f"Populated project {project_id} with event definitions {event_definition_pairs}"
@@ -0,0 +1,409 @@
+"""
+Pre-aggregated time-bucket rollups for the analytics queries.
+
+For every project, the `analytics_rollups` collection stores one document per
+(collection, granularity, time bucket, breakdown value) with:
+- count: the number of documents created in the bucket
+- sums: the sum of some numeric fields that don't change after creation
+
+The rollups are incremented when tasks, sessions and events are inserted (see
+`increment_rollups`, and its twin in the extractor). Projects with data older than the
+rollups are backfilled with `rebuild_rollups`. The rollups of a project are only read
+once they are marked as ready in `analytics_rollup_status`.
+
+Task flags are not part of the rollups: they change after insertion (human evals,
+annotations). Queries broken down by flag use the raw aggregation.
+"""
+
+import datetime
+import math
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from loguru import logger
+from pymongo import UpdateOne
+
+from app.db.models import AnalyticsQuery
+from app.db.mongo import get_mongo_db
+
+# granularity -> (format of $dateToString, size of the bucket in seconds)
+ROLLUP_GRANULARITIES: Dict[str, Tuple[str, int]] = {
+    "minute": ("%Y-%m-%d %H:%M", 60),
+    "hour": ("%Y-%m-%d %H", 3600),
+    "day": ("%Y-%m-%d", 86400),
+}
+
+# collection -> breakdown field and summed fields
+ROLLUP_COLLECTIONS: Dict[str, Dict[str, object]] = {
+    "tasks": {
+        "breakdown": None,
+        "sum_fields": [
+            "metadata.total_tokens",
+            "metadata.prompt_tokens",
+            "metadata.completion_tokens",
+        ],
+    },
+    "sessions": {"breakdown": None, "sum_fields": []},
+    "events": {"breakdown": "event_name", "sum_fields": []},
+}
+
+TIME_DIMENSIONS = ["minute", "hour", "day", "month"]
+
+
+def _get_nested(doc: dict, path: str) -> object:
+    value: object = doc
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compute_rollup_increments(
+    collection: str, docs: Iterable[dict]
+) -> Dict[Tuple[str, str, int, str], Dict[str, float]]:
+    """
+    Group the documents by (project_id, granularity, bucket_start, breakdown) and
+    compute the increments of the counters.
+    """
+    collection_config = ROLLUP_COLLECTIONS[collection]
+    breakdown_field = collection_config["breakdown"]
+    sum_fields: List[str] = collection_config["sum_fields"]  # type: ignore
+
+    increments: Dict[Tuple[str, str, int, str], Dict[str, float]] = defaultdict(
+        lambda: defaultdict(int)
+    )
+    for doc in docs:
+        created_at = doc.get("created_at")
+        project_id = doc.get("project_id")
+        if created_at is None or project_id is None:
+            continue
+        breakdown = ""
+        if breakdown_field is not None:
+            breakdown = str(doc.get(breakdown_field) or "")
+        for granularity, (_, bucket_size) in ROLLUP_GRANULARITIES.items():
+            bucket_start = int(created_at // bucket_size * bucket_size)
+            counters = increments[(project_id, granularity, bucket_start, breakdown)]
+            counters["count"] += 1
+            for field in sum_fields:
+                value = _get_nested(doc, field)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    counters[f"sums.{field}"] += value
+    return increments
+
+
+async def increment_rollups(collection: str, docs: List[dict]) -> None:
+    """
+    Increment the rollups with newly inserted documents of a collection.
+    Errors are logged and not raised: the rollups can be rebuilt with rebuild_rollups.
+    """
+    if collection not in ROLLUP_COLLECTIONS or len(docs) == 0:
+        return
+    increments = compute_rollup_increments(collection, docs)
+    operations = []
+    for (project_id, granularity, bucket_start, breakdown), counters in increments.items():
+        date_format, _ = ROLLUP_GRANULARITIES[granularity]
+        operations.append(
+            UpdateOne(
+                {
+                    "project_id": project_id,
+                    "collection": collection,
+                    "granularity": granularity,
+                    "bucket_start": bucket_start,
+                    "breakdown": breakdown,
+                },
+                {
+                    "$inc": dict(counters),
+                    "$setOnInsert": {
+                        "bucket": datetime.datetime.fromtimestamp(
+                            bucket_start, tz=datetime.timezone.utc
+                        ).strftime(date_format),
+                    },
+                },
+                upsert=True,
+            )
+        )
+    try:
+        mongo_db = await get_mongo_db()
+        await mongo_db["analytics_rollups"].bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.warning(f"Error incrementing the {collection} rollups: {e}")
+
+
+async def rollups_are_ready(project_id: str, collection: str) -> bool:
+    mongo_db = await get_mongo_db()
+    status = await mongo_db["analytics_rollup_status"].find_one(
+        {"project_id": project_id, "collection": collection, "ready": True}
+    )
+    return status is not None
+
+
+async def rebuild_rollups(project_id: str, collection: Optional[str] = None) -> None:
+    """
+    Recompute the rollups of a project from the raw data, then mark them as ready.
+
+    Increments received while the rebuild runs may be counted twice or not at all,
+    so this is meant to be run once when backfilling a project.
+    """
+    mongo_db = await get_mongo_db()
+    collections = [collection] if collection is not None else list(ROLLUP_COLLECTIONS)
+    for collection_name in collections:
+        collection_config = ROLLUP_COLLECTIONS[collection_name]
+        breakdown_field = collection_config["breakdown"]
+        sum_fields: List[str] = collection_config["sum_fields"]  # type: ignore
+
+        await mongo_db["analytics_rollup_status"].update_one(
+            {"project_id": project_id, "collection": collection_name},
+            {"$set": {"ready": False}},
+            upsert=True,
+        )
+        await mongo_db["analytics_rollups"].delete_many(
+            {"project_id": project_id, "collection": collection_name}
+        )
+        for granularity, (date_format, bucket_size) in ROLLUP_GRANULARITIES.items():
+            pipeline: List[Dict[str, object]] = [
+                {"$match": {"project_id": project_id, "created_at": {"$ne": None}}},
+                {
+                    "$group": {
+                        "_id": {
+                            "bucket_start": {
+                                "$subtract": [
+                                    {"$toLong": {"$floor": "$created_at"}},
+                                    {
+                                        "$mod": [
+                                            {"$toLong": {"$floor": "$created_at"}},
+                                            bucket_size,
+                                        ]
+                                    },
+                                ]
+                            },
+                            "breakdown": {
+                                "$ifNull": [f"${breakdown_field}", ""]
+                                if breakdown_field
+                                else ""
+                            },
+                        },
+                        "count": {"$sum": 1},
+                        **{
+                            f"sum_{i}": {"$sum": f"${field}"}
+                            for i, field in enumerate(sum_fields)
+                        },
+                    }
+                },
+                {
+                    "$project": {
+                        "_id": 0,
+                        "project_id": {"$literal": project_id},
+                        "collection": {"$literal": collection_name},
+                        "granularity": {"$literal": granularity},
+                        "bucket_start": "$_id.bucket_start",
+                        "breakdown": "$_id.breakdown",
+                        "bucket": {
+                            "$dateToString": {
+                                "format": date_format,
+                                "date": {
+                                    "$toDate": {"$multiply": ["$_id.bucket_start", 1000]}
+                                },
+                            }
+                        },
+                        "count": 1,
+                        **{
+                            f"sums.{field}": f"$sum_{i}"
+                            for i, field in enumerate(sum_fields)
+                        },
+                    }
+                },
+                {
+                    "$merge": {
+                        "into": "analytics_rollups",
+                        "on": [
+                            "project_id",
+                            "collection",
+                            "granularity",
+                            "bucket_start",
+                            "breakdown",
+                        ],
+                        "whenMatched": "replace",
+                        "whenNotMatched": "insert",
+                    }
+                },
+            ]
+            await mongo_db[collection_name].aggregate(pipeline).to_list(length=None)
+
+        await mongo_db["analytics_rollup_status"].update_one(
+            {"project_id": project_id, "collection": collection_name},
+            {"$set": {"ready": True, "rebuilt_at": int(time.time())}},
+            upsert=True,
+        )
+        logger.info(f"Rebuilt the {collection_name} rollups of project {project_id}")
+
+
+def _get_rollup_granularity(query: AnalyticsQuery) -> Optional[str]:
+    """
+    Returns the granularity of the rollups able to answer the query, or None if the
+    query needs the raw aggregation.
+    """
+    if query.collection not in ROLLUP_COLLECTIONS:
+        return None
+    collection_config = ROLLUP_COLLECTIONS[query.collection]
+
+    if query.aggregation_operation == "sum":
+        if query.aggregation_field not in collection_config["sum_fields"]:  # type: ignore
+            return None
+    elif query.aggregation_operation != "count":
+        return None
+
+    time_dimensions = [d for d in query.dimensions if d in TIME_DIMENSIONS]
+    other_dimensions = [d for d in query.dimensions if d not in TIME_DIMENSIONS]
+    if len(time_dimensions) > 1 or len(set(query.dimensions)) != len(query.dimensions):
+        return None
+    if any(d != collection_config["breakdown"] for d in other_dimensions):
+        return None
+
+    # Only filters on the creation date are supported
+    if any(key != "created_at" for key in (query.filters or {})):
+        return None
+    created_at_filter = (query.filters or {}).get("created_at")
+    if created_at_filter is not None:
+        if not isinstance(created_at_filter, dict):
+            return None
+        for operator, value in created_at_filter.items():
+            if operator not in ["$gte", "$gt", "$lte", "$lt"]:
+                return None
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                return None
+
+    if len(time_dimensions) == 0 or time_dimensions[0] == "month":
+        return "day"
+    return time_dimensions[0]
+
+
+def _get_full_buckets_range(
+    created_at_filter: dict, bucket_size: int
+) -> Tuple[float, float]:
+    """
+    Returns [start, end) such that all the buckets between start and end are fully
+    inside the created_at range of the query.
+    """
+    start: float = -math.inf
+    end: float = math.inf
+    if "$gte" in created_at_filter:
+        start = math.ceil(created_at_filter["$gte"] / bucket_size) * bucket_size
+    if "$gt" in created_at_filter:
+        start = max(
+            start,
+            (math.floor(created_at_filter["$gt"] / bucket_size) + 1) * bucket_size,
+        )
+    if "$lte" in created_at_filter:
+        end = math.floor(created_at_filter["$lte"] / bucket_size) * bucket_size
+    if "$lt" in created_at_filter:
+        end = min(end, math.floor(created_at_filter["$lt"] / bucket_size) * bucket_size)
+    return start, end
+
+
+async def query_rollups(
+    query: AnalyticsQuery,
+) -> Optional[Tuple[List[dict], List[dict]]]:
+    """
+    Answer an analytics query from the rollups.
+
+    Returns None if the query can't be answered with the rollups. Otherwise, returns
+    (rows from the rollups, filters of the edges): the partial buckets at the edges of
+    the date range must be computed from the raw data, using the returned filters.
+    """
+    granularity = _get_rollup_granularity(query)
+    if granularity is None:
+        return None
+    if not await rollups_are_ready(query.project_id, query.collection):
+        return None
+
+    _, bucket_size = ROLLUP_GRANULARITIES[granularity]
+    created_at_filter = (query.filters or {}).get("created_at") or {}
+    start, end = _get_full_buckets_range(created_at_filter, bucket_size)
+    if start >= end:
+        # The range is smaller than a bucket
+        return None
+
+    lower_bounds = {k: v for k, v in created_at_filter.items() if k in ["$gte", "$gt"]}
+    upper_bounds = {k: v for k, v in created_at_filter.items() if k in ["$lte", "$lt"]}
+    edges_filters: List[dict] = []
+    if lower_bounds:
+        edges_filters.append({"created_at": {**lower_bounds, "$lt": start}})
+    if upper_bounds:
+        edges_filters.append({"created_at": {"$gte": end, **upper_bounds}})
+
+    bucket_start_filter: Dict[str, float] = {}
+    if start != -math.inf:
+        bucket_start_filter["$gte"] = start
+    if end != math.inf:
+        bucket_start_filter["$lt"] = end
+    rollup_match: Dict[str, object] = {
+        "project_id": query.project_id,
+        "collection": query.collection,
+        "granularity": granularity,
+    }
+    if bucket_start_filter:
+        rollup_match["bucket_start"] = bucket_start_filter
+
+    group_id: Dict[str, object] = {}
+    for dimension in query.dimensions:
+        if dimension == "month":
+            group_id["month"] = {"$substrBytes": ["$bucket", 0, 7]}
+        elif dimension in TIME_DIMENSIONS:
+            group_id[dimension] = "$bucket"
+        else:
+            group_id[dimension] = "$breakdown"
+    if query.aggregation_operation == "count":
+        value: object = {"$sum": "$count"}
+    else:
+        value = {"$sum": {"$ifNull": [f"$sums.{query.aggregation_field}", 0]}}
+
+    pipeline: List[Dict[str, object]] = [
+        {"$match": rollup_match},
+        {"$group": {"_id": group_id, "value": value}},
+        {
+            "$project": {
+                "_id": 0,
+                **{dimension: f"$_id.{dimension}" for dimension in query.dimensions},
+                "value": 1,
+            }
+        },
+    ]
+    mongo_db = await get_mongo_db()
+    rows = await mongo_db["analytics_rollups"].aggregate(pipeline).to_list(length=None)
+    return rows, edges_filters
+
+
+def merge_analytics_rows(
+    rows_lists: List[List[dict]], dimensions: List[str]
+) -> List[dict]:
+    """
+    Sum the values of rows with the same dimensions
+    """
+    merged: Dict[tuple, dict] = {}
+    for rows in rows_lists:
+        for row in rows:
+            key = tuple(row.get(d) for d in dimensions)
+            if key in merged:
+                merged[key]["value"] += row["value"]
+            else:
+                merged[key] = dict(row)
+    return list(merged.values())
+
+
+def sort_analytics_rows(rows: List[dict], sort: Dict[str, int]) -> List[dict]:
+    """
+    Sort the rows like mongo's $sort would
+    """
+    # Stable sorts, from the last key to the first one
+    for field, direction in reversed(list(sort.items())):
+        rows = sorted(
+            rows,
+            key=lambda row: (
+                row.get(field) is not None,
+                row.get(field) if row.get(field) is not None else 0,
+            ),
+            reverse=direction == -1,
+        )
+    return rows
@@ -1,27 +1,72 @@
-from typing import List, Tuple
+import hashlib
+import re
+from typing import List, Optional, Tuple
 
 import openai
+from app.core import config
 from app.db.models import Session, Task
 from app.db.mongo import get_mongo_db
 from app.db.qdrant import get_qdrant, models
+from app.services.cache import AnalyticsCache, InMemoryLRUBackend
 from loguru import logger
 
 openai_client = openai.AsyncClient()
 
+# Embeddings of the search queries, keyed by normalized text and model.
+# Concurrent searches of the same query share the same embedding call.
+query_embedding_cache = AnalyticsCache(
+    backend=InMemoryLRUBackend(max_size=config.SEARCH_EMBEDDING_CACHE_MAX_SIZE)
+    if config.SEARCH_EMBEDDING_CACHE_MAX_SIZE > 0
+    else None,
+    ttl=config.SEARCH_EMBEDDING_CACHE_TTL,
+)
 
-async def search_tasks_in_project(
+
+def normalize_query(search_query: str) -> str:
+    """
+    Queries that only differ by case or whitespace have the same embedding
+    """
+    return re.sub(r"\s+", " ", search_query).strip().casefold()
+
+
+async def embed_query(
+    search_query: str, model: str = config.SEARCH_EMBEDDING_MODEL
+) -> List[float]:
+    """
+    Embed a search query, from the cache if it was already embedded.
+    Raises openai.APIError if the query can't be embedded.
+    """
+    normalized_query = normalize_query(search_query)
+
+    async def compute() -> List[float]:
+        response = await openai_client.embeddings.create(
+            input=normalized_query, model=model
+        )
+        return response.data[0].embedding
+
+    if not query_embedding_cache.enabled:
+        return await compute()
+    key = "query_embedding:" + hashlib.sha256(
+        f"{model}:{normalized_query}".encode("utf-8")
+    ).hexdigest()
+    return await query_embedding_cache.get_or_compute(key, compute)
+
+
+async def search_task_vectors(
     project_id: str,
     search_query: str,
-) -> List[Task]:
-    mongo_db = await get_mongo_db()
+    limit: int = 5,
+) -> Optional[list]:
+    """
+    The vectors of the tasks of the project closest to the query, best first.
+    None if the vector search is unavailable.
+    """
     qdrant_db = await get_qdrant()
     if qdrant_db is None:
-        return []
+        return None
     # Embed the query
     try:
-        query_embedding = await openai_client.embeddings.create(
-            input=search_query, model="text-embedding-3-small"
-        )
+        query_embedding = await embed_query(search_query)
     except openai.APIError as e:
         # If the query is too short, we can't embed it
         # In this case, we just return an empty list
@@ -29,9 +74,9 @@ async def search_tasks_in_project(
         return []
 
     # Search in the project
-    found_vectors = await qdrant_db.search(
+    return await qdrant_db.search(
         collection_name="tasks",
-        query_vector=query_embedding.data[0].embedding,
+        query_vector=query_embedding,
         query_filter=models.Filter(
             must=[
                 models.FieldCondition(
@@ -39,9 +84,19 @@ async def search_tasks_in_project(
                 )
             ]
         ),
-        limit=5,
+        limit=limit,
         # score_threshold=0.5,
     )
+
+
+async def search_tasks_in_project(
+    project_id: str,
+    search_query: str,
+) -> List[Task]:
+    mongo_db = await get_mongo_db()
+    found_vectors = await search_task_vectors(project_id, search_query)
+    if found_vectors is None:
+        return []
     foud_vectors_mapping = {
         vector.payload.get("task_id"): vector
         for vector in found_vectors
@@ -1,7 +1,9 @@
 from typing import Dict, List, Literal, Optional, Tuple, cast
 
 from app.db.models import Event, EventDefinition, Project, Session, Task
+from app.db.indexes import sample_query_shape
 from app.db.mongo import get_mongo_db
+from app.services.mongo.rollups import increment_rollups
 from app.services.mongo.tasks import task_filtering_pipeline_match
 from fastapi import HTTPException
 from loguru import logger
@@ -20,6 +22,7 @@ async def create_session(
     mongo_db = await get_mongo_db()
     new_session = Session(project_id=project_id, org_id=org_id, data=data)
     mongo_db["sessions"].insert_one(new_session.model_dump())
+    await increment_rollups("sessions", [new_session.model_dump()])
     return new_session
 
 
@@ -374,6 +377,7 @@ async def add_event_to_session(
         score_range=score_range,
     )
     _ = await mongo_db["events"].insert_one(detected_event_data.model_dump())
+    await increment_rollups("events", [detected_event_data.model_dump()])
 
     if session.events is None:
         session.events = []
@@ -542,4 +546,7 @@ async def session_filtering_pipeline_match(
                 )
             match["id"] = {"$in": new_sessions_ids}
 
+    if collection == "sessions":
+        sample_query_shape(collection, project_id, match)
+
     return match, collection
@@ -6,7 +6,10 @@ from phospho.utils import filter_nonjsonable_keys
 
 import pydantic
 from app.db.models import Eval, EventDefinition, Task, Event
+from app.db.indexes import sample_query_shape
 from app.db.mongo import get_mongo_db
+from app.services.cache import bump_project_data_version
+from app.services.mongo.rollups import increment_rollups
 from fastapi import HTTPException
 
 from app.utils import generate_uuid
@@ -47,6 +50,7 @@ async def create_task(
     doc_creation = await mongo_db["tasks"].insert_one(task_data.model_dump())
     if not doc_creation:
         raise Exception("Failed to insert the task in database")
+    await increment_rollups("tasks", [task_data.model_dump()])
     return task_data
 
 
@@ -157,6 +161,8 @@ async def human_eval_task(
             detail=f"Failed to update Session {task_model.session_id}: {e}",
         )
 
+    # The flag changed: invalidate the cached analytics of the project
+    await bump_project_data_version(task_model.project_id)
     return task_model
 
 
@@ -206,6 +212,8 @@ async def update_task(
             status_code=500, detail=f"Failed to update Task {task_model.id}: {e}"
         )
 
+    # Invalidate the cached analytics of the project
+    await bump_project_data_version(task_model.project_id)
     return task_model
 
 
@@ -260,6 +268,8 @@ async def add_event_to_task(
         score_range=score_range,
     )
     await mongo_db["events"].insert_one(detected_event_data.model_dump())
+    await increment_rollups("events", [detected_event_data.model_dump()])
+    await bump_project_data_version(task.project_id)
 
     if task.events is None:
         task.events = []
@@ -287,6 +297,7 @@ async def remove_event_from_task(task: Task, event_name: str) -> Task:
         )
         # Remove the event from the task
         task.events = [e for e in task.events if e.event_name != event_name]
+        await bump_project_data_version(task.project_id)
 
     return task
 
@@ -423,6 +434,9 @@ async def task_filtering_pipeline_match(
     if filters.sessions_ids is not None:
         match[f"{prefix}session_id"] = {"$in": filters.sessions_ids}
 
+    if prefix == "" and collection == "tasks":
+        sample_query_shape(collection, project_id, match)
+
     return match, collection
 
 
@@ -0,0 +1,104 @@
+"""
+Benchmark of the upload of a task file, against the previous row by row upload.
+
+The extractor is replaced by a fake client with a fixed latency per submission.
+Run from the backend folder: python -m scripts.benchmark_file_upload
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+
+import pandas as pd
+from loguru import logger
+
+import app.services.mongo.files as files
+from app.api.v2.models.log import LogEvent
+
+NB_ROWS = 1_000_000
+ROUND_TRIP_LATENCY = 0.002  # Latency of a workflow submission, in seconds
+
+
+class FakeExtractorClient:
+    def __init__(self):
+        self.nb_calls = 0
+        self.nb_logs = 0
+
+    async def run_process_log_for_tasks(
+        self,
+        logs_to_process: List[LogEvent],
+        extra_logs_to_save: Optional[List[LogEvent]] = None,
+    ) -> None:
+        # Serialize the payload and submit it, like the real client
+        [log_event.model_dump(mode="json") for log_event in logs_to_process]
+        await asyncio.sleep(ROUND_TRIP_LATENCY)
+        self.nb_calls += 1
+        self.nb_logs += len(logs_to_process)
+
+
+async def legacy_upload(tasks_df: pd.DataFrame, extractor_client) -> None:
+    """
+    The previous upload: row by row, by batches of 64 tasks
+    """
+    batch_size = 64
+    for i in range(0, len(tasks_df), batch_size):
+        rows = tasks_df.iloc[i : i + batch_size]
+        rows_as_dict = [row.to_dict() for _, row in rows.iterrows()]
+        rows_as_dict = [
+            {k: v if pd.notnull(v) else None for k, v in row_as_dict.items()}
+            for row_as_dict in rows_as_dict
+        ]
+        await extractor_client.run_process_log_for_tasks(
+            logs_to_process=[
+                LogEvent(project_id="project", **row_as_dict)
+                for row_as_dict in rows_as_dict
+            ]
+        )
+
+
+async def main() -> None:
+    async def get_quota(project_id: str):
+        return SimpleNamespace(current_usage=0, max_usage=None)
+
+    files.get_quota = get_quota
+
+    tasks_df = pd.DataFrame(
+        {
+            "Input": [f"What is the price of plan {i}?" for i in range(NB_ROWS)],
+            "Output": [f"Plan {i} costs {i % 100} dollars." for i in range(NB_ROWS)],
+            "session_id": [f"session_{i // 10}" for i in range(NB_ROWS)],
+            "user_id": [f"user_{i % 1000}" for i in range(NB_ROWS)],
+        }
+    )
+    file_path = os.path.join(tempfile.mkdtemp(), "tasks.csv")
+    tasks_df.to_csv(file_path, index=False)
+
+    # Before: measured on the first rows, as it's slow
+    legacy_client = FakeExtractorClient()
+    legacy_df = tasks_df.head(20_000).rename(columns=str.lower)
+    start = time.perf_counter()
+    await legacy_upload(legacy_df, legacy_client)
+    legacy_rows_per_second = len(legacy_df) / (time.perf_counter() - start)
+
+    extractor_client = FakeExtractorClient()
+    start = time.perf_counter()
+    nb_sent = await files.process_file_upload_into_log_events(
+        file_path=file_path,
+        file_extension="csv",
+        project_id="project",
+        org_id="org",
+        extractor_client=extractor_client,
+    )
+    rows_per_second = nb_sent / (time.perf_counter() - start)
+    logger.info(
+        f"Upload of {NB_ROWS} rows: {legacy_rows_per_second:.0f} rows/s before, "
+        + f"{rows_per_second:.0f} rows/s after, {extractor_client.nb_calls} extractor calls "
+        + f"(before: {NB_ROWS // 64 + 1})"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+from loguru import logger
+
+from app.api.platform.models.integrations import DatasetSamplingParameters
+from app.db.models import Event, EventDefinition, Project, Task
+from app.services.integrations.argilla import (
+    add_records_in_batches,
+    apply_dataset_annotations,
+    sample_tasks,
+)
+from phospho.models import ProjectSettings
+
+REQUEST_LATENCY = 0.05  # Latency of a request to the Argilla server, in seconds
+
+
+class StandInRemoteDataset:
+    """
+    A local stand-in for a dataset pushed to Argilla
+    """
+
+    def __init__(self):
+        self.records = []
+        self.requests = 0
+
+    def add_records(self, records, show_progress: bool = True):
+        self.requests += 1
+        time.sleep(REQUEST_LATENCY)
+        self.records.extend(records)
+
+
+@pytest.mark.asyncio
+async def test_add_records_in_batches():
+    dataset = StandInRemoteDataset()
+    records = [{"task_id": f"task_{index}"} for index in range(50_000)]
+
+    start = time.perf_counter()
+    await add_records_in_batches(dataset, records, batch_size=1000, max_concurrency=4)
+    duration = time.perf_counter() - start
+    logger.info(f"Pushed {len(records)} records in {duration:.2f}s")
+
+    assert dataset.requests == 50
+    assert sorted(record["task_id"] for record in dataset.records) == sorted(
+        record["task_id"] for record in records
+    )
+    # The batches are sent a few at once
+    assert duration < 50 * REQUEST_LATENCY / 2
+
+
+def test_sample_tasks_balanced():
+    event_definition = EventDefinition(
+        project_id="project", event_name="question", description="A question"
+    )
+    tasks = []
+    for index in range(1000):
+        task = Task(project_id="project", input=f"input {index}")
+        if index % 10 == 0:
+            task.events = [
+                Event(
+                    event_name="question",
+                    task_id=task.id,
+                    project_id="project",
+                    source="phospho",
+                    event_definition=event_definition,
+                )
+            ]
+        tasks.append(task)
+
+    sampled_tasks = sample_tasks(
+        tasks,
+        DatasetSamplingParameters(sampling_type="balanced"),
+        labels=["no-tag", "question"],
+    )
+    assert len(sampled_tasks) == 200
+    assert sum(1 for task in sampled_tasks if len(task.events) > 0) == 100
+    # The order of the tasks is kept
+    assert sampled_tasks == sorted(sampled_tasks, key=tasks.index)
+
+    naive_tasks = sample_tasks(tasks, DatasetSamplingParameters(sampling_type="naive"))
+    assert naive_tasks == tasks
+
+
+@pytest.mark.asyncio
+async def test_apply_dataset_annotations(db, org_id):
+    question = EventDefinition(
+        org_id=org_id, event_name="question", description="The user asks a question"
+    )
+    greeting = EventDefinition(
+        org_id=org_id, event_name="greeting", description="The user says hello"
+    )
+    project = Project(
+        org_id=org_id,
+        project_name="argilla",
+        settings=ProjectSettings(events={"question": question, "greeting": greeting}),
+    )
+    nb_tasks = 10_000
+    task_ids = [f"{project.id}_{index}" for index in range(nb_tasks)]
+    # Every task has a question event
+    await db["events"].insert_many(
+        [
+            Event(
+                event_name="question",
+                task_id=task_id,
+                project_id=project.id,
+                source="phospho",
+                event_definition=question,
+            ).model_dump()
+            for task_id in task_ids
+        ]
+    )
+
+    def record(index: int, task_id: str):
+        # Even tasks are annotated with both events, odd tasks with none
+        taggers = ["question", "greeting"] if index % 2 == 0 else []
+        return SimpleNamespace(
+            metadata={"task_id": task_id},
+            responses=[
+                SimpleNamespace(values={"taggers": SimpleNamespace(value=taggers)})
+            ],
+        )
+
+    argilla_dataset = SimpleNamespace(
+        metadata_properties=[
+            SimpleNamespace(name="org_id", values=[org_id]),
+            SimpleNamespace(name="project_id", values=[project.id]),
+            SimpleNamespace(name="question", values=[question.id]),
+            SimpleNamespace(name="greeting", values=[greeting.id]),
+        ],
+        questions=[
+            SimpleNamespace(
+                name="taggers",
+                labels={
+                    "no-tag": "No tag",
+                    "question": "question",
+                    "greeting": "greeting",
+                },
+            ),
+            SimpleNamespace(name="comment"),
+        ],
+        records=[record(index, task_id) for index, task_id in enumerate(task_ids)]
+        # A record without annotation is skipped
+        + [SimpleNamespace(metadata={"task_id": "not_annotated"}, responses=[])],
+    )
+
+    start = time.perf_counter()
+    nb_operations = await apply_dataset_annotations(
+        project, argilla_dataset, batch_size=2000
+    )
+    duration = time.perf_counter() - start
+    logger.info(f"Applied the annotations of {nb_tasks} records in {duration:.2f}s")
+
+    assert nb_operations == nb_tasks + nb_tasks // 2
+    events = db["events"]
+    query = {"project_id": project.id}
+    assert await events.count_documents(
+        {**query, "event_name": "question", "confirmed": True}
+    ) == (nb_tasks // 2)
+    assert await events.count_documents(
+        {**query, "event_name": "question", "removed": True}
+    ) == (nb_tasks // 2)
+    assert await events.count_documents(
+        {**query, "event_name": "greeting", "source": "owner"}
+    ) == (nb_tasks // 2)
+
+    await events.delete_many(query)
+    await db["analytics_rollups"].delete_many(query)
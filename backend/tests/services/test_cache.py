@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from loguru import logger
+
+from app.services.cache import (
+    AnalyticsCache,
+    InMemoryLRUBackend,
+    analytics_cache,
+    bump_project_data_version,
+)
+from app.services.mongo.explore import get_total_success_rate
+from phospho.models import ProjectDataFilters
+
+
+@pytest.mark.asyncio
+async def test_analytics_cache(db, populated_project):
+    async for mongo_db in db:
+        test_project_id = populated_project.id
+        filters = ProjectDataFilters(flag="success")
+
+        misses = analytics_cache.misses
+        hits = analytics_cache.hits
+
+        # First call computes the result, the second one is served from the cache
+        first_result = await get_total_success_rate(
+            project_id=test_project_id, filters=filters
+        )
+        second_result = await get_total_success_rate(
+            project_id=test_project_id, filters=filters
+        )
+        logger.debug(f"Cache stats: {analytics_cache.get_stats()}")
+
+        assert first_result == second_result
+        assert analytics_cache.misses == misses + 1
+        assert analytics_cache.hits == hits + 1
+        # The filters of the caller are left untouched
+        assert filters.flag == "success"
+
+        # A write from the extractor invalidates the cached results
+        await bump_project_data_version(test_project_id)
+        await get_total_success_rate(project_id=test_project_id, filters=filters)
+        assert analytics_cache.misses == misses + 2
+
+
+@pytest.mark.asyncio
+async def test_analytics_cache_cancelled_caller():
+    cache = AnalyticsCache(backend=InMemoryLRUBackend(), ttl=60)
+    calls = []
+
+    async def compute():
+        calls.append("compute")
+        await asyncio.sleep(0.1)
+        return "value"
+
+    first = asyncio.create_task(cache.get_or_compute("key", compute))
+    second = asyncio.create_task(cache.get_or_compute("key", compute))
+    await asyncio.sleep(0.01)
+    # The first caller times out: the second one still gets the result
+    first.cancel()
+    assert await second == "value"
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    assert await cache.get_or_compute("key", compute) == "value"
+    assert calls == ["compute"]
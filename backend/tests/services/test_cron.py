@@ -0,0 +1,85 @@
+import asyncio
+import time
+import tracemalloc
+from typing import Dict, Iterator, List
+
+import pytest
+from loguru import logger
+
+from app.services.mongo.cron import run_for_projects
+
+NB_PROJECTS = 100
+NB_PAGES = 5
+PAGE_SIZE = 100
+PAGE_LATENCY = 0.01  # Latency of the Langfuse API, in seconds
+
+
+class FakeLangfusePageSource:
+    """
+    The observations of a project, returned page by page after PAGE_LATENCY
+    """
+
+    def __init__(self, project_id: str):
+        self.project_id = project_id
+
+    def pages(self) -> Iterator[List[dict]]:
+        for page in range(NB_PAGES):
+            yield [
+                {
+                    "id": f"{self.project_id}_{page}_{index}",
+                    "input": "x" * 500,
+                    "output": "y" * 500,
+                }
+                for index in range(PAGE_SIZE)
+            ]
+
+    async def sync(self, synced: Dict[str, int]) -> None:
+        for page in self.pages():
+            await asyncio.sleep(PAGE_LATENCY)
+            synced[self.project_id] = synced.get(self.project_id, 0) + len(page)
+
+
+async def run_sync(max_concurrency: int):
+    synced: Dict[str, int] = {}
+
+    async def sync_project(project_id: str) -> None:
+        if project_id == "project_13":
+            raise ValueError("Invalid Langfuse credentials")
+        await FakeLangfusePageSource(project_id).sync(synced)
+
+    project_ids = [f"project_{index}" for index in range(NB_PROJECTS)]
+    tracemalloc.start()
+    start = time.perf_counter()
+    statuses = await run_for_projects(
+        project_ids, sync_project, max_concurrency=max_concurrency
+    )
+    duration = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return synced, statuses, duration, peak_memory
+
+
+@pytest.mark.asyncio
+async def test_sync_pipeline_fan_out():
+    sequential = await run_sync(max_concurrency=1)
+    concurrent = await run_sync(max_concurrency=10)
+    logger.info(
+        f"Sync of {NB_PROJECTS} projects: sequential {sequential[2]:.2f}s, "
+        + f"{sequential[3] / 1e6:.1f}MB, 10 workers {concurrent[2]:.2f}s, "
+        + f"{concurrent[3] / 1e6:.1f}MB"
+    )
+
+    for synced, statuses, _, _ in [sequential, concurrent]:
+        # The failing project doesn't stop the others
+        assert statuses["project_13"] == "error"
+        assert sum(status == "ok" for status in statuses.values()) == NB_PROJECTS - 1
+        assert all(
+            nb_observations == NB_PAGES * PAGE_SIZE
+            for nb_observations in synced.values()
+        )
+
+    # The wall time shrinks with the number of workers
+    assert concurrent[2] < sequential[2] / 5
+    # At most one page per worker is in memory
+    page_memory = PAGE_SIZE * 1200
+    assert concurrent[3] < 10 * page_memory * 2
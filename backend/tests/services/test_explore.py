@@ -1,3 +1,5 @@
+import datetime
+
 import pytest
 from loguru import logger
 
@@ -8,6 +10,8 @@ from app.services.mongo.explore import (
     compute_successrate_metadata_quantiles,
     compute_nb_items_with_metadata_field,
     compute_session_length_per_metadata,
+    fill_missing_dates_in_results,
+    generate_date_range,
 )
 
 
@@ -84,3 +88,61 @@ async def test_main_pipeline(db, populated_project):
         assert isinstance(average, float)
         assert isinstance(top_quantile, float)
         # assert bottom_quantile <= average <= top_quantile
+
+
+def test_fill_missing_dates():
+    all_dates = generate_date_range(
+        datetime.datetime(2024, 1, 30, 12, 30),
+        datetime.datetime(2024, 2, 1, 8, 0),
+        "day",
+    )
+    assert all_dates == ["2024-01-30", "2024-01-31", "2024-02-01"]
+
+    result = [
+        {"day": "2024-01-31", "flag": "success", "value": 3},
+        {"day": "2024-01-30", "flag": "failure", "value": 1},
+    ]
+    filled_result = fill_missing_dates_in_results(
+        result, ["day", "flag"], "day", all_dates, max_rows=100
+    )
+    logger.debug(f"Filled result: {filled_result}")
+    # Every (day, flag) combination is present
+    assert len(filled_result) == 6
+    assert {"day": "2024-02-01", "flag": "success", "value": 0} in filled_result
+    assert {"day": "2024-01-31", "flag": "success", "value": 3} in filled_result
+
+    # Too many rows
+    assert (
+        fill_missing_dates_in_results(result, ["day", "flag"], "day", all_dates, 5)
+        is None
+    )
+
+    # The dotted dimensions are renamed with a _ by the aggregation
+    result = [
+        {"day": "2024-01-31", "metadata_user_id": "alice", "value": 2},
+    ]
+    filled_result = fill_missing_dates_in_results(
+        result, ["day", "metadata.user_id"], "day", all_dates, max_rows=100
+    )
+    assert len(filled_result) == 3
+    assert {
+        "day": "2024-01-31",
+        "metadata_user_id": "alice",
+        "value": 2,
+    } in filled_result
+    assert {
+        "day": "2024-02-01",
+        "metadata_user_id": "alice",
+        "value": 0,
+    } in filled_result
+
+    # A dimension that is None in every row, like the flag of unflagged tasks
+    result = [{"day": "2024-01-30", "flag": None, "value": 3}]
+    filled_result = fill_missing_dates_in_results(
+        result, ["day", "flag"], "day", all_dates, max_rows=100
+    )
+    assert filled_result == [
+        {"day": "2024-01-30", "flag": None, "value": 3},
+        {"day": "2024-01-31", "flag": None, "value": 0},
+        {"day": "2024-02-01", "flag": None, "value": 0},
+    ]
@@ -0,0 +1,111 @@
+import os
+import time
+from types import SimpleNamespace
+from typing import List, Optional
+
+import pandas as pd
+import pytest
+
+import app.services.mongo.files as files
+from app.api.v2.models.log import LogEvent
+
+NB_ROWS = 10_000
+
+
+class FakeExtractorClient:
+    def __init__(self):
+        self.nb_calls = 0
+        self.nb_logs = 0
+
+    async def run_process_log_for_tasks(
+        self,
+        logs_to_process: List[LogEvent],
+        extra_logs_to_save: Optional[List[LogEvent]] = None,
+    ) -> None:
+        self.nb_calls += 1
+        self.nb_logs += len(logs_to_process)
+
+
+def test_prepare_tasks_chunk():
+    session_ids = {}
+    chunks = [
+        pd.DataFrame(
+            {
+                "input": ["hello", None, "how are you?"],
+                "output": ["hi", "dropped", None],
+                "session_id": ["a", "a", "b"],
+                "created_at": ["2024-05-01 10:00:00", None, "not a date"],
+            }
+        ),
+        pd.DataFrame({"input": ["bye"], "output": ["see you"], "session_id": ["a"]}),
+    ]
+    prepared = [
+        files.prepare_tasks_chunk(chunk, "project", session_ids) for chunk in chunks
+    ]
+    # The rows without input are dropped
+    assert len(prepared[0]) == 2
+    # The sessions are kept across chunks
+    assert prepared[1]["session_id"].iloc[0] == prepared[0]["session_id"].iloc[0]
+    assert prepared[0]["session_id"].iloc[0].startswith("project_a_")
+    assert prepared[0]["created_at"].iloc[0] == 1714557600
+    # The invalid dates are the current timestamp
+    assert abs(prepared[0]["created_at"].iloc[1] - time.time()) < 60
+
+    log_events = files.build_log_events(prepared[0], "project")
+    assert [log_event.input for log_event in log_events] == ["hello", "how are you?"]
+    assert log_events[1].output is None
+
+
+def test_split_in_batches():
+    log_events = [LogEvent(input="short", output="short") for _ in range(100)] + [
+        LogEvent(input="x" * 100_000, output="long") for _ in range(20)
+    ]
+    batches = list(files.split_in_batches(log_events, max_rows=50, max_bytes=500_000))
+    assert sum(len(batch) for batch in batches) == 120
+    assert [len(batch) for batch in batches[:2]] == [50, 50]
+    # The batches of long tasks are smaller
+    assert all(len(batch) <= 4 for batch in batches[2:])
+
+
+@pytest.mark.asyncio
+async def test_process_file_upload_into_log_events(tmp_path, monkeypatch):
+    async def get_quota(project_id: str):
+        return SimpleNamespace(current_usage=0, max_usage=None)
+
+    read_chunks = files.iter_upload_chunks
+
+    def iter_upload_chunks(file_path: str, file_extension: str, **kwargs):
+        return read_chunks(file_path, file_extension, chunk_size=1000, **kwargs)
+
+    monkeypatch.setattr(files, "get_quota", get_quota)
+    monkeypatch.setattr(files, "iter_upload_chunks", iter_upload_chunks)
+
+    tasks_df = pd.DataFrame(
+        {
+            # One row in 10 has no input
+            "Input": [
+                f"What is the price of plan {i}?" if i % 10 != 0 else None
+                for i in range(NB_ROWS)
+            ],
+            "Output": [f"Plan {i} costs {i % 100} dollars." for i in range(NB_ROWS)],
+            "session_id": [f"session_{i // 10}" for i in range(NB_ROWS)],
+        }
+    )
+    file_path = str(tmp_path / "tasks.csv")
+    tasks_df.to_csv(file_path, index=False)
+    # The upload endpoint returns the number of rows, and of rows without input
+    assert files.count_upload_rows(file_path, "csv") == (NB_ROWS, NB_ROWS // 10)
+
+    extractor_client = FakeExtractorClient()
+    nb_sent = await files.process_file_upload_into_log_events(
+        file_path=file_path,
+        file_extension="csv",
+        project_id="project",
+        org_id="org",
+        extractor_client=extractor_client,
+    )
+    assert nb_sent == NB_ROWS * 9 // 10
+    assert extractor_client.nb_logs == nb_sent
+    # One extractor call per chunk, instead of one per 64 rows
+    assert extractor_client.nb_calls == NB_ROWS // 1000
+    assert not os.path.exists(file_path)
@@ -0,0 +1,36 @@
+import pytest
+from loguru import logger
+
+from app.db.indexes import (
+    INDEXES,
+    _suggest_index_for_shape,
+    apply_index_migrations,
+    get_query_shape,
+)
+from app.services.mongo.tasks import task_filtering_pipeline_match
+from phospho.models import ProjectDataFilters
+
+
+@pytest.mark.asyncio
+async def test_index_migrations(db, populated_project):
+    async for mongo_db in db:
+        # Idempotent: running the migrations twice is fine
+        await apply_index_migrations(mongo_db)
+        await apply_index_migrations(mongo_db)
+
+        tasks_indexes = await mongo_db["tasks"].index_information()
+        logger.debug(f"Tasks indexes: {list(tasks_indexes.keys())}")
+        for index in INDEXES:
+            if index.collection == "tasks":
+                assert index.name in tasks_indexes
+
+        # Suggestion for the shape of a filtered task list
+        match, _ = await task_filtering_pipeline_match(
+            project_id=populated_project.id,
+            filters=ProjectDataFilters(
+                flag="success", created_at_start=0, metadata={"user_id": "abc"}
+            ),
+        )
+        suggestion = _suggest_index_for_shape("tasks", get_query_shape(match))
+        assert suggestion is not None
+        assert suggestion.keys == [("project_id", 1), ("flag", 1), ("created_at", -1)]
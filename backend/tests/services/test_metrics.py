@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+from loguru import logger
+
+from app.services.metrics import MetricsOrchestrator
+
+
+@pytest.mark.asyncio
+async def test_metrics_orchestrator():
+    async def slow_metric(duration: float) -> float:
+        await asyncio.sleep(duration)
+        return duration
+
+    async def grouped_metrics() -> dict:
+        return {"nb_tasks": 3, "success_rate": 0.5}
+
+    orchestrator = MetricsOrchestrator(max_concurrency=2, timeout=0.5)
+    orchestrator.add("fast", slow_metric, duration=0.01)
+    orchestrator.add("slow", slow_metric, duration=5)
+    orchestrator.add_group(["nb_tasks", "success_rate"], grouped_metrics)
+
+    output = await orchestrator.run()
+    logger.debug(f"Output: {output}, timings: {orchestrator.timings}")
+
+    # The slow metric exceeded its budget: the other ones are returned
+    assert output == {"fast": 0.01, "nb_tasks": 3, "success_rate": 0.5}
+    assert orchestrator.is_partial
+    assert orchestrator.timings["slow"]["status"] == "timeout"
+    assert orchestrator.timings["fast"]["status"] == "ok"
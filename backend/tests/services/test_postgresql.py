@@ -0,0 +1,34 @@
+from app.services.integrations.postgresql import (
+    EXPORT_COLUMNS,
+    encode_copy_rows,
+    encode_copy_value,
+)
+
+
+def test_encode_copy_value():
+    assert encode_copy_value(None) == "\\N"
+    assert encode_copy_value(True) == "true"
+    assert encode_copy_value(12) == "12"
+    assert encode_copy_value(0.5) == "0.5"
+    # The COPY delimiters and the backslash are escaped
+    assert encode_copy_value("a\tb\nc\r\\d") == "a\\tb\\nc\\r\\\\d"
+    assert encode_copy_value("\\N") == "\\\\N"
+    assert encode_copy_value("nul\x00") == "nul"
+    assert encode_copy_value(["a", "b"]) == '["a", "b"]'
+
+
+def test_encode_copy_rows():
+    columns = list(EXPORT_COLUMNS.keys()) + ["task_metadata.user_id"]
+    rows = [
+        {"task_id": "task_1", "task_input": "Hello\nworld", "event_removed": False},
+        {"task_id": "task_2", "task_metadata.user_id": "user_1"},
+    ]
+    lines = encode_copy_rows(rows, columns).read().split("\n")
+    # One line per row, one field per column
+    assert len(lines) == 3 and lines[2] == ""
+    fields = [line.split("\t") for line in lines[:2]]
+    assert all(len(line_fields) == len(columns) for line_fields in fields)
+    assert fields[0][0:2] == ["task_1", "Hello\\nworld"]
+    assert fields[0][columns.index("event_removed")] == "false"
+    assert fields[0][-1] == "\\N"
+    assert fields[1][-1] == "user_1"
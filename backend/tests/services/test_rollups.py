@@ -0,0 +1,45 @@
+import pytest
+from loguru import logger
+
+from app.db.models import AnalyticsQuery
+from app.services.mongo.explore import _run_raw_analytics_query, run_analytics_query
+from app.services.mongo.rollups import query_rollups, rebuild_rollups
+from app.utils import generate_timestamp
+
+
+@pytest.mark.asyncio
+async def test_analytics_rollups(db, populated_project):
+    async for mongo_db in db:
+        test_project_id = populated_project.id
+        await rebuild_rollups(test_project_id)
+
+        now = generate_timestamp()
+        for collection, dimensions in [
+            ("tasks", ["day"]),
+            ("sessions", ["hour"]),
+            ("events", ["month", "event_name"]),
+        ]:
+            query = AnalyticsQuery(
+                project_id=test_project_id,
+                collection=collection,
+                aggregation_operation="count",
+                dimensions=dimensions,
+                filters={"created_at": {"$gte": now - 3 * 86400, "$lte": now + 1800}},
+                sort={dimensions[0]: 1},
+            )
+            # The query can be answered from the rollups
+            assert await query_rollups(query) is not None
+
+            rollup_result = await run_analytics_query(query)
+            raw_result = await _run_raw_analytics_query(query)
+            logger.debug(f"{collection} rollups: {rollup_result}, raw: {raw_result}")
+            assert sorted(rollup_result, key=str) == sorted(raw_result, key=str)
+
+        # Task flags change after insertion: they are not in the rollups
+        query = AnalyticsQuery(
+            project_id=test_project_id,
+            collection="tasks",
+            aggregation_operation="count",
+            dimensions=["day", "flag"],
+        )
+        assert await query_rollups(query) is None
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import random
+import time
+import uuid
+from types import SimpleNamespace
+from typing import List
+
+import pytest
+from loguru import logger
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.http import models
+
+import app.services.mongo.search as search
+
+EMBEDDING_LATENCY = 0.05  # Latency of the embedding provider, in seconds
+
+
+def stub_embedding(text: str) -> List[float]:
+    """
+    A deterministic embedding of the text
+    """
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16)
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(1536)]
+
+
+class StubEmbeddings:
+    def __init__(self):
+        self.calls = 0
+
+    async def create(self, input: str, model: str):
+        self.calls += 1
+        await asyncio.sleep(EMBEDDING_LATENCY)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=stub_embedding(input))])
+
+
+@pytest.mark.asyncio
+async def test_query_embedding_cache(monkeypatch):
+    qdrant_db = AsyncQdrantClient(location=":memory:")
+    await qdrant_db.create_collection(
+        collection_name="tasks",
+        vectors_config=models.VectorParams(size=1536, distance=models.Distance.COSINE),
+    )
+    await qdrant_db.upsert(
+        collection_name="tasks",
+        points=[
+            models.PointStruct(
+                id=str(uuid.uuid4()),
+                vector=stub_embedding(f"task {index}"),
+                payload={"task_id": f"task_{index}", "project_id": "project"},
+            )
+            for index in range(200)
+        ],
+    )
+
+    async def get_qdrant():
+        return qdrant_db
+
+    embeddings = StubEmbeddings()
+    monkeypatch.setattr(search, "get_qdrant", get_qdrant)
+    monkeypatch.setattr(
+        search, "openai_client", SimpleNamespace(embeddings=embeddings)
+    )
+
+    durations = []
+    for query in ["Task 42", "task 42", "  task   42 ", "task 42"]:
+        start = time.perf_counter()
+        found_vectors = await search.search_task_vectors("project", query)
+        durations.append(time.perf_counter() - start)
+        # The closest vector is the one of the same text
+        assert found_vectors[0].payload["task_id"] == "task_42"
+    logger.info(
+        f"Search latency: first {durations[0] * 1000:.1f}ms, "
+        + f"cached {sum(durations[1:]) / 3 * 1000:.1f}ms"
+    )
+
+    # The query is embedded once: the next searches only query Qdrant
+    assert embeddings.calls == 1
+    assert max(durations[1:]) < durations[0] - EMBEDDING_LATENCY / 2
+
+    # Concurrent searches of a new query share the same embedding call
+    await asyncio.gather(
+        *(search.search_task_vectors("project", "task 7") for _ in range(10))
+    )
+    assert embeddings.calls == 2
+    await qdrant_db.close()
@@ -51,16 +51,68 @@ EVALUATION_SOURCE = "phospho-6"  # If phospho
 FEW_SHOT_MAX_NUMBER_OF_EXAMPLES = 10
 
 
+### EVENT DETECTION ###
+# Max number of event detection jobs running at the same time in a pipeline
+EVENT_DETECTION_MAX_PARALLELISM = int(os.getenv("EVENT_DETECTION_MAX_PARALLELISM", 50))
+# The detected events are saved in the database by batches of this size
+EVENT_DETECTION_FLUSH_EVERY = 100
+
+### LLM CACHE ###
+# Time to live of the LLM responses cached in mongo, in seconds
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 30 * 24 * 3600))
+
+### WEBHOOKS ###
+# Timeout of a webhook delivery, in seconds
+WEBHOOK_TIMEOUT = int(os.getenv("WEBHOOK_TIMEOUT", 3))
+# Size of the connection pool of the webhooks
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 100))
+# Max number of deliveries at the same time to the same URL
+WEBHOOK_MAX_CONCURRENCY_PER_DESTINATION = int(
+    os.getenv("WEBHOOK_MAX_CONCURRENCY_PER_DESTINATION", 5)
+)
+# Above this number of deliveries in progress, new webhooks go to the retry queue
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", 10_000))
+# Receivers with batching enabled get lists of at most this size, every few seconds
+WEBHOOK_BATCH_SIZE = 50
+WEBHOOK_BATCH_INTERVAL = 1
+# Failed deliveries are retried with an exponential backoff, in seconds
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_RETRY_BASE_DELAY = 30
+WEBHOOK_RETRY_MAX_DELAY = 6 * 3600
+WEBHOOK_RETRY_POLL_INTERVAL = 10
+
+### OPENTELEMETRY ###
+# Max number of spans waiting to be written
+OTEL_BUFFER_MAX_SPANS = int(os.getenv("OTEL_BUFFER_MAX_SPANS", 50_000))
+# When the buffer is full: "block" the ingestion until it's flushed, or "drop" the spans
+OTEL_BUFFER_OVERFLOW = os.getenv("OTEL_BUFFER_OVERFLOW", "block")
+# The spans are written by batches of this size, at least every OTEL_FLUSH_INTERVAL seconds
+OTEL_FLUSH_BATCH_SIZE = 1000
+OTEL_FLUSH_INTERVAL = 1
+
+### MESSAGES ###
+# The tasks and sessions of the message logs are written by bulks of this size
+MESSAGES_WRITE_BATCH_SIZE = int(os.getenv("MESSAGES_WRITE_BATCH_SIZE", 10_000))
+
+### VECTORIZATION ###
+VECTORIZER_EMBEDDING_MODEL = "text-embedding-3-small"
+# The new tasks are embedded by batches of this size, at least every few seconds
+VECTORIZER_BATCH_SIZE = int(os.getenv("VECTORIZER_BATCH_SIZE", 256))
+VECTORIZER_FLUSH_INTERVAL = 5
+VECTORIZER_MAX_PENDING = 100_000  # Max number of tasks waiting to be vectorized
+VECTORIZER_MAX_TEXT_LENGTH = 8000  # in characters
+
+### CONNECTORS ###
+# Number of runs pulled, converted and processed at once by the connectors syncs
+CONNECTOR_PAGE_SIZE = int(os.getenv("CONNECTOR_PAGE_SIZE", 500))
+
 ### SENTRY ###
 EXTRACTOR_SENTRY_DSN = os.getenv("EXTRACTOR_SENTRY_DSN")
 
 ### Vector Search ###
+# If QDRANT_URL is not set, the new tasks are not vectorized
 QDRANT_URL = os.getenv("QDRANT_URL")
-if QDRANT_URL is None:
-    raise Exception("QDRANT_URL is missing from the environment variables")
 QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-if QDRANT_API_KEY is None:
-    raise Exception("QDRANT_API_KEY is missing from the environment variables")
 
 ### Hardcoded Jobs object ###
 
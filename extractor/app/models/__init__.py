@@ -3,6 +3,7 @@ from .log import (
     LogProcessRequestForTasks,
     MinimalLogEventForTasks,
     LogProcessRequestForMessages,
+    MinimalLogEventForMessages,
 )
 from .pipelines import (
     PipelineResults,
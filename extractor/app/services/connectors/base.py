@@ -1,8 +1,97 @@
-from typing import Optional
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from app.core import config
+from app.db.mongo import get_mongo_db
+from app.models import LogEventForTasks
+from app.services.log import process_logs_for_tasks
+
+
+class SyncCursor(BaseModel):
+    """
+    High-water mark of an incremental sync.
+
+    The sources return the items from the newest to the oldest, so a sync goes backwards
+    in time, from now to `since`:
+    - since: start time of the newest item of the last complete sync
+    - until: start time of the oldest item processed by the sync in progress
+    - next_since: start time of the newest item of the sync in progress. It becomes
+      `since` when the sync completes.
+
+    The cursor is saved after every page: an interrupted sync resumes after `until`.
+
+    Several items can share a start time, including across pages. So the bounds are
+    inclusive, and the ids of the items already processed at each bound are kept
+    to skip them.
+    """
+
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    next_since: Optional[datetime] = None
+    since_ids: List[str] = Field(default_factory=list)
+    until_ids: List[str] = Field(default_factory=list)
+    next_since_ids: List[str] = Field(default_factory=list)
+
+    def contains(self, start_time: Optional[datetime], item_id: str) -> bool:
+        """
+        Whether an item is between since and until, and was not processed yet
+        """
+        if start_time is None:
+            return True
+        if self.since is not None:
+            if start_time < self.since or (
+                start_time == self.since and item_id in self.since_ids
+            ):
+                return False
+        if self.until is not None:
+            if start_time > self.until or (
+                start_time == self.until and item_id in self.until_ids
+            ):
+                return False
+        return True
+
+    def advance(self, items: List[Tuple[datetime, str]]) -> None:
+        """
+        Move the cursor after a page of processed (start_time, id)
+        """
+        if len(items) == 0:
+            return
+        newest = max(start_time for start_time, _ in items)
+        oldest = min(start_time for start_time, _ in items)
+        if self.next_since is None or newest > self.next_since:
+            self.next_since = newest
+            self.next_since_ids = []
+        self.next_since_ids += [
+            item_id for start_time, item_id in items if start_time == self.next_since
+        ]
+        if self.until is None or oldest < self.until:
+            self.until = oldest
+            self.until_ids = []
+        self.until_ids += [
+            item_id for start_time, item_id in items if start_time == self.until
+        ]
+
+    def complete(self) -> None:
+        """
+        The sync is complete: the next one starts from the newest item
+        """
+        if self.next_since is not None:
+            self.since = self.next_since
+            self.since_ids = self.next_since_ids
+        self.until = None
+        self.until_ids = []
+        self.next_since = None
+        self.next_since_ids = []
 
 
 class BaseConnector:
     project_id: str
+    # Name of the source, used as the key of the sync cursor
+    source: Optional[str] = None
+    page_size: int = config.CONNECTOR_PAGE_SIZE
 
     def __init__(
         self,
@@ -46,6 +135,145 @@ class BaseConnector:
         """
         raise NotImplementedError
 
+    ### Incremental sync ###
+
+    def pull_pages(self, cursor: SyncCursor) -> AsyncIterator[List[Any]]:
+        """
+        Yield the items of the cursor (see SyncCursor.contains), newest first, by pages
+        of at most page_size items. The cursor is advanced after every page.
+        """
+        raise NotImplementedError
+
+    def get_start_time(self, item: Any) -> Optional[datetime]:
+        """
+        Start time of an item, used as the high-water mark
+        """
+        raise NotImplementedError
+
+    def get_item_id(self, item: Any) -> str:
+        """
+        Unique id of an item in the source
+        """
+        raise NotImplementedError
+
+    def convert(self, item: Any, org_id: str) -> Optional[LogEventForTasks]:
+        """
+        Convert an item of the source to a log event. Return None to skip it.
+        """
+        raise NotImplementedError
+
+    async def _dump_page(self, page: List[Any]) -> None:
+        """
+        Dump a page of raw pulled data
+        """
+        return
+
+    async def _get_initial_since(self) -> Optional[datetime]:
+        """
+        Where to start the first sync, if there is no cursor yet
+        """
+        return None
+
+    async def _on_sync_complete(self) -> None:
+        return
+
+    async def load_cursor(self) -> SyncCursor:
+        mongo_db = await get_mongo_db()
+        cursor = await mongo_db["sync_cursors"].find_one(
+            {"project_id": self.project_id, "source": self.source}
+        )
+        if cursor is None:
+            return SyncCursor(since=await self._get_initial_since())
+        return SyncCursor.model_validate(cursor)
+
+    async def save_cursor(self, cursor: SyncCursor) -> None:
+        mongo_db = await get_mongo_db()
+        await mongo_db["sync_cursors"].update_one(
+            {"project_id": self.project_id, "source": self.source},
+            {"$set": {**cursor.model_dump(), "updated_at": datetime.now()}},
+            upsert=True,
+        )
+
+    def _convert_page(
+        self,
+        page: List[Any],
+        org_id: str,
+        current_usage: int,
+        max_usage: Optional[int] = None,
+    ) -> Tuple[List[LogEventForTasks], List[LogEventForTasks]]:
+        """
+        Return the logs to process, and the logs above the quota to only save
+        """
+        logs_to_process: List[LogEventForTasks] = []
+        extra_logs_to_save: List[LogEventForTasks] = []
+        for item in page:
+            try:
+                log_event = self.convert(item, org_id)
+            except Exception as e:
+                logger.error(
+                    f"Error processing {self.source} item for project id: {self.project_id}, {e}"
+                )
+                continue
+            if log_event is None:
+                continue
+            if max_usage is None or current_usage < max_usage:
+                logs_to_process.append(log_event)
+                current_usage += 1
+            else:
+                extra_logs_to_save.append(log_event)
+        return logs_to_process, extra_logs_to_save
+
+    async def sync_pages(
+        self,
+        org_id: str,
+        current_usage: int,
+        max_usage: Optional[int] = None,
+    ) -> int:
+        """
+        Pull, convert and process the items page by page, saving the cursor after every
+        page. The memory used doesn't depend on the number of items.
+        Return the number of logs processed
+        """
+        cursor = await self.load_cursor()
+        if cursor.until is not None:
+            logger.info(
+                f"Resuming the {self.source} sync of project {self.project_id} before {cursor.until}"
+            )
+        nb_processed = 0
+        async for page in self.pull_pages(cursor):
+            if len(page) == 0:
+                continue
+            await self._dump_page(page)
+            logs_to_process, extra_logs_to_save = self._convert_page(
+                page, org_id, current_usage + nb_processed, max_usage
+            )
+            await process_logs_for_tasks(
+                project_id=self.project_id,
+                org_id=org_id,
+                logs_to_process=logs_to_process,
+                extra_logs_to_save=extra_logs_to_save,
+            )
+            nb_processed += len(logs_to_process)
+
+            cursor.advance(
+                [
+                    (start_time, self.get_item_id(item))
+                    for start_time, item in (
+                        (self.get_start_time(item), item) for item in page
+                    )
+                    if start_time is not None
+                ]
+            )
+            await self.save_cursor(cursor)
+
+        cursor.complete()
+        await self.save_cursor(cursor)
+        await self._on_sync_complete()
+        logger.debug(
+            f"Finished the {self.source} sync of project {self.project_id}: {nb_processed} logs processed"
+        )
+        return nb_processed
+
     async def sync(
         self,
         org_id: str,
@@ -54,12 +282,19 @@ class BaseConnector:
         **kwargs,
     ):
         await self.load_config(**kwargs)
-        await self.pull()
-        nb_job_results = await self.process(
-            org_id=org_id,
-            current_usage=current_usage,
-            max_usage=max_usage,
-        )
+        if self.source is not None:
+            nb_job_results = await self.sync_pages(
+                org_id=org_id,
+                current_usage=current_usage,
+                max_usage=max_usage,
+            )
+        else:
+            await self.pull()
+            nb_job_results = await self.process(
+                org_id=org_id,
+                current_usage=current_usage,
+                max_usage=max_usage,
+            )
         await self.save_config(**kwargs)
         return {
             "status": "ok",
@@ -1,6 +1,7 @@
+import asyncio
 import base64
-from datetime import datetime
-from typing import List, Optional
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, List, Optional
 
 from Crypto import Random
 from Crypto.Cipher import AES
@@ -12,15 +13,14 @@ from loguru import logger
 from app.models import LogEventForTasks
 from app.core import config
 from app.db.mongo import get_mongo_db
-from app.services.connectors.base import BaseConnector
-from app.services.log import process_logs_for_tasks
+from app.services.connectors.base import BaseConnector, SyncCursor
 from app.services.projects import get_project_by_id
 
 
 class LangfuseConnector(BaseConnector):
     project_id: str
+    source = "langfuse"
     langfuse: Optional[Langfuse] = None
-    observations: Optional[ObservationsViews] = None
 
     def __init__(
         self,
@@ -111,9 +111,10 @@ class LangfuseConnector(BaseConnector):
             upsert=True,
         )
 
-    async def _get_last_langfuse_extract(self) -> Optional[datetime]:
+    async def _get_initial_since(self) -> Optional[datetime]:
         """
-        Get the last Langfuse extract date for a project
+        Get the last Langfuse extract date for a project, for the projects synced
+        before the sync cursors
         """
         project = await get_project_by_id(self.project_id)
         last_langfuse_extract = project.settings.last_langfuse_extract
@@ -131,40 +132,85 @@ class LangfuseConnector(BaseConnector):
             )
             return None
 
-    async def _dump(self):
-        # Dump to a dedicated db
-        mongo_db = await get_mongo_db()
-        observations_list = [
-            observation.dict() for observation in self.observations.data
-        ]
-        if len(observations_list) > 0:
-            mongo_db["logs_langfuse"].insert_many(observations_list)
+    def _get_observations(
+        self, since: Optional[datetime], until: Optional[datetime], page: int
+    ) -> ObservationsViews:
+        """
+        A page of the generations started between since and until (included),
+        newest first
+        """
+        kwargs = {}
+        if since is not None:
+            kwargs["from_start_time"] = since
+        if until is not None:
+            # to_start_time is exclusive
+            kwargs["to_start_time"] = until + timedelta(microseconds=1)
+        return self.langfuse.client.observations.get_many(
+            type="GENERATION", page=page, limit=self.page_size, **kwargs
+        )
 
-    async def pull(self):
+    async def pull_pages(self, cursor: SyncCursor) -> AsyncIterator[List[Any]]:
         if self.langfuse_public_key is None or self.langfuse_secret_key is None:
             logger.info("No Langfuse credentials provided")
             return
 
-        self.langfuse = Langfuse(
-            public_key=self.langfuse_public_key,
-            secret_key=self.langfuse_secret_key,
-        )
-        last_langfuse_extract = await self._get_last_langfuse_extract()
-        if last_langfuse_extract is None:
-            self.observations = self.langfuse.client.observations.get_many(
-                type="GENERATION"
-            )
-        else:
-            self.observations = self.langfuse.client.observations.get_many(
-                type="GENERATION",
-                from_start_time=last_langfuse_extract,
+        if self.langfuse is None:
+            self.langfuse = Langfuse(
+                public_key=self.langfuse_public_key,
+                secret_key=self.langfuse_secret_key,
             )
+        try:
+            page_number = 1
+            while True:
+                # Read the first pages up to the oldest observation already read:
+                # the new observations don't shift the pages during the sync
+                until = cursor.until
+                observations = await asyncio.to_thread(
+                    self._get_observations, cursor.since, until, page_number
+                )
+                page = [
+                    observation
+                    for observation in observations.data
+                    if cursor.contains(observation.start_time, observation.id)
+                ]
+                if len(page) > 0:
+                    yield page
+                if len(observations.data) < self.page_size:
+                    break
+                if cursor.until == until:
+                    # The whole page was already read or shares the start time of
+                    # the oldest observation: read the next one
+                    page_number += 1
+                else:
+                    page_number = 1
+        finally:
+            self.langfuse.shutdown()
+
+    async def _dump_page(self, page: List[Any]) -> None:
+        # Dump to a dedicated db
+        mongo_db = await get_mongo_db()
+        observations_list = [observation.dict() for observation in page]
+        if len(observations_list) > 0:
+            await mongo_db["logs_langfuse"].insert_many(observations_list)
+
+    def get_start_time(self, observation: Any) -> Optional[datetime]:
+        return observation.start_time
 
-        self.langfuse.shutdown()
-        # Save the raw data
-        await self._dump()
+    def get_item_id(self, observation: Any) -> str:
+        return observation.id
 
-    async def _update_last_langfuse_extract(self):
+    def convert(self, observation: Any, org_id: str) -> Optional[LogEventForTasks]:
+        return LogEventForTasks(
+            created_at=int(observation.start_time.timestamp()),
+            input=observation.input,
+            output=observation.output,
+            session_id=str(observation.trace_id),
+            project_id=self.project_id,
+            metadata={"langsfuse_run_id": observation.id},
+            org_id=org_id,
+        )
+
+    async def _on_sync_complete(self):
         """
         Change the last LangFuse extract for a project
         """
@@ -174,55 +220,3 @@ class LangfuseConnector(BaseConnector):
             {"id": self.project_id},
             {"$set": {"settings.last_langfuse_extract": datetime.now()}},
         )
-
-    async def process(
-        self,
-        org_id: str,
-        current_usage: int,
-        max_usage: Optional[int] = None,
-    ) -> int:
-        logs_to_process: List[LogEventForTasks] = []
-        extra_logs_to_save: List[LogEventForTasks] = []
-
-        if self.observations is None:
-            logger.error(
-                f"No Langfuse observations to process for project id: {self.project_id}"
-            )
-            return 0
-
-        for observation in self.observations.data:
-            try:
-                input = observation.input
-                output = observation.output
-
-                log_event = LogEventForTasks(
-                    created_at=int(observation.start_time.timestamp()),
-                    input=input,
-                    output=output,
-                    session_id=str(observation.trace_id),
-                    project_id=self.project_id,
-                    metadata={"langsfuse_run_id": observation.id},
-                    org_id=org_id,
-                )
-
-                if max_usage is None or (
-                    max_usage is not None and current_usage < max_usage
-                ):
-                    logs_to_process.append(log_event)
-                    current_usage += 1
-                else:
-                    extra_logs_to_save.append(log_event)
-            except Exception as e:
-                logger.error(
-                    f"Error processing langfuse run for project id: {self.project_id}, {e}"
-                )
-
-        await self._update_last_langfuse_extract()
-        await process_logs_for_tasks(
-            project_id=self.project_id,
-            org_id=org_id,
-            logs_to_process=logs_to_process,
-            extra_logs_to_save=extra_logs_to_save,
-        )
-
-        return len(logs_to_process)
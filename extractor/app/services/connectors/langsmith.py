@@ -1,6 +1,8 @@
+import asyncio
 import base64
+import itertools
 from datetime import datetime
-from typing import List, Optional
+from typing import AsyncIterator, Iterator, List, Optional
 from app.core import config
 
 from Crypto import Random
@@ -12,16 +14,15 @@ from loguru import logger
 
 from app.models import LogEventForTasks
 from app.db.mongo import get_mongo_db
-from app.services.connectors.base import BaseConnector
-from app.services.log import process_logs_for_tasks
+from app.services.connectors.base import BaseConnector, SyncCursor
 
 from app.services.projects import get_project_by_id
 
 
 class LangsmithConnector(BaseConnector):
     project_id: str
+    source = "langsmith"
     client: Optional[Client] = None
-    runs: Optional[List[Run]] = None
     langsmith_api_key: Optional[str] = None
     langsmith_project_name: Optional[str] = None
 
@@ -116,9 +117,10 @@ class LangsmithConnector(BaseConnector):
             upsert=True,
         )
 
-    async def _get_last_langsmith_extract(self) -> Optional[datetime]:
+    async def _get_initial_since(self) -> Optional[datetime]:
         """
-        Get the last Langsmith extract date for a project
+        Get the last Langsmith extract date for a project, for the projects synced
+        before the sync cursors
         """
         project = await get_project_by_id(self.project_id)
         last_langsmith_extract = project.settings.last_langsmith_extract
@@ -134,45 +136,105 @@ class LangsmithConnector(BaseConnector):
             )
             return None
 
-    async def _dump(self):
+    def _list_runs(
+        self, since: Optional[datetime], until: Optional[datetime]
+    ) -> Iterator[Run]:
+        """
+        The LLM runs started between since and until (included), newest first. The
+        client fetches the pages lazily while the runs are iterated.
+        """
+        if self.client is None:
+            self.client = Client(api_key=self.langsmith_api_key)
+        filters = []
+        if since is not None:
+            filters.append(f'gte(start_time, "{since.isoformat()}")')
+        if until is not None:
+            filters.append(f'lte(start_time, "{until.isoformat()}")')
+        filter = None
+        if len(filters) == 1:
+            filter = filters[0]
+        elif len(filters) > 1:
+            filter = f"and({', '.join(filters)})"
+        return self.client.list_runs(
+            project_name=self.langsmith_project_name,
+            run_type="llm",
+            filter=filter,
+        )
+
+    async def pull_pages(self, cursor: SyncCursor) -> AsyncIterator[List[Run]]:
+        if self.langsmith_api_key is None or self.langsmith_project_name is None:
+            raise ValueError("Credentials not loaded")
+
+        runs = (
+            run
+            for run in self._list_runs(since=cursor.since, until=cursor.until)
+            # Skip the runs at the bounds that were already processed
+            if cursor.contains(run.start_time, self.get_item_id(run))
+        )
+        while True:
+            # The client is synchronous: fetch the page in a thread
+            page = await asyncio.to_thread(
+                lambda: list(itertools.islice(runs, self.page_size))
+            )
+            if len(page) == 0:
+                break
+            yield page
+
+    async def _dump_page(self, page: List[Run]) -> None:
         # Dump to a dedicated db
         mongo_db = await get_mongo_db()
         runs_as_dict = []
         try:
             # Runs are pydantic model v1
-            runs_as_dict = [run.dict() for run in self.runs]
+            runs_as_dict = [run.dict() for run in page]
         except Exception as e:
             logger.error(
                 f"Error converting runs to dict: {e}. Retrying with model_dump method"
             )
             # Try with pydantic model v2
-            runs_as_dict = [run.model_dump() for run in self.runs]
+            runs_as_dict = [run.model_dump() for run in page]
 
         if len(runs_as_dict) > 0:
-            mongo_db["logs_langsmith"].insert_many(runs_as_dict)
+            await mongo_db["logs_langsmith"].insert_many(runs_as_dict)
 
-    async def pull(self):
-        if self.langsmith_api_key is None or self.langsmith_project_name is None:
-            raise ValueError("Credentials not loaded")
+    def get_start_time(self, run: Run) -> Optional[datetime]:
+        return run.start_time
 
-        self.client = Client(api_key=self.langsmith_api_key)
+    def get_item_id(self, run: Run) -> str:
+        return str(run.id)
 
-        last_langsmith_extract = await self._get_last_langsmith_extract()
-        if last_langsmith_extract is None:
-            self.runs = self.client.list_runs(
-                project_name=self.langsmith_project_name,
-                run_type="llm",
-            )
+    def convert(self, run: Run, org_id: str) -> Optional[LogEventForTasks]:
+        input = ""
+        for message in run.inputs["messages"]:
+            if "HumanMessage" in message["id"]:
+                input += message["kwargs"]["content"]
+
+        output = ""
+        if run.outputs:
+            generations = run.outputs.get("generations", [])
+            for generation in generations:
+                output += generation["text"]
+
+        if input == "" or output == "":
+            return None
+
+        run_end_time = run.end_time
+        if run_end_time:
+            run_end_time_ts = int(run_end_time.timestamp())
         else:
-            self.runs = self.client.list_runs(
-                project_name=self.langsmith_project_name,
-                run_type="llm",
-                start_time=last_langsmith_extract,
-            )
-        # Save the raw data
-        await self._dump()
+            run_end_time_ts = None
+
+        return LogEventForTasks(
+            created_at=run_end_time_ts,
+            input=input,
+            output=output,
+            session_id=str(run.session_id),
+            project_id=self.project_id,
+            metadata={"langsmith_run_id": run.id},
+            org_id=org_id,
+        )
 
-    async def _update_last_langsmith_extract(self):
+    async def _on_sync_complete(self):
         """
         Change the last Langsmith extract for a project
         """
@@ -182,75 +244,3 @@ class LangsmithConnector(BaseConnector):
             {"id": self.project_id},
             {"$set": {"settings.last_langsmith_extract": datetime.now()}},
         )
-
-    async def process(
-        self,
-        org_id: str,
-        current_usage: int,
-        max_usage: Optional[int] = None,
-    ) -> int:
-        logs_to_process: List[LogEventForTasks] = []
-        extra_logs_to_save: List[LogEventForTasks] = []
-
-        if self.runs is None:
-            logger.error(
-                f"No Langsmith runs to process for project id: {self.project_id}"
-            )
-            return 0
-
-        for run in self.runs:
-            try:
-                input = ""
-                for message in run.inputs["messages"]:
-                    if "HumanMessage" in message["id"]:
-                        input += message["kwargs"]["content"]
-
-                output = ""
-                if run.outputs:
-                    generations = run.outputs.get("generations", [])
-                    for generation in generations:
-                        output += generation["text"]
-
-                if input == "" or output == "":
-                    continue
-
-                run_end_time = run.end_time
-                if run_end_time:
-                    run_end_time_ts = int(run_end_time.timestamp())
-                else:
-                    run_end_time_ts = None
-
-                log_event = LogEventForTasks(
-                    created_at=run_end_time_ts,
-                    input=input,
-                    output=output,
-                    session_id=str(run.session_id),
-                    project_id=self.project_id,
-                    metadata={"langsmith_run_id": run.id},
-                    org_id=org_id,
-                )
-
-                if max_usage is None or (
-                    max_usage is not None and current_usage < max_usage
-                ):
-                    logs_to_process.append(log_event)
-                    current_usage += 1
-                else:
-                    extra_logs_to_save.append(log_event)
-            except Exception as e:
-                logger.error(
-                    f"Error processing langsmith run for project id: {self.project_id}, {e}"
-                )
-
-        await self._update_last_langsmith_extract()
-        await process_logs_for_tasks(
-            project_id=self.project_id,
-            org_id=org_id,
-            logs_to_process=logs_to_process,
-            extra_logs_to_save=extra_logs_to_save,
-        )
-        logger.debug(
-            f"Finished processing langsmith runs for project id: {self.project_id}"
-        )
-
-        return len(logs_to_process)
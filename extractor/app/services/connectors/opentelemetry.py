@@ -1,24 +1,323 @@
-from typing import Optional
+"""
+Ingestion of the OpenTelemetry (OTLP JSON) exports.
+
+Every span of an export request is unpacked, and the spans of the LLM calls (with
+"gen_ai" attributes) are handed to a shared SpanWriter. The writer buffers them and
+writes them in the background with unordered bulk inserts, the spans of the same
+trace in the same batch. SpanWriter.add returns once the spans are flushed, so an
+export is only acknowledged after its spans are written. If a write fails, add raises
+and StoreOpenTelemetryDataWorkflow retries the export. The raw export and the spans
+have deterministic ids, so the retries don't store them twice: the spans already
+written are counted as written.
+
+The buffer is bounded (OTEL_BUFFER_MAX_SPANS). When it's full, OTEL_BUFFER_OVERFLOW
+decides what happens to the new spans:
+- "block": the ingestion waits for the buffer to be flushed (backpressure)
+- "drop": the spans are dropped and counted in SpanWriter.dropped_spans
+"""
+
+import asyncio
+import time
+from typing import Dict, List, Optional
 
 from loguru import logger
 
+from app.core import config
 from app.db.mongo import get_mongo_db
 from app.services.connectors.base import BaseConnector
 
+# Mongo error code of the inserts of an existing _id
+DUPLICATE_KEY_ERROR = 11000
+
+
+def unpack_attributes(attributes: List[dict]) -> dict:
+    """
+    Convert the OTLP attributes [{"key": "a.b.0.c", "value": {"stringValue": ...}}]
+    to nested dicts and lists {"a": {"b": [{"c": ...}]}}
+    """
+    unpacked_attributes: dict = {}
+    for attr in attributes:
+        k = attr["key"]
+
+        if "stringValue" in attr["value"]:
+            value = attr["value"]["stringValue"]
+        elif "intValue" in attr["value"]:
+            value = attr["value"]["intValue"]
+        elif "boolValue" in attr["value"]:
+            value = attr["value"]["boolValue"]
+        elif "doubleValue" in attr["value"]:
+            value = attr["value"]["doubleValue"]
+        elif "arrayValue" in attr["value"]:
+            value = attr["value"]["arrayValue"]
+        else:
+            logger.error(f"Unknown value type: {attr['value']}")
+            continue
+
+        keys = k.split(".")
+        current_dict = unpacked_attributes
+        for i, key in enumerate(keys[:-1]):
+            if key.isdigit():
+                # Skip if key is a digit: No need to unpack
+                continue
+
+            # Initialize the key if it does not exist
+            if key not in current_dict:
+                if keys[i + 1].isdigit():
+                    # If next key is a digit, then current key is a list
+                    current_dict[key] = []
+                else:
+                    # If next key is not a digit, then current key is a dictionary
+                    current_dict[key] = {}
+
+            # Move to the next level
+            if keys[i + 1].isdigit():
+                # If next key is a digit, then the current key is a list
+                if len(current_dict[key]) < int(keys[i + 1]) + 1:
+                    current_dict[key].append({})
+                try:
+                    current_dict = current_dict[key][int(keys[i + 1])]
+                except IndexError:
+                    logger.error(f"IndexError: {key} {keys[i + 1]} {current_dict[key]}")
+                    continue
+            else:
+                current_dict = current_dict[key]
+        current_dict[keys[-1]] = value
+    return unpacked_attributes
+
+
+def extract_spans(data: dict) -> List[dict]:
+    """
+    All the spans of an OTLP export request, with their attributes unpacked
+    """
+    spans = []
+    for resource_spans in data.get("resourceSpans", []):
+        for scope_spans in resource_spans.get("scopeSpans", []):
+            for span in scope_spans.get("spans", []):
+                try:
+                    span["attributes"] = unpack_attributes(span.get("attributes", []))
+                except (KeyError, TypeError) as e:
+                    logger.error(f"Error unpacking the span attributes: {e!r}")
+                    continue
+                spans.append(span)
+    return spans
+
+
+class SpanWriter:
+    def __init__(
+        self,
+        max_spans: int = config.OTEL_BUFFER_MAX_SPANS,
+        batch_size: int = config.OTEL_FLUSH_BATCH_SIZE,
+        flush_interval: float = config.OTEL_FLUSH_INTERVAL,
+        overflow: str = config.OTEL_BUFFER_OVERFLOW,
+        collection: str = "opentelemetry",
+    ):
+        if overflow not in ["block", "drop"]:
+            raise ValueError(f"Unknown overflow behavior {overflow}")
+        self.max_spans = max_spans
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.collection = collection
+        # trace_id -> documents of the spans of the trace
+        self._traces: Dict[str, List[dict]] = {}
+        self._nb_buffered = 0
+        # Set when the buffer has room
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._flush_lock = asyncio.Lock()
+        self._flush_loop: Optional[asyncio.Task] = None
+        self._flush_tasks: set = set()
+        # Resolved with the number of failed spans when the buffered spans are flushed
+        self._flushed: Optional[asyncio.Future] = None
+        # Counters
+        self.written_spans = 0
+        self.dropped_spans = 0
+        self.failed_spans = 0
+
+    def start(self) -> None:
+        if self._flush_loop is None or self._flush_loop.done():
+            self._flush_loop = asyncio.create_task(self._run_flush_loop())
+
+    async def add(self, documents: List[dict]) -> int:
+        """
+        Buffer the span documents and wait for them to be flushed. Return the number
+        of documents accepted: with the "drop" overflow, the ones that don't fit in the
+        buffer are dropped. Raise if some of the flushed spans failed to be written.
+        """
+        self.start()
+        accepted = 0
+        # With the "block" overflow, the documents can be split over several flushes
+        flushes: List[asyncio.Future] = []
+        for document in documents:
+            if self._nb_buffered >= self.max_spans and self.overflow == "drop":
+                self.dropped_spans += len(documents) - accepted
+                logger.warning(
+                    f"OpenTelemetry buffer full, {len(documents) - accepted} spans dropped"
+                )
+                break
+            while self._nb_buffered >= self.max_spans:
+                self._not_full.clear()
+                self._flush_soon()
+                await self._not_full.wait()
+            self._traces.setdefault(document.get("trace_id") or "", []).append(
+                document
+            )
+            self._nb_buffered += 1
+            accepted += 1
+            if self._flushed is None:
+                self._flushed = asyncio.get_running_loop().create_future()
+            if len(flushes) == 0 or flushes[-1] is not self._flushed:
+                flushes.append(self._flushed)
+        if self._nb_buffered >= self.batch_size:
+            self._flush_soon()
+        # The flushes are shared with the other exports: don't cancel them
+        nb_failed = sum(
+            await asyncio.gather(*(asyncio.shield(flushed) for flushed in flushes))
+        )
+        if nb_failed > 0:
+            raise RuntimeError(
+                f"{nb_failed} OpenTelemetry spans of the flush could not be written"
+            )
+        return accepted
+
+    def _flush_soon(self) -> None:
+        task = asyncio.create_task(self.flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    def _take_batches(self) -> List[List[dict]]:
+        """
+        Empty the buffer into batches of about batch_size spans. The spans of a trace
+        are in the same batch. They count in the buffer until they are written.
+        """
+        traces, self._traces = self._traces, {}
+        batches: List[List[dict]] = []
+        batch: List[dict] = []
+        for documents in traces.values():
+            if len(batch) > 0 and len(batch) + len(documents) > self.batch_size:
+                batches.append(batch)
+                batch = []
+            batch.extend(documents)
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    async def _write_batch(self, batch: List[dict]) -> int:
+        """
+        Write a batch of spans. Return the number of spans that failed to be written
+        """
+        try:
+            mongo_db = await get_mongo_db()
+            await mongo_db[self.collection].insert_many(batch, ordered=False)
+            self.written_spans += len(batch)
+            return 0
+        except Exception as e:
+            # With unordered inserts, the other spans of the batch are written
+            details = getattr(e, "details", None) or {}
+            # The spans already written by a previous attempt of the export
+            nb_written = details.get("nInserted", 0) + sum(
+                1
+                for error in details.get("writeErrors", [])
+                if error.get("code") == DUPLICATE_KEY_ERROR
+            )
+            self.written_spans += nb_written
+            nb_failed = len(batch) - nb_written
+            if nb_failed > 0:
+                self.failed_spans += nb_failed
+                logger.error(f"Error writing {nb_failed} OpenTelemetry spans: {e}")
+            return nb_failed
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            batches = self._take_batches()
+            flushed, self._flushed = self._flushed, None
+            nb_spans = sum(len(batch) for batch in batches)
+            # If the flush is interrupted, all its spans count as failed
+            nb_failed = nb_spans
+            try:
+                nb_failed = sum(
+                    await asyncio.gather(
+                        *(self._write_batch(batch) for batch in batches)
+                    )
+                )
+            finally:
+                self._nb_buffered -= nb_spans
+                if self._nb_buffered < self.max_spans:
+                    self._not_full.set()
+                if flushed is not None and not flushed.done():
+                    flushed.set_result(nb_failed)
+
+    async def _run_flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing the OpenTelemetry spans: {e}")
+
+    async def close(self) -> None:
+        if self._flush_loop is not None:
+            self._flush_loop.cancel()
+        if len(self._flush_tasks) > 0:
+            await asyncio.gather(*list(self._flush_tasks), return_exceptions=True)
+        await self.flush()
+
+
+_span_writer: Optional[SpanWriter] = None
+
+
+def get_span_writer() -> SpanWriter:
+    global _span_writer
+    if _span_writer is None:
+        _span_writer = SpanWriter()
+    return _span_writer
+
+
+async def close_span_writer() -> None:
+    global _span_writer
+    if _span_writer is not None:
+        await _span_writer.close()
+        _span_writer = None
+
 
 class OpenTelemetryConnector(BaseConnector):
     data: dict
 
-    def __init__(self, project_id: str, data: dict):
+    def __init__(
+        self,
+        project_id: str,
+        data: dict,
+        span_writer: Optional[SpanWriter] = None,
+        export_id: Optional[str] = None,
+    ):
+        """
+        :param export_id: Same id for all the attempts to process the export, so that
+            the raw data is only stored once.
+        """
         self.project_id = project_id
         self.data = data
+        self.span_writer = span_writer or get_span_writer()
+        self.export_id = export_id
 
     async def _dump(self):
         """
         Store the raw data in the database
         """
         mongo_db = await get_mongo_db()
-        mongo_db["logs_opentelemetry"].insert_one(self.data)
+        if self.export_id is None:
+            await mongo_db["logs_opentelemetry"].insert_one(self.data)
+            return
+        await mongo_db["logs_opentelemetry"].update_one(
+            {"_id": self.export_id}, {"$setOnInsert": self.data}, upsert=True
+        )
+
+    def get_span_document_id(self, span: dict) -> Optional[str]:
+        """
+        Deterministic id of a span: a retried export doesn't write its spans twice
+        """
+        if not span.get("traceId") or not span.get("spanId"):
+            return None
+        return f"{self.project_id}/{span['traceId']}/{span['spanId']}"
 
     async def process(
         self,
@@ -27,86 +326,30 @@ class OpenTelemetryConnector(BaseConnector):
         max_usage: Optional[int] = None,
     ) -> int:
         """
-        Push the data and process it
+        Push the spans to the span writer and wait for them to be written.
+        Return the number of spans accepted
         """
-        self._dump()
-        try:
-            # TODO: Find better way of doing this
-            resource_spans = self.data["resourceSpans"]
-            resource = resource_spans[0]["scopeSpans"]
-            spans = resource[0]["spans"][0]
-
-            # Unpack attributes
-            attributes = spans["attributes"]
-            unpacked_attributes = {}
-            for attr in attributes:
-                k = attr["key"]
-
-                if "stringValue" in attr["value"]:
-                    value = attr["value"]["stringValue"]
-                elif "intValue" in attr["value"]:
-                    value = attr["value"]["intValue"]
-                elif "boolValue" in attr["value"]:
-                    value = attr["value"]["boolValue"]
-                elif "doubleValue" in attr["value"]:
-                    value = attr["value"]["doubleValue"]
-                elif "arrayValue" in attr["value"]:
-                    value = attr["value"]["arrayValue"]
-                else:
-                    logger.error(f"Unknown value type: {attr['value']}")
-                    continue
-
-                keys = k.split(".")
-                current_dict = unpacked_attributes
-                for i, key in enumerate(keys[:-1]):
-                    if key.isdigit():
-                        # Skip if key is a digit: No need to unpack
-                        continue
-
-                    # Initialize the key if it does not exist
-                    if key not in current_dict:
-                        if keys[i + 1].isdigit():
-                            # If next key is a digit, then current key is a list
-                            current_dict[key] = []
-                        else:
-                            # If next key is not a digit, then current key is a dictionary
-                            current_dict[key] = {}
-
-                    # Move to the next level
-                    if keys[i + 1].isdigit():
-                        # If next key is a digit, then the current key is a list
-                        if len(current_dict[key]) < int(keys[i + 1]) + 1:
-                            current_dict[key].append({})
-                        try:
-                            current_dict = current_dict[key][int(keys[i + 1])]
-                        except IndexError:
-                            logger.error(
-                                f"IndexError: {key} {keys[i + 1]} {current_dict[key]}"
-                            )
-                            continue
-                    else:
-                        current_dict = current_dict[key]
-                current_dict[keys[-1]] = value
-
-            spans["attributes"] = unpacked_attributes
-
+        await self._dump()
+        received_at = int(time.time())
+        documents = []
+        for span in extract_spans(self.data):
             # We only keep the spans that have the "gen_ai.system" attribute
-            if "gen_ai" in unpacked_attributes:
-                mongo_db = await get_mongo_db()
-
-                # Store the data in the database
-                mongo_db["opentelemetry"].insert_one(
-                    {
-                        "org_id": org_id,
-                        "project_id": self.project_id,
-                        "open_telemetry_data": spans,
-                    }
-                )
-                logger.info("Opentelemetry data stored in the database")
-
-            # TODO: Implement the log processing
-
-        except KeyError as e:
-            logger.error(f"KeyError: {e}")
-
-        return 0
+            if "gen_ai" not in span["attributes"]:
+                continue
+            document = {
+                "org_id": org_id,
+                "project_id": self.project_id,
+                "trace_id": span.get("traceId"),
+                "received_at": received_at,
+                "open_telemetry_data": span,
+            }
+            document_id = self.get_span_document_id(span)
+            if document_id is not None:
+                document["_id"] = document_id
+            documents.append(document)
+        nb_accepted = await self.span_writer.add(documents)
+        logger.debug(
+            f"Project {self.project_id}: {nb_accepted} OpenTelemetry spans written"
+        )
+        # TODO: Implement the log processing
+        return nb_accepted
@@ -0,0 +1,49 @@
+"""
+Mongo backend of the LLM cache of phospho.lab (see phospho/lab/llm_cache.py).
+
+The responses of the deterministic LLM calls of the jobs are shared by all the workers,
+so retried activities and re-runs of the recipes on the same tasks don't call the
+provider again. Expired responses are removed by a TTL index on `expires_at`.
+"""
+
+import datetime
+from typing import Optional
+
+from phospho.lab.llm_cache import LLMCache, set_llm_cache
+
+from app.core import config
+from app.db.mongo import get_mongo_db
+
+
+class MongoLLMCacheBackend:
+    collection = "llm_cache"
+
+    async def get(self, key: str) -> Optional[dict]:
+        mongo_db = await get_mongo_db()
+        cached = await mongo_db[self.collection].find_one(
+            {
+                "key": key,
+                "expires_at": {"$gt": datetime.datetime.now(datetime.timezone.utc)},
+            }
+        )
+        if cached is None:
+            return None
+        return cached["value"]
+
+    async def set(self, key: str, value: dict, ttl: Optional[int]) -> None:
+        mongo_db = await get_mongo_db()
+        expires_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            seconds=ttl if ttl is not None else config.LLM_CACHE_TTL
+        )
+        await mongo_db[self.collection].update_one(
+            {"key": key},
+            {"$set": {"value": value, "expires_at": expires_at}},
+            upsert=True,
+        )
+
+
+def init_llm_cache() -> None:
+    """
+    Use the mongo backend for the LLM calls of the jobs.
+    """
+    set_llm_cache(LLMCache(MongoLLMCacheBackend(), ttl=config.LLM_CACHE_TTL))
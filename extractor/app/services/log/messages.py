@@ -1,2 +1,554 @@
-async def process_logs_for_messages(*args, **kwargs):
-    raise NotImplementedError
+"""
+Ingestion of the message logs (v3 /log endpoint).
+
+A message log event carries a conversation: a session_id and a list of messages,
+alternating between the user and the assistant. Every (user, assistant) pair of
+messages is a task of the session, and the task_position is the position of the
+pair in the conversation (starting at 1).
+
+The merge_mode of the log event tells how its messages combine with the
+conversation already stored for the session:
+- "replace": the messages are the whole conversation
+- "append": the messages follow the stored conversation
+- "resolve": if the messages start with the stored conversation, the client sent
+the whole history and they replace it. If they are the beginning of the stored
+conversation, they are already known. Otherwise, they are appended.
+
+A batch is processed in a single pass: the log events are grouped by session in
+memory, the stored conversations are loaded with one query per collection, and the
+new and changed tasks and the sessions are written with bulk upserts. The session
+length, the task positions and the last task of each session are computed during
+this pass, so there is no need to run compute_task_position afterwards.
+
+The stored conversation is rebuilt from the input and output of the stored tasks. If
+they don't alternate cleanly (a task without output before the last one, for
+instance logged through the task path), the stored tasks are kept as they are and
+the new messages are paired into the tasks that follow them.
+"""
+
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+from pymongo import DeleteMany, UpdateOne
+
+from app.core import config
+from app.db.mongo import get_mongo_db
+from app.models import MinimalLogEventForMessages
+from app.services.log.base import get_time_created_at
+from app.services.pipelines import MainPipeline
+from app.services.projects import bump_project_data_version
+from app.services.rollups import increment_rollups
+from app.services.vectorizer import get_task_vectorizer
+from phospho.lab.utils import get_tokenizer
+from phospho.models import Session, Task
+from phospho.utils import filter_nonjsonable_keys, is_jsonable
+
+# Namespace of the ids of the tasks created from messages
+MESSAGES_TASK_ID_NAMESPACE = uuid.UUID("6d2b4f0e-4c1a-4a51-9a3e-0d7c1f5b8e21")
+
+# Fields of the log event that are not copied to the task metadata
+LOG_EVENT_FIELDS = ["session_id", "messages", "merge_mode", "created_at", "metadata"]
+
+# Fields of the tasks that are updated when the conversation changes. The other
+# fields are only set when the task is created.
+TASK_UPDATED_FIELDS = [
+    "input",
+    "output",
+    "metadata",
+    "flag",
+    "test_id",
+    "task_position",
+    "is_last_task",
+]
+TOKEN_FIELDS = ["prompt_tokens", "completion_tokens", "total_tokens"]
+
+
+def get_message_task_id(project_id: str, session_id: str, task_position: int) -> str:
+    """
+    Deterministic id of the task at a position of a session. Logging the same
+    conversation twice upserts the same tasks.
+    """
+    return uuid.uuid5(
+        MESSAGES_TASK_ID_NAMESPACE, f"{project_id}/{session_id}/{task_position}"
+    ).hex
+
+
+def collect_messages_metadata(log_event: MinimalLogEventForMessages) -> dict:
+    """
+    Metadata of the tasks of a log event: the metadata of the log event, and its
+    unknown fields (user_id, version_id, ...)
+    """
+    metadata = dict(log_event.metadata or {})
+    for key, value in log_event.model_dump().items():
+        if (
+            key not in metadata.keys()
+            and key not in LOG_EVENT_FIELDS
+            and key not in Task.model_fields.keys()
+            and is_jsonable(value)
+        ):
+            metadata[key] = value
+    return filter_nonjsonable_keys(metadata)
+
+
+def merge_messages(
+    messages: List[str],
+    sources: List[Optional[int]],
+    log_event: MinimalLogEventForMessages,
+    log_event_index: int,
+) -> Tuple[List[str], List[Optional[int]]]:
+    """
+    Merge the messages of a log event into a conversation.
+
+    sources[i] is the index of the log event that sent the message i, or None if
+    the message was already stored.
+    """
+    new_messages = log_event.messages
+    if log_event.merge_mode == "replace":
+        return list(new_messages), [log_event_index] * len(new_messages)
+    if log_event.merge_mode == "resolve":
+        if new_messages[: len(messages)] == messages:
+            # The whole history was sent again
+            return (
+                list(new_messages),
+                sources + [log_event_index] * (len(new_messages) - len(messages)),
+            )
+        if messages[: len(new_messages)] == new_messages:
+            # The messages are already known
+            return messages, sources
+    return (
+        messages + new_messages,
+        sources + [log_event_index] * len(new_messages),
+    )
+
+
+def get_stored_messages(stored_tasks: List[dict]) -> Optional[List[str]]:
+    """
+    The conversation of the stored tasks, or None if it can't be paired again into
+    the same tasks: only the last task can be without output.
+    """
+    messages: List[str] = []
+    for position, task in enumerate(stored_tasks, start=1):
+        messages.append(task["input"])
+        if task.get("output") is not None:
+            messages.append(task["output"])
+        elif position < len(stored_tasks):
+            return None
+    return messages
+
+
+def count_tokens(text: Optional[str], model: Any, tokenizers: Dict[Any, Any]) -> int:
+    if text is None:
+        return 0
+    if not isinstance(model, str):
+        model = None
+    if model not in tokenizers:
+        tokenizers[model] = get_tokenizer(model)
+    return len(tokenizers[model].encode(text))
+
+
+async def load_conversations(
+    project_id: str, session_ids: List[str]
+) -> Tuple[Dict[str, dict], Dict[str, List[dict]]]:
+    """
+    Load the stored sessions and their tasks, sorted by position
+    """
+    mongo_db = await get_mongo_db()
+    existing_sessions = await (
+        mongo_db["sessions"]
+        .find(
+            {"project_id": project_id, "id": {"$in": session_ids}},
+            {"_id": 0, "id": 1, "session_length": 1},
+        )
+        .to_list(length=None)
+    )
+    sessions_in_db = {session["id"]: session for session in existing_sessions}
+
+    tasks_in_db: Dict[str, List[dict]] = defaultdict(list)
+    if len(sessions_in_db) > 0:
+        existing_tasks = await (
+            mongo_db["tasks"]
+            .find(
+                {
+                    "project_id": project_id,
+                    "session_id": {"$in": list(sessions_in_db.keys())},
+                },
+                {
+                    "_id": 0,
+                    "id": 1,
+                    "session_id": 1,
+                    "input": 1,
+                    "output": 1,
+                    "task_position": 1,
+                    "created_at": 1,
+                    **{f"metadata.{field}": 1 for field in TOKEN_FIELDS},
+                },
+            )
+            .to_list(length=None)
+        )
+        for task in existing_tasks:
+            tasks_in_db[task["session_id"]].append(task)
+        for tasks in tasks_in_db.values():
+            tasks.sort(
+                key=lambda task: (task.get("task_position") or 0, task["created_at"])
+            )
+    return sessions_in_db, tasks_in_db
+
+
+async def clean_removed_tasks(project_id: str, removed_tasks: List[dict]) -> None:
+    """
+    Remove the rollups, the events and the vectors of the tasks deleted because their
+    conversation got shorter.
+    """
+    if len(removed_tasks) == 0:
+        return
+    mongo_db = await get_mongo_db()
+    removed_task_ids = [task["id"] for task in removed_tasks]
+    await increment_rollups(
+        "tasks",
+        [{**task, "project_id": project_id} for task in removed_tasks],
+        sign=-1,
+    )
+    try:
+        events_query = {"project_id": project_id, "task_id": {"$in": removed_task_ids}}
+        removed_events = await (
+            mongo_db["events"]
+            .find(
+                events_query,
+                {"_id": 0, "project_id": 1, "event_name": 1, "created_at": 1},
+            )
+            .to_list(length=None)
+        )
+        await mongo_db["events"].delete_many(events_query)
+        await increment_rollups("events", removed_events, sign=-1)
+    except Exception as e:
+        logger.error(f"Error deleting the events of the removed tasks: {e}")
+    await get_task_vectorizer().delete(removed_task_ids)
+
+
+async def bulk_write_in_batches(
+    collection: str, operations: List[Any], batch_size: int
+) -> None:
+    if len(operations) == 0:
+        return
+    mongo_db = await get_mongo_db()
+    for i in range(0, len(operations), batch_size):
+        try:
+            await mongo_db[collection].bulk_write(
+                operations[i : i + batch_size], ordered=False
+            )
+        except Exception as e:
+            logger.error(f"Error saving {collection} to the database: {e}")
+
+
+async def process_messages_log_events(
+    project_id: str,
+    org_id: str,
+    list_of_log_event: List[MinimalLogEventForMessages],
+    trigger_pipeline: bool = True,
+    batch_size: Optional[int] = 256,
+) -> List[str]:
+    """
+    Create or update the tasks and the sessions of a list of message log events.
+    Returns the ids of the tasks that were created or changed.
+    """
+    if len(list_of_log_event) == 0:
+        logger.debug("No message log event to process")
+        return []
+    logger.info(
+        f"Project {project_id}: processing {len(list_of_log_event)} message log events"
+    )
+
+    # Group the log events by conversation, in the order they were sent
+    log_events_by_session: Dict[str, List[int]] = defaultdict(list)
+    for index, log_event in enumerate(list_of_log_event):
+        log_events_by_session[log_event.session_id].append(index)
+    for indexes in log_events_by_session.values():
+        indexes.sort(key=lambda index: list_of_log_event[index].created_at)
+
+    sessions_in_db, tasks_in_db = await load_conversations(
+        project_id, list(log_events_by_session.keys())
+    )
+
+    metadata_by_log_event: Dict[int, dict] = {}
+    tokenizers: Dict[Any, Any] = {}
+    task_operations: List[Any] = []
+    session_operations: List[UpdateOne] = []
+    created_tasks: List[dict] = []
+    created_sessions: List[dict] = []
+    removed_tasks: List[dict] = []
+    tasks_id_to_process: List[str] = []
+
+    for session_id, indexes in log_events_by_session.items():
+        stored_tasks = tasks_in_db.get(session_id, [])
+        # Number of stored tasks kept as they are, before the merged messages
+        nb_kept_tasks = 0
+        stored_messages = get_stored_messages(stored_tasks)
+        if stored_messages is None:
+            nb_kept_tasks = len(stored_tasks)
+            stored_messages = []
+        messages = stored_messages
+        sources: List[Optional[int]] = [None] * len(messages)
+        for index in indexes:
+            if list_of_log_event[index].merge_mode == "replace":
+                nb_kept_tasks = 0
+            messages, sources = merge_messages(
+                messages, sources, list_of_log_event[index], index
+            )
+
+        # Pair the messages into tasks and compare them to the stored ones
+        session_length = nb_kept_tasks + (len(messages) + 1) // 2
+        session_tokens = {field: 0 for field in TOKEN_FIELDS}
+        first_task: Optional[Task] = None
+        for position in range(1, session_length + 1):
+            stored_task = None
+            if position <= len(stored_tasks):
+                stored_task = stored_tasks[position - 1]
+            if position <= nb_kept_tasks:
+                task_input = stored_tasks[position - 1]["input"]
+                task_output = stored_tasks[position - 1].get("output")
+            else:
+                message_index = 2 * (position - nb_kept_tasks) - 2
+                task_input = messages[message_index]
+                task_output = None
+                if message_index + 1 < len(messages):
+                    task_output = messages[message_index + 1]
+            is_last_task = position == session_length
+            if (
+                stored_task is not None
+                and stored_task["input"] == task_input
+                and stored_task.get("output") == task_output
+            ):
+                stored_metadata = stored_task.get("metadata") or {}
+                for field in TOKEN_FIELDS:
+                    if isinstance(stored_metadata.get(field), int):
+                        session_tokens[field] += stored_metadata[field]
+                if position == 1:
+                    first_task = Task(
+                        project_id=project_id, input=task_input, output=task_output
+                    )
+                # Only the last task flag of the former and the new last task change
+                last_task_changed = session_length != len(stored_tasks) and (
+                    position in [len(stored_tasks), session_length]
+                )
+                if stored_task.get("task_position") != position or last_task_changed:
+                    task_operations.append(
+                        UpdateOne(
+                            {"id": stored_task["id"]},
+                            {
+                                "$set": {
+                                    "task_position": position,
+                                    "is_last_task": is_last_task,
+                                }
+                            },
+                        )
+                    )
+                continue
+
+            # The task is new or its messages changed
+            source_index = sources[min(message_index + 1, len(messages) - 1)]
+            if source_index is None:
+                source_index = indexes[-1]
+            log_event = list_of_log_event[source_index]
+            if source_index not in metadata_by_log_event:
+                metadata_by_log_event[source_index] = collect_messages_metadata(
+                    log_event
+                )
+            metadata = dict(metadata_by_log_event[source_index])
+            model = metadata.get("model")
+            if "prompt_tokens" not in metadata:
+                metadata["prompt_tokens"] = count_tokens(task_input, model, tokenizers)
+            if "completion_tokens" not in metadata:
+                metadata["completion_tokens"] = count_tokens(
+                    task_output, model, tokenizers
+                )
+            if "total_tokens" not in metadata:
+                prompt_tokens = metadata["prompt_tokens"]
+                completion_tokens = metadata["completion_tokens"]
+                metadata["total_tokens"] = None
+                if isinstance(prompt_tokens, int) and isinstance(
+                    completion_tokens, int
+                ):
+                    metadata["total_tokens"] = prompt_tokens + completion_tokens
+            for field in TOKEN_FIELDS:
+                if isinstance(metadata.get(field), int):
+                    session_tokens[field] += metadata[field]
+
+            task = Task(
+                id=(
+                    stored_task["id"]
+                    if stored_task is not None
+                    else get_message_task_id(project_id, session_id, position)
+                ),
+                project_id=project_id,
+                org_id=org_id,
+                created_at=get_time_created_at(None, log_event.created_at),
+                session_id=session_id,
+                input=task_input,
+                output=task_output,
+                metadata=metadata,
+                data=None,
+                flag=log_event.flag,
+                test_id=log_event.test_id,
+                task_position=position,
+                is_last_task=is_last_task,
+            )
+            if position == 1:
+                first_task = task
+            task_data = task.model_dump()
+            task_operations.append(
+                UpdateOne(
+                    {"id": task.id},
+                    {
+                        "$set": {
+                            field: task_data[field] for field in TASK_UPDATED_FIELDS
+                        },
+                        "$setOnInsert": {
+                            field: value
+                            for field, value in task_data.items()
+                            if field not in TASK_UPDATED_FIELDS
+                        },
+                    },
+                    upsert=True,
+                )
+            )
+            tasks_id_to_process.append(task.id)
+            if stored_task is None:
+                created_tasks.append(task_data)
+
+        # The conversation is shorter than the stored one
+        removed_task_ids = [task["id"] for task in stored_tasks[session_length:]]
+        if len(removed_task_ids) > 0:
+            task_operations.append(DeleteMany({"id": {"$in": removed_task_ids}}))
+            removed_tasks.extend(stored_tasks[session_length:])
+
+        session_fields: Dict[str, Any] = {
+            "session_length": session_length,
+            "preview": first_task.preview() if first_task is not None else None,
+            **{f"metadata.{field}": value for field, value in session_tokens.items()},
+        }
+        if session_id not in sessions_in_db:
+            first_log_event = list_of_log_event[indexes[0]]
+            session = Session(
+                id=session_id,
+                created_at=get_time_created_at(None, first_log_event.created_at),
+                project_id=project_id,
+                org_id=org_id,
+                metadata=session_tokens,
+                data={},
+                preview=session_fields["preview"],
+                session_length=session_length,
+            )
+            session_data = session.model_dump()
+            created_sessions.append(session_data)
+            session_operations.append(
+                UpdateOne(
+                    {"id": session_id, "project_id": project_id},
+                    {
+                        "$set": session_fields,
+                        "$setOnInsert": {
+                            field: value
+                            for field, value in session_data.items()
+                            # The metadata is set field by field
+                            if field not in ["session_length", "preview", "metadata"]
+                        },
+                    },
+                    upsert=True,
+                )
+            )
+        else:
+            session_operations.append(
+                UpdateOne(
+                    {"id": session_id, "project_id": project_id},
+                    {"$set": session_fields},
+                )
+            )
+
+    logger.info(
+        f"Project {project_id}: writing {len(task_operations)} task operations and "
+        + f"{len(session_operations)} sessions"
+    )
+    await bulk_write_in_batches(
+        "tasks", task_operations, config.MESSAGES_WRITE_BATCH_SIZE
+    )
+    await bulk_write_in_batches(
+        "sessions", session_operations, config.MESSAGES_WRITE_BATCH_SIZE
+    )
+    await increment_rollups("tasks", created_tasks)
+    await increment_rollups("sessions", created_sessions)
+    await clean_removed_tasks(project_id, removed_tasks)
+
+    if trigger_pipeline and len(tasks_id_to_process) > 0:
+        logger.info(f"Triggering pipeline for {len(tasks_id_to_process)} tasks")
+        get_task_vectorizer().enqueue(tasks_id_to_process)
+        main_pipeline = MainPipeline(
+            project_id=project_id,
+            org_id=org_id,
+        )
+        # Batch the processing
+        if batch_size is not None:
+            for i in range(0, len(tasks_id_to_process), batch_size):
+                await main_pipeline.set_input(
+                    tasks_ids=tasks_id_to_process[i : i + batch_size]
+                )
+                await main_pipeline.run()
+        else:
+            await main_pipeline.set_input(tasks_ids=tasks_id_to_process)
+            await main_pipeline.run()
+
+    return tasks_id_to_process
+
+
+async def process_logs_for_messages(
+    project_id: str,
+    org_id: str,
+    logs_to_process: List[MinimalLogEventForMessages],
+    extra_logs_to_save: List[MinimalLogEventForMessages],
+) -> None:
+    """From message logs
+    - Create or update the Tasks of the conversations
+    - Create or update the Sessions
+    - Trigger the Tasks processing pipeline
+    """
+    mongo_db = await get_mongo_db()
+    logger.info(
+        f"Project {project_id}: processing {len(logs_to_process)} message log events"
+    )
+
+    # Save the log events
+    log_events = logs_to_process + extra_logs_to_save
+    if len(log_events) > 0:
+        try:
+            await mongo_db["logs"].insert_many(
+                [
+                    {"project_id": project_id, **log_event.model_dump()}
+                    for log_event in log_events
+                ],
+                ordered=False,
+            )
+        except Exception as e:
+            error_mesagge = f"Error saving logs to the database: {e}"
+            logger.error(error_mesagge)
+
+    await process_messages_log_events(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=logs_to_process,
+    )
+
+    if len(extra_logs_to_save) > 0:
+        logger.info(
+            f"Project {project_id}: saving {len(extra_logs_to_save)} extra message log events"
+        )
+        await process_messages_log_events(
+            project_id=project_id,
+            org_id=org_id,
+            list_of_log_event=extra_logs_to_save,
+            trigger_pipeline=False,
+        )
+
+    # Invalidate the cached analytics of the project
+    await bump_project_data_version(project_id)
+
+    return None
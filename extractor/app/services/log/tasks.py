@@ -1,75 +1,38 @@
+from collections import defaultdict
 from typing import Any, Dict, List, Optional, Tuple
 
-import openai
 from loguru import logger
+from pymongo import UpdateOne
 
 from app.models import LogEventForTasks
 from app.core import config
 from app.db.mongo import get_mongo_db
-from app.db.qdrant import get_qdrant, models
 from app.services.log.base import (
     collect_metadata,
     convert_additional_data_to_dict,
     get_time_created_at,
 )
 from app.services.pipelines import MainPipeline
+from app.services.projects import bump_project_data_version
+from app.services.rollups import increment_rollups
 from app.services.tasks import compute_task_position
+from app.services.vectorizer import get_task_vectorizer
 from app.utils import generate_uuid
 from phospho.models import Session, Task
 
 
 async def add_vectorized_tasks(tasks_id: List[str]):
     """
-    Compute the vector representation of the tasks and add them to Qdrant database
+    Compute the vector representation of the tasks and add them to Qdrant database.
+    To vectorize the tasks in the background, by batches, use
+    get_task_vectorizer().enqueue() instead.
     """
     if config.ENVIRONMENT == "preview":
         logger.info("Vectorization is disabled in preview")
         return
 
     logger.info(f"Vectorizing {len(tasks_id)} tasks and adding them to Qdrant")
-    mongo_db = await get_mongo_db()
-    qdrant_db = await get_qdrant()
-    if qdrant_db is None:
-        return
-    # Get tasks
-    tasks = await mongo_db["tasks"].find({"id": {"$in": tasks_id}}).to_list(length=None)
-    tasks = [Task.model_validate(task) for task in tasks]
-
-    openai_client = openai.AsyncClient()
-
-    # Create tasks_text representations
-    tasks_text = [f"{task.input} {task.output}" for task in tasks]
-    try:
-        # TODO : count the number of token for each task_text and if it's too big, do something smart
-        embedding = await openai_client.embeddings.create(
-            input=tasks_text, model="text-embedding-3-small"
-        )
-    except openai.APIError as e:
-        logger.warning(f"Error while embedding the tasks: {e}")
-        return
-
-    try:
-        await qdrant_db.upsert(
-            collection_name="tasks",
-            points=[
-                models.PointStruct(
-                    id=task.id,
-                    vector=embedding.embedding,
-                    payload={
-                        "task_id": task.id,
-                        "project_id": task.project_id,
-                        "session_id": task.session_id,
-                        "created_at": task.created_at,
-                        "org_id": task.org_id,
-                        "metadata": task.metadata,
-                    },
-                )
-                for task, embedding in zip(tasks, embedding.data)
-            ],
-        )
-    except Exception as e:
-        logger.warning(f"Error while adding the tasks to Qdrant: {e}")
-        return
+    await get_task_vectorizer().vectorize(tasks_id)
 
 
 def create_task_from_logevent(
@@ -113,29 +76,33 @@ async def ignore_existing_tasks(
     tasks_id_to_process: List[str],
 ) -> Tuple[List[Dict[str, object]], List[str]]:
     """
-    Filter out tasks that already exist in the database
+    Filter out tasks that already exist in the database, and the duplicates of the batch
     """
     mongo_db = await get_mongo_db()
+    task_ids = list({task["id"] for task in tasks_to_create})
     existing_tasks = (
         await mongo_db["tasks"]
-        .find({"id": {"$in": [task["id"] for task in tasks_to_create]}})
-        .to_list(length=len(tasks_to_create))
+        .find({"id": {"$in": task_ids}}, {"_id": 0, "id": 1})
+        .to_list(length=len(task_ids))
     )
-    existing_task_ids = [task["id"] for task in existing_tasks]
+    existing_task_ids = {task["id"] for task in existing_tasks}
+
+    seen_task_ids = set(existing_task_ids)
     new_tasks_to_create = []
     for task in tasks_to_create:
-        if (
-            task["id"] not in existing_task_ids
-            and task["id"] not in new_tasks_to_create
-        ):
+        if task["id"] not in seen_task_ids:
+            seen_task_ids.add(task["id"])
             new_tasks_to_create.append(task)
 
     # Filter tasks_id_to_process
-    tasks_id_to_process = [
-        task_id for task_id in tasks_id_to_process if task_id not in existing_task_ids
-    ]
+    seen_task_ids = set(existing_task_ids)
+    new_tasks_id_to_process = []
+    for task_id in tasks_id_to_process:
+        if task_id not in seen_task_ids:
+            seen_task_ids.add(task_id)
+            new_tasks_id_to_process.append(task_id)
 
-    return new_tasks_to_create, tasks_id_to_process
+    return new_tasks_to_create, new_tasks_id_to_process
 
 
 async def process_log_without_session_id(
@@ -183,14 +150,15 @@ async def process_log_without_session_id(
     if len(tasks_to_create) > 0:
         try:
             await mongo_db["tasks"].insert_many(tasks_to_create, ordered=False)
+            await increment_rollups("tasks", tasks_to_create)
         except Exception as e:
             error_mesagge = f"Error saving tasks to the database: {e}"
             logger.error(error_mesagge)
 
     if trigger_pipeline:
         logger.info(f"Triggering pipeline for {len(tasks_id_to_process)} tasks")
-        # Vectorize them
-        # await add_vectorized_tasks(tasks_id_to_process)
+        # Vectorize them in the background
+        get_task_vectorizer().enqueue(tasks_id_to_process)
         main_pipeline = MainPipeline(
             project_id=project_id,
             org_id=org_id,
@@ -218,6 +186,9 @@ async def process_log_with_session_id(
 ) -> None:
     """
     Process a list of log events with session_id
+
+    The new tasks are grouped by session: every session gets a single upsert that
+    increments its length and token counts, whatever its number of new tasks.
     """
     if len(list_of_log_event) == 0:
         logger.debug("No log event with session_id to process")
@@ -227,32 +198,9 @@ async def process_log_with_session_id(
         f"Project {project_id}: processing {len(list_of_log_event)} log events with session_id"
     )
     tasks_id_to_process: List[str] = []
-    tasks_to_create: List[Dict[str, object]] = []
-    sessions_to_create: Dict[str, Dict[str, Any]] = {}
-    sessions_to_earliest_task: Dict[str, Task] = {}
+    tasks_to_create: List[Dict[str, Any]] = []
 
     mongo_db = await get_mongo_db()
-    sessions_ids_already_in_db = (
-        await mongo_db["sessions"]
-        .aggregate(
-            [
-                {
-                    "$match": {
-                        "id": {
-                            "$in": [
-                                log_event.session_id for log_event in list_of_log_event
-                            ]
-                        }
-                    }
-                },
-                {"$project": {"id": 1}},
-            ]
-        )
-        .to_list(length=len(list_of_log_event))
-    )
-    sessions_ids_already_in_db = [
-        str(session["id"]) for session in sessions_ids_already_in_db
-    ]
 
     for log_event in list_of_log_event:
         if log_event.project_id is None:
@@ -261,63 +209,6 @@ async def process_log_with_session_id(
         # Calculate log_event metadata
         log_event_metadata = collect_metadata(log_event)
 
-        # Only create a new session if the session doesn't exist in db
-        session_is_in_db = log_event.session_id in sessions_ids_already_in_db
-
-        session_project_id = project_id
-        if log_event.project_id is not None:
-            session_project_id = log_event.project_id
-
-        if (
-            log_event.session_id is not None
-            and not session_is_in_db
-            and log_event.session_id not in sessions_to_create.keys()
-        ):
-            # Add to sessions to create
-            session_data: Dict[str, Any] = {
-                "id": log_event.session_id,
-                "project_id": session_project_id,
-                # Note: there is no metadata and data
-                "metadata": {
-                    "total_tokens": log_event_metadata.get("total_tokens", 0),
-                    "prompt_tokens": log_event_metadata.get("prompt_tokens", 0),
-                    "completion_tokens": log_event_metadata.get("completion_tokens", 0),
-                },
-                "data": {},
-                "session_length": 1,
-            }
-            # The sessions will be created later, once we know the earliest task creation time
-            sessions_to_create[log_event.session_id] = session_data
-        elif (
-            log_event.session_id is not None
-            and log_event.session_id in sessions_to_create.keys()
-        ):
-            # Increment the session length of the session to create
-            sessions_to_create[log_event.session_id]["session_length"] += 1
-        elif log_event.session_id is not None and session_is_in_db:
-            # Increment the session length, total_tokens, prompt_tokens and completion_tokens in the database
-            mongo_db["sessions"].update_one(
-                {"id": log_event.session_id},
-                {
-                    "$inc": {
-                        "session_length": 1,
-                        "metadata.total_tokens": log_event_metadata.get(
-                            "total_tokens", 0
-                        ),
-                        "metadata.prompt_tokens": log_event_metadata.get(
-                            "prompt_tokens", 0
-                        ),
-                        "metadata.completion_tokens": log_event_metadata.get(
-                            "completion_tokens", 0
-                        ),
-                    }
-                },
-            )
-        else:
-            logger.info(
-                "Log event: session with no session_id, skipping session creation"
-            )
-
         task = create_task_from_logevent(
             org_id=org_id,
             project_id=log_event.project_id,
@@ -328,83 +219,126 @@ async def process_log_with_session_id(
         tasks_id_to_process.append(task.id)
         tasks_to_create.append(task.model_dump())
 
-        # Update the session creation time if needed
-        if log_event.session_id is not None:
-            if log_event.session_id not in sessions_to_earliest_task.keys():
-                sessions_to_earliest_task[log_event.session_id] = task
-            else:
-                # Update it if lower
-                if (
-                    task.created_at
-                    < sessions_to_earliest_task[log_event.session_id].created_at
-                ):
-                    sessions_to_earliest_task[log_event.session_id] = task
-
-    # Create the tasks
+    # Only the new tasks count in the sessions
     tasks_to_create, tasks_id_to_process = await ignore_existing_tasks(
         tasks_to_create, tasks_id_to_process
     )
+
+    tasks_by_session: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for task_data in tasks_to_create:
+        if task_data["session_id"] is not None:
+            tasks_by_session[task_data["session_id"]].append(task_data)
+        else:
+            logger.info(
+                "Log event: session with no session_id, skipping session creation"
+            )
+
+    existing_sessions = (
+        await mongo_db["sessions"]
+        .find({"id": {"$in": list(tasks_by_session.keys())}}, {"_id": 0, "id": 1})
+        .to_list(length=len(tasks_by_session))
+    )
+    sessions_ids_already_in_db = {session["id"] for session in existing_sessions}
+
+    # One aggregated upsert per session
+    sessions_operations: List[UpdateOne] = []
+    sessions_to_create: List[Optional[Dict[str, Any]]] = []
+    for session_id, session_tasks in tasks_by_session.items():
+        session_tasks.sort(key=lambda task_data: task_data["created_at"])
+        token_counts = {"total_tokens": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        for task_data in session_tasks:
+            task_metadata = task_data["metadata"] or {}
+            for field in token_counts.keys():
+                if isinstance(task_metadata.get(field), int):
+                    token_counts[field] += task_metadata[field]
+
+        session_data: Optional[Dict[str, Any]] = None
+        if session_id not in sessions_ids_already_in_db:
+            # The positions of the tasks of a new session are known
+            for position, task_data in enumerate(session_tasks, start=1):
+                task_data["task_position"] = position
+                task_data["is_last_task"] = position == len(session_tasks)
+            earliest_task = session_tasks[0]
+            session = Session(
+                id=session_id,
+                created_at=earliest_task["created_at"],
+                project_id=earliest_task["project_id"],
+                org_id=org_id,
+                metadata=token_counts,
+                data={},
+                preview=Task.model_validate(earliest_task).preview(),
+                session_length=len(session_tasks),
+            )
+            session_data = session.model_dump()
+
+        session_update: Dict[str, Any] = {
+            "$inc": {
+                "session_length": len(session_tasks),
+                **{
+                    f"metadata.{field}": value
+                    for field, value in token_counts.items()
+                },
+            }
+        }
+        if session_data is not None:
+            session_update["$setOnInsert"] = {
+                field: value
+                for field, value in session_data.items()
+                # Those fields are incremented
+                if field not in ["session_length", "metadata"]
+            }
+        sessions_operations.append(
+            UpdateOne(
+                {"id": session_id}, session_update, upsert=session_data is not None
+            )
+        )
+        sessions_to_create.append(session_data)
+
+    # Create the tasks
     if len(tasks_to_create) > 0:
         try:
             await mongo_db["tasks"].insert_many(tasks_to_create, ordered=False)
+            await increment_rollups("tasks", tasks_to_create)
         except Exception as e:
             error_mesagge = f"Error saving tasks to the database: {e}"
             logger.error(error_mesagge)
 
-    # Add sessions to database
-    if len(sessions_to_create) > 0:
-        sessions_to_create_dump: List[dict] = []
-        for session_id, session_data in sessions_to_create.items():
-            # logger.info(
-            #     f"Logevent: creating session with session_id {session_id} from log event"
-            # )
-            # Verify if the session already exists
-            session_is_in_db = session_id in sessions_ids_already_in_db
-            if session_is_in_db:
-                # Increment the session length in the database
-                await mongo_db["sessions"].update_one(
-                    {"id": session_id},
-                    {
-                        "$inc": {"session_length": session_data["session_length"]},
-                    },
-                )
-            else:
-                session = Session(
-                    id=session_id,
-                    created_at=sessions_to_earliest_task[session_id].created_at,
-                    project_id=session_data["project_id"],
-                    org_id=org_id,
-                    metadata=session_data["metadata"],
-                    data=session_data["data"],
-                    preview=sessions_to_earliest_task[session_id].preview(),
-                    session_length=session_data["session_length"],
-                )
-                sessions_to_create_dump.append(session.model_dump())
-
-        if len(sessions_to_create_dump) > 0:
+    # Add the sessions to database
+    if len(sessions_operations) > 0:
+        try:
+            result = await mongo_db["sessions"].bulk_write(
+                sessions_operations, ordered=False
+            )
+            created_sessions = [
+                sessions_to_create[index]
+                for index in result.upserted_ids.keys()
+                if sessions_to_create[index] is not None
+            ]
             logger.info(
-                f"Creating sessions: {' '.join([session_id for session_id in sessions_to_create.keys()])}"
+                f"Created {len(created_sessions)} sessions and updated "
+                + f"{result.modified_count} sessions"
             )
-            try:
-                insert_result = await mongo_db["sessions"].insert_many(
-                    sessions_to_create_dump, ordered=False
-                )
-                logger.info(f"Created {len(insert_result.inserted_ids)} sessions")
-            except Exception as e:
-                error_mesagge = f"Error saving sessions to the database: {e}"
-                logger.error(error_mesagge)
+            await increment_rollups("sessions", created_sessions)  # type: ignore
+        except Exception as e:
+            error_mesagge = f"Error saving sessions to the database: {e}"
+            logger.error(error_mesagge)
     else:
         logger.info("Logevent: no session to create")
 
-    # Compute the task position
-    await compute_task_position(
-        project_id=project_id,
-        session_ids=list(sessions_to_create.keys()) + sessions_ids_already_in_db,
-    )
+    # Compute the task position in the sessions that already had tasks
+    updated_session_ids = [
+        session_id
+        for session_id in tasks_by_session.keys()
+        if session_id in sessions_ids_already_in_db
+    ]
+    if len(updated_session_ids) > 0:
+        await compute_task_position(
+            project_id=project_id, session_ids=updated_session_ids
+        )
 
     if trigger_pipeline:
         logger.info(f"Triggering pipeline for {len(tasks_id_to_process)} tasks")
-        # await add_vectorized_tasks(tasks_id_to_process)
+        get_task_vectorizer().enqueue(tasks_id_to_process)
         main_pipeline = MainPipeline(
             project_id=project_id,
             org_id=org_id,
@@ -509,4 +443,7 @@ async def process_logs_for_tasks(
             trigger_pipeline=False,
         )
 
+    # Invalidate the cached analytics of the project
+    await bump_project_data_version(project_id)
+
     return None
@@ -1,7 +1,8 @@
+import functools
 import time
 from collections import defaultdict
 import traceback
-from typing import Dict, List, Literal, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional, Tuple
 
 from app.utils import generate_uuid
 from loguru import logger
@@ -16,9 +17,10 @@ from app.db.models import (
 )
 from app.db.mongo import get_mongo_db
 from app.services.data import fetch_previous_tasks
-from app.services.projects import get_project_by_id
+from app.services.projects import bump_project_data_version, get_project_by_id
+from app.services.rollups import increment_rollups
 from app.services.sentiment_analysis import call_sentiment_and_language_api
-from app.services.webhook import trigger_webhook
+from app.services.webhook import get_webhook_dispatcher
 from phospho import lab
 from phospho.models import (
     JobResult,
@@ -38,17 +40,59 @@ class EventConfig(lab.JobConfig):
     event_description: str
 
 
+def profiled_stage(
+    stage: str,
+) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+    """
+    Record the duration and the LLM usage of a stage of the pipeline in its profiler
+    """
+
+    def decorator(method: Callable[..., Awaitable[Any]]):
+        @functools.wraps(method)
+        async def wrapper(self: "MainPipeline", *args, **kwargs):
+            with self.profiler.span(
+                f"pipeline.{stage}", stats_key=stage, project_id=self.project_id
+            ):
+                return await method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 class MainPipeline:
     project_id: str
     project: Optional[Project] = None
     messages: List[lab.Message]
+    # Duration, LLM usage and errors of the stages and of the jobs
+    profiler: lab.Profiler
 
     def __init__(self, project_id: str, org_id: str):
         self.project_id = project_id
         self.org_id = org_id
         self.project = None
         self.messages = []
+        self.profiler = lab.Profiler()
+
+    def log_profile(self) -> None:
+        """
+        Log the metrics of the stages of the pipeline and of the jobs.
+        The time outside of the LLM calls is spent in Mongo, other APIs or Python.
+        """
+        for operation, stats in self.profiler.profile().items():
+            wall_time = stats["wall_time"]
+            if wall_time["count"] == 0:
+                continue
+            logger.info(
+                f"Pipeline profile for project {self.project_id}: {operation} ran {stats['runs']} times "
+                + f"(errors: {stats['errors']}) in {wall_time['mean']:.3f}s on average "
+                + f"(p95: {wall_time['p95']:.3f}s), total LLM time {stats['llm_time']:.2f}s, "
+                + f"total other time {stats['other_time']:.2f}s, {stats['llm_calls']} LLM calls, "
+                + f"{stats['prompt_tokens']} prompt tokens, {stats['completion_tokens']} completion tokens, "
+                + f"{stats['retries']} retries"
+            )
 
+    @profiled_stage("set_input")
     async def set_input(
         self,
         task: Optional[Task] = None,
@@ -303,6 +347,7 @@ class MainPipeline:
                 )
             )
 
+    @profiled_stage("run_events")
     async def run_events(
         self, recipe: Optional[Recipe] = None
     ) -> Dict[str, List[Event]]:
@@ -326,101 +371,117 @@ class MainPipeline:
             self.workload.project_id = recipe.project_id
         else:
             self.workload = lab.Workload.from_phospho_project_config(self.project)
+        # Aggregate the metrics of the jobs with the ones of the stages
+        self.workload.profiler = self.profiler
         logger.info(
             f"Running event detection pipeline for project {self.project_id} on {len(self.messages)} messages with {len(self.workload.jobs)} jobs"
         )
-        # Run
-        await self.workload.async_run(
-            messages=self.messages, executor_type="parallel_jobs"
-        )
-
-        if self.workload.results is None or self.workload.jobs is None:
-            logger.error("Worlkload.results is None")
-            return {}
-
+        messages_by_id = {message.id: message for message in self.messages}
         events_per_task_to_return: Dict[str, List[Event]] = defaultdict(list)
         events_to_push_to_db: List[dict] = []
         job_results_to_push_to_db: List[dict] = []
         llm_calls_to_push_to_db: List[dict] = []
 
-        # Iter over the results
-        for message in self.messages:
-            results = self.workload.results.get(message.id, {})
-            for event_name, result in results.items():
-                # event_name is the primary key of the table
-                # Get back the event definition from the job metadata
-                event_definition = EventDefinition.model_validate(
-                    self.workload.jobs[result.job_id].metadata
-                )
-                task = message.metadata.get("task", None)
-                task_id = task.id if task is not None else None
-                session_id = task.session_id if task is not None else None
-
-                # Store the LLM call in the database
-                llm_call = result.metadata.get("llm_call", None)
-                if llm_call is not None:
-                    llm_call_obj = LlmCall(
-                        **llm_call,
-                        org_id=self.org_id,
-                        task_id=task_id,
-                        recipe_id=result.job_metadata.get("recipe_id"),
-                    )
-                    llm_calls_to_push_to_db.append(llm_call_obj.model_dump())
-                else:
-                    logger.warning(f"No LLM call detected for event {event_name}")
+        async def flush_to_db() -> None:
+            """
+            Save the detected events and jobs results in the database
+            """
+            with self.profiler.span(
+                "pipeline.run_events.flush_to_db", stats_key="run_events.flush_to_db"
+            ):
+                await _flush_to_db()
 
-                detected_event_data = Event(
-                    event_name=event_name,
-                    # Events detected at the session scope are not linked to a task
-                    task_id=task_id,
-                    session_id=session_id,
-                    project_id=self.project_id,
-                    source=result.metadata.get("evaluation_source", "phospho-unknown"),
-                    webhook=event_definition.webhook,
+        async def _flush_to_db() -> None:
+            mongo_db = await get_mongo_db()
+            if len(events_to_push_to_db) > 0:
+                try:
+                    await mongo_db["events"].insert_many(events_to_push_to_db)
+                    await increment_rollups("events", events_to_push_to_db)
+                except Exception as e:
+                    logger.error(f"Error saving detected events to the database: {e}")
+            if len(llm_calls_to_push_to_db) > 0:
+                try:
+                    await mongo_db["llm_calls"].insert_many(llm_calls_to_push_to_db)
+                except Exception as e:
+                    logger.error(f"Error saving LLM calls to the database: {e}")
+            if len(job_results_to_push_to_db) > 0:
+                try:
+                    await mongo_db["job_results"].insert_many(job_results_to_push_to_db)
+                except Exception as e:
+                    logger.error(f"Error saving job results to the database: {e}")
+            events_to_push_to_db.clear()
+            llm_calls_to_push_to_db.clear()
+            job_results_to_push_to_db.clear()
+
+        # Run. The results are processed as soon as they are available, and saved
+        # in the database by batches.
+        async for message_id, event_name, result in self.workload.stream(
+            self.messages,
+            max_parallelism=config.EVENT_DETECTION_MAX_PARALLELISM,
+        ):
+            message = messages_by_id[message_id]
+            # event_name is the primary key of the table
+            # Get back the event definition from the job metadata
+            event_definition = EventDefinition.model_validate(
+                self.workload.jobs[result.job_id].metadata
+            )
+            task = message.metadata.get("task", None)
+            task_id = task.id if task is not None else None
+            session_id = task.session_id if task is not None else None
+
+            # Store the LLM call in the database
+            llm_call = result.metadata.get("llm_call", None)
+            if llm_call is not None:
+                llm_call_obj = LlmCall(
+                    **llm_call,
                     org_id=self.org_id,
-                    event_definition=event_definition,
-                    task=task,
-                    score_range=result.metadata.get("score_range", None),
+                    task_id=task_id,
+                    recipe_id=result.job_metadata.get("recipe_id"),
                 )
+                llm_calls_to_push_to_db.append(llm_call_obj.model_dump())
+            else:
+                logger.warning(f"No LLM call detected for event {event_name}")
+
+            detected_event_data = Event(
+                event_name=event_name,
+                # Events detected at the session scope are not linked to a task
+                task_id=task_id,
+                session_id=session_id,
+                project_id=self.project_id,
+                source=result.metadata.get("evaluation_source", "phospho-unknown"),
+                webhook=event_definition.webhook,
+                org_id=self.org_id,
+                event_definition=event_definition,
+                task=task,
+                score_range=result.metadata.get("score_range", None),
+            )
 
-                if result.value:
-                    logger.info(f"Event {event_name} detected for task {task_id}")
-                    if (
-                        event_definition.webhook is not None
-                        and event_definition.webhook != ""
-                    ):
-                        logger.info(f"Webhook url: {event_definition.webhook}")
-                        await trigger_webhook(
-                            url=event_definition.webhook,
-                            json=detected_event_data.model_dump(),
-                            headers=event_definition.webhook_headers,
-                        )
-                    events_to_push_to_db.append(detected_event_data.model_dump())
-
-                events_per_task_to_return[task_id].append(detected_event_data)
-                # Save the prediction
-                result.task_id = task_id
-                if result.job_metadata.get("recipe_id") is None:
-                    logger.error(f"No recipe_id found for event {event_name}.")
-                job_results_to_push_to_db.append(result.model_dump())
-
-        # Save the detected events and jobs results in the database
-        mongo_db = await get_mongo_db()
-        if len(events_to_push_to_db) > 0:
-            try:
-                await mongo_db["events"].insert_many(events_to_push_to_db)
-            except Exception as e:
-                logger.error(f"Error saving detected events to the database: {e}")
-        if len(llm_calls_to_push_to_db) > 0:
-            try:
-                await mongo_db["llm_calls"].insert_many(llm_calls_to_push_to_db)
-            except Exception as e:
-                logger.error(f"Error saving LLM calls to the database: {e}")
-        if len(job_results_to_push_to_db) > 0:
-            try:
-                await mongo_db["job_results"].insert_many(job_results_to_push_to_db)
-            except Exception as e:
-                logger.error(f"Error saving job results to the database: {e}")
+            if result.value:
+                logger.info(f"Event {event_name} detected for task {task_id}")
+                if (
+                    event_definition.webhook is not None
+                    and event_definition.webhook != ""
+                ):
+                    logger.info(f"Webhook url: {event_definition.webhook}")
+                    # Sent in the background: the pipeline doesn't wait for the receiver
+                    get_webhook_dispatcher().dispatch(
+                        url=event_definition.webhook,
+                        json=detected_event_data.model_dump(mode="json"),
+                        headers=event_definition.webhook_headers,
+                        batch=event_definition.webhook_batch,
+                    )
+                events_to_push_to_db.append(detected_event_data.model_dump())
+
+            events_per_task_to_return[task_id].append(detected_event_data)
+            # Save the prediction
+            result.task_id = task_id
+            if result.job_metadata.get("recipe_id") is None:
+                logger.error(f"No recipe_id found for event {event_name}.")
+            job_results_to_push_to_db.append(result.model_dump())
+            if len(job_results_to_push_to_db) >= config.EVENT_DETECTION_FLUSH_EVERY:
+                await flush_to_db()
+
+        await flush_to_db()
 
         return events_per_task_to_return
 
@@ -456,6 +517,7 @@ class MainPipeline:
                 },
             )
 
+    @profiled_stage("session_stats")
     async def compute_session_info_pipeline(self) -> Dict[str, SessionStats]:
         """
         Compute session information from its tasks
@@ -565,6 +627,7 @@ class MainPipeline:
 
         return outputs
 
+    @profiled_stage("sentiment")
     async def run_sentiment_and_language(
         self,
     ) -> Tuple[Dict[str, Optional[SentimentObject]], Dict[str, Optional[str]]]:
@@ -715,6 +778,9 @@ class MainPipeline:
             raise NotImplementedError(
                 f"Recipe type {recipe.recipe_type} not implemented"
             )
+        # Invalidate the cached analytics of the project
+        await bump_project_data_version(self.project_id)
+        self.log_profile()
 
     async def run(self) -> PipelineResults:
         """
@@ -750,7 +816,11 @@ class MainPipeline:
         except Exception as e:
             logger.error(f"Error updating the version id: {e}")
 
+        # Invalidate the cached analytics of the project
+        await bump_project_data_version(self.project_id)
+
         logger.info("Main pipeline completed")
+        self.log_profile()
         return PipelineResults(
             events=events,
             language=languages,
@@ -1,4 +1,5 @@
 from loguru import logger
+from app.utils import generate_timestamp
 from app.db.mongo import get_mongo_db
 from app.db.models import Project, Recipe
 
@@ -99,3 +100,19 @@ async def get_project_by_id(project_id: str) -> Project:
         )
 
     return project
+
+
+async def bump_project_data_version(project_id: str) -> None:
+    """
+    Increment the data version of a project. The backend uses this version in the keys
+    of its analytics cache: bumping it invalidates the cached dashboards of the project.
+    """
+    mongo_db = await get_mongo_db()
+    try:
+        await mongo_db["project_data_versions"].update_one(
+            {"project_id": project_id},
+            {"$inc": {"version": 1}, "$set": {"updated_at": generate_timestamp()}},
+            upsert=True,
+        )
+    except Exception as e:
+        logger.warning(f"Error bumping the data version of project {project_id}: {e}")
@@ -0,0 +1,111 @@
+"""
+Incremental updates of the analytics rollups.
+
+The backend answers the time series analytics queries from the `analytics_rollups`
+collection (see backend/app/services/mongo/rollups.py, which defines the same buckets).
+Every time the extractor inserts tasks, sessions or events, it increments the
+counters of the matching minute, hour and day buckets.
+"""
+
+import datetime
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from loguru import logger
+from pymongo import UpdateOne
+
+from app.db.mongo import get_mongo_db
+
+# granularity -> (format of $dateToString, size of the bucket in seconds)
+ROLLUP_GRANULARITIES: Dict[str, Tuple[str, int]] = {
+    "minute": ("%Y-%m-%d %H:%M", 60),
+    "hour": ("%Y-%m-%d %H", 3600),
+    "day": ("%Y-%m-%d", 86400),
+}
+
+# collection -> breakdown field and summed fields
+ROLLUP_COLLECTIONS: Dict[str, Dict[str, object]] = {
+    "tasks": {
+        "breakdown": None,
+        "sum_fields": [
+            "metadata.total_tokens",
+            "metadata.prompt_tokens",
+            "metadata.completion_tokens",
+        ],
+    },
+    "sessions": {"breakdown": None, "sum_fields": []},
+    "events": {"breakdown": "event_name", "sum_fields": []},
+}
+
+
+def _get_nested(doc: dict, path: str) -> object:
+    value: object = doc
+    for key in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+async def increment_rollups(
+    collection: str, docs: List[dict], sign: int = 1
+) -> None:
+    """
+    Increment the rollups with newly inserted documents of a collection. With
+    sign=-1, decrement them with deleted documents.
+    Errors are logged and not raised: the rollups can be rebuilt from the backend.
+    """
+    if collection not in ROLLUP_COLLECTIONS or len(docs) == 0:
+        return
+    breakdown_field = ROLLUP_COLLECTIONS[collection]["breakdown"]
+    sum_fields: List[str] = ROLLUP_COLLECTIONS[collection]["sum_fields"]  # type: ignore
+
+    # (project_id, granularity, bucket_start, breakdown) -> counters
+    increments: Dict[Tuple[str, str, int, str], Dict[str, float]] = defaultdict(
+        lambda: defaultdict(int)
+    )
+    for doc in docs:
+        created_at = doc.get("created_at")
+        project_id = doc.get("project_id")
+        if created_at is None or project_id is None:
+            continue
+        breakdown = ""
+        if breakdown_field is not None:
+            breakdown = str(doc.get(breakdown_field) or "")
+        for granularity, (_, bucket_size) in ROLLUP_GRANULARITIES.items():
+            bucket_start = int(created_at // bucket_size * bucket_size)
+            counters = increments[(project_id, granularity, bucket_start, breakdown)]
+            counters["count"] += sign
+            for field in sum_fields:
+                value = _get_nested(doc, field)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    counters[f"sums.{field}"] += sign * value
+
+    operations = []
+    for (project_id, granularity, bucket_start, breakdown), counters in increments.items():
+        date_format, _ = ROLLUP_GRANULARITIES[granularity]
+        operations.append(
+            UpdateOne(
+                {
+                    "project_id": project_id,
+                    "collection": collection,
+                    "granularity": granularity,
+                    "bucket_start": bucket_start,
+                    "breakdown": breakdown,
+                },
+                {
+                    "$inc": dict(counters),
+                    "$setOnInsert": {
+                        "bucket": datetime.datetime.fromtimestamp(
+                            bucket_start, tz=datetime.timezone.utc
+                        ).strftime(date_format),
+                    },
+                },
+                upsert=True,
+            )
+        )
+    try:
+        mongo_db = await get_mongo_db()
+        await mongo_db["analytics_rollups"].bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.warning(f"Error incrementing the {collection} rollups: {e}")
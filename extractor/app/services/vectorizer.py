@@ -0,0 +1,199 @@
+"""
+Vectorization of the new tasks, for the semantic search.
+
+The tasks are embedded in the background by a shared TaskVectorizer: the ids of the new
+tasks are queued, and embedded every VECTORIZER_BATCH_SIZE tasks or VECTORIZER_FLUSH_INTERVAL
+seconds, with one embedding call per batch. The vectors are upserted in the Qdrant
+`tasks` collection in bulk.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Set
+
+from loguru import logger
+
+from app.core import config
+from app.db.mongo import get_mongo_db
+from app.db.qdrant import get_qdrant, models
+from phospho.lab.language_models import get_async_client
+from phospho.models import Task
+
+EmbeddingFunction = Callable[[List[str]], Awaitable[List[List[float]]]]
+
+
+async def openai_embeddings(texts: List[str]) -> List[List[float]]:
+    # The client is shared, and closed with the other clients at shutdown
+    response = await get_async_client("openai").embeddings.create(
+        input=texts, model=config.VECTORIZER_EMBEDDING_MODEL
+    )
+    return [embedding.embedding for embedding in response.data]
+
+
+def get_task_text(task: Task) -> str:
+    # The embedding model has a limited context: long tasks are truncated
+    return f"{task.input} {task.output or ''}"[: config.VECTORIZER_MAX_TEXT_LENGTH]
+
+
+class TaskVectorizer:
+    def __init__(
+        self,
+        embed: EmbeddingFunction = openai_embeddings,
+        batch_size: int = config.VECTORIZER_BATCH_SIZE,
+        flush_interval: float = config.VECTORIZER_FLUSH_INTERVAL,
+        max_pending: int = config.VECTORIZER_MAX_PENDING,
+    ):
+        """
+        :param embed: Returns the embeddings of a list of texts.
+        :param max_pending: Above this number of queued tasks, the new ones are not vectorized.
+        """
+        self.embed = embed
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: List[str] = []
+        self._flush_timer: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        # Counters
+        self.vectorized_tasks = 0
+        self.embedding_calls = 0
+        self.dropped_tasks = 0
+
+    def enqueue(self, task_ids: List[str]) -> None:
+        """
+        Queue the tasks to vectorize. Returns immediately.
+        """
+        if config.ENVIRONMENT == "preview":
+            return
+        nb_accepted = max(0, self.max_pending - len(self._pending))
+        if nb_accepted < len(task_ids):
+            self.dropped_tasks += len(task_ids) - nb_accepted
+            logger.warning(
+                f"Too many tasks to vectorize: {len(task_ids) - nb_accepted} tasks skipped"
+            )
+        self._pending.extend(task_ids[:nb_accepted])
+        while len(self._pending) >= self.batch_size:
+            batch, self._pending = (
+                self._pending[: self.batch_size],
+                self._pending[self.batch_size :],
+            )
+            self._start(self.vectorize(batch))
+        if len(self._pending) > 0 and (
+            self._flush_timer is None or self._flush_timer.done()
+        ):
+            self._flush_timer = asyncio.create_task(self._flush_later())
+
+    def _start(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        batch, self._pending = self._pending, []
+        if len(batch) > 0:
+            self._start(self.vectorize(batch))
+
+    async def _load_tasks(self, task_ids: List[str]) -> List[Task]:
+        mongo_db = await get_mongo_db()
+        tasks = (
+            await mongo_db["tasks"]
+            .find({"id": {"$in": task_ids}})
+            .to_list(length=None)
+        )
+        return [Task.model_validate(task) for task in tasks]
+
+    async def vectorize(self, task_ids: List[str]) -> int:
+        """
+        Embed the tasks with one embedding call and upsert them in Qdrant.
+        Return the number of tasks vectorized
+        """
+        qdrant_db = await get_qdrant()
+        if qdrant_db is None or len(task_ids) == 0:
+            return 0
+        try:
+            tasks = await self._load_tasks(task_ids)
+            if len(tasks) == 0:
+                return 0
+            self.embedding_calls += 1
+            embeddings = await self.embed([get_task_text(task) for task in tasks])
+            await qdrant_db.upsert(
+                collection_name="tasks",
+                points=[
+                    models.PointStruct(
+                        id=task.id,
+                        vector=embedding,
+                        payload={
+                            "task_id": task.id,
+                            "project_id": task.project_id,
+                            "session_id": task.session_id,
+                            "created_at": task.created_at,
+                            "org_id": task.org_id,
+                            "metadata": task.metadata,
+                        },
+                    )
+                    for task, embedding in zip(tasks, embeddings)
+                ],
+                wait=False,
+            )
+        except Exception as e:
+            logger.warning(f"Error while vectorizing {len(task_ids)} tasks: {e}")
+            return 0
+        self.vectorized_tasks += len(tasks)
+        return len(tasks)
+
+    async def delete(self, task_ids: List[str]) -> None:
+        """
+        Remove the vectors of deleted tasks, and the deleted tasks from the queue.
+        """
+        removed_ids = set(task_ids)
+        self._pending = [
+            task_id for task_id in self._pending if task_id not in removed_ids
+        ]
+        qdrant_db = await get_qdrant()
+        if qdrant_db is None or len(task_ids) == 0:
+            return
+        try:
+            await qdrant_db.delete(
+                collection_name="tasks",
+                points_selector=models.PointIdsList(points=task_ids),
+                wait=False,
+            )
+        except Exception as e:
+            logger.warning(
+                f"Error while deleting the vectors of {len(task_ids)} tasks: {e}"
+            )
+
+    async def flush(self) -> None:
+        """
+        Vectorize the queued tasks and wait for the vectorizations in progress.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+        batch, self._pending = self._pending, []
+        if len(batch) > 0:
+            self._start(self.vectorize(batch))
+        while len(self._tasks) > 0:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def close(self) -> None:
+        try:
+            await asyncio.wait_for(self.flush(), timeout=30)
+        except asyncio.TimeoutError:
+            logger.warning("Vectorization of the queued tasks not finished at shutdown")
+
+
+_task_vectorizer: Optional[TaskVectorizer] = None
+
+
+def get_task_vectorizer() -> TaskVectorizer:
+    global _task_vectorizer
+    if _task_vectorizer is None:
+        _task_vectorizer = TaskVectorizer()
+    return _task_vectorizer
+
+
+async def close_task_vectorizer() -> None:
+    global _task_vectorizer
+    if _task_vectorizer is not None:
+        await _task_vectorizer.close()
+        _task_vectorizer = None
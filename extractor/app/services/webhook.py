@@ -1,23 +1,65 @@
-from typing import Optional
+"""
+Delivery of the webhooks of the detected events.
+
+The webhooks are sent in the background by a shared dispatcher, so that the pipeline
+doesn't wait for the receivers:
+- The HTTP connections are pooled in a single aiohttp session.
+- The number of concurrent deliveries to the same URL is capped.
+- Receivers that opt in (EventDefinition.webhook_batch) receive lists of events, sent
+  every WEBHOOK_BATCH_SIZE events or WEBHOOK_BATCH_INTERVAL seconds.
+- Failed deliveries are stored in the `webhook_retries` collection, and retried with an
+  exponential backoff by the retry loop of the worker.
+"""
+
+import asyncio
+import datetime
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Protocol, Set, Tuple
 
 import aiohttp
 from loguru import logger
 
+from app.core import config
+from app.db.mongo import get_mongo_db
+from app.utils import generate_uuid
+
+
+def _clean_headers(headers: Optional[dict]) -> Dict[str, str]:
+    # Filter empty values from the headers (where str is "")
+    return {k: v for k, v in (headers or {}).items() if v is not None and v != ""}
+
+
+async def _post(
+    session: aiohttp.ClientSession,
+    url: str,
+    json: Any,
+    headers: Optional[dict],
+    timeout: float,
+) -> str:
+    async with session.post(
+        url,
+        json=json,
+        headers=_clean_headers(headers),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as response:
+        response.raise_for_status()
+        return await response.text()
+
 
 async def trigger_webhook(
     url: str, json: dict, timeout: int = 3, headers: Optional[dict] = None
-) -> None:
+) -> Optional[str]:
     """
     Async function to trigger a webhook. Sends a POST request to the given URL
-    with the given data.
+    with the given data, with the connection pool of the dispatcher.
+
+    To send the webhook without waiting for the receiver, use
+    get_webhook_dispatcher().dispatch() instead.
 
     :param url: The URL to trigger the webhook on.
     :param data: The data to send to the webhook.
     :param timeout: The timeout for the request, an int in seconds.
     """
-    # Filter empty values from the headers (where str is "")
-    headers = {k: v for k, v in (headers or {}).items() if v is not None and v != ""}
-
     # If the url is not set, return early
     if url == "":
         logger.warning("No webhook URL set, skipping webhook trigger")
@@ -25,16 +67,268 @@ async def trigger_webhook(
 
     try:
         logger.info(f"Triggering webhook: {url}")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                url, json=json, timeout=timeout, headers=headers
-            ) as response:
-                response.raise_for_status()
-                logger.info(f"Webhook triggered successfully: {response.status}")
-                response_txt = await response.text()
-            await session.close()
+        session = get_webhook_dispatcher().get_session()
+        response_txt = await _post(session, url, json, headers, timeout)
+        logger.info("Webhook triggered successfully")
         return response_txt
-    except aiohttp.ClientError as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.error(f"Error sending webhook to {url}: {e}")
-        await session.close()
         return None
+
+
+class WebhookRetryQueue(Protocol):
+    async def push(
+        self, url: str, json: Any, headers: Optional[dict], error: str
+    ) -> None:
+        ...
+
+    async def pop_due(self, limit: int) -> List[dict]:
+        """Claim the deliveries to retry now"""
+        ...
+
+    async def succeeded(self, delivery: dict) -> None:
+        ...
+
+    async def failed(self, delivery: dict, error: str) -> None:
+        ...
+
+
+def get_retry_delay(attempts: int) -> float:
+    """
+    Exponential backoff: the delay in seconds before the next attempt
+    """
+    return min(
+        config.WEBHOOK_RETRY_BASE_DELAY * 2 ** (attempts - 1),
+        config.WEBHOOK_RETRY_MAX_DELAY,
+    )
+
+
+class MongoWebhookRetryQueue:
+    """
+    Failed deliveries, stored in mongo so that they survive a restart of the worker.
+
+    A delivery is "pending" until it succeeds, or "failed" after WEBHOOK_MAX_ATTEMPTS.
+    While a worker retries it, its next_attempt_at is pushed back, so that the other
+    workers don't claim it.
+    """
+
+    collection = "webhook_retries"
+
+    async def push(
+        self, url: str, json: Any, headers: Optional[dict], error: str
+    ) -> None:
+        mongo_db = await get_mongo_db()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        await mongo_db[self.collection].insert_one(
+            {
+                "id": generate_uuid(),
+                "url": url,
+                "json": json,
+                "headers": headers,
+                "status": "pending",
+                "attempts": 1,
+                "last_error": error,
+                "created_at": now,
+                "next_attempt_at": now
+                + datetime.timedelta(seconds=get_retry_delay(1)),
+            }
+        )
+
+    async def pop_due(self, limit: int) -> List[dict]:
+        mongo_db = await get_mongo_db()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        deliveries = []
+        for _ in range(limit):
+            delivery = await mongo_db[self.collection].find_one_and_update(
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {
+                    "$set": {
+                        "next_attempt_at": now
+                        + datetime.timedelta(seconds=config.WEBHOOK_TIMEOUT * 10)
+                    }
+                },
+                sort=[("next_attempt_at", 1)],
+            )
+            if delivery is None:
+                break
+            deliveries.append(delivery)
+        return deliveries
+
+    async def succeeded(self, delivery: dict) -> None:
+        mongo_db = await get_mongo_db()
+        await mongo_db[self.collection].delete_one({"id": delivery["id"]})
+
+    async def failed(self, delivery: dict, error: str) -> None:
+        mongo_db = await get_mongo_db()
+        attempts = delivery["attempts"] + 1
+        update: Dict[str, Any] = {"attempts": attempts, "last_error": error}
+        if attempts >= config.WEBHOOK_MAX_ATTEMPTS:
+            logger.error(
+                f"Webhook to {delivery['url']} failed after {attempts} attempts: {error}"
+            )
+            update["status"] = "failed"
+        else:
+            update["next_attempt_at"] = datetime.datetime.now(
+                datetime.timezone.utc
+            ) + datetime.timedelta(seconds=get_retry_delay(attempts))
+        await mongo_db[self.collection].update_one(
+            {"id": delivery["id"]}, {"$set": update}
+        )
+
+
+# (url, headers) of a batching receiver
+BatchKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class WebhookDispatcher:
+    def __init__(self, retry_queue: Optional[WebhookRetryQueue] = None):
+        self.retry_queue: WebhookRetryQueue = retry_queue or MongoWebhookRetryQueue()
+        self._session: Optional[aiohttp.ClientSession] = None
+        # url -> semaphore capping the concurrent deliveries to the url
+        self._semaphores: Dict[str, asyncio.Semaphore] = defaultdict(
+            lambda: asyncio.Semaphore(config.WEBHOOK_MAX_CONCURRENCY_PER_DESTINATION)
+        )
+        self._tasks: Set[asyncio.Task] = set()
+        # Events waiting to be sent to the batching receivers
+        self._batches: Dict[BatchKey, List[Any]] = defaultdict(list)
+        self._batch_timers: Dict[BatchKey, asyncio.Task] = {}
+        self._retry_loop: Optional[asyncio.Task] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=config.WEBHOOK_MAX_CONNECTIONS,
+                    limit_per_host=config.WEBHOOK_MAX_CONCURRENCY_PER_DESTINATION,
+                )
+            )
+        return self._session
+
+    def _start(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def dispatch(
+        self,
+        url: str,
+        json: Any,
+        headers: Optional[dict] = None,
+        batch: bool = False,
+    ) -> None:
+        """
+        Send the webhook in the background. Returns immediately.
+
+        :param batch: If True, the event is sent in a list with the other events to the
+            same receiver.
+        """
+        if url is None or url == "":
+            return
+        if len(self._tasks) >= config.WEBHOOK_MAX_PENDING:
+            # Too many deliveries in progress: don't keep them in memory
+            self._start(
+                self.retry_queue.push(url, json, headers, "Too many pending webhooks")
+            )
+            return
+        if not batch:
+            self._start(self._deliver(url, json, headers))
+            return
+
+        key: BatchKey = (url, tuple(sorted(_clean_headers(headers).items())))
+        self._batches[key].append(json)
+        if len(self._batches[key]) >= config.WEBHOOK_BATCH_SIZE:
+            self._flush_batch(key)
+        elif key not in self._batch_timers:
+            self._batch_timers[key] = asyncio.create_task(self._flush_batch_later(key))
+
+    def _flush_batch(self, key: BatchKey) -> None:
+        timer = self._batch_timers.pop(key, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        events = self._batches.pop(key, [])
+        if len(events) > 0:
+            url, headers = key
+            self._start(self._deliver(url, events, dict(headers)))
+
+    async def _flush_batch_later(self, key: BatchKey) -> None:
+        await asyncio.sleep(config.WEBHOOK_BATCH_INTERVAL)
+        self._flush_batch(key)
+
+    async def _send(self, url: str, json: Any, headers: Optional[dict]) -> None:
+        async with self._semaphores[url]:
+            await _post(self.get_session(), url, json, headers, config.WEBHOOK_TIMEOUT)
+
+    async def _deliver(self, url: str, json: Any, headers: Optional[dict]) -> None:
+        try:
+            await self._send(url, json, headers)
+            logger.debug(f"Webhook delivered to {url}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Error sending webhook to {url}, will retry: {e!r}")
+            try:
+                await self.retry_queue.push(url, json, headers, repr(e))
+            except Exception as e:
+                logger.error(f"Error storing the webhook to {url} for retry: {e}")
+
+    async def retry_due(self, limit: int = 100) -> int:
+        """
+        Retry the failed deliveries that are due. Returns the number of retries.
+        """
+        deliveries = await self.retry_queue.pop_due(limit)
+
+        async def retry(delivery: dict) -> None:
+            try:
+                await self._send(delivery["url"], delivery["json"], delivery["headers"])
+                await self.retry_queue.succeeded(delivery)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await self.retry_queue.failed(delivery, repr(e))
+
+        await asyncio.gather(*(retry(delivery) for delivery in deliveries))
+        return len(deliveries)
+
+    async def _run_retry_loop(self) -> None:
+        while True:
+            try:
+                await self.retry_due()
+            except Exception as e:
+                logger.error(f"Error retrying the webhooks: {e}")
+            await asyncio.sleep(config.WEBHOOK_RETRY_POLL_INTERVAL)
+
+    def start_retry_loop(self) -> None:
+        if self._retry_loop is None or self._retry_loop.done():
+            self._retry_loop = asyncio.create_task(self._run_retry_loop())
+
+    async def flush(self) -> None:
+        """
+        Send the pending batches and wait for the deliveries in progress.
+        """
+        for key in list(self._batches.keys()):
+            self._flush_batch(key)
+        while len(self._tasks) > 0:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def close(self) -> None:
+        if self._retry_loop is not None:
+            self._retry_loop.cancel()
+        try:
+            await asyncio.wait_for(self.flush(), timeout=config.WEBHOOK_TIMEOUT * 2)
+        except asyncio.TimeoutError:
+            logger.warning(f"{len(self._tasks)} webhooks not delivered at shutdown")
+        if self._session is not None:
+            await self._session.close()
+
+
+_webhook_dispatcher: Optional[WebhookDispatcher] = None
+
+
+def get_webhook_dispatcher() -> WebhookDispatcher:
+    global _webhook_dispatcher
+    if _webhook_dispatcher is None:
+        _webhook_dispatcher = WebhookDispatcher()
+    return _webhook_dispatcher
+
+
+async def close_webhook_dispatcher() -> None:
+    global _webhook_dispatcher
+    if _webhook_dispatcher is not None:
+        await _webhook_dispatcher.close()
+        _webhook_dispatcher = None
@@ -163,6 +163,8 @@ async def store_open_telemetry_data(
     opentelemetry_connector = OpenTelemetryConnector(
         project_id=request.project_id,
         data=request.open_telemetry_data,
+        # The same for all the attempts of the activity
+        export_id=activity.info().workflow_run_id,
     )
     return await opentelemetry_connector.process(
         org_id=request.org_id,
@@ -176,7 +178,7 @@ async def run_process_logs_for_messages(
     request_body: LogProcessRequestForMessages,
 ):
     """
-    Not implemented
+    Create the tasks and sessions of a batch of message logs, and process them
     """
     logger.info(
         f"Project {request_body.project_id} org {request_body.org_id}: processing {len(request_body.logs_to_process)} logs and saving {len(request_body.extra_logs_to_save)} extra logs."
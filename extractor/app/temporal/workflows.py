@@ -134,6 +134,9 @@ class StoreOpenTelemetryDataWorkflow(BaseWorkflow):
             activity_func=store_open_telemetry_data,
             request_class=PipelineOpentelemetryRequest,
             bill=False,
+            # The spans are only acknowledged once written: retry the failed writes.
+            # The retries don't store the export or its spans twice.
+            max_retries=5,
         )
 
     @workflow.run
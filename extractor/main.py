@@ -15,6 +15,12 @@ from loguru import logger
 
 from app.core import config
 from app.db.mongo import close_mongo_db, connect_and_init_db
+from app.db.qdrant import close_qdrant, init_qdrant
+from app.services.llm_cache import init_llm_cache
+from app.services.connectors.opentelemetry import close_span_writer
+from app.services.vectorizer import close_task_vectorizer
+from app.services.webhook import close_webhook_dispatcher, get_webhook_dispatcher
+from phospho.lab.language_models import close_clients
 from app.temporal.workflows import (
     ExtractLangSmithDataWorkflow,
     ExtractLangfuseDataWorkflow,
@@ -75,6 +81,10 @@ async def main() -> None:
         sentry_sdk.set_level("warning")
 
     await connect_and_init_db()
+    await init_qdrant()
+    init_llm_cache()
+    # Retry the failed webhooks in the background
+    get_webhook_dispatcher().start_retry_loop()
 
     client: Client
     if config.ENVIRONMENT in ["production", "staging"]:
@@ -135,6 +145,11 @@ async def main() -> None:
     ):
         logger.info("Worker started")
         await interrupt_event.wait()
+        await close_webhook_dispatcher()
+        await close_span_writer()
+        await close_task_vectorizer()
+        await close_qdrant()
+        await close_clients()
         await close_mongo_db()
         logger.info("Shutting down")
 
@@ -0,0 +1,271 @@
+import datetime
+import tracemalloc
+from types import SimpleNamespace
+from typing import Iterator, List, Optional
+
+import pytest
+
+import app.core.config as config
+import app.services.connectors.base as connectors_base
+from app.services.connectors import LangfuseConnector, LangsmithConnector
+from app.services.connectors.base import SyncCursor
+
+assert config.ENVIRONMENT != "production"
+
+START = datetime.datetime(2024, 1, 1)
+
+
+def fake_run(index: int, runs_per_second: int = 1) -> SimpleNamespace:
+    start_time = START + datetime.timedelta(seconds=index // runs_per_second)
+    return SimpleNamespace(
+        id=f"run_{index}",
+        session_id="session",
+        inputs={
+            "messages": [
+                {"id": ["HumanMessage"], "kwargs": {"content": f"question {index}"}}
+            ]
+        },
+        outputs={"generations": [{"text": f"answer {index}"}]},
+        start_time=start_time,
+        end_time=start_time,
+    )
+
+
+class FakeLangsmithConnector(LangsmithConnector):
+    """
+    A LangSmith connector reading from a generator of runs, with the cursor in memory
+    """
+
+    def __init__(
+        self,
+        nb_runs: int,
+        fail_after_pages: Optional[int] = None,
+        runs_per_second: int = 1,
+    ):
+        super().__init__(
+            project_id="project", langsmith_api_key="key", langsmith_project_name="p"
+        )
+        self.nb_runs = nb_runs
+        self.fail_after_pages = fail_after_pages
+        self.runs_per_second = runs_per_second
+        self.cursor = SyncCursor()
+        self.runs_read = 0
+
+    def _list_runs(
+        self, since: Optional[datetime.datetime], until: Optional[datetime.datetime]
+    ) -> Iterator[SimpleNamespace]:
+        pages = 0
+        # Newest first, like the LangSmith API
+        for index in range(self.nb_runs - 1, -1, -1):
+            run = fake_run(index, self.runs_per_second)
+            if until is not None and run.start_time > until:
+                continue
+            if since is not None and run.start_time < since:
+                return
+            self.runs_read += 1
+            if self.runs_read % self.page_size == 1 and self.runs_read > 1:
+                pages += 1
+                if self.fail_after_pages is not None and pages >= self.fail_after_pages:
+                    raise RuntimeError("Quota exceeded")
+            yield run
+
+    async def load_cursor(self) -> SyncCursor:
+        return self.cursor.model_copy()
+
+    async def save_cursor(self, cursor: SyncCursor) -> None:
+        self.cursor = cursor.model_copy()
+
+    async def _dump_page(self, page) -> None:
+        pass
+
+    async def _on_sync_complete(self) -> None:
+        pass
+
+
+@pytest.fixture
+def processed_runs(monkeypatch) -> List[str]:
+    processed: List[str] = []
+
+    async def process_logs_for_tasks(
+        project_id, org_id, logs_to_process, extra_logs_to_save
+    ):
+        processed.extend(log.metadata["langsmith_run_id"] for log in logs_to_process)
+
+    monkeypatch.setattr(
+        connectors_base, "process_logs_for_tasks", process_logs_for_tasks
+    )
+    return processed
+
+
+@pytest.mark.asyncio
+async def test_langsmith_sync_resumes_after_a_crash(processed_runs):
+    connector = FakeLangsmithConnector(nb_runs=1000, fail_after_pages=3)
+    connector.page_size = 100
+    with pytest.raises(RuntimeError):
+        await connector.sync_pages(org_id="org", current_usage=0)
+    assert len(processed_runs) == 300
+    assert connector.cursor.until == fake_run(700).start_time
+
+    # The next sync only reads the run at the boundary again, and skips it
+    connector.fail_after_pages = None
+    connector.runs_read = 0
+    await connector.sync_pages(org_id="org", current_usage=0)
+    assert connector.runs_read == 701
+    assert sorted(processed_runs) == sorted(f"run_{i}" for i in range(1000))
+    assert connector.cursor.since == fake_run(999).start_time
+    assert connector.cursor.until is None
+
+    # Nothing new: only the newest run is read, and skipped
+    connector.runs_read = 0
+    await connector.sync_pages(org_id="org", current_usage=0)
+    assert connector.runs_read == 1
+    assert len(processed_runs) == 1000
+
+
+@pytest.mark.asyncio
+async def test_langsmith_sync_with_shared_start_times(processed_runs):
+    # 250 runs per second: the pages and the crash cut through the same start time
+    connector = FakeLangsmithConnector(
+        nb_runs=900, fail_after_pages=3, runs_per_second=250
+    )
+    connector.page_size = 100
+    with pytest.raises(RuntimeError):
+        await connector.sync_pages(org_id="org", current_usage=0)
+    assert len(processed_runs) == 300
+
+    connector.fail_after_pages = None
+    await connector.sync_pages(org_id="org", current_usage=0)
+    # Every run is processed exactly once
+    assert sorted(processed_runs) == sorted(f"run_{i}" for i in range(900))
+
+    # New runs at the same start time as the newest processed run are pulled
+    connector.nb_runs = 1000
+    processed_runs.clear()
+    await connector.sync_pages(org_id="org", current_usage=0)
+    assert sorted(processed_runs) == sorted(f"run_{i}" for i in range(900, 1000))
+
+
+@pytest.mark.asyncio
+async def test_langsmith_sync_memory_is_bounded(processed_runs, monkeypatch):
+    # Don't keep the processed ids: only the memory of the sync is measured
+    async def process_logs_for_tasks(**kwargs):
+        pass
+
+    monkeypatch.setattr(
+        connectors_base, "process_logs_for_tasks", process_logs_for_tasks
+    )
+
+    peaks = []
+    for nb_runs in [10_000, 200_000]:
+        connector = FakeLangsmithConnector(nb_runs=nb_runs)
+        connector.page_size = 500
+        tracemalloc.start()
+        nb_processed = await connector.sync_pages(org_id="org", current_usage=0)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert nb_processed == nb_runs
+
+    # 20x more runs, same memory
+    assert peaks[1] < 2 * peaks[0]
+    assert peaks[1] < 20 * 1024 * 1024
+
+
+class FakeLangfuseConnector(LangfuseConnector):
+    """
+    A Langfuse connector reading the observations from a list, newest first
+    """
+
+    def __init__(self, nb_observations: int, observations_per_second: int = 1):
+        super().__init__(
+            project_id="project", langfuse_public_key="pk", langfuse_secret_key="sk"
+        )
+        self.observations = [
+            SimpleNamespace(
+                id=f"observation_{index}",
+                trace_id="trace",
+                input=f"question {index}",
+                output=f"answer {index}",
+                start_time=START
+                + datetime.timedelta(seconds=index // observations_per_second),
+            )
+            for index in range(nb_observations - 1, -1, -1)
+        ]
+        self.langfuse = SimpleNamespace(shutdown=lambda: None)
+        self.cursor = SyncCursor()
+        self.requests = 0
+
+    def _get_observations(self, since, until, page):
+        self.requests += 1
+        data = [
+            observation
+            for observation in self.observations
+            if (since is None or observation.start_time >= since)
+            and (until is None or observation.start_time <= until)
+        ]
+        offset = (page - 1) * self.page_size
+        return SimpleNamespace(data=data[offset : offset + self.page_size])
+
+    load_cursor = FakeLangsmithConnector.load_cursor
+    save_cursor = FakeLangsmithConnector.save_cursor
+    _dump_page = FakeLangsmithConnector._dump_page
+    _on_sync_complete = FakeLangsmithConnector._on_sync_complete
+
+
+@pytest.fixture
+def processed_observations(monkeypatch) -> List[str]:
+    processed: List[str] = []
+
+    async def process_logs_for_tasks(
+        project_id, org_id, logs_to_process, extra_logs_to_save
+    ):
+        processed.extend(log.metadata["langsfuse_run_id"] for log in logs_to_process)
+
+    monkeypatch.setattr(
+        connectors_base, "process_logs_for_tasks", process_logs_for_tasks
+    )
+    return processed
+
+
+@pytest.mark.asyncio
+async def test_langfuse_sync_is_paged(processed_observations):
+    processed = processed_observations
+    connector = FakeLangfuseConnector(nb_observations=250)
+    connector.page_size = 100
+    await connector.sync_pages(org_id="org", current_usage=0, max_usage=None)
+    assert sorted(processed) == sorted(f"observation_{i}" for i in range(250))
+    assert connector.requests == 3
+    assert connector.cursor.since == START + datetime.timedelta(seconds=249)
+
+    # Only the new observations are pulled by the next sync
+    processed.clear()
+    connector.observations.insert(
+        0,
+        SimpleNamespace(
+            id="observation_250",
+            trace_id="trace",
+            input="question",
+            output="answer",
+            start_time=START + datetime.timedelta(seconds=250),
+        ),
+    )
+    await connector.sync_pages(org_id="org", current_usage=0, max_usage=None)
+    assert processed == ["observation_250"]
+
+
+@pytest.mark.asyncio
+async def test_langfuse_sync_with_shared_start_times(processed_observations):
+    # More observations share a start time than fit in a page
+    connector = FakeLangfuseConnector(nb_observations=1000, observations_per_second=250)
+    connector.page_size = 100
+    await connector.sync_pages(org_id="org", current_usage=0, max_usage=None)
+    # Every observation is processed exactly once
+    assert sorted(processed_observations) == sorted(
+        f"observation_{i}" for i in range(1000)
+    )
+    assert connector.cursor.since == START + datetime.timedelta(seconds=3)
+    assert len(connector.cursor.since_ids) == 250
+
+    # Nothing new: nothing is processed
+    processed_observations.clear()
+    await connector.sync_pages(org_id="org", current_usage=0, max_usage=None)
+    assert processed_observations == []
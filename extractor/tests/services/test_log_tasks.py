@@ -0,0 +1,139 @@
+import time
+from typing import List
+
+import pytest
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import app.core.config as config
+import app.services.log.tasks as log_tasks
+import app.services.rollups as rollups
+import app.services.tasks as tasks
+from app.models import LogEventForTasks
+from app.utils import generate_uuid
+
+from tests.utils import CommandCounter
+
+assert config.ENVIRONMENT != "production"
+
+NB_SESSIONS = 500
+NB_EVENTS = 10_000
+WRITE_COMMANDS = ["insert", "update", "delete", "aggregate"]
+
+
+def count_writes(counter: CommandCounter) -> int:
+    return sum(counter.commands[command] for command in WRITE_COMMANDS)
+
+
+def make_log_events(
+    project_id: str, nb_events: int, start: int
+) -> List[LogEventForTasks]:
+    return [
+        LogEventForTasks(
+            project_id=project_id,
+            session_id=f"{project_id}_{index % NB_SESSIONS}",
+            input=f"Question {index}",
+            output=f"Answer {index}",
+            created_at=start + index,
+            metadata={"prompt_tokens": 3, "completion_tokens": 2},
+        )
+        for index in range(nb_events)
+    ]
+
+
+async def legacy_session_updates(
+    mongo_db, list_of_log_event: List[LogEventForTasks]
+) -> None:
+    """
+    The previous session updates: one update per log event
+    """
+    for log_event in list_of_log_event:
+        await mongo_db["sessions"].update_one(
+            {"id": log_event.session_id},
+            {
+                "$inc": {
+                    "session_length": 1,
+                    "metadata.total_tokens": 5,
+                    "metadata.prompt_tokens": 3,
+                    "metadata.completion_tokens": 2,
+                }
+            },
+        )
+
+
+@pytest.mark.asyncio
+async def test_process_log_with_session_id_benchmark(org_id, monkeypatch):
+    counter = CommandCounter()
+    client = AsyncIOMotorClient(config.MONGODB_URL, event_listeners=[counter])
+    mongo_db = client[config.MONGODB_NAME]
+
+    async def get_mongo_db():
+        return mongo_db
+
+    for module in [log_tasks, rollups, tasks]:
+        monkeypatch.setattr(module, "get_mongo_db", get_mongo_db)
+
+    project_id = generate_uuid()
+    start = 1_700_000_000
+    # The sessions are created by a first batch
+    await log_tasks.process_log_with_session_id(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=make_log_events(project_id, NB_SESSIONS, start),
+        trigger_pipeline=False,
+    )
+    query = {"project_id": project_id}
+    assert await mongo_db["sessions"].count_documents(query) == NB_SESSIONS
+
+    log_events = make_log_events(project_id, NB_EVENTS, start + NB_SESSIONS)
+    counter.commands.clear()
+    timer = time.perf_counter()
+    await log_tasks.process_log_with_session_id(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=log_events,
+        trigger_pipeline=False,
+    )
+    duration = time.perf_counter() - timer
+    nb_writes = count_writes(counter)
+
+    # Sending the same batch again doesn't create anything
+    await log_tasks.process_log_with_session_id(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=log_events,
+        trigger_pipeline=False,
+    )
+
+    nb_tasks_per_session = NB_EVENTS // NB_SESSIONS + 1
+    assert await mongo_db["tasks"].count_documents(query) == NB_EVENTS + NB_SESSIONS
+    session = await mongo_db["sessions"].find_one({"id": f"{project_id}_0"})
+    assert session["session_length"] == nb_tasks_per_session
+    assert session["metadata"]["total_tokens"] == 5 * nb_tasks_per_session
+    last_tasks = await (
+        mongo_db["tasks"]
+        .find({**query, "is_last_task": True}, {"task_position": 1})
+        .to_list(length=None)
+    )
+    assert len(last_tasks) == NB_SESSIONS
+    assert all(task["task_position"] == nb_tasks_per_session for task in last_tasks)
+
+    # Before: one session update per log event
+    counter.commands.clear()
+    timer = time.perf_counter()
+    await legacy_session_updates(mongo_db, log_events)
+    legacy_duration = time.perf_counter() - timer
+    legacy_nb_writes = count_writes(counter)
+    logger.info(
+        f"{NB_EVENTS} log events in {NB_SESSIONS} sessions: {nb_writes} writes in "
+        + f"{duration:.2f}s, before: {legacy_nb_writes} session writes in "
+        + f"{legacy_duration:.2f}s"
+    )
+
+    # The writes depend on the number of sessions, not on the number of events
+    assert legacy_nb_writes == NB_EVENTS
+    assert nb_writes <= 10
+
+    for collection in ["tasks", "sessions", "analytics_rollups"]:
+        await mongo_db[collection].delete_many(query)
+    client.close()
@@ -0,0 +1,246 @@
+import time
+
+import pytest
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import app.core.config as config
+import app.services.log.messages as messages
+import app.services.projects as projects
+import app.services.rollups as rollups
+from app.models import MinimalLogEventForMessages
+from app.services.log.messages import merge_messages
+from app.utils import generate_uuid
+
+from tests.utils import CommandCounter
+
+assert config.ENVIRONMENT != "production"
+
+NB_SESSIONS = 5_000
+NB_MESSAGES_PER_SESSION = 20
+
+
+def test_merge_messages():
+    def log_event(messages, merge_mode):
+        return MinimalLogEventForMessages(
+            session_id="session", messages=messages, merge_mode=merge_mode
+        )
+
+    stored = ["hi", "hello", "how are you?"]
+    sources = [None, None, None]
+    # The whole history is sent again, with a new message
+    merged, merged_sources = merge_messages(
+        stored, sources, log_event(stored + ["fine"], "resolve"), 0
+    )
+    assert merged == stored + ["fine"]
+    assert merged_sources == [None, None, None, 0]
+    # The beginning of the conversation is already known
+    merged, _ = merge_messages(stored, sources, log_event(["hi"], "resolve"), 0)
+    assert merged == stored
+    # New messages are appended
+    merged, _ = merge_messages(stored, sources, log_event(["fine"], "resolve"), 0)
+    assert merged == stored + ["fine"]
+    merged, _ = merge_messages(stored, sources, log_event(["hi"], "append"), 0)
+    assert merged == stored + ["hi"]
+    merged, merged_sources = merge_messages(
+        stored, sources, log_event(["bye"], "replace"), 1
+    )
+    assert merged == ["bye"] and merged_sources == [1]
+
+
+@pytest.mark.asyncio
+async def test_process_messages_log_events(org_id, monkeypatch):
+    counter = CommandCounter()
+    client = AsyncIOMotorClient(config.MONGODB_URL, event_listeners=[counter])
+    mongo_db = client[config.MONGODB_NAME]
+
+    async def get_mongo_db():
+        return mongo_db
+
+    for module in [messages, projects, rollups]:
+        monkeypatch.setattr(module, "get_mongo_db", get_mongo_db)
+
+    project_id = generate_uuid()
+    session_ids = [f"{project_id}_{index}" for index in range(NB_SESSIONS)]
+    log_events = [
+        MinimalLogEventForMessages(
+            session_id=session_id,
+            messages=[
+                f"Message {index} of {session_id}"
+                for index in range(NB_MESSAGES_PER_SESSION)
+            ],
+            user_id="user",
+        )
+        for session_id in session_ids
+    ]
+
+    start = time.perf_counter()
+    await messages.process_messages_log_events(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=log_events,
+        trigger_pipeline=False,
+    )
+    duration = time.perf_counter() - start
+    logger.info(
+        f"Ingested {NB_SESSIONS * NB_MESSAGES_PER_SESSION} messages in {duration:.2f}s "
+        + f"with {counter.total()} commands: {dict(counter.commands)}"
+    )
+
+    # The number of round trips doesn't depend on the number of conversations
+    assert counter.total() <= 15
+    nb_tasks = NB_SESSIONS * NB_MESSAGES_PER_SESSION // 2
+    query = {"project_id": project_id}
+    assert await mongo_db["tasks"].count_documents(query) == nb_tasks
+    assert (
+        await mongo_db["tasks"].count_documents({**query, "is_last_task": True})
+        == NB_SESSIONS
+    )
+    task = await mongo_db["tasks"].find_one(
+        {**query, "session_id": session_ids[0], "task_position": 2}
+    )
+    assert task["input"] == f"Message 2 of {session_ids[0]}"
+    assert task["metadata"]["user_id"] == "user"
+    session = await mongo_db["sessions"].find_one({"id": session_ids[0]})
+    assert session["session_length"] == NB_MESSAGES_PER_SESSION // 2
+
+    # Append a task to every conversation
+    counter.commands.clear()
+    await messages.process_messages_log_events(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=[
+            MinimalLogEventForMessages(
+                session_id=session_id,
+                messages=["One more question", "One more answer"],
+                merge_mode="append",
+            )
+            for session_id in session_ids
+        ],
+        trigger_pipeline=False,
+    )
+    logger.info(f"Appended to {NB_SESSIONS} sessions with {counter.total()} commands")
+    assert counter.total() <= 15
+    assert await mongo_db["tasks"].count_documents(query) == nb_tasks + NB_SESSIONS
+    last_tasks = await (
+        mongo_db["tasks"]
+        .find({**query, "is_last_task": True}, {"task_position": 1})
+        .to_list(length=None)
+    )
+    assert len(last_tasks) == NB_SESSIONS
+    assert all(
+        task["task_position"] == NB_MESSAGES_PER_SESSION // 2 + 1 for task in last_tasks
+    )
+
+    for collection in ["tasks", "sessions", "analytics_rollups"]:
+        await mongo_db[collection].delete_many(query)
+    client.close()
+
+
+@pytest.mark.asyncio
+async def test_process_messages_shorter_and_task_path_conversations(
+    org_id, monkeypatch
+):
+    client = AsyncIOMotorClient(config.MONGODB_URL)
+    mongo_db = client[config.MONGODB_NAME]
+
+    async def get_mongo_db():
+        return mongo_db
+
+    for module in [messages, projects, rollups]:
+        monkeypatch.setattr(module, "get_mongo_db", get_mongo_db)
+
+    project_id = generate_uuid()
+    query = {"project_id": project_id}
+
+    async def nb_tasks_in_rollups() -> int:
+        rollup_buckets = await (
+            mongo_db["analytics_rollups"]
+            .find({**query, "collection": "tasks", "granularity": "day"})
+            .to_list(length=None)
+        )
+        return sum(bucket["count"] for bucket in rollup_buckets)
+
+    # A shorter conversation deletes the tasks at the end, and their events
+    await messages.process_messages_log_events(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=[
+            MinimalLogEventForMessages(
+                session_id="replaced", messages=["q1", "a1", "q2", "a2", "q3", "a3"]
+            )
+        ],
+        trigger_pipeline=False,
+    )
+    removed_task_id = messages.get_message_task_id(project_id, "replaced", 3)
+    await mongo_db["events"].insert_one(
+        {
+            "project_id": project_id,
+            "task_id": removed_task_id,
+            "event_name": "event",
+            "created_at": 1_700_000_000,
+        }
+    )
+    assert await nb_tasks_in_rollups() == 3
+    await messages.process_messages_log_events(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=[
+            MinimalLogEventForMessages(
+                session_id="replaced", messages=["q1", "a1"], merge_mode="replace"
+            )
+        ],
+        trigger_pipeline=False,
+    )
+    assert await mongo_db["tasks"].count_documents(query) == 1
+    assert await nb_tasks_in_rollups() == 1
+    assert await mongo_db["events"].count_documents({"task_id": removed_task_id}) == 0
+
+    # A conversation logged through the task path, with a task without output
+    await mongo_db["sessions"].insert_one(
+        {"id": "task_path", "project_id": project_id, "session_length": 2}
+    )
+    await mongo_db["tasks"].insert_many(
+        [
+            {
+                "id": f"task_path_{position}",
+                "project_id": project_id,
+                "session_id": "task_path",
+                "input": f"q{position}",
+                "output": None if position == 1 else f"a{position}",
+                "task_position": position,
+                "is_last_task": position == 2,
+                "created_at": 1_700_000_000 + position,
+            }
+            for position in [1, 2]
+        ]
+    )
+    await messages.process_messages_log_events(
+        project_id=project_id,
+        org_id=org_id,
+        list_of_log_event=[
+            MinimalLogEventForMessages(
+                session_id="task_path", messages=["q3", "a3"], merge_mode="append"
+            )
+        ],
+        trigger_pipeline=False,
+    )
+    # The stored tasks are kept, the new messages follow them
+    session_tasks = await (
+        mongo_db["tasks"]
+        .find({**query, "session_id": "task_path"})
+        .sort("task_position", 1)
+        .to_list(length=None)
+    )
+    assert [(task["input"], task["output"]) for task in session_tasks] == [
+        ("q1", None),
+        ("q2", "a2"),
+        ("q3", "a3"),
+    ]
+    assert [task["is_last_task"] for task in session_tasks] == [False, False, True]
+    session = await mongo_db["sessions"].find_one({"id": "task_path"})
+    assert session["session_length"] == 3
+
+    for collection in ["tasks", "sessions", "events", "analytics_rollups"]:
+        await mongo_db[collection].delete_many(query)
+    client.close()
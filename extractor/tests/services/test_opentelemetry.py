@@ -0,0 +1,230 @@
+import asyncio
+import copy
+import time
+
+import pytest
+from loguru import logger
+from pymongo.errors import BulkWriteError
+
+import app.core.config as config
+from app.services.connectors.opentelemetry import (
+    OpenTelemetryConnector,
+    SpanWriter,
+    extract_spans,
+)
+from app.utils import generate_uuid
+
+assert config.ENVIRONMENT != "production"
+
+# An OTLP export of an instrumented OpenAI call, as received by /log/{project_id}/opentelemetry
+RECORDED_SPAN = {
+    "traceId": "",
+    "spanId": "",
+    "name": "openai.chat",
+    "kind": 3,
+    "startTimeUnixNano": "1717000000000000000",
+    "endTimeUnixNano": "1717000001000000000",
+    "attributes": [
+        {"key": "llm.request.type", "value": {"stringValue": "chat"}},
+        {"key": "gen_ai.system", "value": {"stringValue": "OpenAI"}},
+        {"key": "gen_ai.request.model", "value": {"stringValue": "gpt-4o"}},
+        {"key": "gen_ai.request.temperature", "value": {"doubleValue": 0.7}},
+        {"key": "gen_ai.prompt.0.role", "value": {"stringValue": "user"}},
+        {"key": "gen_ai.prompt.0.content", "value": {"stringValue": "Hello"}},
+        {"key": "gen_ai.completion.0.role", "value": {"stringValue": "assistant"}},
+        {"key": "gen_ai.completion.0.content", "value": {"stringValue": "Hi!"}},
+        {"key": "gen_ai.usage.prompt_tokens", "value": {"intValue": "8"}},
+    ],
+    "status": {"code": 1},
+}
+
+
+def recorded_payload(nb_traces: int, spans_per_trace: int) -> dict:
+    spans = []
+    for _ in range(nb_traces):
+        trace_id = generate_uuid()
+        for index in range(spans_per_trace):
+            span = copy.deepcopy(RECORDED_SPAN)
+            span["traceId"] = trace_id
+            span["spanId"] = f"{trace_id}_{index}"
+            spans.append(span)
+    # A span without gen_ai attributes, which is not stored
+    spans.append({"traceId": "http", "spanId": "http", "attributes": []})
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": []},
+                "scopeSpans": [
+                    {"scope": {"name": "opentelemetry.instrumentation.openai"}},
+                    {"scope": {"name": "openai"}, "spans": spans},
+                ],
+            }
+        ]
+    }
+
+
+def test_extract_spans():
+    spans = extract_spans(recorded_payload(nb_traces=2, spans_per_trace=3))
+    assert len(spans) == 7
+    assert spans[0]["attributes"]["gen_ai"]["prompt"] == [
+        {"role": "user", "content": "Hello"}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_opentelemetry_ingestion_load(db):
+    project_id = f"test_otel_{generate_uuid()}"
+    writer = SpanWriter(max_spans=20_000, batch_size=1000, overflow="block")
+    nb_payloads = 200
+    spans_per_payload = 50
+
+    start = time.perf_counter()
+
+    async def send(_):
+        connector = OpenTelemetryConnector(
+            project_id=project_id,
+            data=recorded_payload(nb_traces=10, spans_per_trace=5),
+            span_writer=writer,
+        )
+        return await connector.process(org_id="org", current_usage=0)
+
+    accepted = await asyncio.gather(*(send(index) for index in range(nb_payloads)))
+    await writer.close()
+    duration = time.perf_counter() - start
+
+    nb_spans = nb_payloads * spans_per_payload
+    logger.info(
+        f"Ingested {nb_spans} spans in {duration:.2f}s: {nb_spans / duration:.0f} spans/s"
+    )
+    assert sum(accepted) == nb_spans
+    assert writer.dropped_spans == 0
+    assert writer.failed_spans == 0
+    assert writer.written_spans == nb_spans
+    assert await db["opentelemetry"].count_documents({"project_id": project_id}) == (
+        nb_spans
+    )
+
+    await db["opentelemetry"].delete_many({"project_id": project_id})
+    await db["logs_opentelemetry"].delete_many(
+        {"resourceSpans.scopeSpans.spans.traceId": "http"}
+    )
+
+
+@pytest.mark.asyncio
+async def test_opentelemetry_buffer_overflow(monkeypatch):
+    written = []
+
+    class SlowCollection:
+        async def insert_many(self, documents, ordered=True):
+            await asyncio.sleep(0.05)
+            written.extend(documents)
+
+    async def get_mongo_db():
+        return {"opentelemetry": SlowCollection()}
+
+    monkeypatch.setattr(
+        "app.services.connectors.opentelemetry.get_mongo_db", get_mongo_db
+    )
+    documents = [{"trace_id": str(index % 7), "span": index} for index in range(250)]
+
+    # Drop: the spans above the limit are dropped and counted
+    writer = SpanWriter(max_spans=100, batch_size=1000, overflow="drop")
+    assert await writer.add(documents) == 100
+    await writer.close()
+    assert writer.dropped_spans == 150
+    assert len(written) == 100
+
+    # Block: the ingestion waits for the flushes, nothing is dropped
+    written.clear()
+    writer = SpanWriter(max_spans=100, batch_size=40, overflow="block")
+    assert await writer.add(documents) == 250
+    await writer.close()
+    assert writer.dropped_spans == 0
+    assert len(written) == 250
+    # The spans of a trace are written together
+    assert written[0]["trace_id"] == written[1]["trace_id"]
+
+
+@pytest.mark.asyncio
+async def test_opentelemetry_write_failure(monkeypatch):
+    class FailingCollection:
+        async def insert_many(self, documents, ordered=True):
+            raise RuntimeError("Write failed")
+
+    async def get_mongo_db():
+        return {"opentelemetry": FailingCollection()}
+
+    monkeypatch.setattr(
+        "app.services.connectors.opentelemetry.get_mongo_db", get_mongo_db
+    )
+    # The spans are not acknowledged if they are not written
+    writer = SpanWriter(max_spans=100, batch_size=10, overflow="block")
+    with pytest.raises(RuntimeError):
+        await writer.add([{"trace_id": "trace", "span": index} for index in range(10)])
+    await writer.close()
+    assert writer.failed_spans == 10
+    assert writer.written_spans == 0
+
+
+@pytest.mark.asyncio
+async def test_opentelemetry_retried_export(monkeypatch):
+    stored_spans = {}
+    stored_exports = {}
+
+    class SpansCollection:
+        fail = True
+
+        async def insert_many(self, documents, ordered=True):
+            details = {"nInserted": 0, "writeErrors": []}
+            for index, document in enumerate(documents):
+                if document["_id"] in stored_spans:
+                    details["writeErrors"].append({"index": index, "code": 11000})
+                elif self.fail and index % 2 == 1:
+                    details["writeErrors"].append({"index": index, "code": 91})
+                else:
+                    stored_spans[document["_id"]] = document
+                    details["nInserted"] += 1
+            if len(details["writeErrors"]) > 0:
+                raise BulkWriteError(details)
+
+    class ExportsCollection:
+        async def update_one(self, query, update, upsert=False):
+            stored_exports.setdefault(query["_id"], update["$setOnInsert"])
+
+    spans_collection = SpansCollection()
+    collections = {
+        "opentelemetry": spans_collection,
+        "logs_opentelemetry": ExportsCollection(),
+    }
+
+    async def get_mongo_db():
+        return collections
+
+    monkeypatch.setattr(
+        "app.services.connectors.opentelemetry.get_mongo_db", get_mongo_db
+    )
+    payload = recorded_payload(nb_traces=2, spans_per_trace=5)
+
+    async def process_export() -> int:
+        writer = SpanWriter(flush_interval=0.01)
+        connector = OpenTelemetryConnector(
+            project_id="project",
+            data=copy.deepcopy(payload),
+            span_writer=writer,
+            export_id="export",
+        )
+        try:
+            return await connector.process(org_id="org", current_usage=0)
+        finally:
+            await writer.close()
+
+    # The first attempt fails to write some spans: the export is not acknowledged
+    with pytest.raises(RuntimeError):
+        await process_export()
+    assert len(stored_spans) == 5
+
+    # The retry writes the other spans, and doesn't store anything twice
+    spans_collection.fail = False
+    assert await process_export() == 10
+    assert len(stored_spans) == 10
+    assert list(stored_exports.keys()) == ["export"]
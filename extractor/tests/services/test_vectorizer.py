@@ -0,0 +1,99 @@
+import asyncio
+import hashlib
+import random
+import time
+from typing import List
+
+import pytest
+from loguru import logger
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.http import models
+
+import app.core.config as config
+import app.services.vectorizer as vectorizer
+from app.services.vectorizer import TaskVectorizer
+from app.utils import generate_uuid
+from phospho.models import Task
+
+assert config.ENVIRONMENT != "production"
+
+EMBEDDING_LATENCY = 0.02  # Latency of an embedding call, in seconds
+
+
+def stub_embedding(text: str) -> List[float]:
+    """
+    A deterministic embedding of the text
+    """
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16)
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(1536)]
+
+
+async def stub_embeddings(texts: List[str]) -> List[List[float]]:
+    await asyncio.sleep(EMBEDDING_LATENCY)
+    return [stub_embedding(text) for text in texts]
+
+
+class InMemoryTaskVectorizer(TaskVectorizer):
+    def __init__(self, tasks: List[Task], **kwargs):
+        super().__init__(embed=stub_embeddings, **kwargs)
+        self.tasks = {task.id: task for task in tasks}
+
+    async def _load_tasks(self, task_ids: List[str]) -> List[Task]:
+        return [self.tasks[task_id] for task_id in task_ids]
+
+
+@pytest.mark.asyncio
+async def test_task_vectorizer(monkeypatch):
+    qdrant_db = AsyncQdrantClient(location=":memory:")
+    await qdrant_db.create_collection(
+        collection_name="tasks",
+        vectors_config=models.VectorParams(size=1536, distance=models.Distance.COSINE),
+    )
+
+    async def get_qdrant():
+        return qdrant_db
+
+    monkeypatch.setattr(vectorizer, "get_qdrant", get_qdrant)
+
+    tasks = [
+        Task(
+            id=generate_uuid(),
+            project_id="project",
+            org_id="org",
+            session_id="session",
+            input=f"question {index}",
+            output=f"answer {index}",
+        )
+        for index in range(1000)
+    ]
+    task_vectorizer = InMemoryTaskVectorizer(tasks, batch_size=256, flush_interval=0.1)
+
+    # The pipeline queues the tasks by small groups, like process_logs_for_tasks
+    start = time.perf_counter()
+    for index in range(0, len(tasks), 10):
+        task_vectorizer.enqueue([task.id for task in tasks[index : index + 10]])
+    enqueue_duration = time.perf_counter() - start
+    await task_vectorizer.flush()
+    duration = time.perf_counter() - start
+    logger.info(
+        f"Vectorized {task_vectorizer.vectorized_tasks} tasks in {duration:.2f}s "
+        + f"with {task_vectorizer.embedding_calls} embedding calls"
+    )
+
+    # Queuing doesn't wait for the embeddings
+    assert enqueue_duration < EMBEDDING_LATENCY
+    assert task_vectorizer.vectorized_tasks == 1000
+    # One embedding call per batch, instead of one per group of tasks
+    assert task_vectorizer.embedding_calls == 4
+    count = await qdrant_db.count(collection_name="tasks")
+    assert count.count == 1000
+
+    # The vectors can be searched
+    found_vectors = await qdrant_db.search(
+        collection_name="tasks",
+        query_vector=stub_embedding(f"{tasks[3].input} {tasks[3].output}"),
+        limit=1,
+    )
+    assert found_vectors[0].payload["task_id"] == tasks[3].id
+    await qdrant_db.close()
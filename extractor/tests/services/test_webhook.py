@@ -0,0 +1,102 @@
+import asyncio
+import time
+from typing import Any, List, Optional
+
+import pytest
+from aiohttp import web
+
+import app.core.config as config
+from app.services.webhook import WebhookDispatcher
+
+assert config.ENVIRONMENT != "production"
+
+
+class InMemoryRetryQueue:
+    def __init__(self):
+        self.deliveries: List[dict] = []
+
+    async def push(self, url: str, json: Any, headers: Optional[dict], error: str):
+        self.deliveries.append(
+            {"url": url, "json": json, "headers": headers, "attempts": 1}
+        )
+
+    async def pop_due(self, limit: int) -> List[dict]:
+        deliveries, self.deliveries = self.deliveries[:limit], self.deliveries[limit:]
+        return deliveries
+
+    async def succeeded(self, delivery: dict) -> None:
+        pass
+
+    async def failed(self, delivery: dict, error: str) -> None:
+        self.deliveries.append({**delivery, "attempts": delivery["attempts"] + 1})
+
+
+async def start_stub_server(delay: float, status: int = 200):
+    """
+    A webhook receiver that answers after `delay` seconds
+    """
+    received: List[Any] = []
+
+    async def handler(request: web.Request) -> web.Response:
+        received.append(await request.json())
+        await asyncio.sleep(delay)
+        return web.Response(status=status, text="ok")
+
+    app = web.Application()
+    app.router.add_post("/webhook", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/webhook", received
+
+
+@pytest.mark.asyncio
+async def test_webhook_latency_does_not_slow_the_pipeline():
+    pipeline_durations = []
+    for delay in [0, 0.1, 0.2]:
+        runner, url, received = await start_stub_server(delay)
+        dispatcher = WebhookDispatcher(retry_queue=InMemoryRetryQueue())
+
+        # A pipeline detecting 100 events, each with a webhook
+        start = time.perf_counter()
+        for i in range(100):
+            dispatcher.dispatch(url, {"event": i})
+            await asyncio.sleep(0)
+        pipeline_durations.append(time.perf_counter() - start)
+
+        # The deliveries continue in the background
+        await dispatcher.flush()
+        assert len(received) == 100
+        await dispatcher.close()
+        await runner.cleanup()
+
+    # The pipeline doesn't wait for the receivers
+    assert max(pipeline_durations) < 0.2
+
+
+@pytest.mark.asyncio
+async def test_webhook_batches_and_retries():
+    runner, url, received = await start_stub_server(0)
+    retry_queue = InMemoryRetryQueue()
+    dispatcher = WebhookDispatcher(retry_queue=retry_queue)
+    for i in range(config.WEBHOOK_BATCH_SIZE + 1):
+        dispatcher.dispatch(url, {"event": i}, batch=True)
+    await dispatcher.flush()
+    assert [len(batch) for batch in received] == [config.WEBHOOK_BATCH_SIZE, 1]
+
+    # Failed deliveries go to the retry queue
+    await runner.cleanup()
+    dispatcher.dispatch(url, {"event": "lost"})
+    await dispatcher.flush()
+    assert len(retry_queue.deliveries) == 1
+
+    # and are delivered when the receiver is back
+    runner, url, received = await start_stub_server(0)
+    retry_queue.deliveries[0]["url"] = url
+    assert await dispatcher.retry_due() == 1
+    assert received == [{"event": "lost"}]
+    assert retry_queue.deliveries == []
+    await dispatcher.close()
+    await runner.cleanup()
@@ -1,5 +1,7 @@
 import logging
 import pymongo
+from collections import Counter
+from pymongo import monitoring
 from typing import Dict, List
 
 logger = logging.getLogger(__name__)
@@ -25,3 +27,24 @@ def cleanup(
         raise RuntimeError(
             "You are trying to clean the production database. Set MONGODB_NAME to something else than 'production'"
         )
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Count the commands sent to Mongo by a client, by command name
+    """
+
+    def __init__(self):
+        self.commands: Counter = Counter()
+
+    def started(self, event):
+        self.commands[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def total(self) -> int:
+        return sum(self.commands.values())
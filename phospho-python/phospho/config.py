@@ -11,3 +11,17 @@ MISTRAL_API_KEY = os.environ.get("MISTRAL_API_KEY")
 
 # Optional: Set this environment variable to instead use an Ollama model everywhere
 OVERRIDE_WITH_OLLAMA_MODEL = os.getenv("OVERRIDE_WITH_OLLAMA_MODEL", None)
+
+# Cache of the deterministic LLM calls of the lab jobs (see phospho/lab/llm_cache.py)
+# LLM_CACHE_BACKEND can be "memory", "sqlite" or "none"
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "memory")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "phospho_llm_cache.sqlite")
+LLM_CACHE_MAX_SIZE = int(os.getenv("LLM_CACHE_MAX_SIZE", 1000))
+# Time to live of the cached responses, in seconds
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+
+# Connection pools of the clients of the LLM providers (see phospho/lab/language_models.py)
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 20))
+# Timeout of the calls to the LLM providers, in seconds
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 600))
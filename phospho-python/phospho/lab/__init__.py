@@ -1,4 +1,6 @@
 from .lab import Workload, Job
+from .message_batch import MessageBatch
+from .profiling import Profiler
 from .models import (
     JobResult,
     Message,
@@ -0,0 +1,303 @@
+"""
+Offline execution of a workload with a batch API.
+
+Instead of one chat completion per message per job, the workload runs in three steps:
+1. Collect: the jobs run on every message, and their LLM calls are recorded instead of
+   being sent. The requests are written to a JSONL batch file.
+2. Submit: the batch file is sent to a BatchProvider (the OpenAI Batch API, or the local
+   fake provider for tests), which is polled until the batch is done.
+3. Replay: the jobs run again, and their LLM calls are answered from the batch results.
+
+A job stops at its first LLM call that has no response yet. So a job that makes several
+calls in a row collects its next call during the replay: the steps are repeated, with
+one batch per round, until no new call is collected.
+
+Calls are identified by the same content addressed key as the LLM cache.
+
+```python
+from phospho.lab.batch import OpenAIBatchProvider
+
+results = await workload.async_run_offline(messages, OpenAIBatchProvider())
+```
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Protocol,
+    Set,
+)
+
+from .llm_cache import LLMCache
+from .models import JobResult, Message, ResultType
+
+try:
+    from openai.types.chat import ChatCompletion
+except ImportError:
+    ChatCompletion = None
+
+if TYPE_CHECKING:
+    from .lab import Workload
+
+logger = logging.getLogger(__name__)
+
+BatchStatus = Literal["in_progress", "completed", "failed"]
+
+
+class BatchRequestCollected(Exception):
+    """Raised instead of calling the provider during the collect step"""
+
+
+class BatchResponseMissing(Exception):
+    """Raised during the replay step if the batch has no response for a call"""
+
+
+class BatchProvider(Protocol):
+    async def submit(self, batch_file: str) -> str:
+        """Submit the JSONL batch file and return the id of the batch"""
+        ...
+
+    async def status(self, batch_id: str) -> BatchStatus:
+        ...
+
+    async def results(self, batch_id: str) -> Dict[str, dict]:
+        """Return a mapping custom_id -> chat completion (as a dict)"""
+        ...
+
+
+class OpenAIBatchProvider:
+    def __init__(self, client: Optional[Any] = None, completion_window: str = "24h"):
+        """
+        :param client: An AsyncOpenAI client. Defaults to the openai client of the lab.
+        """
+        if client is None:
+            from .language_models import get_async_client
+
+            client = get_async_client("openai")
+        self.client = client
+        self.completion_window = completion_window
+
+    async def submit(self, batch_file: str) -> str:
+        with open(batch_file, "rb") as f:
+            uploaded_file = await self.client.files.create(file=f, purpose="batch")
+        batch = await self.client.batches.create(
+            input_file_id=uploaded_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+        )
+        return batch.id
+
+    async def status(self, batch_id: str) -> BatchStatus:
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.status == "completed":
+            return "completed"
+        if batch.status in ["failed", "expired", "cancelled"]:
+            return "failed"
+        return "in_progress"
+
+    async def results(self, batch_id: str) -> Dict[str, dict]:
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.output_file_id is None:
+            return {}
+        content = await self.client.files.content(batch.output_file_id)
+        responses: Dict[str, dict] = {}
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            output = json.loads(line)
+            response = output.get("response") or {}
+            if response.get("status_code") == 200:
+                responses[output["custom_id"]] = response["body"]
+        return responses
+
+
+class LocalBatchProvider:
+    def __init__(self, respond: Optional[Callable[[dict], str]] = None):
+        """
+        A fake batch provider, for tests. The batch is done as soon as it's submitted.
+
+        :param respond: A function that returns the content of the response to a request
+            body (model, messages, params). Defaults to "no".
+        """
+        self.respond = respond or (lambda body: "no")
+        self._batches: Dict[str, List[dict]] = {}
+
+    async def submit(self, batch_file: str) -> str:
+        with open(batch_file) as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        batch_id = f"local_batch_{len(self._batches)}"
+        self._batches[batch_id] = requests
+        return batch_id
+
+    async def status(self, batch_id: str) -> BatchStatus:
+        return "completed"
+
+    async def results(self, batch_id: str) -> Dict[str, dict]:
+        responses: Dict[str, dict] = {}
+        for request in self._batches[batch_id]:
+            body = request["body"]
+            responses[request["custom_id"]] = {
+                "id": f"chatcmpl-{request['custom_id'][:8]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {
+                            "role": "assistant",
+                            "content": self.respond(body),
+                        },
+                    }
+                ],
+            }
+        return responses
+
+
+class BatchSession:
+    def __init__(self) -> None:
+        # custom_id -> request body, of the calls collected for the next batch
+        self.requests: Dict[str, dict] = {}
+        # custom_id of the calls already sent in a batch
+        self.submitted: Set[str] = set()
+        # custom_id -> chat completion
+        self.responses: Dict[str, dict] = {}
+
+    async def chat_completion(
+        self, provider: str, model: str, messages: list, **params
+    ) -> Any:
+        key = LLMCache.get_key(provider, model, messages, params)
+        if key in self.responses:
+            return ChatCompletion.model_validate(self.responses[key])
+        if key in self.submitted:
+            raise BatchResponseMissing(f"No response in the batch for the call {key}")
+        self.requests[key] = {"model": model, "messages": messages, **params}
+        raise BatchRequestCollected(key)
+
+    def write_batch_file(self, batch_file: str) -> None:
+        with open(batch_file, "w") as f:
+            for custom_id, body in self.requests.items():
+                f.write(
+                    json.dumps(
+                        {
+                            "custom_id": custom_id,
+                            "method": "POST",
+                            "url": "/v1/chat/completions",
+                            "body": body,
+                        },
+                        default=str,
+                    )
+                    + "\n"
+                )
+
+
+_batch_session: contextvars.ContextVar[Optional[BatchSession]] = contextvars.ContextVar(
+    "phospho_batch_session", default=None
+)
+
+
+def get_batch_session() -> Optional[BatchSession]:
+    """
+    Return the batch session of the current offline run, if any.
+    """
+    return _batch_session.get()
+
+
+async def _run_jobs(
+    workload: "Workload", messages: List[Message], max_parallelism: int
+) -> Dict[str, Dict[str, JobResult]]:
+    """
+    Run all the jobs on the messages. Errors of a job are returned as error results.
+    """
+    semaphore = asyncio.Semaphore(max_parallelism)
+    results: Dict[str, Dict[str, JobResult]] = {message.id: {} for message in messages}
+
+    async def run_job(job: Any, message: Message) -> None:
+        async with semaphore:
+            try:
+                result = await job.async_compute(message)
+            except Exception as e:
+                result = JobResult(
+                    result_type=ResultType.error, value=None, logs=[str(e)]
+                )
+                result.job_id = job.id
+                result.job_metadata = job.metadata or {}
+        results[message.id][job.id] = result
+
+    await asyncio.gather(
+        *(
+            run_job(job, message)
+            for message in messages
+            for job in workload.jobs.values()
+        )
+    )
+    return results
+
+
+async def run_offline(
+    workload: "Workload",
+    messages: Iterable[Message],
+    batch_provider: BatchProvider,
+    batch_file: str = "phospho_batch.jsonl",
+    poll_interval: float = 60,
+    max_parallelism: int = 10,
+) -> Dict[str, Dict[str, JobResult]]:
+    """
+    Run the workload on the messages with a batch API. See the module docstring.
+
+    Returns: a mapping of message.id -> job_id -> job_result
+    """
+    messages = list(messages)
+    session = BatchSession()
+    token = _batch_session.set(session)
+    try:
+        while True:
+            # 1. and 3. Run the jobs: the calls with a response are answered from the
+            # batch results, the other calls are collected
+            results = await _run_jobs(workload, messages, max_parallelism)
+            if len(session.requests) == 0:
+                break
+            logger.info(f"Collected {len(session.requests)} LLM calls in {batch_file}")
+
+            # 2. Submit them as a batch and wait for the results
+            session.write_batch_file(batch_file)
+            batch_id = await batch_provider.submit(batch_file)
+            logger.info(f"Submitted batch {batch_id}")
+            while True:
+                status = await batch_provider.status(batch_id)
+                if status == "completed":
+                    break
+                if status == "failed":
+                    raise RuntimeError(f"Batch {batch_id} failed")
+                await asyncio.sleep(poll_interval)
+            responses = await batch_provider.results(batch_id)
+            logger.info(
+                f"Batch {batch_id} done: {len(responses)}/{len(session.requests)} responses"
+            )
+            session.responses.update(responses)
+            session.submitted.update(session.requests)
+            session.requests = {}
+    finally:
+        _batch_session.reset(token)
+        if workload.rule_detector is not None:
+            workload.rule_detector.clear()
+
+    for message_id, job_results in results.items():
+        for job_id, job_result in job_results.items():
+            job_result.org_id = workload.org_id
+            job_result.project_id = workload.project_id
+            workload.jobs[job_id].results[message_id] = job_result
+    workload._results = results
+    return results
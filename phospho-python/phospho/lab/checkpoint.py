@@ -0,0 +1,318 @@
+"""
+Persistent checkpoints of the results of a workload.
+
+The results of the completed (message, job) pairs are appended to a local store. If the
+run is interrupted, running the workload again with the same store skips the pairs that
+are already done: they are not recomputed nor billed again.
+
+```python
+from phospho.lab.checkpoint import open_checkpoint
+
+checkpoint = open_checkpoint("checkpoint.sqlite")
+workload.run(messages, checkpoint=checkpoint)
+```
+
+Two stores are available: SQLite and JSONL (one result per line, append only). The
+results are written by batches of flush_every: if the process dies, at most the last
+batch is lost. A result is only reused if the configuration of the job didn't change.
+Old results are dropped after `retention` seconds, when the store is opened or
+compacted. The SQLite file only shrinks on an explicit `checkpoint.compact()`.
+
+Resuming requires stable message ids: the messages must have the same ids in each run.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from .models import JobResult
+
+if TYPE_CHECKING:
+    from .lab import Job
+
+logger = logging.getLogger(__name__)
+
+# (run_id, message_id, job_id)
+CheckpointKey = Tuple[str, str, str]
+
+
+def job_fingerprint(job: "Job") -> str:
+    """
+    A hash of the configuration of the job. Results computed with another configuration
+    are not reused.
+    """
+    return hashlib.sha256(job.config.model_dump_json().encode("utf-8")).hexdigest()[
+        :16
+    ]
+
+
+class CheckpointStore:
+    """
+    Base class of the checkpoint stores. Subclasses implement _load, _write and _compact.
+    """
+
+    def __init__(
+        self,
+        run_id: str = "default",
+        retention: Optional[float] = None,
+        flush_every: int = 20,
+        compact_on_open: bool = True,
+    ):
+        """
+        :param run_id: Results of different runs (for example different versions of an agent)
+            are kept separate in the same store.
+        :param retention: Time to keep the results, in seconds. None to keep them forever.
+        :param flush_every: Number of results buffered before writing them to the store.
+        :param compact_on_open: Drop the expired results when the store is opened.
+        """
+        self.run_id = run_id
+        self.retention = retention
+        self.flush_every = flush_every
+        self.compact_on_open = compact_on_open
+        self._buffer: List[Dict[str, Any]] = []
+        self._lock = threading.RLock()
+
+    def _is_expired(self, created_at: float) -> bool:
+        return self.retention is not None and created_at < time.time() - self.retention
+
+    def _load(self, key: CheckpointKey) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        raise NotImplementedError
+
+    def _compact(self) -> None:
+        raise NotImplementedError
+
+    def get(self, message_id: str, job: "Job") -> Optional[JobResult]:
+        """
+        Return the result of the job on the message, if it's in the store.
+        """
+        key = (self.run_id, message_id, job.id)
+        with self._lock:
+            record = next(
+                (
+                    record
+                    for record in self._buffer
+                    if (record["run_id"], record["message_id"], record["job_id"])
+                    == key
+                ),
+                None,
+            )
+            if record is None:
+                record = self._load(key)
+        if (
+            record is None
+            or record["fingerprint"] != job_fingerprint(job)
+            or self._is_expired(record["created_at"])
+        ):
+            return None
+        return JobResult.model_validate(record["result"])
+
+    def add(self, message_id: str, job: "Job", result: JobResult) -> None:
+        record = {
+            "run_id": self.run_id,
+            "message_id": message_id,
+            "job_id": job.id,
+            "fingerprint": job_fingerprint(job),
+            "result": result.model_dump(mode="json"),
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._buffer.append(record)
+            if len(self._buffer) >= self.flush_every:
+                self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if len(self._buffer) == 0:
+                return
+            self._write(self._buffer)
+            self._buffer = []
+
+    def compact(self) -> None:
+        """
+        Drop the expired results, and reclaim the space of the overwritten ones.
+        """
+        with self._lock:
+            self.flush()
+            self._compact()
+
+    def close(self) -> None:
+        self.flush()
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    def __init__(self, path: str = "phospho_checkpoint.sqlite", **kwargs: Any):
+        super().__init__(**kwargs)
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                + "run_id TEXT NOT NULL, message_id TEXT NOT NULL, job_id TEXT NOT NULL, "
+                + "fingerprint TEXT NOT NULL, result TEXT NOT NULL, created_at REAL NOT NULL, "
+                + "PRIMARY KEY (run_id, message_id, job_id))"
+            )
+            self._connection.commit()
+        if self.compact_on_open:
+            # VACUUM rewrites the whole file: it only runs on an explicit compact()
+            with self._lock:
+                self._compact()
+
+    def _load(self, key: CheckpointKey) -> Optional[Dict[str, Any]]:
+        row = self._connection.execute(
+            "SELECT fingerprint, result, created_at FROM checkpoints "
+            + "WHERE run_id = ? AND message_id = ? AND job_id = ?",
+            key,
+        ).fetchone()
+        if row is None:
+            return None
+        fingerprint, result, created_at = row
+        return {
+            "fingerprint": fingerprint,
+            "result": json.loads(result),
+            "created_at": created_at,
+        }
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO checkpoints "
+            + "(run_id, message_id, job_id, fingerprint, result, created_at) "
+            + "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    record["run_id"],
+                    record["message_id"],
+                    record["job_id"],
+                    record["fingerprint"],
+                    json.dumps(record["result"]),
+                    record["created_at"],
+                )
+                for record in records
+            ],
+        )
+        self._connection.commit()
+
+    def _compact(self) -> None:
+        if self.retention is not None:
+            self._connection.execute(
+                "DELETE FROM checkpoints WHERE created_at < ?",
+                (time.time() - self.retention,),
+            )
+            self._connection.commit()
+
+    def compact(self) -> None:
+        """
+        Drop the expired results, and reclaim the space of the deleted ones (VACUUM).
+        """
+        with self._lock:
+            super().compact()
+            self._connection.execute("VACUUM")
+
+    def close(self) -> None:
+        super().close()
+        with self._lock:
+            self._connection.close()
+
+
+class JSONLCheckpointStore(CheckpointStore):
+    def __init__(self, path: str = "phospho_checkpoint.jsonl", **kwargs: Any):
+        super().__init__(**kwargs)
+        self.path = path
+        # The latest record of every key
+        self._index: Dict[CheckpointKey, Dict[str, Any]] = {}
+        # Number of lines in the file, to know if it's worth compacting
+        self._lines = 0
+        if os.path.exists(path):
+            self._repair_last_line()
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # For instance a line truncated by a crash, before a newer run
+                        logger.warning(f"Skipping a corrupted line in {path}")
+                        continue
+                    self._lines += 1
+                    self._index[
+                        (record["run_id"], record["message_id"], record["job_id"])
+                    ] = record
+        if self.compact_on_open:
+            self.compact()
+
+    def _repair_last_line(self) -> None:
+        """
+        If the process died while writing a line, the file doesn't end with a newline
+        and the next records would be appended to the truncated line. Drop it.
+        """
+        with open(self.path, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            if end == 0:
+                return
+            position = end
+            # Look for the last newline, from the end of the file
+            while position > 0:
+                block_start = max(0, position - 4096)
+                f.seek(block_start)
+                block = f.read(position - block_start)
+                if position == end and block.endswith(b"\n"):
+                    return
+                newline = block.rfind(b"\n")
+                if newline >= 0:
+                    position = block_start + newline + 1
+                    break
+                position = block_start
+            f.seek(position)
+            last_line = f.read()
+            try:
+                json.loads(last_line)
+                # Only the newline is missing
+                f.write(b"\n")
+            except json.JSONDecodeError:
+                logger.warning(f"Dropping a truncated line at the end of {self.path}")
+                f.truncate(position)
+
+    def _load(self, key: CheckpointKey) -> Optional[Dict[str, Any]]:
+        return self._index.get(key)
+
+    def _write(self, records: List[Dict[str, Any]]) -> None:
+        with open(self.path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        self._lines += len(records)
+        for record in records:
+            self._index[
+                (record["run_id"], record["message_id"], record["job_id"])
+            ] = record
+
+    def _compact(self) -> None:
+        self._index = {
+            key: record
+            for key, record in self._index.items()
+            if not self._is_expired(record["created_at"])
+        }
+        if self._lines == len(self._index):
+            return
+        # Rewrite the file with the latest records, and replace it atomically
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for record in self._index.values():
+                f.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, self.path)
+        self._lines = len(self._index)
+
+
+def open_checkpoint(path: str, **kwargs: Any) -> CheckpointStore:
+    """
+    Open a JSONL checkpoint store if the path ends with .jsonl, a SQLite one otherwise.
+    See CheckpointStore for the parameters.
+    """
+    if path.endswith(".jsonl"):
+        return JSONLCheckpointStore(path, **kwargs)
+    return SQLiteCheckpointStore(path, **kwargs)
@@ -10,7 +10,7 @@ import math
 import os
 import random
 import time
-from typing import List, Literal, Optional, Tuple, cast
+from typing import TYPE_CHECKING, List, Literal, Optional, Tuple, cast
 
 from phospho.models import ScoreRange, ScoreRangeSettings
 from phospho.utils import get_number_of_tokens, shorten_text
@@ -20,12 +20,51 @@ try:
 except ImportError:
     pass
 
-from .language_models import get_async_client, get_provider_and_model, get_sync_client
+from .batch import BatchRequestCollected
+from .language_models import get_provider_and_model, get_sync_client
+from .llm_cache import cached_chat_completion
 from phospho.models import JobResult, Message, ResultType, DetectionScope
 
+if TYPE_CHECKING:
+    from .lab import Workload
+
 logger = logging.getLogger(__name__)
 
 
+def _bool_result(formated_prompt: str, llm_response: Optional[str]) -> JobResult:
+    # Cast the response to a bool
+    if llm_response is None:
+        bool_response = False
+    else:
+        bool_response = llm_response.lower() == "true"
+
+    return JobResult(
+        result_type=ResultType.bool,
+        value=bool_response,
+        logs=[formated_prompt, llm_response],
+    )
+
+
+def _literal_result(
+    formated_prompt: str, llm_response: Optional[str], output_literal: List[str]
+) -> JobResult:
+    literal_response = None
+    if llm_response is not None:
+        response_content = llm_response.strip()
+        # Best scenario: Check if the response is in the output_literal
+        if response_content in output_literal:
+            literal_response = response_content
+        # Greedy: Check if the response contains one of the output_literal
+        elif any(literal in response_content for literal in output_literal):
+            literal_response = response_content
+
+    return JobResult(
+        result_type=ResultType.literal,
+        value=literal_response,
+        logs=[formated_prompt, llm_response],
+    )
+
+
 def prompt_to_bool(
     message: Message,
     prompt: str,
@@ -34,6 +73,7 @@ def prompt_to_bool(
 ) -> JobResult:
     """
     Runs a prompt on a message and returns a boolean result.
+    In a workload, use async_prompt_to_bool to run the calls concurrently.
     """
     # Check if some Env variables override the default model and LLM provider
     provider, model_name = get_provider_and_model(model)
@@ -58,19 +98,43 @@ def prompt_to_bool(
         ],
         max_tokens=1,
     )
-    llm_response = response.choices[0].message.content
+    return _bool_result(formated_prompt, response.choices[0].message.content)
 
-    # Cast the response to a bool
-    if llm_response is None:
-        bool_response = False
-    else:
-        bool_response = llm_response.lower() == "true"
 
-    return JobResult(
-        result_type=ResultType.bool,
-        value=bool_response,
-        logs=[formated_prompt, llm_response],
+async def async_prompt_to_bool(
+    message: Message,
+    prompt: str,
+    format_kwargs: Optional[dict] = None,
+    model: str = "openai:gpt-4o",
+) -> JobResult:
+    """
+    Async version of prompt_to_bool, with the LLM cache.
+    """
+    # Check if some Env variables override the default model and LLM provider
+    provider, model_name = get_provider_and_model(model)
+
+    if format_kwargs is None:
+        format_kwargs = {}
+
+    formated_prompt = prompt.format(
+        message_content=message.content,
+        message_context=message.previous_messages_transcript(with_role=True),
+        **format_kwargs,
+    )
+    response = await cached_chat_completion(
+        None,
+        provider=provider,
+        model=model_name,
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {
+                "role": "user",
+                "content": formated_prompt,
+            },
+        ],
+        max_tokens=1,
     )
+    return _bool_result(formated_prompt, response.choices[0].message.content)
 
 
 def prompt_to_literal(
@@ -82,6 +146,7 @@ def prompt_to_literal(
 ) -> JobResult:
     """
     Runs a prompt on a message and returns a str from the list ouput_literal.
+    In a workload, use async_prompt_to_literal to run the calls concurrently.
     """
     provider, model_name = get_provider_and_model(model)
     openai_client = get_sync_client(provider)
@@ -108,31 +173,49 @@ def prompt_to_literal(
         max_tokens=1,
         temperature=0,
     )
+    return _literal_result(
+        formated_prompt, response.choices[0].message.content, output_literal
+    )
 
-    response_content = response.choices[0].message.content
-    literal_response = None
-    if response_content is not None:
-        response_content = response_content.strip()
-        # Best scenario: Check if the response is in the output_literal
-        if response_content in output_literal:
-            return JobResult(
-                result_type=ResultType.literal,
-                value=response_content,
-                logs=[formated_prompt, response.choices[0].message.content],
-            )
-        # Greedy: Check if the response contains one of the output_literal
-        for literal in output_literal:
-            if literal in response_content:
-                return JobResult(
-                    result_type=ResultType.literal,
-                    value=response_content,
-                    logs=[formated_prompt, response.choices[0].message.content],
-                )
 
-    return JobResult(
-        result_type=ResultType.literal,
-        value=literal_response,
-        logs=[formated_prompt, response.choices[0].message.content],
+async def async_prompt_to_literal(
+    message: Message,
+    prompt: str,
+    output_literal: List[str],
+    format_kwargs: Optional[dict] = None,
+    model: str = "openai:gpt-3.5-turbo",
+) -> JobResult:
+    """
+    Async version of prompt_to_literal, with the LLM cache.
+    """
+    provider, model_name = get_provider_and_model(model)
+
+    if format_kwargs is None:
+        format_kwargs = {}
+
+    formated_prompt = prompt.format(
+        message_content=message.transcript(with_role=True),
+        message_context=message.transcript(
+            only_previous_messages=True, with_previous_messages=True, with_role=True
+        ),
+        **format_kwargs,
+    )
+    response = await cached_chat_completion(
+        None,
+        provider=provider,
+        model=model_name,
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {
+                "role": "user",
+                "content": formated_prompt,
+            },
+        ],
+        max_tokens=1,
+        temperature=0,
+    )
+    return _literal_result(
+        formated_prompt, response.choices[0].message.content, output_literal
     )
 
 
@@ -156,7 +239,6 @@ async def event_detection(
 
     # Check if some Env variables override the default model and LLM provider
     provider, model_name = get_provider_and_model(model)
-    async_openai_client = get_async_client(provider)
 
     if score_range_settings is None:
         score_range_settings = ScoreRangeSettings()
@@ -306,10 +388,11 @@ Assistant: {truncated_context}
 """
     elif event_scope == "session":
         truncated_context = shorten_text(
-            message.transcript(with_role=True, with_previous_messages=True),
+            message.scope_text("session"),
             MAX_TOKENS,
             get_number_of_tokens(prompt) + 100,
             how="right",
+            tokens=message.scope_tokens("session"),
         )
         prompt += f"""
 Label the following interaction with the event '{event_name}':
@@ -351,7 +434,9 @@ If the event '{event_name}' is not present in the interaction or you can't categ
     # Call the API
     start_time = time.time()
     try:
-        response = await async_openai_client.chat.completions.create(
+        response = await cached_chat_completion(
+            None,
+            provider=provider,
             model=model_name,
             messages=[
                 {
@@ -365,6 +450,9 @@ If the event '{event_name}' is not present in the interaction or you can't categ
             logprobs=True,
             top_logprobs=20,
         )
+    except BatchRequestCollected:
+        # Not a failure: the call is sent later, in a batch
+        raise
     except Exception as e:
         logger.error(f"event_detection call to OpenAI API failed : {e}")
         return JobResult(
@@ -380,6 +468,10 @@ If the event '{event_name}' is not present in the interaction or you can't categ
         "prompt": prompt,
         "llm_output": llm_response,
         "api_call_time": api_call_time,
+        "prompt_tokens": response.usage.prompt_tokens if response.usage else None,
+        "completion_tokens": response.usage.completion_tokens
+        if response.usage
+        else None,
     }
     metadata = {
         "api_call_time": api_call_time,
@@ -629,7 +721,6 @@ async def evaluate_task(
 
     # Check if some Env variables override the default model and LLM provider
     provider, model_name = get_provider_and_model(model)
-    async_openai_client = get_async_client(provider)
 
     successful_evals = message.metadata.get("successful_evals", [])
     unsuccessful_evals = message.metadata.get("unsuccessful_evals", [])
@@ -668,7 +759,9 @@ async def evaluate_task(
             return None
 
         start_time = time.time()
-        response = await async_openai_client.chat.completions.create(
+        response = await cached_chat_completion(
+            None,
+            provider=provider,
             model=model_name,
             messages=[
                 {
@@ -690,6 +783,10 @@ async def evaluate_task(
             "llm_output": llm_response,
             "api_call_time": api_call_time,
             "evaluation_source": "phospho-6",
+            "prompt_tokens": response.usage.prompt_tokens if response.usage else None,
+            "completion_tokens": response.usage.completion_tokens
+            if response.usage
+            else None,
         }
 
         # Parse the llm response to avoid basic errors
@@ -795,78 +892,22 @@ async def keyword_event_detection(
     event_name: str,
     keywords: str,
     event_scope: DetectionScope = "task",
+    workload: Optional["Workload"] = None,
     **kwargs,
 ) -> JobResult:
     """
-    Uses regexes to detect if an event is present in a message.
-    """
-    from re import search
-
-    listExchangeToSearch: List[str] = []
-    if event_scope == "task":
-        listExchangeToSearch = [message.latest_interaction()]
-
-    elif event_scope == "task_input_only":
-        message_list = message.as_list()
-        # Filter to keep only the user messages
-        listExchangeToSearch = [
-            " " + m.content + " " for m in message_list if m.role == "User"
-        ]
-
-    elif event_scope == "task_output_only":
-        message_list = message.as_list()
-        # Filter to keep only the assistant messages
-        listExchangeToSearch = [
-            " " + m.content + " " for m in message_list if m.role == "Assistant"
-        ]
-        print(listExchangeToSearch)
-
-    elif event_scope == "session":
-        listExchangeToSearch = [
-            message.transcript(with_role=True, with_previous_messages=True)
-        ]
-
-    # text to look into for the keywords
-    text = " ".join(listExchangeToSearch).lower()
-
-    # [ ,.:'/\n\r\t+=]{1} is used to match the keyword only if it is a separate word, because we don't want to match substrings
-    keywordlist = [
-        "[ ,.:'/\n\r\t+=]{1}"
-        + keyword.strip().lower()  # we match the keyword in the middle of the text
-        + "[ ,.:'/\n\r\t+=]{1}|^"
-        + keyword.strip().lower()  # we match the keyword at the beginning of the text
-        + "[ ,:'/.\n\r\t]{1}"
-        + "|[ ,:'/.\n\r\t]{1}"
-        + keyword.strip().lower()  # we match the keyword at the end of the text
-        + "$"
-        for keyword in keywords.split(",")
-    ]
-
-    # we use a regex pattern to match the keywords in the text
-    regex_pattern = "|".join(keywordlist)
-
-    try:
-        result = search(regex_pattern, text)
-        found = result is not None
+    Detect if one of the comma separated keywords is present in a message.
 
-        return JobResult(
-            result_type=ResultType.bool,
-            value=found,
-            logs=[text, regex_pattern],
-            metadata={
-                "evaluation_source": "phospho-keywords",
-                "score_range": ScoreRange(
-                    score_type="confidence", max=1, min=0, value=1 if found else 0
-                ),
-            },
-        )
+    If the job is part of a workload, all the keyword and regex events of the workload
+    are detected in a single pass on the message (see rule_detection.py).
+    """
+    from .rule_detection import RuleBasedEvent, detect_rule_based_event
 
-    except Exception as e:
-        return JobResult(
-            result_type=ResultType.error,
-            value=None,
-            logs=[str(e)],
-        )
+    return detect_rule_based_event(
+        message,
+        RuleBasedEvent(event_name, "keyword_detection", keywords, event_scope),
+        detector=workload.rule_detector if workload is not None else None,
+    )
 
 
 async def regex_event_detection(
@@ -874,60 +915,22 @@ async def regex_event_detection(
     event_name: str,
     regex_pattern: str,
     event_scope: DetectionScope = "task",
+    workload: Optional["Workload"] = None,
     **kwargs,
 ) -> JobResult:
     """
     Uses regexes to detect if an event is present in a message.
-    """
-    from re import search
-
-    listExchangeToSearch: List[str] = []
-    if event_scope == "task":
-        listExchangeToSearch = [message.latest_interaction()]
-
-    elif event_scope == "task_input_only":
-        message_list = message.as_list()
-        # Filter to keep only the user messages
-        listExchangeToSearch = [
-            " " + m.content + " " for m in message_list if m.role == "User"
-        ]
-
-    elif event_scope == "task_output_only":
-        message_list = message.as_list()
-        # Filter to keep only the assistant messages
-        listExchangeToSearch = [
-            " " + m.content + " " for m in message_list if m.role == "Assistant"
-        ]
-
-    elif event_scope == "session":
-        listExchangeToSearch = [
-            message.transcript(with_role=True, with_previous_messages=True)
-        ]
 
-    text = " ".join(listExchangeToSearch)
-
-    try:
-        result = search(regex_pattern, text)
-        found = result is not None
-
-        return JobResult(
-            result_type=ResultType.bool,
-            value=found,
-            logs=[text, regex_pattern],
-            metadata={
-                "evaluation_source": "phospho-regex",
-                "score_range": ScoreRange(
-                    score_type="confidence", max=1, min=0, value=1 if found else 0
-                ),
-            },
-        )
+    If the job is part of a workload, all the keyword and regex events of the workload
+    are detected in a single pass on the message (see rule_detection.py).
+    """
+    from .rule_detection import RuleBasedEvent, detect_rule_based_event
 
-    except Exception as e:
-        return JobResult(
-            result_type=ResultType.error,
-            value=None,
-            logs=[str(e)],
-        )
+    return detect_rule_based_event(
+        message,
+        RuleBasedEvent(event_name, "regex_detection", regex_pattern, event_scope),
+        detector=workload.rule_detector if workload is not None else None,
+    )
 
 
 async def get_topic_of_conversation(
@@ -941,7 +944,6 @@ async def get_topic_of_conversation(
     from phospho.utils import shorten_text
 
     provider, model_name = get_provider_and_model(model)
-    openai_client = get_sync_client(provider)
 
     # We look at the full session
     messages = message.transcript(with_role=True, with_previous_messages=True)
@@ -954,7 +956,9 @@ async def get_topic_of_conversation(
     prompt = "DISCUSSION START" + messages + "DISCUSSION END"
 
     try:
-        response = openai_client.chat.completions.create(
+        response = await cached_chat_completion(
+            None,
+            provider=provider,
             model=model_name,
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -976,6 +980,9 @@ async def get_topic_of_conversation(
             logs=[prompt, llm_response],
         )
 
+    except BatchRequestCollected:
+        # Not a failure: the call is sent later, in a batch
+        raise
     except Exception as e:
         logger.error(f"get_topic_of_conversation call to OpenAI API failed : {e}")
         return JobResult(
@@ -3,8 +3,12 @@ import concurrent.futures
 import itertools
 import logging
 import random
+import time
 from typing import (
+    TYPE_CHECKING,
     Any,
+    AsyncIterable,
+    AsyncIterator,
     Awaitable,
     Callable,
     Dict,
@@ -34,12 +38,31 @@ from .models import (
     Project,
     Recipe,
 )
+from .checkpoint import CheckpointStore
+from .language_models import close_async_clients
+from .profiling import Profiler
+from .rule_detection import RuleBasedDetector, RuleBasedEvent
+from .sweep import SweepResults
+
+if TYPE_CHECKING:
+    from .batch import BatchProvider
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+async def _run_and_close_clients(coroutine: Awaitable[Any]) -> Any:
+    """
+    Await a coroutine run with asyncio.run: the async clients created in this
+    event loop are closed before the loop is.
+    """
+    try:
+        return await coroutine
+    finally:
+        await close_async_clients()
+
+
 class Job:
     id: str
     job_function: Union[
@@ -59,6 +82,8 @@ class Job:
     metadata: Optional[Dict[str, Any]] = None
     workload: Optional["Workload"] = None
     sample: float = 1
+    # Results of the last configuration sweep
+    sweep_results: Optional[SweepResults] = None
 
     def __init__(
         self,
@@ -153,12 +178,66 @@ class Job:
         self.workload = workload
         self.sample = sample
 
-    async def async_run(self, message: Message) -> JobResult:
+    async def async_run(
+        self,
+        message: Message,
+        queued_at: Optional[float] = None,
+        checkpoint: Optional[CheckpointStore] = None,
+    ) -> JobResult:
         """
         Asynchronously run the job on a single message.
+
+        :param queued_at: time.perf_counter() when the run was scheduled, for the profiler.
+        :param checkpoint: If the result is in the checkpoint, the job doesn't run again.
+            Otherwise, the result is added to the checkpoint, unless it's an error.
+        """
+        if checkpoint is not None:
+            result = checkpoint.get(message.id, self)
+            if result is not None:
+                self.results[message.id] = result
+                return result
+
+        result = await self.async_compute(message, queued_at=queued_at)
+        # Store the result
+        self.results[message.id] = result
+        # Failed runs (for example rate limited) are retried when the run is resumed
+        if checkpoint is not None and result.result_type != ResultType.error:
+            checkpoint.add(message.id, self, result)
+        return result
+
+    async def async_compute(
+        self,
+        message: Message,
+        config: Optional[JobConfig] = None,
+        queued_at: Optional[float] = None,
+    ) -> JobResult:
         """
+        Asynchronously run the job on a single message, without storing the result.
+
+        :param config: The configuration to run the job with. Defaults to the job config.
+        :param queued_at: time.perf_counter() when the run was scheduled, for the profiler.
+        """
+        if self.workload is None:
+            return await self._async_compute(message, config)
+
+        is_default_config = config is None or config is self.config
+        with self.workload.profiler.span(
+            "phospho.job",
+            stats_key=self.id if is_default_config else f"{self.id} (alternative)",
+            queued_at=queued_at,
+            job_id=self.id,
+            message_id=message.id,
+        ) as span:
+            result = await self._async_compute(message, config)
+            if result.result_type == ResultType.error:
+                span.set_error()
+        return result
+
+    async def _async_compute(
+        self, message: Message, config: Optional[JobConfig] = None
+    ) -> JobResult:
         logger.debug(f"Running job {self.id} on message {message.id}.")
-        params = self.config.model_dump()
+        params = (config if config is not None else self.config).model_dump()
 
         # if 'job' is in the job_function signature, we pass the self object
         # Don't override the job parameter if it's already in the params
@@ -184,9 +263,7 @@ class Job:
 
         # Add the job_id to the result
         result.job_id = self.id
-        result.job_metadata = self.metadata
-        # Store the result
-        self.results[message.id] = result
+        result.job_metadata = self.metadata or {}
 
         return result
 
@@ -203,24 +280,14 @@ class Job:
             )
             return [{}]
 
-        for alternative_config_index in range(0, len(self.alternative_configs)):
-            params = self.alternative_configs[alternative_config_index].model_dump()
-            if asyncio.iscoroutinefunction(self.job_function):
-                job_result = await self.job_function(message, **params)
-            else:
-                job_result = self.job_function(message, **params)
-
-            if job_result is None:
-                logger.error(
-                    f"Job {self.id} returned None for message {message.id} on alternative config run."
-                )
-                job_result = JobResult(
-                    result_type=ResultType.error,
-                    value=None,
-                )
-            # Add the job_id to the result
-            job_result.job_id = self.id
-            job_result.job_metadata = self.metadata
+        # The alternative configurations are independent: run them concurrently
+        job_results = await asyncio.gather(
+            *(
+                self.async_compute(message, config=alternative_config)
+                for alternative_config in self.alternative_configs
+            )
+        )
+        for alternative_config_index, job_result in enumerate(job_results):
             # Add the prediction to the alternative_results
             self.alternative_results[alternative_config_index][message.id] = job_result
 
@@ -235,6 +302,10 @@ class Job:
 
         For now, we just check if the accuracy is above the threshold.
         """
+        if self.sweep_results is not None:
+            self._optimize_from_sweep(accuracy_threshold, min_count)
+            return
+
         # Check that the alternative_results are not empty
         if len(self.alternative_results) == 0:
             logger.warning(
@@ -294,6 +365,34 @@ class Job:
                 self.alternative_results = self.alternative_results[i + 1 :]
                 break
 
+    def _optimize_from_sweep(self, accuracy_threshold: float, min_count: int) -> None:
+        """
+        Same as optimize(), with the accuracies computed from the columnar sweep results.
+        """
+        sweep_results = self.sweep_results
+        assert sweep_results is not None
+        if len(sweep_results.message_ids) < min_count:
+            logger.info(
+                f"Can't run Workload.optimize(): {min_count} results are required, but only {len(sweep_results.message_ids)} found. Skipping."
+            )
+            return
+
+        # The first config of the sweep is the reference (the current config)
+        accuracies = sweep_results.accuracies()[1:]
+        logger.info(f"Accuracies: {accuracies}")
+
+        # The latest alternative configurations are the most preferred ones
+        for i in range(len(accuracies) - 1, -1, -1):
+            if accuracies[i] >= accuracy_threshold:
+                logger.info(
+                    f"Found a less costly config with accuracy of {accuracies[i]}. Swapping to it."
+                )
+                self.config = self.alternative_configs[i]
+                self.alternative_configs = self.alternative_configs[i + 1 :]
+                self.alternative_results = self.alternative_results[i + 1 :]
+                self.sweep_results = None
+                break
+
     def __repr__(self):
         return f"""Job(
     job_id={self.id},
@@ -319,6 +418,10 @@ class Workload:
     _results: Optional[Dict[str, Dict[str, JobResult]]]
 
     _valid_project_events: Optional[Dict[str, EventDefinition]] = None
+    # Detects all the keyword and regex events of the workload in a single pass
+    rule_detector: Optional[RuleBasedDetector] = None
+    # Timing, token usage and errors of the jobs
+    profiler: Profiler
 
     project_id: Optional[str] = None
     org_id: Optional[str] = None
@@ -343,6 +446,7 @@ class Workload:
         """
         self.jobs = {}
         self._results = None
+        self.profiler = Profiler()
 
         if jobs is not None:
             for job in jobs:
@@ -444,6 +548,7 @@ class Workload:
         cls, event_definitions: List[EventDefinition]
     ) -> "Workload":
         workload = cls()
+        rule_based_events: List[RuleBasedEvent] = []
 
         for event_definition in event_definitions:
             event_name = event_definition.event_name
@@ -487,6 +592,14 @@ class Workload:
                         metadata=event_definition.model_dump(),
                     )
                 )
+                rule_based_events.append(
+                    RuleBasedEvent(
+                        event_name,
+                        "keyword_detection",
+                        event_definition.keywords,
+                        event_definition.detection_scope,
+                    )
+                )
 
             # We use a regex pattern to detect the event
             elif (
@@ -506,12 +619,23 @@ class Workload:
                         metadata=event_definition.model_dump(),
                     )
                 )
+                rule_based_events.append(
+                    RuleBasedEvent(
+                        event_name,
+                        "regex_detection",
+                        event_definition.regex_pattern,
+                        event_definition.detection_scope,
+                    )
+                )
 
             else:
                 logger.warning(
                     f"Skipping unsupported detection engine {event_definition.detection_engine} for event {event_name}"
                 )
 
+        if len(rule_based_events) > 0:
+            workload.rule_detector = RuleBasedDetector(rule_based_events)
+
         return workload
 
     @classmethod
@@ -591,6 +715,7 @@ class Workload:
         messages: Iterable[Message],
         executor_type: Literal["parallel", "sequential", "parallel_jobs"] = "parallel",
         max_parallelism: int = 10,
+        checkpoint: Optional[CheckpointStore] = None,
     ) -> Dict[str, Dict[str, JobResult]]:
         """
         Runs all the jobs on the message.
@@ -600,9 +725,16 @@ class Workload:
         :param executor_type: The type of executor to use. Can be "parallel" or "sequential".
         :param max_parallelism: The maximum number of parallel jobs to run per seconds.
             Use this to adhere to rate limits. Only used if executor_type is "parallel" or "parallel_jobs".
+        :param checkpoint: Store of the completed results, to resume an interrupted run.
+            The (message, job) pairs already in the checkpoint don't run again.
+            See phospho.lab.checkpoint.
 
         Returns: a mapping of message.id -> job_id -> job_result
         """
+        # The messages are iterated several times: one-shot iterators are consumed once here.
+        # To process messages lazily, use Workload.stream()
+        if not isinstance(messages, (list, tuple)):
+            messages = list(messages)
 
         # Run the jobs sequentially on every message
         # TODO : For Jobs, implement a batched_run method that takes a list of messages
@@ -617,10 +749,13 @@ class Workload:
                     t = tqdm()
 
                 async def job_limit_wrap(message: Message):
+                    queued_at = time.perf_counter()
                     # Account for the semaphore (rate limit, max_parallelism)
                     async with semaphore:
                         if job.sample >= 1 or random.random() < job.sample:
-                            await job.async_run(message)
+                            await job.async_run(
+                                message, queued_at=queued_at, checkpoint=checkpoint
+                            )
                         # Update the progress bar
                         t.update()
 
@@ -640,11 +775,14 @@ class Workload:
 
             messages_and_jobs = itertools.product(messages, self.jobs.values())
             semaphore = asyncio.Semaphore(max_parallelism)
+            queued_at = time.perf_counter()
 
             async def message_job_limit_wrap(message_and_job: Tuple[Message, Job]):
                 message, job = message_and_job
                 if job.sample >= 1 or random.random() < job.sample:
-                    await job.async_run(message)
+                    await job.async_run(
+                        message, queued_at=queued_at, checkpoint=checkpoint
+                    )
                 # Update the progress bar
                 t.update()
 
@@ -663,12 +801,18 @@ class Workload:
             for job_id, job in self.jobs.items():
                 for one_message in tqdm(messages):
                     if job.sample >= 1 or random.random() < job.sample:
-                        await job.async_run(one_message)
+                        await job.async_run(one_message, checkpoint=checkpoint)
         else:
             raise NotImplementedError(
                 f"Executor type {executor_type} is not implemented"
             )
 
+        # The rule based detections are only shared during the run
+        if self.rule_detector is not None:
+            self.rule_detector.clear()
+        if checkpoint is not None:
+            checkpoint.flush()
+
         # Collect the results:
         # Result is a mapping of message.id -> job_id -> job_result
         results: Dict[str, Dict[str, JobResult]] = {}
@@ -682,29 +826,291 @@ class Workload:
         self._results = results
         return results
 
+    def profile(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Cost and latency of the jobs of the workload, since it was created or since
+        profiler.reset() was called.
+
+        Returns: a mapping of job_id -> stats. The stats are the number of runs, the error
+        rate, the histograms of the wall time and of the time waiting for a slot (queue
+        time), the time spent in LLM calls, the tokens used and the retries of the LLM calls.
+        Runs with alternative configurations are under "job_id (alternative)".
+
+        The runs are also recorded as spans in workload.profiler.spans.
+        """
+        return self.profiler.profile()
+
+    async def stream(
+        self,
+        messages: Union[Iterable[Message], AsyncIterable[Message]],
+        max_parallelism: int = 10,
+        sink: Optional[
+            Callable[[List[Tuple[str, str, JobResult]]], Awaitable[None]]
+        ] = None,
+        flush_every: int = 100,
+        raise_errors: bool = True,
+    ) -> AsyncIterator[Tuple[str, str, JobResult]]:
+        """
+        Runs all the jobs on the messages and yields the results as soon as they are available.
+
+        Unlike async_run, the messages are consumed lazily (sync or async iterables, iterators
+        and generators are supported) and the results are not stored in the workload: the
+        memory stays bounded, whatever the number of messages. At most 2 * max_parallelism
+        results wait for the consumer: if it (or the sink) is slower than the jobs, the
+        jobs wait before starting on the next messages.
+
+        ```python
+        async for message_id, job_id, job_result in workload.stream(messages):
+            ...
+        ```
+
+        Args:
+        :param messages: The messages to run the jobs on.
+        :param max_parallelism: The maximum number of jobs running at the same time.
+            Messages are only read when a job can start.
+        :param sink: An async function called with batches of (message_id, job_id, job_result),
+            for example to insert the results in a database.
+        :param flush_every: The size of the batches passed to the sink.
+        :param raise_errors: If True (default), an exception raised by a job stops the
+            stream and is raised, like in async_run. If False, it is logged and yielded
+            as a JobResult of type error, and the stream goes on.
+
+        Yields: (message.id, job.id, job_result)
+        """
+        semaphore = asyncio.Semaphore(max_parallelism)
+        # Results, exceptions raised by the jobs, or None when all the jobs are done.
+        # A job keeps its slot of the semaphore until its result is in the queue.
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * max_parallelism)
+        # message.id -> number of jobs still running on the message
+        remaining_jobs: Dict[str, int] = {}
+        running_tasks: set = set()
+
+        async def run_job(job: Job, message: Message, queued_at: float) -> None:
+            try:
+                result = await job.async_compute(message, queued_at=queued_at)
+                result.org_id = self.org_id
+                result.project_id = self.project_id
+                await queue.put((message.id, job.id, result))
+            except Exception as e:
+                if raise_errors:
+                    await queue.put(e)
+                else:
+                    logger.error(f"Job {job.id} failed on message {message.id}: {e}")
+                    result = JobResult(
+                        job_id=job.id,
+                        result_type=ResultType.error,
+                        value=None,
+                        metadata={"error": str(e)},
+                    )
+                    await queue.put((message.id, job.id, result))
+            finally:
+                semaphore.release()
+                remaining_jobs[message.id] -= 1
+                if remaining_jobs[message.id] == 0:
+                    del remaining_jobs[message.id]
+                    # The rule based detections of the message are not needed anymore
+                    if self.rule_detector is not None:
+                        self.rule_detector.forget(message.id)
+
+        async def schedule(message: Message) -> None:
+            jobs = [
+                job
+                for job in self.jobs.values()
+                if job.sample >= 1 or random.random() < job.sample
+            ]
+            if len(jobs) == 0:
+                return
+            remaining_jobs[message.id] = remaining_jobs.get(message.id, 0) + len(jobs)
+            for job in jobs:
+                queued_at = time.perf_counter()
+                await semaphore.acquire()
+                task = asyncio.create_task(run_job(job, message, queued_at))
+                running_tasks.add(task)
+                task.add_done_callback(running_tasks.discard)
+
+        async def produce() -> None:
+            try:
+                if hasattr(messages, "__aiter__"):
+                    async for message in messages:  # type: ignore
+                        await schedule(message)
+                else:
+                    for message in messages:  # type: ignore
+                        await schedule(message)
+                await asyncio.gather(*running_tasks)
+            except Exception as e:
+                await queue.put(e)
+            await queue.put(None)
+
+        producer = asyncio.create_task(produce())
+        batch: List[Tuple[str, str, JobResult]] = []
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if sink is not None:
+                    batch.append(item)
+                    if len(batch) >= flush_every:
+                        await sink(batch)
+                        batch = []
+                yield item
+            if sink is not None and len(batch) > 0:
+                await sink(batch)
+        finally:
+            # If the caller stops iterating, or a job failed, stop the running jobs
+            if not producer.done():
+                producer.cancel()
+                for task in list(running_tasks):
+                    task.cancel()
+
+    async def async_sweep(
+        self,
+        messages: Iterable[Message],
+        max_parallelism: int = 10,
+        include_default: bool = True,
+        job_ids: Optional[List[str]] = None,
+    ) -> Dict[str, SweepResults]:
+        """
+        Runs the jobs on the messages with all their configurations: the default one and
+        the alternative ones. All the (message, configuration) pairs run concurrently, with
+        at most max_parallelism of them at the same time.
+
+        The results are stored in columnar arrays, to compare the accuracy, the cost and the
+        latency of the configurations:
+
+        ```python
+        sweeps = await workload.async_sweep(messages)
+        sweeps["job_id"].pareto_table()
+        ```
+
+        The results are also stored in the jobs, so that Workload.optimize_jobs() can be called.
+
+        Args:
+        :param messages: The messages to run the jobs on.
+        :param max_parallelism: The maximum number of jobs running at the same time.
+        :param include_default: If False, the default configuration is not run again: the
+            results of a previous async_run are used as reference.
+        :param job_ids: The jobs to sweep. Defaults to all the jobs with alternative configurations.
+
+        Returns: a mapping of job_id -> SweepResults
+        """
+        if not isinstance(messages, (list, tuple)):
+            messages = list(messages)
+        message_ids = [message.id for message in messages]
+        semaphore = asyncio.Semaphore(max_parallelism)
+
+        jobs = [
+            job
+            for job in self.jobs.values()
+            if (job_ids is None and len(job.alternative_configs) > 0)
+            or (job_ids is not None and job.id in job_ids)
+        ]
+
+        async def run_config(
+            job: Job,
+            sweep_results: SweepResults,
+            config_index: int,
+            message: Message,
+        ) -> None:
+            config = sweep_results.configs[config_index]
+            queued_at = time.perf_counter()
+            async with semaphore:
+                start_time = time.perf_counter()
+                result = await job.async_compute(
+                    message, config=config, queued_at=queued_at
+                )
+                latency = time.perf_counter() - start_time
+            sweep_results.record(config_index, message.id, result, latency)
+            if config_index == 0:
+                job.results[message.id] = result
+            else:
+                job.alternative_results[config_index - 1][message.id] = result
+
+        runs = []
+        sweeps: Dict[str, SweepResults] = {}
+        for job in jobs:
+            sweep_results = SweepResults(
+                job_id=job.id,
+                configs=[job.config] + job.alternative_configs,
+                message_ids=message_ids,
+            )
+            sweeps[job.id] = sweep_results
+            job.sweep_results = sweep_results
+            for message in messages:
+                if include_default:
+                    runs.append(run_config(job, sweep_results, 0, message))
+                elif message.id in job.results:
+                    sweep_results.record(0, message.id, job.results[message.id])
+                for config_index in range(1, len(sweep_results.configs)):
+                    runs.append(run_config(job, sweep_results, config_index, message))
+
+        await asyncio.gather(*runs)
+        # The rule based detections are only shared during the sweep
+        if self.rule_detector is not None:
+            self.rule_detector.clear()
+        return sweeps
+
+    async def async_run_offline(
+        self,
+        messages: Iterable[Message],
+        batch_provider: "BatchProvider",
+        batch_file: str = "phospho_batch.jsonl",
+        poll_interval: float = 60,
+        max_parallelism: int = 10,
+    ) -> Dict[str, Dict[str, JobResult]]:
+        """
+        Runs all the jobs on the messages with a batch API, instead of one LLM call per
+        message per job. Use this for large offline evaluations.
+
+        The LLM calls of the jobs are written to the JSONL batch_file, submitted to the
+        batch_provider, and the results are mapped back to the jobs. See phospho.lab.batch.
+
+        Args:
+        :param messages: The messages to run the jobs on.
+        :param batch_provider: For example OpenAIBatchProvider(), or LocalBatchProvider() for tests.
+        :param batch_file: Where to write the requests of the batch.
+        :param poll_interval: Seconds between two checks of the status of the batch.
+        :param max_parallelism: The maximum number of jobs running at the same time.
+
+        Returns: a mapping of message.id -> job_id -> job_result
+        """
+        from .batch import run_offline
+
+        return await run_offline(
+            self,
+            messages,
+            batch_provider=batch_provider,
+            batch_file=batch_file,
+            poll_interval=poll_interval,
+            max_parallelism=max_parallelism,
+        )
+
     async def async_run_on_alternative_configurations(
         self,
         messages: Iterable[Message],
         executor_type: Literal["parallel", "sequential"] = "parallel",
+        max_parallelism: int = 10,
     ) -> None:
         """
-        Runs all the jobs on the message.
+        Runs all the jobs on the message, with their alternative configurations.
+        The results of the default configurations of a previous async_run are used as reference.
 
-        Returns: a mapping of message.id -> job_id -> job_result
+        :param max_parallelism: The maximum number of jobs running at the same time.
+            Only used if executor_type is "parallel".
         """
 
-        # Run the jobs sequentially on every message
-        # TODO : Run the jobs in parallel on every message
+        if executor_type == "parallel":
+            # Run all the (message, config) pairs concurrently
+            await self.async_sweep(
+                messages, max_parallelism=max_parallelism, include_default=False
+            )
+            return
+
         for job_id, job in self.jobs.items():
-            if executor_type == "parallel":
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    # Submit tasks to the executor
-                    executor_predictions = executor.map(
-                        job.async_run_on_alternative_configurations, messages
-                    )
-                # Await all the results
-                await asyncio.gather(*executor_predictions)
-            elif executor_type == "sequential":
+            job.sweep_results = None
+            if executor_type == "sequential":
                 for one_message in messages:
                     await job.async_run_on_alternative_configurations(one_message)
             else:
@@ -720,6 +1126,7 @@ class Workload:
         messages: Iterable[Message],
         executor_type: Literal["parallel", "sequential", "parallel_jobs"] = "parallel",
         max_parallelism: int = 10,
+        checkpoint: Optional[CheckpointStore] = None,
     ):
         """
         Runs all the jobs on the message.
@@ -729,9 +1136,16 @@ class Workload:
         :param executor_type: The type of executor to use. Can be "parallel" or "sequential".
         :param max_parallelism: The maximum number of parallel jobs to run per seconds.
             Use this to adhere to rate limits. Only used if executor_type is "parallel" or "parallel_jobs".
+        :param checkpoint: Store of the completed results, to resume an interrupted run.
+            The (message, job) pairs already in the checkpoint don't run again.
+            See phospho.lab.checkpoint.
 
         Returns: a mapping of message.id -> job_id -> job_result
         """
+        # The messages are iterated several times: one-shot iterators are consumed once here.
+        # To process messages lazily, use Workload.stream()
+        if not isinstance(messages, (list, tuple)):
+            messages = list(messages)
 
         # Run the jobs sequentially on every message
         # TODO : For Jobs, implement a batched_run method that takes a list of messages
@@ -746,7 +1160,11 @@ class Workload:
                 def job_limit_wrap(message: Message):
                     # Account for the semaphore (rate limit, max_parallelism)
                     if job.sample >= 1 or random.random() < job.sample:
-                        asyncio.run(job.async_run(message))
+                        asyncio.run(
+                            _run_and_close_clients(
+                                job.async_run(message, checkpoint=checkpoint)
+                            )
+                        )
                     # Update the progress bar
                     t.update()
 
@@ -770,7 +1188,11 @@ class Workload:
             def message_job_limit_wrap(message_and_job: Tuple[Message, Job]):
                 message, job = message_and_job
                 if job.sample >= 1 or random.random() < job.sample:
-                    asyncio.run(job.async_run(message))
+                    asyncio.run(
+                        _run_and_close_clients(
+                            job.async_run(message, checkpoint=checkpoint)
+                        )
+                    )
                 # Update the progress bar
                 t.update()
 
@@ -789,12 +1211,22 @@ class Workload:
             for job_id, job in self.jobs.items():
                 for one_message in tqdm(messages):
                     if job.sample >= 1 or random.random() < job.sample:
-                        asyncio.run(job.async_run(one_message))
+                        asyncio.run(
+                            _run_and_close_clients(
+                                job.async_run(one_message, checkpoint=checkpoint)
+                            )
+                        )
         else:
             raise NotImplementedError(
                 f"Executor type {executor_type} is not implemented"
             )
 
+        # The rule based detections are only shared during the run
+        if self.rule_detector is not None:
+            self.rule_detector.clear()
+        if checkpoint is not None:
+            checkpoint.flush()
+
         # Collect the results:
         # Result is a mapping of message.id -> job_id -> job_result
         results: Dict[str, Dict[str, JobResult]] = {}
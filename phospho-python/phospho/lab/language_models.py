@@ -1,9 +1,15 @@
+import asyncio
 import os
-from typing import Literal, Optional, Tuple
+import threading
+import weakref
+from typing import Dict, Literal, Optional, Tuple
 
 import phospho.config as config
 
+from .profiling import record_llm_request
+
 try:
+    import httpx
     from openai import AsyncOpenAI, OpenAI
 
 except ImportError:
@@ -43,95 +49,143 @@ def get_provider_and_model(model: str) -> Tuple[str, str]:
     return provider, model_name
 
 
+# provider -> (base_url, environment variable of the api key)
+PROVIDERS: Dict[str, Tuple[Optional[str], Optional[str]]] = {
+    "openai": (None, None),
+    "mistral": ("https://api.mistral.ai/v1/", "MISTRAL_API_KEY"),
+    "ollama": ("http://localhost:11434/v1/", None),
+    "solar": ("https://api.upstage.ai/v1/solar/", "SOLAR_API_KEY"),
+    "together": ("https://api.together.xyz/v1/", "TOGETHER_API_KEY"),
+    "anyscale": ("https://api.endpoints.anyscale.com/v1/", "ANYSCALE_API_KEY"),
+    "fireworks": ("https://api.fireworks.ai/inference/v1/", "FIREWORKS_API_KEY"),
+}
+
+ProviderName = Literal[
+    "openai",
+    "mistral",
+    "ollama",
+    "solar",
+    "together",
+    "anyscale",
+    "fireworks",
+]
+
+# (provider, api_key, base_url)
+ClientKey = Tuple[str, Optional[str], Optional[str]]
+
+# The clients are reused, so that their connection pools are kept between the calls.
+_sync_clients: Dict[ClientKey, OpenAI] = {}
+# An async client is bound to the event loop it's used in: they are stored per loop.
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[ClientKey, AsyncOpenAI]]" = (
+    weakref.WeakKeyDictionary()
+)
+_clients_lock = threading.Lock()
+
+
+def _get_client_params(
+    provider: str, api_key: Optional[str]
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Return the api_key and the base_url of the provider.
+    """
+    if provider not in PROVIDERS:
+        raise NotImplementedError(f"Provider {provider} is not supported.")
+    base_url, api_key_env = PROVIDERS[provider]
+    if provider == "ollama":
+        return "ollama", base_url
+    if api_key is None and api_key_env is not None:
+        api_key = os.getenv(api_key_env)
+    return api_key, base_url
+
+
+def _get_connection_limits() -> "httpx.Limits":
+    return httpx.Limits(
+        max_connections=config.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=config.LLM_MAX_KEEPALIVE_CONNECTIONS,
+    )
+
+
+async def _on_request(request: "httpx.Request") -> None:
+    # Count the requests, to know how many calls were retried
+    record_llm_request()
+
+
+def _create_async_client(api_key: Optional[str], base_url: Optional[str]):
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=httpx.AsyncClient(
+            limits=_get_connection_limits(),
+            timeout=config.LLM_TIMEOUT,
+            event_hooks={"request": [_on_request]},
+        ),
+    )
+
+
 def get_async_client(
-    provider: Literal[
-        "openai",
-        "mistral",
-        "ollama",
-        "solar",
-        "together",
-        "anyscale",
-        "fireworks",
-    ],
+    provider: ProviderName,
     api_key: Optional[str] = None,
 ) -> AsyncOpenAI:
-    if provider == "openai":
-        return AsyncOpenAI()
-    if provider == "mistral":
-        return AsyncOpenAI(
-            base_url="https://api.mistral.ai/v1/",
-            api_key=api_key or os.getenv("MISTRAL_API_KEY"),
-        )
-    if provider == "ollama":
-        return AsyncOpenAI(
-            base_url="http://localhost:11434/v1/",
-            api_key="ollama",
-        )
-    if provider == "solar":
-        return AsyncOpenAI(
-            base_url="https://api.upstage.ai/v1/solar/",
-            api_key=api_key or os.getenv("SOLAR_API_KEY"),
-        )
-    if provider == "together":
-        return AsyncOpenAI(
-            base_url="https://api.together.xyz/v1/",
-            api_key=api_key or os.getenv("TOGETHER_API_KEY"),
-        )
-    if provider == "anyscale":
-        return AsyncOpenAI(
-            base_url="https://api.endpoints.anyscale.com/v1/",
-            api_key=api_key or os.getenv("ANYSCALE_API_KEY"),
-        )
-    if provider == "fireworks":
-        return AsyncOpenAI(
-            base_url="https://api.fireworks.ai/inference/v1/",
-            api_key=api_key or os.getenv("FIREWORKS_API_KEY"),
-        )
-    raise NotImplementedError(f"Provider {provider} is not supported.")
+    """
+    Return an async client for the provider. Clients are reused for the same
+    (provider, api_key, base_url) in the same event loop.
+    """
+    api_key, base_url = _get_client_params(provider, api_key)
+    key = (provider, api_key, base_url)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Outside of an event loop, the client can't be shared
+        return _create_async_client(api_key, base_url)
+
+    with _clients_lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        if key not in loop_clients:
+            loop_clients[key] = _create_async_client(api_key, base_url)
+        return loop_clients[key]
 
 
 def get_sync_client(
-    provider: Literal[
-        "openai",
-        "mistral",
-        "ollama",
-        "solar",
-        "together",
-        "anyscale",
-        "fireworks",
-    ],
+    provider: ProviderName,
     api_key: Optional[str] = None,
 ) -> OpenAI:
-    if provider == "openai":
-        return OpenAI()
-    if provider == "mistral":
-        return OpenAI(
-            base_url="https://api.mistral.ai/v1/",
-            api_key=api_key or os.getenv("MISTRAL_API_KEY"),
-        )
-    if provider == "ollama":
-        return OpenAI(
-            base_url="http://localhost:11434/v1/",
-            api_key="ollama",
-        )
-    if provider == "solar":
-        return OpenAI(
-            base_url="https://api.upstage.ai/v1/solar/",
-            api_key=api_key or os.getenv("SOLAR_API_KEY"),
-        )
-    if provider == "together":
-        return OpenAI(
-            base_url="https://api.together.xyz/v1/",
-            api_key=api_key or os.getenv("TOGETHER_API_KEY"),
-        )
-    if provider == "anyscale":
-        return OpenAI(
-            base_url="https://api.endpoints.anyscale.com/v1/",
-            api_key=api_key or os.getenv("ANYSCALE_API_KEY"),
-        )
-    if provider == "fireworks":
-        return OpenAI(
-            base_url="https://api.fireworks.ai/inference/v1/",
-            api_key=api_key or os.getenv("FIREWORKS_API_KEY"),
-        )
-    raise NotImplementedError(f"Provider {provider} is not supported.")
+    """
+    Return a client for the provider. Clients are reused for the same
+    (provider, api_key, base_url).
+    """
+    api_key, base_url = _get_client_params(provider, api_key)
+    key = (provider, api_key, base_url)
+    with _clients_lock:
+        if key not in _sync_clients:
+            _sync_clients[key] = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=httpx.Client(
+                    limits=_get_connection_limits(), timeout=config.LLM_TIMEOUT
+                ),
+            )
+        return _sync_clients[key]
+
+
+async def close_async_clients() -> None:
+    """
+    Close the async clients of the running event loop.
+    Call this before the event loop is closed, for example at the end of asyncio.run.
+    """
+    with _clients_lock:
+        loop_clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for async_client in loop_clients.values():
+        await async_client.close()
+
+
+async def close_clients() -> None:
+    """
+    Close the clients of the providers and their connection pools.
+    Call this when shutting down the application.
+    """
+    with _clients_lock:
+        sync_clients = list(_sync_clients.values())
+        _sync_clients.clear()
+    for client in sync_clients:
+        client.close()
+    await close_async_clients()
@@ -0,0 +1,274 @@
+"""
+Content addressed cache of the LLM calls of the jobs.
+
+A call is identified by the hash of (provider, model, messages, params). Only the
+deterministic calls (temperature=0) are cached: running the same job twice on the same
+message (re-runs of the recipes, alternative configurations, retried activities) doesn't
+call the provider again.
+
+The cache has a backend to store the responses:
+- in memory (LRU), the default
+- SQLite, to keep the responses between runs
+- any object implementing LLMCacheBackend, for example the Mongo backend of the extractor
+
+Configure it with the LLM_CACHE_* environment variables or with set_llm_cache().
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Protocol
+
+import phospho.config as config
+
+from .profiling import llm_call, record_llm_cache_hit
+
+try:
+    from openai.types.chat import ChatCompletion
+except ImportError:
+    ChatCompletion = None
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCacheBackend(Protocol):
+    async def get(self, key: str) -> Optional[dict]:
+        """Return the cached response, or None if it's missing or expired"""
+        ...
+
+    async def set(self, key: str, value: dict, ttl: Optional[int]) -> None:
+        ...
+
+
+class InMemoryLLMCacheBackend:
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        # key -> (expires_at, value)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: dict, ttl: Optional[int]) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class SQLiteLLMCacheBackend:
+    def __init__(self, path: str = "phospho_llm_cache.sqlite"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache "
+                + "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self._connection.commit()
+
+    def _get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return json.loads(value)
+
+    def _set(self, key: str, value: dict, ttl: Optional[int]) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+            self._connection.commit()
+
+    async def get(self, key: str) -> Optional[dict]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: dict, ttl: Optional[int]) -> None:
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+
+class LLMCache:
+    def __init__(self, backend: LLMCacheBackend, ttl: Optional[int] = None):
+        """
+        :param backend: Where the responses are stored.
+        :param ttl: Time to live of the responses, in seconds. None to keep them forever.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(provider: str, model: str, messages: list, params: dict) -> str:
+        payload = json.dumps(
+            {
+                "provider": provider,
+                "model": model,
+                "messages": messages,
+                "params": params,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_cacheable(params: dict) -> bool:
+        """
+        Only deterministic calls are cached
+        """
+        return params.get("temperature") == 0 and not params.get("stream", False)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else None,
+        }
+
+    async def chat_completion(
+        self,
+        client: Optional[Any],
+        provider: str,
+        model: str,
+        messages: list,
+        **params,
+    ) -> Any:
+        """
+        Return `await client.chat.completions.create(model=model, messages=messages, **params)`,
+        from the cache if the same deterministic call was already made.
+
+        Errors of the cache backend are logged, and the provider is called.
+        """
+        if not self.is_cacheable(params) or ChatCompletion is None:
+            return await _create_chat_completion(
+                client, provider, model, messages, **params
+            )
+
+        key = self.get_key(provider, model, messages, params)
+        try:
+            cached_response = await self.backend.get(key)
+        except Exception as e:
+            logger.warning(f"Error reading the LLM cache: {e}")
+            cached_response = None
+        if cached_response is not None:
+            self.hits += 1
+            record_llm_cache_hit()
+            return ChatCompletion.model_validate(cached_response)
+
+        self.misses += 1
+        response = await _create_chat_completion(
+            client, provider, model, messages, **params
+        )
+        try:
+            await self.backend.set(key, response.model_dump(), self.ttl)
+        except Exception as e:
+            logger.warning(f"Error writing the LLM cache: {e}")
+        return response
+
+
+async def _create_chat_completion(
+    client: Optional[Any], provider: str, model: str, messages: list, **params
+) -> Any:
+    """
+    Call the provider, and account the call in the profiling spans.
+    If client is None, the shared async client of the provider is used.
+    """
+    if client is None:
+        from .language_models import get_async_client
+
+        client = get_async_client(provider)
+    with llm_call() as recorder:
+        response = await client.chat.completions.create(
+            model=model, messages=messages, **params
+        )
+        recorder.record_response(response)
+    return response
+
+
+_llm_cache: Optional[LLMCache] = None
+
+
+def get_llm_cache() -> Optional[LLMCache]:
+    """
+    Return the LLM cache used by the jobs, or None if it's disabled (LLM_CACHE_BACKEND=none).
+    By default, the cache is built from the LLM_CACHE_* environment variables.
+    """
+    global _llm_cache
+    if _llm_cache is None and config.LLM_CACHE_BACKEND != "none":
+        backend: LLMCacheBackend
+        if config.LLM_CACHE_BACKEND == "sqlite":
+            backend = SQLiteLLMCacheBackend(config.LLM_CACHE_PATH)
+        else:
+            backend = InMemoryLLMCacheBackend(config.LLM_CACHE_MAX_SIZE)
+        _llm_cache = LLMCache(backend, ttl=config.LLM_CACHE_TTL)
+    return _llm_cache
+
+
+def set_llm_cache(cache: Optional[LLMCache]) -> None:
+    """
+    Replace the LLM cache used by the jobs. Pass None to use the default one.
+    """
+    global _llm_cache
+    _llm_cache = cache
+
+
+async def cached_chat_completion(
+    client: Optional[Any],
+    provider: str,
+    model: str,
+    messages: list,
+    **params,
+) -> Any:
+    """
+    Call the chat completion API through the LLM cache, if it's enabled.
+
+    If client is None, the shared async client of the provider is used. It's only
+    created if the provider is called: cache hits and offline runs need no API key.
+
+    During an offline run (see batch.py), the call is recorded or answered from the batch.
+    """
+    from .batch import get_batch_session
+
+    batch_session = get_batch_session()
+    if batch_session is not None:
+        return await batch_session.chat_completion(
+            provider=provider, model=model, messages=messages, **params
+        )
+
+    llm_cache = get_llm_cache()
+    if llm_cache is None:
+        return await _create_chat_completion(
+            client, provider, model, messages, **params
+        )
+    # The cache hits are not accounted as LLM calls
+    return await llm_cache.chat_completion(
+        client, provider=provider, model=model, messages=messages, **params
+    )
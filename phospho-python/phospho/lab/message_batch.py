@@ -0,0 +1,347 @@
+"""
+Columnar batches of messages.
+
+A MessageBatch stores the fields of many messages as NumPy arrays: ids, roles, contents,
+timestamps, and the previous messages flattened with offsets (the previous messages of
+the message i are context_*[context_offsets[i]:context_offsets[i + 1]]).
+
+Loading a dataset in a MessageBatch is vectorized: no pydantic object is created per row.
+The Message objects are only created when they are read, so a batch can be passed
+directly to Workload.stream, which reads the messages as the jobs start.
+
+```python
+from phospho.lab import MessageBatch
+
+batch = MessageBatch.from_parquet("dataset.parquet", content="question")
+async for message_id, job_id, result in workload.stream(batch):
+    ...
+```
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+from phospho.models import Message
+from phospho.utils import generate_timestamp
+
+
+def _import_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError("Please install the `numpy` package to use MessageBatch.")
+    return np
+
+
+def _import_pandas():
+    try:
+        import pandas as pd
+    except ImportError:
+        raise ImportError("Please install the `pandas` package to use MessageBatch.")
+    return pd
+
+
+def get_column_mapping(df, mapping: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    """
+    The mapping from the Message fields to the columns of the DataFrame.
+    See Message.from_df.
+    """
+    # If not provided, the default mapping is used
+    default_mapping: Dict[str, Any] = {
+        "id": None,
+        "created_at": "created_at",
+        "role": "role",
+        "content": "content",
+        "previous_messages": "previous_messages",
+        "metadata": "metadata",
+    }
+    # If a default mapping value is not found in the DataFrame, it is skipped
+    for key, value in default_mapping.items():
+        if value not in df.columns:
+            default_mapping[key] = None
+    # If a kwargs refers to an unknwon column name, raise a ValueError
+    for key, value in mapping.items():
+        if value not in df.columns and value is not None:
+            raise ValueError(f"Column {value} not found in the DataFrame")
+
+    col_mapping = {**default_mapping, **mapping}
+
+    # Verify that mandatory field are present. If not, raise a ValueError
+    if col_mapping["content"] is None:
+        raise ValueError(
+            'Column "content" not found in the DataFrame. '
+            + 'Please provide a keyword argument with the column to use: `Message.from_df(df, content="message_content")`.'
+        )
+    return col_mapping
+
+
+class MessageBatch:
+    def __init__(
+        self,
+        ids: Sequence[str],
+        contents: Sequence[str],
+        roles: Optional[Sequence[Optional[str]]] = None,
+        created_at: Optional[Sequence[int]] = None,
+        metadata: Optional[Sequence[Optional[dict]]] = None,
+        metadata_columns: Optional[Dict[str, Sequence[Any]]] = None,
+        context_offsets: Optional[Sequence[int]] = None,
+        context_ids: Optional[Sequence[str]] = None,
+        context_roles: Optional[Sequence[Optional[str]]] = None,
+        context_contents: Optional[Sequence[str]] = None,
+    ):
+        """
+        :param metadata: The metadata of every message, as dicts.
+        :param metadata_columns: Columns added to the metadata of the messages: the metadata
+            of the message i is {key: column[i]}, merged with metadata[i].
+        :param context_offsets: n + 1 offsets into the context_* arrays, which hold the
+            previous messages of all the messages.
+        """
+        np = _import_numpy()
+
+        self.ids = np.asarray(ids, dtype=object)
+        self.contents = np.asarray(contents, dtype=object)
+        size = len(self.ids)
+        if len(self.contents) != size:
+            raise ValueError("ids and contents must have the same length")
+        self.roles = (
+            np.asarray(roles, dtype=object)
+            if roles is not None
+            else np.full(size, None, dtype=object)
+        )
+        self.created_at = (
+            np.asarray(created_at, dtype=np.int64)
+            if created_at is not None
+            else np.full(size, generate_timestamp(), dtype=np.int64)
+        )
+        self.metadata = np.asarray(metadata, dtype=object) if metadata is not None else None
+        self.metadata_columns = {
+            key: np.asarray(column, dtype=object)
+            for key, column in (metadata_columns or {}).items()
+        }
+        if context_offsets is None:
+            self.context_offsets = np.zeros(size + 1, dtype=np.int64)
+        else:
+            self.context_offsets = np.asarray(context_offsets, dtype=np.int64)
+        self.context_ids = np.asarray(
+            context_ids if context_ids is not None else [], dtype=object
+        )
+        self.context_roles = np.asarray(
+            context_roles if context_roles is not None else [], dtype=object
+        )
+        self.context_contents = np.asarray(
+            context_contents if context_contents is not None else [], dtype=object
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _get_message(self, index: int) -> Message:
+        start, end = self.context_offsets[index], self.context_offsets[index + 1]
+        previous_messages = [
+            Message.model_construct(
+                id=self.context_ids[i],
+                role=self.context_roles[i],
+                content=self.context_contents[i],
+            )
+            for i in range(start, end)
+        ]
+        metadata: dict = {}
+        if self.metadata is not None and self.metadata[index] is not None:
+            metadata.update(self.metadata[index])
+        for key, column in self.metadata_columns.items():
+            metadata[key] = column[index]
+        # The columns are already validated: skip the validation of pydantic
+        return Message.model_construct(
+            id=self.ids[index],
+            created_at=int(self.created_at[index]),
+            role=self.roles[index],
+            content=self.contents[index],
+            previous_messages=previous_messages,
+            metadata=metadata,
+        )
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Message, "MessageBatch"]:
+        if isinstance(index, slice):
+            return self.take(range(len(self))[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("MessageBatch index out of range")
+        return self._get_message(index)
+
+    def __iter__(self) -> Iterator[Message]:
+        for index in range(len(self)):
+            yield self._get_message(index)
+
+    def to_messages(self) -> List[Message]:
+        return list(self)
+
+    def take(self, indices: Sequence[int]) -> "MessageBatch":
+        """
+        A new batch with the messages at the indices.
+        """
+        np = _import_numpy()
+
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.context_offsets[indices]
+        ends = self.context_offsets[indices + 1]
+        lengths = ends - starts
+        context_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        # Positions of the previous messages of the selected messages
+        context_indices = (
+            np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+            if lengths.sum() > 0
+            else np.zeros(0, dtype=np.int64)
+        )
+        return MessageBatch(
+            ids=self.ids[indices],
+            contents=self.contents[indices],
+            roles=self.roles[indices],
+            created_at=self.created_at[indices],
+            metadata=self.metadata[indices] if self.metadata is not None else None,
+            metadata_columns={
+                key: column[indices] for key, column in self.metadata_columns.items()
+            },
+            context_offsets=context_offsets,
+            context_ids=self.context_ids[context_indices],
+            context_roles=self.context_roles[context_indices],
+            context_contents=self.context_contents[context_indices],
+        )
+
+    @classmethod
+    def from_messages(cls, messages: Sequence[Message]) -> "MessageBatch":
+        context_offsets = [0]
+        context_ids: List[str] = []
+        context_roles: List[Optional[str]] = []
+        context_contents: List[str] = []
+        for message in messages:
+            for previous_message in message.previous_messages:
+                context_ids.append(previous_message.id)
+                context_roles.append(previous_message.role)
+                context_contents.append(previous_message.content)
+            context_offsets.append(len(context_ids))
+        return cls(
+            ids=[message.id for message in messages],
+            contents=[message.content for message in messages],
+            roles=[message.role for message in messages],
+            created_at=[message.created_at for message in messages],
+            metadata=[message.metadata for message in messages],
+            context_offsets=context_offsets,
+            context_ids=context_ids,
+            context_roles=context_roles,
+            context_contents=context_contents,
+        )
+
+    @classmethod
+    def from_df(
+        cls,
+        df,
+        metadata_columns: Optional[List[str]] = None,
+        **kwargs: Optional[str],
+    ) -> "MessageBatch":
+        """
+        Create a MessageBatch from a pandas DataFrame, with vectorized operations.
+
+        :param df: The DataFrame to convert.
+        :param metadata_columns: Columns to add to the metadata of the messages.
+        :param kwargs: The mapping from the Message fields to the column names of the
+            DataFrame, like in Message.from_df. Rows with an empty content are skipped.
+        """
+        np = _import_numpy()
+
+        col_mapping = get_column_mapping(df, kwargs)
+
+        contents = df[col_mapping["content"]]
+        df = df[(contents.notna() & (contents != "")).to_numpy()]
+        size = len(df)
+
+        def column(field: str) -> Optional[Any]:
+            col_name = col_mapping[field]
+            if col_name is None:
+                return None
+            values = df[col_name]
+            return values.where(values.notna(), None).to_numpy(dtype=object)
+
+        if col_mapping["id"] is None:
+            # By default, the id is the index of the row
+            ids = df.index.astype(str).to_numpy(dtype=object)
+        else:
+            ids = df[col_mapping["id"]].astype(str).to_numpy(dtype=object)
+
+        created_at = None
+        if col_mapping["created_at"] is not None:
+            created_at = df[col_mapping["created_at"]].to_numpy(dtype=np.int64)
+
+        # The previous messages are lists in the cells: they are flattened
+        context_offsets = None
+        context_ids: List[str] = []
+        context_roles: List[Optional[str]] = []
+        context_contents: List[str] = []
+        previous_messages = column("previous_messages")
+        if previous_messages is not None:
+            context_offsets = np.zeros(size + 1, dtype=np.int64)
+            for index, messages in enumerate(previous_messages):
+                for previous_message in messages if messages is not None else []:
+                    if not isinstance(previous_message, Message):
+                        previous_message = Message.model_validate(previous_message)
+                    context_ids.append(previous_message.id)
+                    context_roles.append(previous_message.role)
+                    context_contents.append(previous_message.content)
+                context_offsets[index + 1] = len(context_ids)
+
+        return cls(
+            ids=ids,
+            contents=df[col_mapping["content"]].astype(str).to_numpy(dtype=object),
+            roles=column("role"),
+            created_at=created_at,
+            metadata=column("metadata"),
+            metadata_columns={
+                col_name: df[col_name].to_numpy(dtype=object)
+                for col_name in metadata_columns or []
+            },
+            context_offsets=context_offsets,
+            context_ids=context_ids,
+            context_roles=context_roles,
+            context_contents=context_contents,
+        )
+
+    @classmethod
+    def from_parquet(
+        cls,
+        path: str,
+        metadata_columns: Optional[List[str]] = None,
+        **kwargs: Optional[str],
+    ) -> "MessageBatch":
+        """
+        Create a MessageBatch from a parquet file. See from_df for the parameters.
+        """
+        pd = _import_pandas()
+
+        return cls.from_df(
+            pd.read_parquet(path), metadata_columns=metadata_columns, **kwargs
+        )
+
+    @classmethod
+    def from_jsonl(
+        cls,
+        path: str,
+        metadata_columns: Optional[List[str]] = None,
+        **kwargs: Optional[str],
+    ) -> "MessageBatch":
+        """
+        Create a MessageBatch from a JSONL file, one message per line. See from_df for
+        the parameters.
+        """
+        pd = _import_pandas()
+
+        # Keep the ids as strings and the timestamps as integers
+        return cls.from_df(
+            pd.read_json(
+                path,
+                lines=True,
+                dtype={"id": str},
+                convert_dates=False,
+                keep_default_dates=False,
+            ),
+            metadata_columns=metadata_columns,
+            **kwargs,
+        )
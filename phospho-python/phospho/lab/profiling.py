@@ -0,0 +1,420 @@
+"""
+Cost and latency accounting of the jobs of a workload.
+
+Every run of a job is a span: its wall time, the time it waited for a slot (queue time),
+the time spent in LLM calls, the tokens used and the retries of the LLM calls are
+aggregated per job in the Profiler of the workload.
+
+```python
+await workload.async_run(messages)
+workload.profile()
+# {"job_id": {"runs": 100, "error_rate": 0.01, "wall_time": {"mean": ..., "p95": ...}, ...}}
+```
+
+The spans follow the OpenTelemetry data model, and can be exported with
+Profiler.add_span_exporter. If the `opentelemetry-api` package is installed, they are
+also emitted as OpenTelemetry spans.
+
+Spans can be nested (for example the stages of a pipeline and the jobs running in them):
+the LLM usage is added to the stats of all the enclosing spans.
+
+The calls answered by the LLM cache are counted as cache hits, not as LLM calls: they
+don't use tokens or LLM time.
+"""
+
+import contextlib
+import contextvars
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+try:
+    from opentelemetry import trace as otel_trace  # type: ignore
+except ImportError:
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the buckets of the histograms, in seconds
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    math.inf,
+)
+
+
+class Histogram:
+    """
+    A histogram with fixed buckets: the memory used doesn't depend on the number of values.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def record(self, value: float) -> None:
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimate the quantile q (between 0 and 1), by linear interpolation in its bucket.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulated = 0
+        lower_bound = 0.0
+        for upper_bound, count in zip(self.buckets, self.counts):
+            if count > 0 and cumulated + count >= rank:
+                upper_bound = min(upper_bound, self.max)
+                lower_bound = max(lower_bound, self.min)
+                share = (rank - cumulated) / count
+                return lower_bound + (upper_bound - lower_bound) * share
+            cumulated += count
+            lower_bound = upper_bound
+        return self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count,
+            "min": self.min,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": {
+                str(upper_bound): count
+                for upper_bound, count in zip(self.buckets, self.counts)
+                if count > 0
+            },
+        }
+
+
+class SpanStats:
+    """
+    LLM usage during a span
+    """
+
+    def __init__(self) -> None:
+        self.llm_calls = 0
+        self.llm_requests = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.llm_time = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        parent: Optional["Span"] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else random.getrandbits(128)
+        self.span_id = random.getrandbits(64)
+        self.attributes: Dict[str, Any] = attributes or {}
+        self.status: str = "OK"
+        self.stats = SpanStats()
+        self.start_time = time.time_ns()
+        self.end_time: Optional[int] = None
+        self._start = time.perf_counter()
+        self.duration: Optional[float] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_error(self, description: Optional[str] = None) -> None:
+        self.status = "ERROR"
+        if description is not None:
+            self.attributes["error.message"] = description
+
+    def end(self) -> None:
+        self.duration = time.perf_counter() - self._start
+        self.end_time = time.time_ns()
+        self.attributes.update(
+            {
+                "llm.calls": self.stats.llm_calls,
+                "llm.cache_hits": self.stats.cache_hits,
+                "llm.retries": self.stats.retries,
+                "llm.time": self.stats.llm_time,
+                "llm.usage.prompt_tokens": self.stats.prompt_tokens,
+                "llm.usage.completion_tokens": self.stats.completion_tokens,
+            }
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        The span in the OpenTelemetry JSON format
+        """
+        return {
+            "traceId": f"{self.trace_id:032x}",
+            "spanId": f"{self.span_id:016x}",
+            "parentSpanId": f"{self.parent.span_id:016x}"
+            if self.parent is not None
+            else "",
+            "name": self.name,
+            "startTimeUnixNano": self.start_time,
+            "endTimeUnixNano": self.end_time,
+            "attributes": [
+                {"key": key, "value": value} for key, value in self.attributes.items()
+            ],
+            "status": {"code": self.status},
+        }
+
+
+class OperationStats:
+    """
+    Aggregated stats of the spans of an operation (a job, a stage of a pipeline)
+    """
+
+    def __init__(self) -> None:
+        self.runs = 0
+        self.errors = 0
+        self.wall_time = Histogram()
+        self.queue_time = Histogram()
+        self.llm_time = 0.0
+        self.llm_calls = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record(self, span: Span, queue_time: Optional[float] = None) -> None:
+        self.runs += 1
+        if span.status == "ERROR":
+            self.errors += 1
+        if span.duration is not None:
+            self.wall_time.record(span.duration)
+        if queue_time is not None:
+            self.queue_time.record(queue_time)
+        self.llm_time += span.stats.llm_time
+        self.llm_calls += span.stats.llm_calls
+        self.cache_hits += span.stats.cache_hits
+        self.retries += span.stats.retries
+        self.prompt_tokens += span.stats.prompt_tokens
+        self.completion_tokens += span.stats.completion_tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "error_rate": self.errors / self.runs if self.runs > 0 else None,
+            "wall_time": self.wall_time.to_dict(),
+            "queue_time": self.queue_time.to_dict(),
+            # Time spent outside of the LLM calls: python code, database, other APIs
+            "llm_time": self.llm_time,
+            "other_time": max(self.wall_time.sum - self.llm_time, 0),
+            "llm_calls": self.llm_calls,
+            "cache_hits": self.cache_hits,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar(
+    "phospho_current_span", default=None
+)
+# Number of HTTP requests sent by the current LLM call
+_current_llm_requests: contextvars.ContextVar[Optional[List[int]]] = (
+    contextvars.ContextVar("phospho_current_llm_requests", default=None)
+)
+
+
+def get_current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def _enclosing_spans() -> Iterator[Span]:
+    span = _current_span.get()
+    while span is not None:
+        yield span
+        span = span.parent
+
+
+def record_llm_request() -> None:
+    """
+    Count an HTTP request to a LLM provider. Called by the hooks of the LLM clients:
+    a call that sends more than one request was retried.
+    """
+    requests = _current_llm_requests.get()
+    if requests is not None:
+        requests[0] += 1
+    for span in _enclosing_spans():
+        span.stats.llm_requests += 1
+
+
+def record_llm_cache_hit() -> None:
+    """
+    Count a LLM call answered by the LLM cache
+    """
+    for span in _enclosing_spans():
+        span.stats.cache_hits += 1
+
+
+class LLMCallRecorder:
+    def __init__(self) -> None:
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def record_response(self, response: Any) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.prompt_tokens = usage.prompt_tokens or 0
+            self.completion_tokens = usage.completion_tokens or 0
+
+
+@contextlib.contextmanager
+def llm_call() -> Iterator[LLMCallRecorder]:
+    """
+    Account a LLM call in the enclosing spans: time, tokens and retries.
+    """
+    recorder = LLMCallRecorder()
+    requests = [0]
+    token = _current_llm_requests.set(requests)
+    start = time.perf_counter()
+    try:
+        yield recorder
+    finally:
+        _current_llm_requests.reset(token)
+        duration = time.perf_counter() - start
+        for span in _enclosing_spans():
+            span.stats.llm_calls += 1
+            span.stats.llm_time += duration
+            span.stats.retries += max(requests[0] - 1, 0)
+            span.stats.prompt_tokens += recorder.prompt_tokens
+            span.stats.completion_tokens += recorder.completion_tokens
+
+
+class Profiler:
+    def __init__(self, max_spans: int = 1000, use_opentelemetry: bool = True):
+        """
+        :param max_spans: The number of finished spans kept in Profiler.spans.
+        :param use_opentelemetry: Also emit the spans with opentelemetry, if it's installed.
+        """
+        # operation -> stats
+        self.stats: Dict[str, OperationStats] = {}
+        self.spans: Deque[Span] = deque(maxlen=max_spans)
+        self.span_exporters: List[Callable[[Span], None]] = []
+        self.use_opentelemetry = use_opentelemetry and otel_trace is not None
+        self._lock = threading.Lock()
+
+    def add_span_exporter(self, exporter: Callable[[Span], None]) -> None:
+        """
+        Call exporter with every finished span.
+        """
+        self.span_exporters.append(exporter)
+
+    @contextlib.contextmanager
+    def span(
+        self,
+        name: str,
+        stats_key: Optional[str] = None,
+        queued_at: Optional[float] = None,
+        **attributes: Any,
+    ) -> Iterator[Span]:
+        """
+        Measure the code in the block as a span.
+
+        :param stats_key: The operation the span is aggregated in. If None, the span is
+            not aggregated in the stats.
+        :param queued_at: time.perf_counter() when the operation was scheduled, to
+            measure the time it waited before starting.
+        """
+        queue_time = (
+            time.perf_counter() - queued_at if queued_at is not None else None
+        )
+        span = Span(name, parent=_current_span.get(), attributes=attributes)
+        if queue_time is not None:
+            span.set_attribute("queue_time", queue_time)
+        token = _current_span.set(span)
+
+        otel_context: Any = contextlib.nullcontext()
+        if self.use_opentelemetry:
+            otel_context = otel_trace.get_tracer("phospho.lab").start_as_current_span(
+                name, attributes=attributes
+            )
+        try:
+            with otel_context as otel_span:
+                try:
+                    yield span
+                except Exception as e:
+                    span.set_error(str(e))
+                    raise
+                finally:
+                    span.end()
+                    if otel_span is not None:
+                        otel_span.set_attributes(
+                            {
+                                key: value
+                                for key, value in span.attributes.items()
+                                if isinstance(value, (str, bool, int, float))
+                            }
+                        )
+                        if span.status == "ERROR":
+                            otel_span.set_status(otel_trace.StatusCode.ERROR)
+        finally:
+            _current_span.reset(token)
+            self._finish(span, stats_key, queue_time)
+
+    def _finish(
+        self, span: Span, stats_key: Optional[str], queue_time: Optional[float]
+    ) -> None:
+        with self._lock:
+            if stats_key is not None:
+                if stats_key not in self.stats:
+                    self.stats[stats_key] = OperationStats()
+                self.stats[stats_key].record(span, queue_time)
+            self.spans.append(span)
+        for exporter in self.span_exporters:
+            try:
+                exporter(span)
+            except Exception as e:
+                logger.warning(f"Error exporting span {span.name}: {e}")
+
+    def profile(self) -> Dict[str, Dict[str, Any]]:
+        """
+        The stats of every operation: runs, error rate, wall and queue time histograms,
+        time spent in LLM calls, tokens and retries.
+        """
+        with self._lock:
+            return {key: stats.to_dict() for key, stats in self.stats.items()}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stats = {}
+            self.spans.clear()
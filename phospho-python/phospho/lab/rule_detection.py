@@ -0,0 +1,313 @@
+"""
+Compiled detection of the rule based events (keyword_detection and regex_detection).
+
+All the keyword and regex events of a workload are compiled together: the keywords of
+every event are merged into a single automaton, and each message is scanned once per
+detection scope, whatever the number of events. The compiled rules only depend on the
+event definitions, so they are cached and shared by the workloads of the same project
+configuration.
+
+If `pyahocorasick` is installed, the keywords are matched with an Aho-Corasick automaton.
+Otherwise, they are merged into a single compiled regex.
+"""
+
+import functools
+import logging
+import re
+import threading
+from collections import defaultdict
+from typing import Dict, Iterator, List, Literal, NamedTuple, Optional, Set, Tuple
+
+from phospho.models import DetectionScope, JobResult, Message, ResultType, ScoreRange
+
+try:
+    import ahocorasick  # type: ignore
+except ImportError:
+    ahocorasick = None
+
+logger = logging.getLogger(__name__)
+
+# A keyword is only matched if it is a separate word, because we don't want to match substrings.
+# Characters allowed around a keyword in the middle of the text
+KEYWORD_SEPARATORS = " ,.:'/\n\r\t+="
+# Characters allowed after a keyword at the start of the text, or before it at the end
+KEYWORD_EDGE_SEPARATORS = " ,:'/.\n\r\t"
+
+# Keywords with these characters are interpreted as regexes by the keyword detection
+REGEX_SPECIAL_CHARACTERS = set(r".^$*+?{}[]\|()")
+
+
+class RuleBasedEvent(NamedTuple):
+    event_name: str
+    detection_engine: Literal["keyword_detection", "regex_detection"]
+    # The comma separated keywords, or the regex pattern
+    pattern: str
+    event_scope: DetectionScope = "task"
+
+
+def build_keywords_regex(keywords: str) -> str:
+    """
+    Build the regex matching any of the comma separated keywords as a separate word.
+    """
+    keyword_regexes = []
+    for keyword in keywords.split(","):
+        keyword = keyword.strip().lower()
+        keyword_regexes.append(
+            # we match the keyword in the middle of the text
+            f"[{KEYWORD_SEPARATORS}]{{1}}{keyword}[{KEYWORD_SEPARATORS}]{{1}}"
+            # we match the keyword at the beginning of the text
+            + f"|^{keyword}[{KEYWORD_EDGE_SEPARATORS}]{{1}}"
+            # we match the keyword at the end of the text
+            + f"|[{KEYWORD_EDGE_SEPARATORS}]{{1}}{keyword}$"
+        )
+    return "|".join(keyword_regexes)
+
+
+def _is_separate_word(text: str, start: int, end: int) -> bool:
+    """
+    Check that text[start:end] is matched by the regex of build_keywords_regex
+    """
+    if start > 0 and end < len(text):
+        return (
+            text[start - 1] in KEYWORD_SEPARATORS and text[end] in KEYWORD_SEPARATORS
+        )
+    if start == 0 and end < len(text):
+        return text[end] in KEYWORD_EDGE_SEPARATORS
+    if start > 0 and end == len(text):
+        return text[start - 1] in KEYWORD_EDGE_SEPARATORS
+    return False
+
+
+class KeywordMatcher:
+    """
+    Find in a single pass which keywords of a set appear as separate words in a text.
+    """
+
+    def __init__(self, keywords: Set[str]):
+        self.keywords = keywords
+        self._automaton = None
+        self._regex: Optional[re.Pattern] = None
+        self._lengths: List[int] = []
+
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for keyword in keywords:
+                self._automaton.add_word(keyword, keyword)
+            self._automaton.make_automaton()
+        else:
+            # The regex finds the positions where at least one keyword starts.
+            # The other keywords starting at the same position are looked up by length.
+            alternatives = "|".join(
+                re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True)
+            )
+            separators = re.escape(KEYWORD_SEPARATORS)
+            self._regex = re.compile(
+                f"(?<![^{separators}])(?=(?:{alternatives})(?![^{separators}]))"
+            )
+            self._lengths = sorted({len(keyword) for keyword in keywords})
+
+    def _iter_occurrences(self, text: str) -> Iterator[Tuple[int, str]]:
+        if self._automaton is not None:
+            for end_index, keyword in self._automaton.iter(text):
+                yield end_index - len(keyword) + 1, keyword
+        elif self._regex is not None:
+            for match in self._regex.finditer(text):
+                start = match.start()
+                for length in self._lengths:
+                    candidate = text[start : start + length]
+                    if candidate in self.keywords:
+                        yield start, candidate
+
+    def find(self, text: str) -> Set[str]:
+        found: Set[str] = set()
+        if len(self.keywords) == 0:
+            return found
+        for start, keyword in self._iter_occurrences(text):
+            if keyword not in found and _is_separate_word(
+                text, start, start + len(keyword)
+            ):
+                found.add(keyword)
+        return found
+
+
+class CompiledScopeRules:
+    """
+    The rule based events of a detection scope, compiled.
+    """
+
+    def __init__(self, events: List[RuleBasedEvent]):
+        self.events = events
+        # keyword -> events triggered by the keyword
+        self.keyword_to_events: Dict[str, List[RuleBasedEvent]] = defaultdict(list)
+        # event -> compiled regex, or the error raised by the compilation
+        self.regexes: Dict[RuleBasedEvent, re.Pattern] = {}
+        self.errors: Dict[RuleBasedEvent, str] = {}
+        # event -> regex displayed in the logs of the job result
+        self.logged_patterns: Dict[RuleBasedEvent, str] = {}
+
+        compiled_patterns: Dict[str, re.Pattern] = {}
+
+        def compile_pattern(event: RuleBasedEvent, pattern: str) -> None:
+            try:
+                if pattern not in compiled_patterns:
+                    compiled_patterns[pattern] = re.compile(pattern)
+                self.regexes[event] = compiled_patterns[pattern]
+            except re.error as e:
+                self.errors[event] = str(e)
+
+        for event in events:
+            if event.detection_engine == "keyword_detection":
+                self.logged_patterns[event] = build_keywords_regex(event.pattern)
+                keywords = [
+                    keyword.strip().lower() for keyword in event.pattern.split(",")
+                ]
+                if all(
+                    keyword != "" and REGEX_SPECIAL_CHARACTERS.isdisjoint(keyword)
+                    for keyword in keywords
+                ):
+                    for keyword in set(keywords):
+                        self.keyword_to_events[keyword].append(event)
+                else:
+                    # The keywords are regexes: fall back to the regex of the event
+                    compile_pattern(event, self.logged_patterns[event])
+            else:
+                self.logged_patterns[event] = event.pattern
+                compile_pattern(event, event.pattern)
+
+        self.keyword_matcher = KeywordMatcher(set(self.keyword_to_events.keys()))
+
+    def detect(self, text: str) -> Dict[RuleBasedEvent, JobResult]:
+        """
+        Detect all the events of the scope in the text.
+        """
+        lowered_text = text.lower()
+        found_events: Set[RuleBasedEvent] = set()
+        for keyword in self.keyword_matcher.find(lowered_text):
+            found_events.update(self.keyword_to_events[keyword])
+
+        results: Dict[RuleBasedEvent, JobResult] = {}
+        for event in self.events:
+            if event in self.errors:
+                results[event] = JobResult(
+                    result_type=ResultType.error,
+                    value=None,
+                    logs=[self.errors[event]],
+                )
+                continue
+
+            if event.detection_engine == "keyword_detection":
+                event_text = lowered_text
+                evaluation_source = "phospho-keywords"
+            else:
+                event_text = text
+                evaluation_source = "phospho-regex"
+
+            if event in self.regexes:
+                found = self.regexes[event].search(event_text) is not None
+            else:
+                found = event in found_events
+
+            results[event] = JobResult(
+                result_type=ResultType.bool,
+                value=found,
+                logs=[event_text, self.logged_patterns[event]],
+                metadata={
+                    "evaluation_source": evaluation_source,
+                    "score_range": ScoreRange(
+                        score_type="confidence", max=1, min=0, value=1 if found else 0
+                    ),
+                },
+            )
+        return results
+
+
+class CompiledRules:
+    """
+    The rule based events of a workload, compiled and grouped by detection scope.
+    """
+
+    def __init__(self, events: Tuple[RuleBasedEvent, ...]):
+        self.events = events
+        events_by_scope: Dict[DetectionScope, List[RuleBasedEvent]] = defaultdict(
+            list
+        )
+        for event in events:
+            events_by_scope[event.event_scope].append(event)
+        self.scopes: Dict[DetectionScope, CompiledScopeRules] = {
+            scope: CompiledScopeRules(scope_events)
+            for scope, scope_events in events_by_scope.items()
+        }
+
+    def detect(self, message: Message) -> Dict[RuleBasedEvent, JobResult]:
+        """
+        Detect all the events in the message, with a single pass per scope.
+        """
+        results: Dict[RuleBasedEvent, JobResult] = {}
+        for scope, scope_rules in self.scopes.items():
+            results.update(scope_rules.detect(message.scope_text(scope)))
+        return results
+
+
+@functools.lru_cache(maxsize=128)
+def compile_rule_based_events(events: Tuple[RuleBasedEvent, ...]) -> CompiledRules:
+    """
+    Compile the rule based events. The compilation is cached: workloads created from
+    the same events definitions share it.
+    """
+    logger.debug(f"Compiling {len(events)} rule based events")
+    return CompiledRules(events)
+
+
+class RuleBasedDetector:
+    """
+    Detects the rule based events of a workload.
+
+    The first job that runs on a message detects all the events of the workload. The
+    results are kept until clear() is called, so that the jobs of the other events
+    don't scan the message again.
+    """
+
+    def __init__(self, events: List[RuleBasedEvent]):
+        self.rules = compile_rule_based_events(tuple(events))
+        self._results: Dict[str, Dict[RuleBasedEvent, JobResult]] = {}
+        self._lock = threading.Lock()
+
+    def handles(self, event: RuleBasedEvent) -> bool:
+        return event.event_scope in self.rules.scopes and (
+            event in self.rules.scopes[event.event_scope].logged_patterns
+        )
+
+    def detect(self, message: Message, event: RuleBasedEvent) -> JobResult:
+        with self._lock:
+            message_results = self._results.get(message.id)
+        if message_results is None:
+            message_results = self.rules.detect(message)
+            with self._lock:
+                self._results[message.id] = message_results
+        # The job updates the result: return a copy
+        return message_results[event].model_copy(deep=True)
+
+    def forget(self, message_id: str) -> None:
+        """
+        Drop the results of a message, once all the jobs ran on it.
+        """
+        with self._lock:
+            self._results.pop(message_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results = {}
+
+
+def detect_rule_based_event(
+    message: Message,
+    event: RuleBasedEvent,
+    detector: Optional[RuleBasedDetector] = None,
+) -> JobResult:
+    """
+    Detect a rule based event in a message, using the detector of the workload if it
+    handles the event.
+    """
+    if detector is None or not detector.handles(event):
+        return compile_rule_based_events((event,)).detect(message)[event]
+    return detector.detect(message, event)
@@ -0,0 +1,194 @@
+"""
+Results of a configuration sweep: a job run on the same messages with all its configurations.
+
+The results are stored in columnar arrays (configuration x message), so that the accuracy,
+the cost and the latency of every configuration are computed with NumPy. The reference
+configuration is the default configuration of the job: the other configurations are
+compared to it.
+"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+from .models import JobConfig, JobResult, ResultType
+
+logger = logging.getLogger(__name__)
+
+
+def _import_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError(
+            "Please install the `numpy` package to run configuration sweeps."
+        )
+    return np
+
+
+class SweepResults:
+    def __init__(self, job_id: str, configs: List[JobConfig], message_ids: List[str]):
+        """
+        :param job_id: The id of the swept job.
+        :param configs: The configurations of the job. The first one is the reference.
+        :param message_ids: The ids of the messages the job ran on.
+        """
+        np = _import_numpy()
+
+        self.job_id = job_id
+        self.configs = configs
+        self.message_ids = message_ids
+        self.message_index = {
+            message_id: index for index, message_id in enumerate(message_ids)
+        }
+        shape = (len(configs), len(message_ids))
+        self.values = np.full(shape, None, dtype=object)
+        self.errors = np.ones(shape, dtype=bool)
+        # In seconds. NaN if the job didn't run
+        self.latencies = np.full(shape, np.nan)
+        # Tokens used by the LLM calls of the job
+        self.prompt_tokens = np.zeros(shape)
+        self.completion_tokens = np.zeros(shape)
+
+    def record(
+        self,
+        config_index: int,
+        message_id: str,
+        result: JobResult,
+        latency: Optional[float] = None,
+    ) -> None:
+        message_index = self.message_index[message_id]
+        self.values[config_index, message_index] = result.value
+        self.errors[config_index, message_index] = (
+            result.result_type == ResultType.error
+        )
+        if latency is not None:
+            self.latencies[config_index, message_index] = latency
+        llm_call = result.metadata.get("llm_call") or {}
+        self.prompt_tokens[config_index, message_index] = (
+            llm_call.get("prompt_tokens") or 0
+        )
+        self.completion_tokens[config_index, message_index] = (
+            llm_call.get("completion_tokens") or 0
+        )
+
+    def accuracies(self) -> Any:
+        """
+        The share of messages where each configuration agrees with the reference
+        configuration. Messages where the reference failed are not counted.
+        """
+        np = _import_numpy()
+
+        valid = ~self.errors[0]
+        if not valid.any():
+            return np.full(len(self.configs), np.nan)
+        agreements = (self.values[:, valid] == self.values[0, valid]) & ~self.errors[
+            :, valid
+        ]
+        return agreements.astype(float).mean(axis=1)
+
+    def costs(self, prices: Optional[Dict[str, Dict[str, float]]] = None) -> Any:
+        """
+        The mean cost of each configuration per message.
+
+        :param prices: model -> {"prompt": price, "completion": price} per million tokens.
+            If a model is missing, or if no prices are provided, the cost is the number of tokens.
+        """
+        np = _import_numpy()
+
+        prompt_price = np.ones(len(self.configs))
+        completion_price = np.ones(len(self.configs))
+        if prices is not None:
+            for index, config in enumerate(self.configs):
+                model = getattr(config, "model", None)
+                if model in prices:
+                    prompt_price[index] = prices[model].get("prompt", 0) / 1_000_000
+                    completion_price[index] = (
+                        prices[model].get("completion", 0) / 1_000_000
+                    )
+        return (
+            self.prompt_tokens.mean(axis=1) * prompt_price
+            + self.completion_tokens.mean(axis=1) * completion_price
+        )
+
+    def pareto_front(self, accuracies: Any, costs: Any, latencies: Any) -> Any:
+        """
+        Configurations that are not dominated: no other configuration is at least as
+        accurate, as cheap and as fast, and strictly better on one of them.
+        """
+        np = _import_numpy()
+
+        # Missing latencies (reference not run) don't dominate nor are dominated
+        latencies = np.nan_to_num(latencies, nan=np.inf)
+        accuracies = np.nan_to_num(accuracies, nan=-np.inf)
+        # dominates[i, j] is True if config i dominates config j
+        at_least_as_good = (
+            (accuracies[:, None] >= accuracies[None, :])
+            & (costs[:, None] <= costs[None, :])
+            & (latencies[:, None] <= latencies[None, :])
+        )
+        strictly_better = (
+            (accuracies[:, None] > accuracies[None, :])
+            | (costs[:, None] < costs[None, :])
+            | (latencies[:, None] < latencies[None, :])
+        )
+        dominates = at_least_as_good & strictly_better
+        return ~dominates.any(axis=0)
+
+    def summary(
+        self, prices: Optional[Dict[str, Dict[str, float]]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Accuracy, cost and latency of every configuration, and whether it's on the Pareto front.
+        The first row is the reference configuration.
+        """
+        np = _import_numpy()
+
+        accuracies = self.accuracies()
+        costs = self.costs(prices)
+        with np.errstate(all="ignore"):
+            mean_latencies = np.array(
+                [
+                    np.nanmean(row) if not np.isnan(row).all() else np.nan
+                    for row in self.latencies
+                ]
+            )
+            p95_latencies = np.array(
+                [
+                    np.nanpercentile(row, 95) if not np.isnan(row).all() else np.nan
+                    for row in self.latencies
+                ]
+            )
+        error_rates = self.errors.mean(axis=1) if len(self.message_ids) > 0 else None
+        pareto = self.pareto_front(accuracies, costs, mean_latencies)
+
+        rows = []
+        for index, config in enumerate(self.configs):
+            rows.append(
+                {
+                    "job_id": self.job_id,
+                    "config": config.model_dump(),
+                    "is_reference": index == 0,
+                    "accuracy": float(accuracies[index]),
+                    "cost": float(costs[index]),
+                    "mean_latency": float(mean_latencies[index]),
+                    "p95_latency": float(p95_latencies[index]),
+                    "error_rate": float(error_rates[index])
+                    if error_rates is not None
+                    else None,
+                    "pareto": bool(pareto[index]),
+                }
+            )
+        return rows
+
+    def pareto_table(self, prices: Optional[Dict[str, Dict[str, float]]] = None) -> Any:
+        """
+        The summary of the sweep as a pandas DataFrame, sorted by cost.
+        """
+        try:
+            import pandas as pd
+        except ImportError:
+            raise ImportError("Pandas is required to use the pareto_table method")
+
+        return (
+            pd.DataFrame(self.summary(prices)).sort_values("cost").reset_index(drop=True)
+        )
@@ -5,9 +5,9 @@ All the models stored in database.
 import datetime
 import json
 from enum import Enum
-from typing import Any, Dict, List, Literal, Optional, Union
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, TypeVar, Union
 
-from pydantic import BaseModel, Field, field_serializer
+from pydantic import BaseModel, Field, PrivateAttr, field_serializer
 
 from phospho.utils import (
     generate_timestamp,
@@ -98,6 +98,8 @@ class EventDefinition(DatedBaseModel):
     description: str
     webhook: Optional[str] = None
     webhook_headers: Optional[dict] = None
+    # If true, the webhook receives lists of detected events instead of one event per call
+    webhook_batch: bool = False
     detection_engine: DetectionEngine = "llm_detection"
     detection_scope: DetectionScope = "task"
     keywords: Optional[str] = None
@@ -406,6 +408,8 @@ class LlmCall(DatedBaseModel, extra="allow"):
     prompt: str
     llm_output: Optional[str] = None
     api_call_time: float  # In seconds
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
     # Identifier of the source of the evaluation, with the version of the model if phospho
     evaluation_source: Optional[str] = None
     task_id: Optional[str] = None
@@ -462,20 +466,59 @@ class FineTuningJob(DatedBaseModel, extra="allow"):
     status: Literal["started", "finished", "failed", "cancelled"]
 
 
+T = TypeVar("T")
+
+
 class Message(DatedBaseModel):
     role: Optional[str] = None
     content: str
     previous_messages: List["Message"] = Field(default_factory=list)
     metadata: dict = Field(default_factory=dict)
 
+    # The views of the message (transcripts, scope texts, tokens) are computed once and
+    # shared by all the jobs that run on the message.
+    # They are reset when a field is assigned. If you mutate previous_messages in place,
+    # call clear_views().
+    _views: Dict[Tuple, Any] = PrivateAttr(default_factory=dict)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        if name in type(self).model_fields:
+            self.clear_views()
+
+    def __eq__(self, other: Any) -> bool:
+        # The memoized views are not compared
+        if not isinstance(other, Message):
+            return NotImplemented
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def model_copy(self, *, update: Optional[Dict[str, Any]] = None, deep: bool = False):
+        copy = super().model_copy(update=update, deep=deep)
+        copy.clear_views()
+        return copy
+
+    def clear_views(self) -> None:
+        """
+        Reset the memoized views of the message.
+        """
+        self._views = {}
+
+    def _memoized(self, key: Tuple, compute: Callable[[], T]) -> T:
+        if key not in self._views:
+            self._views[key] = compute()
+        return self._views[key]
+
     def as_list(self):
         """
         Return the message and its previous messages as a list of Message objects.
         """
-        if self.previous_messages:
-            return self.previous_messages + [self]
-        else:
-            return [self]
+        # Return a new list so that the memoized one isn't modified
+        return list(
+            self._memoized(
+                ("as_list",),
+                lambda: tuple(self.previous_messages) + (self,),
+            )
+        )
 
     def transcript(
         self,
@@ -487,6 +530,29 @@ class Message(DatedBaseModel):
         """
         Return a string representation of the message.
         """
+        return self._memoized(
+            (
+                "transcript",
+                with_role,
+                with_previous_messages,
+                only_previous_messages,
+                max_previous_messages,
+            ),
+            lambda: self._transcript(
+                with_role=with_role,
+                with_previous_messages=with_previous_messages,
+                only_previous_messages=only_previous_messages,
+                max_previous_messages=max_previous_messages,
+            ),
+        )
+
+    def _transcript(
+        self,
+        with_role: bool,
+        with_previous_messages: bool,
+        only_previous_messages: bool,
+        max_previous_messages: Optional[int],
+    ) -> str:
         transcript = ""
         if max_previous_messages is not None:
             if max_previous_messages > len(self.previous_messages):
@@ -535,11 +601,14 @@ class Message(DatedBaseModel):
         if len(self.previous_messages) == 0:
             return self.transcript(with_role=True)
         else:
-            return "\n".join(
-                [
-                    self.previous_messages[-1].transcript(with_role=True),
-                    self.transcript(with_role=True),
-                ]
+            return self._memoized(
+                ("latest_interaction",),
+                lambda: "\n".join(
+                    [
+                        self.previous_messages[-1].transcript(with_role=True),
+                        self.transcript(with_role=True),
+                    ]
+                ),
             )
 
     def latest_interaction_context(self) -> Optional[str]:
@@ -550,13 +619,60 @@ class Message(DatedBaseModel):
         if len(self.previous_messages) <= 1:
             return None
         else:
-            return "\n".join(
-                [
-                    message.transcript(with_role=True)
-                    for message in self.previous_messages[:-1]
-                ]
+            return self._memoized(
+                ("latest_interaction_context",),
+                lambda: "\n".join(
+                    [
+                        message.transcript(with_role=True)
+                        for message in self.previous_messages[:-1]
+                    ]
+                ),
             )
 
+    def scope_text(self, scope: DetectionScope) -> str:
+        """
+        Return the text of the message in which events of the detection scope are detected:
+        - task: the latest interaction
+        - task_input_only: the user messages
+        - task_output_only: the assistant messages
+        - session: the transcript of the message and its previous messages
+        """
+
+        def compute() -> str:
+            list_exchange_to_search: List[str] = []
+            if scope == "task":
+                list_exchange_to_search = [self.latest_interaction()]
+            elif scope == "task_input_only":
+                # Keep only the user messages
+                list_exchange_to_search = [
+                    " " + m.content + " " for m in self.as_list() if m.role == "User"
+                ]
+            elif scope == "task_output_only":
+                # Keep only the assistant messages
+                list_exchange_to_search = [
+                    " " + m.content + " "
+                    for m in self.as_list()
+                    if m.role == "Assistant"
+                ]
+            elif scope == "session":
+                list_exchange_to_search = [
+                    self.transcript(with_role=True, with_previous_messages=True)
+                ]
+            return " ".join(list_exchange_to_search)
+
+        return self._memoized(("scope_text", scope), compute)
+
+    def scope_tokens(self, scope: DetectionScope) -> Tuple[int, ...]:
+        """
+        Return the tokens (cl100k_base encoding) of the text of the detection scope.
+        Requires the `tiktoken` package.
+        """
+        from phospho.utils import encode_text
+
+        return self._memoized(
+            ("scope_tokens", scope), lambda: tuple(encode_text(self.scope_text(scope)))
+        )
+
     @classmethod
     def from_df(cls, df, **kwargs) -> List["Message"]:
         """
@@ -582,63 +698,42 @@ class Message(DatedBaseModel):
             - Pass None to a field to skip it and use a default value.
 
         :return: A list of Message objects
+
+        To load a large DataFrame without validating every message, use
+        `lab.MessageBatch.from_df` instead.
         """
-        try:
-            import pandas as pd
-        except ImportError:
-            raise ImportError("Pandas is required to use the from_df method")
-
-        # The keyword arguments are understood as mapping from the Message
-        # fields to the column names of the DataFrame
-        # If not provided, the default mapping is used
-        default_mapping: Dict[str, object] = {
-            "id": None,
-            "created_at": "created_at",
-            "role": "role",
-            "content": "content",
-            "previous_messages": "previous_messages",
-            "metadata": "metadata",
+        from phospho.lab.message_batch import get_column_mapping
+
+        col_mapping = get_column_mapping(df, kwargs)
+
+        # Skip the rows with an empty content
+        contents = df[col_mapping["content"]]
+        df = df[(contents.notna() & (contents != "")).to_numpy()]
+
+        # Select the columns of the fields with vectorized operations instead of
+        # df.iterrows(), then validate every message
+        field_columns = {
+            attribute: col_name
+            for attribute, col_name in col_mapping.items()
+            if col_name is not None and attribute != "id"
         }
-        # If a default mapping value is not found in the DataFrame, it is skipped
-        for key, value in default_mapping.items():
-            if value not in df.columns:
-                default_mapping[key] = None
-        # If a kwargs refers to an unknwon column name, raise a ValueError
-        for key, value in kwargs.items():
-            if value not in df.columns and value is not None:
-                raise ValueError(f"Column {value} not found in the DataFrame")
-
-        col_mapping = {**default_mapping, **kwargs}
-
-        # Verify that mandatory field are present. If not, raise a ValueError
-        if col_mapping["content"] is None:
-            raise ValueError(
-                'Column "content" not found in the DataFrame. '
-                + 'Please provide a keyword argument with the column to use: `Message.from_df(df, content="message_content")`.'
+        records = df[list(set(field_columns.values()))].to_dict(orient="records")
+        if col_mapping["id"] is None:
+            # By default, the id is the index of the row
+            message_ids = [str(index) for index in df.index]
+        else:
+            message_ids = df[col_mapping["id"]].tolist()
+
+        return [
+            cls(
+                **{
+                    attribute: record[col_name]
+                    for attribute, col_name in field_columns.items()
+                },
+                id=message_id,
             )
-
-        # Convert every row of the df into a lab.Message
-        messages = []
-        for index, row in df.iterrows():
-            content = row[col_mapping["content"]]
-            if content and not pd.isnull(content):
-                values_to_create_message = {}
-                for attribute, col_name in col_mapping.items():
-                    if col_name is not None:
-                        values_to_create_message[attribute] = row[col_name]
-                if col_mapping["id"] is None:
-                    # By default, the id is the index of the row
-                    message_id = str(index)
-                else:
-                    message_id = row[col_mapping["id"]]
-                message_dict = {
-                    **values_to_create_message,
-                    "id": message_id,
-                    "content": content,
-                }
-                messages.append(cls(**message_dict))
-
-        return messages
+            for message_id, record in zip(message_ids, records)
+        ]
 
     @classmethod
     def from_task(
@@ -10,6 +10,7 @@ from rich import print
 
 from phospho import lab
 from phospho.client import Client
+from phospho.lab.checkpoint import CheckpointStore, open_checkpoint
 
 logger = logging.getLogger(__name__)
 
@@ -142,6 +143,8 @@ class BacktestLoader(Loader):
         for task in tasks:
             # Convert to a lab.Message
             message = lab.Message(
+                # Stable ids, so that an interrupted run can be resumed
+                id=task.id,
                 role="user",
                 content=task.input,
                 metadata={
@@ -224,30 +227,45 @@ class DatasetLoader(Loader):
                 f"File format {path.split('.')[-1]} is not supported. Supported formats: .csv, .json, .xlsx"
             )
 
+        # Load the dataset in columns: the messages are created when they are read.
+        # The columns that are not fields of the message are passed in the metadata.
+        message_fields = ["id", "role", "content", "created_at"]
+        df = self.df
+        self.batch = lab.MessageBatch(
+            ids=(
+                df["id"].astype(str) if "id" in df.columns else df.index.astype(str)
+            ).to_numpy(dtype=object),
+            roles=(
+                df["role"].str.lower().to_numpy(dtype=object)
+                if "role" in df.columns
+                else ["user"] * len(df)
+            ),
+            contents=(
+                df["content"].to_numpy(dtype=object)
+                if "content" in df.columns
+                else [""] * len(df)
+            ),
+            created_at=(
+                df["created_at"].to_numpy() if "created_at" in df.columns else None
+            ),
+            metadata_columns={
+                col_name: df[col_name].to_numpy(dtype=object)
+                for col_name in df.columns
+                if col_name not in message_fields
+            },
+        )
         # Create an iterator over the dataset
-        self.dataset = iter(self.df.to_dict(orient="records"))
+        self.dataset = iter(self.batch)
         self.function_to_evaluate = agent_function
 
     def __iter__(self):
         return self
 
     def __next__(self) -> lab.Message:
-        next_item = next(self.dataset)
-        id = next_item.pop("id", None)
-        role = next_item.pop("role", "user").lower()
-        content = next_item.pop("content", "")
-        created_at = next_item.pop("created_at", None)
-        message = lab.Message(
-            id=id,
-            role=role,
-            content=content,
-            created_at=created_at,
-            metadata=next_item,
-        )
-        return message
+        return next(self.dataset)
 
-    def __len__(self):
-        return self.df.shape[0]
+    def __len__(self) -> int:
+        return len(self.batch)
 
 
 class FunctionToEvaluate(BaseModel):
@@ -352,9 +370,14 @@ class PhosphoTest:
         self,
         executor_type: Literal["parallel", "sequential", "parallel_jobs"] = "parallel",
         max_parallelism: int = 20,
+        checkpoint_path: Optional[str] = None,
     ):
         """
         Run the tests
+
+        :param checkpoint_path: Path of a checkpoint file (.sqlite or .jsonl). If the run is
+            interrupted, running the tests again with the same version_id and checkpoint_path
+            skips the messages already tested.
         """
 
         # Start timer
@@ -365,6 +388,10 @@ class PhosphoTest:
 
         # os.environ["PHOSPHO_VERSION_ID"] = self.version_id
 
+        checkpoint: Optional[CheckpointStore] = None
+        if checkpoint_path is not None:
+            checkpoint = open_checkpoint(checkpoint_path, run_id=self.version_id)
+
         # Collect the functions.
         for function_name, function_to_eval in self.functions_to_evaluate.items():
             print(f"Running test: [green]🧪 {function_name}[/green]")
@@ -433,8 +460,11 @@ class PhosphoTest:
                 messages=messages,
                 executor_type=executor_type,
                 max_parallelism=max_parallelism,
+                checkpoint=checkpoint,
             )
 
+        if checkpoint is not None:
+            checkpoint.close()
         self.flush()
         # Stop timer
         end_time = time.time()
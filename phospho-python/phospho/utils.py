@@ -11,8 +11,10 @@ from typing import (
     AsyncGenerator,
     Generator,
     Callable,
+    List,
     Literal,
     Optional,
+    Sequence,
     Union,
 )
 from random import choice
@@ -237,6 +239,21 @@ def fits_in_context_window(prompt: str, context_window_size: int) -> bool:
     return num_tokens <= context_window_size
 
 
+def encode_text(text: str) -> List[int]:
+    """
+    Get the tokens of a string, with the cl100k_base encoding
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        raise ImportError(
+            "Please install the `tiktoken` package to use the `encode_text` function."
+        )
+
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return encoding.encode(text)
+
+
 def get_number_of_tokens(prompt: str) -> int:
     """
     Get the number of tokens in a string
@@ -257,9 +274,13 @@ def shorten_text(
     max_length: int,
     margin: int = 20,
     how: Literal["left", "right"] = "left",
+    tokens: Optional[Sequence[int]] = None,
 ) -> str:
     """
     Shorten the text to fit in the max_length by only keeping the beginning of the text
+
+    If the tokens of the text were already computed (see Message.scope_tokens), pass them
+    to avoid encoding the text again.
     """
     try:
         import tiktoken
@@ -271,14 +292,15 @@ def shorten_text(
     if prompt is None:
         return ""
     encoding = tiktoken.get_encoding("cl100k_base")
-    tokens = encoding.encode(prompt)
+    if tokens is None:
+        tokens = encoding.encode(prompt)
     number_of_tokens = len(tokens)
     if number_of_tokens <= max_length:
         return prompt
     else:
         if how == "left":
-            return encoding.decode(tokens[: max_length - margin])
+            return encoding.decode(list(tokens[: max_length - margin]))
         if how == "right":
-            return encoding.decode(tokens[-(max_length - margin) :])
+            return encoding.decode(list(tokens[-(max_length - margin) :]))
         else:
             raise ValueError(f"Unknown value for how: {how}")
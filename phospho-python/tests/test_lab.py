@@ -1,4 +1,6 @@
+import asyncio
 import pytest
+import pydantic
 from phospho import lab
 
 
@@ -117,3 +119,591 @@ async def test_evaluation():
 
     await workload.async_run(messages=messages, executor_type="parallel")
     assert len(workload.results) == 1
+
+
+@pytest.mark.asyncio
+async def test_rule_based_event_detection():
+    event_definitions = [
+        lab.EventDefinition(
+            project_id="project",
+            org_id="org",
+            event_name="price",
+            description="The user asks for the price",
+            detection_engine="keyword_detection",
+            keywords="price, cost",
+        ),
+        lab.EventDefinition(
+            project_id="project",
+            org_id="org",
+            event_name="new_york",
+            description="The user mentions New York",
+            detection_engine="keyword_detection",
+            keywords="new york",
+            detection_scope="task_input_only",
+        ),
+        lab.EventDefinition(
+            project_id="project",
+            org_id="org",
+            event_name="amount",
+            description="An amount in euros",
+            detection_engine="regex_detection",
+            regex_pattern=r"\d+ ?€",
+        ),
+    ]
+    workload = lab.Workload.from_phospho_events(event_definitions)
+    assert workload.rule_detector is not None
+
+    messages = [
+        lab.Message(
+            id="current",
+            role="Assistant",
+            content="It costs 10 €.",
+            previous_messages=[
+                lab.Message(
+                    id="previous",
+                    role="User",
+                    content="What is the Price of a ticket to New York ?",
+                ),
+            ],
+        ),
+        lab.Message(id="other", role="User", content="Priceless"),
+    ]
+
+    await workload.async_run(messages=messages, executor_type="sequential")
+    assert workload.results["current"]["price"].value is True
+    assert workload.results["current"]["new_york"].value is True
+    assert workload.results["current"]["amount"].value is True
+    assert workload.results["other"]["price"].value is False
+    assert workload.results["other"]["amount"].value is False
+
+    # The detections are not kept after a run or a sweep
+    assert workload.rule_detector._results == {}
+    await workload.async_sweep(messages=messages, job_ids=["price"])
+    assert workload.rule_detector._results == {}
+
+    # The jobs return the same results outside of a workload
+    result = await lab.job_library.keyword_event_detection(
+        messages[0], event_name="price", keywords="price, cost"
+    )
+    assert result.value is True
+    assert result.metadata["evaluation_source"] == "phospho-keywords"
+
+
+def test_message_scope_views():
+    message = lab.Message(
+        role="Assistant",
+        content="It costs 10 €.",
+        previous_messages=[lab.Message(role="User", content="What is the price?")],
+    )
+    session_text = message.scope_text("session")
+    assert session_text == message.transcript(
+        with_role=True, with_previous_messages=True
+    )
+    # The views are memoized
+    assert message.scope_text("session") is session_text
+    assert message.scope_text("task_input_only") == " What is the price? "
+
+    # Assigning a field resets the views
+    message.content = "It's free."
+    assert message.latest_interaction() == "User: What is the price?\nAssistant: It's free."
+    assert message == lab.Message(**message.model_dump())
+
+
+@pytest.mark.asyncio
+async def test_llm_cache(tmp_path):
+    from openai.types.chat import ChatCompletion
+
+    from phospho.lab.llm_cache import (
+        InMemoryLLMCacheBackend,
+        LLMCache,
+        SQLiteLLMCacheBackend,
+    )
+
+    class FakeCompletions:
+        calls = 0
+
+        async def create(self, **kwargs):
+            FakeCompletions.calls += 1
+            return ChatCompletion(
+                id="chatcmpl",
+                created=0,
+                model=kwargs["model"],
+                object="chat.completion",
+                choices=[
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "Yes"},
+                    }
+                ],
+            )
+
+    class FakeClient:
+        class chat:
+            completions = FakeCompletions()
+
+    messages = [{"role": "user", "content": "Is it raining?"}]
+    for backend in [
+        InMemoryLLMCacheBackend(max_size=10),
+        SQLiteLLMCacheBackend(str(tmp_path / "llm_cache.sqlite")),
+    ]:
+        FakeCompletions.calls = 0
+        llm_cache = LLMCache(backend, ttl=60)
+        for _ in range(3):
+            response = await llm_cache.chat_completion(
+                FakeClient(), "openai", "gpt-4o", messages, temperature=0
+            )
+            assert response.choices[0].message.content == "Yes"
+        assert FakeCompletions.calls == 1
+        assert llm_cache.get_stats()["hits"] == 2
+
+        # Non deterministic calls are not cached
+        await llm_cache.chat_completion(
+            FakeClient(), "openai", "gpt-4o", messages, temperature=1
+        )
+        assert FakeCompletions.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_workload_stream():
+    def contains_hello(message: lab.Message) -> lab.JobResult:
+        return lab.JobResult(
+            result_type=lab.ResultType.bool, value="hello" in message.content
+        )
+
+    workload = lab.Workload(jobs=[contains_hello])
+
+    async def messages():
+        for i in range(25):
+            yield lab.Message(id=str(i), content="hello" if i % 2 == 0 else "bye")
+
+    batches = []
+
+    async def sink(batch):
+        batches.append(len(batch))
+
+    results = [
+        (message_id, job_id, job_result.value)
+        async for message_id, job_id, job_result in workload.stream(
+            messages(), max_parallelism=4, sink=sink, flush_every=10
+        )
+    ]
+    assert len(results) == 25
+    assert sum(value for _, _, value in results) == 13
+    assert all(job_id == "contains_hello" for _, job_id, _ in results)
+    assert batches == [10, 10, 5]
+    # The results are not kept in the workload
+    assert workload.jobs["contains_hello"].results == {}
+
+
+@pytest.mark.asyncio
+async def test_workload_stream_backpressure():
+    started = []
+
+    def record(message: lab.Message) -> lab.JobResult:
+        started.append(message.id)
+        if message.content == "fail":
+            raise ValueError("job failed")
+        return lab.JobResult(result_type=lab.ResultType.bool, value=True)
+
+    workload = lab.Workload(jobs=[record])
+    messages = [
+        lab.Message(id=str(i), content="fail" if i == 3 else "ok") for i in range(100)
+    ]
+
+    stream = workload.stream(messages, max_parallelism=2, raise_errors=False)
+    results = [await stream.__anext__()]
+    await asyncio.sleep(0.05)
+    # The jobs wait for the slow consumer: the queue and the running jobs are bounded
+    assert len(started) <= 2 * 2 + 2 + 1
+    results += [item async for item in stream]
+    assert len(results) == 100
+    errors = [result for _, _, result in results if result.result_type == "error"]
+    assert len(errors) == 1 and errors[0].metadata["error"] == "job failed"
+
+    # By default, a failing job stops the stream
+    with pytest.raises(ValueError):
+        async for _ in workload.stream(messages, max_parallelism=2):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_config_sweep():
+    from typing import Literal
+
+    class LengthConfig(lab.JobConfig):
+        model: Literal["big", "small", "tiny"] = "big"
+
+    async def is_long(message: lab.Message, model: str) -> lab.JobResult:
+        # The smaller the model, the cheaper and the less accurate
+        threshold = {"big": 10, "small": 10, "tiny": 3}[model]
+        tokens = {"big": 100, "small": 10, "tiny": 1}[model]
+        # and the faster
+        await asyncio.sleep({"big": 0.01, "small": 0, "tiny": 0}[model])
+        return lab.JobResult(
+            result_type=lab.ResultType.bool,
+            value=len(message.content) > threshold,
+            metadata={"llm_call": {"prompt_tokens": tokens, "completion_tokens": 1}},
+        )
+
+    workload = lab.Workload()
+    workload.add_job(lab.Job(id="is_long", job_function=is_long, config=LengthConfig()))
+    messages = [lab.Message(content="a" * length) for length in range(20)]
+
+    sweeps = await workload.async_sweep(messages, max_parallelism=5)
+    summary = {row["config"]["model"]: row for row in sweeps["is_long"].summary()}
+    assert summary["big"]["is_reference"]
+    assert summary["small"]["accuracy"] == 1.0
+    assert summary["tiny"]["accuracy"] == 0.65
+    assert summary["small"]["cost"] == 11
+    # The big model is as accurate as the small one, but more expensive
+    assert not summary["big"]["pareto"]
+    assert summary["small"]["pareto"] and summary["tiny"]["pareto"]
+
+    workload.optimize_jobs(accuracy_threshold=1.0)
+    assert workload.jobs["is_long"].config.model == "small"
+
+
+@pytest.mark.asyncio
+async def test_run_offline(tmp_path, caplog):
+    from phospho.lab.batch import LocalBatchProvider
+
+    workload = lab.Workload()
+    workload.add_job(
+        lab.Job(
+            id="asks_price",
+            job_function=lab.job_library.event_detection,
+            config=lab.EventConfig(
+                event_name="asks_price",
+                event_description="The user asks for the price",
+            ),
+        )
+    )
+    messages = [
+        lab.Message(id="price", role="User", content="How much is it?"),
+        lab.Message(id="hello", role="User", content="Hello!"),
+    ]
+
+    def respond(body: dict) -> str:
+        return "Yes" if "How much" in body["messages"][-1]["content"] else "No"
+
+    caplog.set_level("ERROR")
+    results = await workload.async_run_offline(
+        messages,
+        batch_provider=LocalBatchProvider(respond),
+        batch_file=str(tmp_path / "batch.jsonl"),
+    )
+    # Collecting the calls is not logged as a failure
+    assert caplog.records == []
+    assert results["price"]["asks_price"].value is True
+    assert results["hello"]["asks_price"].value is False
+    with open(tmp_path / "batch.jsonl") as f:
+        assert len(f.readlines()) == 2
+
+
+@pytest.mark.asyncio
+async def test_run_offline_with_several_calls(tmp_path, caplog):
+    from phospho.lab.batch import LocalBatchProvider
+    from phospho.lab.llm_cache import cached_chat_completion
+
+    async def summary_then_answer(message: lab.Message) -> lab.JobResult:
+        # The second call depends on the response to the first one
+        summary = await cached_chat_completion(
+            None,
+            provider="openai",
+            model="gpt-4o",
+            messages=[{"role": "user", "content": f"Summarize: {message.content}"}],
+        )
+        answer = await cached_chat_completion(
+            None,
+            provider="openai",
+            model="gpt-4o",
+            messages=[
+                {
+                    "role": "user",
+                    "content": f"Answer: {summary.choices[0].message.content}",
+                }
+            ],
+        )
+        return lab.JobResult(
+            result_type=lab.ResultType.literal,
+            value=answer.choices[0].message.content,
+        )
+
+    def respond(body: dict) -> str:
+        return body["messages"][-1]["content"].split(": ", 1)[1].upper()
+
+    workload = lab.Workload(jobs=[summary_then_answer])
+    caplog.set_level("ERROR")
+    results = await workload.async_run_offline(
+        [lab.Message(id="hello", content="hello")],
+        batch_provider=LocalBatchProvider(respond),
+        batch_file=str(tmp_path / "batch.jsonl"),
+    )
+    assert results["hello"]["summary_then_answer"].value == "HELLO"
+    assert caplog.records == []
+
+
+@pytest.mark.asyncio
+async def test_workload_profile():
+    from openai.types.chat import ChatCompletion
+
+    from phospho.lab.llm_cache import (
+        InMemoryLLMCacheBackend,
+        LLMCache,
+        cached_chat_completion,
+        set_llm_cache,
+    )
+
+    class FakeCompletions:
+        async def create(self, **kwargs):
+            return ChatCompletion(
+                id="chatcmpl",
+                created=0,
+                model=kwargs["model"],
+                object="chat.completion",
+                choices=[
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "Yes"},
+                    }
+                ],
+                usage={"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+            )
+
+    class FakeClient:
+        class chat:
+            completions = FakeCompletions()
+
+    async def ask_llm(message: lab.Message) -> lab.JobResult:
+        response = await cached_chat_completion(
+            FakeClient(),
+            provider="openai",
+            model="gpt-4o",
+            messages=[{"role": "user", "content": message.content}],
+        )
+        return lab.JobResult(
+            result_type=lab.ResultType.bool,
+            value=response.choices[0].message.content == "Yes",
+        )
+
+    def fails_on_bye(message: lab.Message) -> lab.JobResult:
+        if message.content == "bye":
+            return lab.JobResult(result_type=lab.ResultType.error, value=None)
+        return lab.JobResult(result_type=lab.ResultType.bool, value=True)
+
+    workload = lab.Workload(jobs=[ask_llm, fails_on_bye])
+    messages = [lab.Message(content="hello"), lab.Message(content="bye")]
+    await workload.async_run(messages)
+
+    profile = workload.profile()
+    assert profile["ask_llm"]["runs"] == 2
+    assert profile["ask_llm"]["llm_calls"] == 2
+    assert profile["ask_llm"]["prompt_tokens"] == 20
+    assert profile["ask_llm"]["completion_tokens"] == 2
+    assert profile["ask_llm"]["queue_time"]["count"] == 2
+    assert profile["fails_on_bye"]["error_rate"] == 0.5
+    assert profile["fails_on_bye"]["llm_calls"] == 0
+    assert len(workload.profiler.spans) == 4
+    span = workload.profiler.spans[0].to_dict()
+    assert span["name"] == "phospho.job"
+    assert len(span["traceId"]) == 32
+
+    # The calls answered by the cache are not LLM calls
+    async def ask_llm_cached(message: lab.Message) -> lab.JobResult:
+        await cached_chat_completion(
+            FakeClient(),
+            provider="openai",
+            model="gpt-4o",
+            messages=[{"role": "user", "content": message.content}],
+            temperature=0,
+        )
+        return lab.JobResult(result_type=lab.ResultType.bool, value=True)
+
+    set_llm_cache(LLMCache(InMemoryLLMCacheBackend()))
+    try:
+        workload = lab.Workload(jobs=[ask_llm_cached])
+        await workload.async_run([lab.Message(id="1", content="hello")])
+        await workload.async_run([lab.Message(id="2", content="hello")])
+    finally:
+        set_llm_cache(None)
+    profile = workload.profile()
+    assert profile["ask_llm_cached"]["runs"] == 2
+    assert profile["ask_llm_cached"]["llm_calls"] == 1
+    assert profile["ask_llm_cached"]["cache_hits"] == 1
+    assert profile["ask_llm_cached"]["prompt_tokens"] == 10
+
+
+@pytest.mark.parametrize("executor_type", ["parallel", "parallel_jobs", "sequential"])
+def test_workload_run_closes_async_clients(executor_type):
+    from phospho.lab.language_models import get_async_client
+
+    clients = []
+
+    async def uses_client(message: lab.Message) -> lab.JobResult:
+        # The client of the event loop created by Workload.run
+        clients.append(get_async_client("openai", api_key="key"))
+        return lab.JobResult(result_type=lab.ResultType.bool, value=True)
+
+    workload = lab.Workload(jobs=[uses_client])
+    workload.run(
+        [lab.Message(id=str(i), content="hello") for i in range(3)],
+        executor_type=executor_type,
+    )
+    assert len(clients) == 3
+    assert all(client.is_closed() for client in clients)
+
+
+@pytest.mark.parametrize("file_name", ["checkpoint.sqlite", "checkpoint.jsonl"])
+def test_workload_checkpoint(tmp_path, file_name):
+    from phospho.lab.checkpoint import open_checkpoint
+
+    calls = []
+
+    def contains_hello(message: lab.Message) -> lab.JobResult:
+        calls.append(message.id)
+        if message.content == "error":
+            return lab.JobResult(result_type=lab.ResultType.error, value=None)
+        return lab.JobResult(
+            result_type=lab.ResultType.bool, value="hello" in message.content
+        )
+
+    path = str(tmp_path / file_name)
+    messages = [
+        lab.Message(id=str(i), content="hello" if i % 2 == 0 else "bye")
+        for i in range(10)
+    ] + [lab.Message(id="error", content="error")]
+
+    # The first run is interrupted after 4 messages
+    checkpoint = open_checkpoint(path, flush_every=2)
+    workload = lab.Workload(jobs=[contains_hello])
+    workload.run(messages[:4], executor_type="sequential", checkpoint=checkpoint)
+    checkpoint.close()
+
+    # The resumed run skips them, and the results are the same
+    calls.clear()
+    checkpoint = open_checkpoint(path, flush_every=2)
+    workload = lab.Workload(jobs=[contains_hello])
+    results = workload.run(messages, executor_type="parallel", checkpoint=checkpoint)
+    checkpoint.close()
+    assert sorted(calls) == sorted(["4", "5", "6", "7", "8", "9", "error"])
+    assert [results[str(i)]["contains_hello"].value for i in range(10)] == [
+        i % 2 == 0 for i in range(10)
+    ]
+
+    # Errors are not checkpointed, and expired results are dropped
+    calls.clear()
+    checkpoint = open_checkpoint(path, retention=-1)
+    workload = lab.Workload(jobs=[contains_hello])
+    workload.run(messages, executor_type="sequential", checkpoint=checkpoint)
+    assert len(calls) == 11
+
+
+def test_jsonl_checkpoint_truncated_line(tmp_path):
+    from phospho.lab.checkpoint import open_checkpoint
+
+    def contains_hello(message: lab.Message) -> lab.JobResult:
+        return lab.JobResult(
+            result_type=lab.ResultType.bool, value="hello" in message.content
+        )
+
+    path = tmp_path / "checkpoint.jsonl"
+    messages = [lab.Message(id=f"m{i}", content="hello") for i in range(3)]
+    workload = lab.Workload(jobs=[contains_hello])
+    job = workload.jobs["contains_hello"]
+
+    checkpoint = open_checkpoint(str(path), flush_every=1)
+    workload.run(messages[:1], executor_type="sequential", checkpoint=checkpoint)
+    checkpoint.close()
+    # The process died while writing the result of m1
+    with open(path, "a") as f:
+        f.write('{"run_id": "default", "message_id": "m1", "job')
+
+    # The results written after resuming are not merged into the truncated line
+    checkpoint = open_checkpoint(str(path), flush_every=1)
+    workload.run(messages[2:], executor_type="sequential", checkpoint=checkpoint)
+    checkpoint.close()
+    checkpoint = open_checkpoint(str(path))
+    assert checkpoint.get("m0", job) is not None
+    assert checkpoint.get("m1", job) is None
+    assert checkpoint.get("m2", job) is not None
+    checkpoint.close()
+
+
+def test_sqlite_checkpoint_vacuum(tmp_path, monkeypatch):
+    import sqlite3
+
+    from phospho.lab.checkpoint import open_checkpoint
+
+    statements = []
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs):
+        connection = connect(*args, **kwargs)
+        connection.set_trace_callback(statements.append)
+        return connection
+
+    monkeypatch.setattr(sqlite3, "connect", traced_connect)
+    path = str(tmp_path / "checkpoint.sqlite")
+
+    # Opening the store drops the expired results without rewriting the file
+    checkpoint = open_checkpoint(path, retention=3600)
+    assert any(statement.startswith("DELETE") for statement in statements)
+    assert "VACUUM" not in statements
+    checkpoint.compact()
+    assert "VACUUM" in statements
+    checkpoint.close()
+
+
+def test_message_batch(tmp_path):
+    import pandas as pd
+
+    df = pd.DataFrame(
+        {
+            "question": ["Hello", "", "How are you?", None],
+            "role": ["user", "user", None, "user"],
+            "created_at": [1, 2, 3, 4],
+            "previous_messages": [
+                [],
+                [],
+                [{"role": "user", "content": "Hi"}, lab.Message(content="Hello")],
+                [],
+            ],
+            "label": ["a", "b", "c", "d"],
+        }
+    )
+    batch = lab.MessageBatch.from_df(df, content="question", metadata_columns=["label"])
+    assert len(batch) == 2
+    assert list(batch.ids) == ["0", "2"]
+    message = batch[1]
+    assert message.content == "How are you?"
+    assert message.role is None
+    assert message.created_at == 3
+    assert message.metadata == {"label": "c"}
+    assert [m.content for m in message.previous_messages] == ["Hi", "Hello"]
+    assert message.transcript(with_previous_messages=True).count("Hi") == 1
+
+    # Slices keep the previous messages of the selected messages
+    sliced = batch[1:]
+    assert len(sliced) == 1
+    assert sliced[0] == message
+
+    # Message.from_df returns the same messages, validated
+    messages = lab.Message.from_df(df, content="question")
+    assert [m.id for m in messages] == ["0", "2"]
+    assert messages[1].content == message.content
+    assert len(messages[1].previous_messages) == 2
+    assert all(isinstance(m, lab.Message) for m in messages[1].previous_messages)
+    with pytest.raises(pydantic.ValidationError):
+        lab.Message.from_df(df.assign(created_at="not a date"), content="question")
+
+    path = tmp_path / "messages.jsonl"
+    jsonl_df = df.drop(columns=["previous_messages"]).rename(
+        columns={"question": "content"}
+    )
+    jsonl_df["id"] = ["a", "b", "c", "d"]
+    jsonl_df.to_json(path, orient="records", lines=True)
+    batch = lab.MessageBatch.from_jsonl(str(path), id="id")
+    assert list(batch.ids) == ["a", "c"]
+    assert list(batch.created_at) == [1, 3]